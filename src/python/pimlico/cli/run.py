@@ -63,6 +63,19 @@ class RunCmd(PimlicoCLISubcommand):
                                  "fails and a summary at the end of everything), 'end' "
                                  "(send only the final summary). Email sending must be configured: "
                                  "see 'email' command to test")
+        parser.add_argument("--jobs", "-j", type=int, default=1,
+                            help="Execute up to this number of modules at once. When running multiple modules, "
+                                 "each is started as soon as the modules it depends on have been completed, as long "
+                                 "as the processes and memory used by the modules running together stay within the "
+                                 "limits set in the local config (max_processes and max_memory). Default: 1, "
+                                 "execute modules one at a time in the order given")
+        parser.add_argument("--profile", nargs="?", const="sampling", choices=["sampling", "deterministic"],
+                            help="Profile the execution of each module, including its worker processes, and store "
+                                 "the merged profile in the module's output directory, in pstats format and (in "
+                                 "sampling mode) as collapsed stacks for flame graphs. 'sampling' (the default if "
+                                 "no mode is given) samples call stacks every profile_interval seconds (local "
+                                 "config, default 0.01) and is cheap enough to use on full-size inputs. "
+                                 "'deterministic' records every function call with cProfile, which is much slower")
         parser.add_argument("--last-error", "-e", action="store_true",
                             help="Don't execute, just output the error log from the last execution of the given "
                                  "module(s)")
@@ -178,7 +191,8 @@ class RunCmd(PimlicoCLISubcommand):
             exit_status = check_and_execute_modules(
                 pipeline, module_specs, force_rerun=opts.force_rerun, debug=debug, log=log,
                 all_deps=opts.all_deps, check_only=dry_run, exit_on_error=opts.exit_on_error,
-                preliminary=preliminary, email=opts.email
+                preliminary=preliminary, email=opts.email, jobs=opts.jobs,
+                profile=opts.profile,
             )
         except (ModuleInfoLoadError, ModuleNotReadyError) as e:
             exit_status = 1
@@ -42,6 +42,7 @@ from pimlico.datatypes import load_datatype
 from pimlico.utils.core import remove_duplicates
 from pimlico.utils.format import title_box
 from pimlico.utils.logging import get_console_logger
+from pimlico.utils.pimarc.compression import parse_compression_spec, PimarcCompressionError
 
 __all__ = [
     "PipelineConfig", "PipelineConfigParseError", "PipelineStructureError", "preprocess_config_file",
@@ -333,6 +334,7 @@ class PipelineConfig(object):
         from pimlico.core.modules.inputs import input_module_factory
         from pimlico.core.modules.map import DocumentMapModuleInfo
         from pimlico.core.modules.map.filter import wrap_module_info_as_filter
+        from pimlico.core.modules.multistage import MultistageModuleInfo
         from pimlico.core.modules.options import str_to_bool, ModuleOptionParseError
 
         if variant is None:
@@ -540,6 +542,8 @@ class PipelineConfig(object):
 
                 # Allow document map types to be used as filters simply by specifying filter=T
                 filter_type = str_to_bool(module_config.pop("filter", ""))
+                # Document map types can also be told that the order of documents in their outputs doesn't matter
+                unordered_output = str_to_bool(module_config.pop("unordered_output", ""))
 
                 # Check for the tie_alts option, which causes us to tie together lists of alternatives instead
                 # of taking their product
@@ -567,6 +571,32 @@ class PipelineConfig(object):
                 # Remove the alt_naming parameter now, which we use later on
                 alt_naming = module_config.pop("alt_naming", "")
 
+                # Resources the module may use: override the pipeline's number of processes and give a memory
+                # budget in MB, which is used when scheduling modules to run in parallel
+                try:
+                    requested_processes = module_config.pop("processes", None)
+                    if requested_processes is not None:
+                        requested_processes = int(requested_processes)
+                    requested_memory = module_config.pop("memory_budget", None)
+                    if requested_memory is not None:
+                        requested_memory = int(requested_memory)
+                except ValueError:
+                    raise PipelineConfigParseError("processes and memory_budget must be integers in module '%s'"
+                                                   % module_name)
+
+                # Compression to use for outputs whose writers support it (e.g. grouped corpora): compression=X
+                # sets the default for all outputs, compression_<output>=X for a specific output
+                output_compression = {}
+                for compression_key in [key for key in module_config.keys()
+                                        if key == "compression" or key.startswith("compression_")]:
+                    compression_output = compression_key[12:] or None
+                    try:
+                        output_compression[compression_output] = \
+                            parse_compression_spec(module_config.pop(compression_key))
+                    except PimarcCompressionError as e:
+                        raise PipelineConfigParseError("invalid compression setting {} in module '{}': {}".format(
+                            compression_key, module_name, e))
+
                 # End of special parameter processing
                 #########################################################
 
@@ -1091,6 +1121,29 @@ class PipelineConfig(object):
                         module_variables=module_variables,
                     )
 
+                    module_info.requested_processes = requested_processes
+                    module_info.requested_memory = requested_memory
+                    if isinstance(module_info, MultistageModuleInfo):
+                        # Each stage is executed as a module in its own right, using the same resources
+                        for stage_module_info in module_info.internal_modules:
+                            stage_module_info.requested_processes = requested_processes
+                            stage_module_info.requested_memory = requested_memory
+
+                    unknown_outputs = [output for output in output_compression
+                                       if output is not None and output not in module_info.output_names]
+                    if unknown_outputs:
+                        raise PipelineConfigParseError("compression specified for unknown output(s) of module "
+                                                       "'{}': {}".format(module_name, ", ".join(unknown_outputs)))
+                    module_info.output_compression = output_compression
+
+                    if unordered_output:
+                        if not isinstance(module_info, DocumentMapModuleInfo):
+                            raise PipelineStructureError(
+                                "only document map module types can produce unordered output. Got option "
+                                "unordered_output=True for module %s" % module_name
+                            )
+                        module_info.unordered_output = True
+
                     # If we're loading as a filter, wrap the module info
                     if filter_type:
                         if not issubclass(module_info_class, DocumentMapModuleInfo):
@@ -41,6 +41,8 @@ from importlib import import_module
 from tabulate import tabulate
 
 from pimlico.core.config import PipelineStructureError
+from pimlico.core.modules.memory import MemoryMonitor
+from pimlico.core.modules.metrics import ModuleRunMetrics
 from pimlico.core.modules.options import process_module_options
 from pimlico.datatypes.base import PimlicoDatatype, DynamicOutputDatatype, DynamicInputDatatypeRequirement, \
     MultipleInputs, DataNotReadyError
@@ -115,6 +117,13 @@ class BaseModuleInfo(object):
         # were assigned to the parameters for this expansion
         # key is the parameter name, val the assigned value and name the name associated with the alternative, if any
         self.alt_param_settings = alt_param_settings
+        # Resources this module is allowed to use during execution, which may be set using the special module
+        # parameters `processes` and `memory_budget`. See `get_processes()` and `get_memory_budget()`
+        self.requested_processes = None
+        self.requested_memory = None
+        # Compression to use for outputs, set using the special module parameters `compression` and
+        # `compression_<output>`. See `get_output_compression()`
+        self.output_compression = {}
 
         # Allow the module's list of outputs to be expanded at this point, depending on options and inputs
         self.module_outputs = self.module_outputs + self.provide_further_outputs()
@@ -217,9 +226,13 @@ class BaseModuleInfo(object):
         metadata = self.get_metadata()
         # Add our new values to it
         metadata.update(val_dict)
-        # Write the whole thing out to the file
-        with open(os.path.join(output_dir, "metadata"), "w") as f:
+        # Write the whole thing out to a temporary file and move it into place, so that the metadata
+        # file is never left half-written if we're interrupted
+        metadata_path = os.path.join(output_dir, "metadata")
+        tmp_path = "{}.tmp".format(metadata_path)
+        with open(tmp_path, "w") as f:
             json.dump(metadata, f)
+        os.replace(tmp_path, metadata_path)
 
     def __get_status(self):
         # Check the metadata for current module status
@@ -660,6 +673,11 @@ class BaseModuleInfo(object):
         :return:
         """
         output_name, datatype = self.get_output_datatype(output_name=output_name)
+        compression = self.get_output_compression(output_name)
+        if compression is not None and datatype.Writer is not None and \
+                "compression" in datatype.Writer.metadata_defaults:
+            # Compression set in the config overrides what the module asks for
+            kwargs["compression"], kwargs["compression_level"] = compression
         return datatype.get_writer(
             self.get_output_dir(output_name, absolute=True),
             self.pipeline,
@@ -948,6 +966,47 @@ class BaseModuleInfo(object):
             [module_name for input_connections in self.inputs.values()
              for (module_name, output_name) in input_connections])
 
+    def get_processes(self):
+        """
+        Number of processes this module should use when it's executed. Normally, this is just the number
+        set for the whole pipeline (in the local config or with `--processes`), but it may be overridden
+        for an individual module using the special module parameter `processes`.
+
+        This is also the module's processor budget when modules are run in parallel by the scheduler.
+
+        """
+        if self.requested_processes is not None:
+            return self.requested_processes
+        return self.pipeline.processes
+
+    def get_memory_budget(self):
+        """
+        Amount of memory (in MB) that this module is expected to use during execution, as given by the
+        special module parameter `memory_budget`. None if no budget has been set.
+
+        Used by the scheduler when running modules in parallel, to avoid starting modules together that
+        would use more memory than is available.
+
+        """
+        return self.requested_memory
+
+    def get_output_compression(self, output_name=None):
+        """
+        Compression that should be used to store the given output, if its writer supports
+        compression (e.g. grouped corpora, which use block-compressed Pimarc archives). This is
+        given by the special module parameter `compression_<output>` or, failing that, `compression`,
+        whose value is a codec name, optionally followed by a compression level (e.g. `lzma:9`).
+
+        :return: tuple (codec name, level), where the codec name is None for no compression and
+            the level may be None to use the codec's default. None if no compression has been
+            specified for the output, so the module's (or writer's) default should be used
+        """
+        if output_name is None:
+            output_name = self.default_output_name
+        if output_name in self.output_compression:
+            return self.output_compression[output_name]
+        return self.output_compression.get(None, None)
+
     def get_transitive_dependencies(self):
         """
         Transitive closure of `dependencies`.
@@ -1399,6 +1458,14 @@ class BaseModuleExecutor(object):
     Abstract base class for executors for Pimlico modules. These are classes that actually
     do the work of executing the module on given inputs, writing to given output locations.
 
+    Performance metrics for the run are recorded in `metrics`, a
+    :class:`~pimlico.core.modules.metrics.ModuleRunMetrics`. Executors that process documents
+    should count them using its `add_docs()`.
+
+    Memory use is monitored by `memory`, a :class:`~pimlico.core.modules.memory.MemoryMonitor`,
+    which enforces the module's memory budget, if it has one. Executors that can use a lot of
+    memory should call its `check()` regularly.
+
     """
     def __init__(self, module_instance_info, stage=None, debug=False, force_rerun=False):
         self.debug = debug
@@ -1408,7 +1475,14 @@ class BaseModuleExecutor(object):
         self.log = module_instance_info.pipeline.log.getChild(module_instance_info.module_name)
         # Work out how many processes we should use
         # Normally just comes from pipeline, but we don't parallelize filters
-        self.processes = module_instance_info.pipeline.processes if not module_instance_info.is_filter() else 1
+        self.processes = module_instance_info.get_processes() if not module_instance_info.is_filter() else 1
+        # Performance metrics for this run, started and stored by execute_module()
+        self.metrics = ModuleRunMetrics(processes=self.processes)
+        # Memory monitoring for this run, also started and stopped by execute_module()
+        local_config = module_instance_info.pipeline.local_config
+        self.memory = MemoryMonitor(budget=module_instance_info.get_memory_budget(),
+                                    pressure_fraction=local_config.get("memory_pressure_fraction"),
+                                    interval=local_config.get("memory_check_interval"))
 
     def execute(self):
         """
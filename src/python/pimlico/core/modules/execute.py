@@ -33,12 +33,14 @@ from pimlico.cli.util import format_execution_error
 from pimlico.core.config import check_pipeline, PipelineCheckError, print_missing_dependencies
 from pimlico.core.modules.base import ModuleInfoLoadError, collect_unexecuted_dependencies
 from pimlico.core.modules.multistage import MultistageModuleInfo
+from pimlico.core.modules.profiling import ModuleProfiler
 from pimlico.utils.email import send_pimlico_email
 from pimlico.utils.logging import get_console_logger
 
 
 def check_and_execute_modules(pipeline, module_names, force_rerun=False, debug=False, log=None, all_deps=False,
-                              check_only=False, exit_on_error=False, preliminary=False, email=None):
+                              check_only=False, exit_on_error=False, preliminary=False, email=None, jobs=1,
+                              profile=None):
     """
     Main method called by the `run` command that first checks a pipeline, checks all pre-execution requirements
     of the modules to be executed and then executes each of them. The most common case is to execute just one
@@ -53,6 +55,11 @@ def check_and_execute_modules(pipeline, module_names, force_rerun=False, debug=F
     :param log: logger, if you have one you want to reuse
     :param all_deps: also include unexecuted dependencies of the given modules
     :param check_only: run all checks, but stop before executing. Used for `check` command
+    :param jobs: maximum number of modules to execute at once. If greater than 1, modules whose
+        dependencies have been completed are run in parallel by the scheduler
+        (see :mod:`pimlico.core.modules.scheduler`)
+    :param profile: profiling mode ("sampling" or "deterministic") to profile each module's execution
+        in, storing the profile in its output directory (see :mod:`pimlico.core.modules.profiling`)
     :return:
     """
     if log is None:
@@ -132,7 +139,7 @@ def check_and_execute_modules(pipeline, module_names, force_rerun=False, debug=F
         # Checks passed: run the module
         # Returns the exit status the should be used (i.e. 1 if there was an error)
         return execute_modules(pipeline, modules, log, force_rerun=force_rerun, debug=debug, exit_on_error=exit_on_error,
-                               preliminary=execute_preliminary, email=email)
+                               preliminary=execute_preliminary, email=email, jobs=jobs, profile=profile)
 
 
 def check_modules_ready(pipeline, modules, log, preliminary=False):
@@ -200,8 +207,17 @@ def check_modules_ready(pipeline, modules, log, preliminary=False):
 
 
 def execute_modules(pipeline, modules, log, force_rerun=False, debug=False, exit_on_error=False, preliminary=False,
-                    email=None):
+                    email=None, jobs=1, profile=None):
     # We assume that all checks have been run and that the modules are ready to be executed
+    if jobs > 1 and len(modules) > 1:
+        if pipeline.step:
+            log.warning("Step mode is interactive, so can't run modules in parallel: executing them one at a time")
+        else:
+            from pimlico.core.modules.scheduler import execute_modules_parallel
+            return execute_modules_parallel(pipeline, modules, log, jobs, force_rerun=force_rerun, debug=debug,
+                                            exit_on_error=exit_on_error, preliminary=preliminary, email=email,
+                                            profile=profile)
+
     if len(modules) > 1:
         log.info("Executing a sequence of modules: %s" % ", ".join(mod.module_name for mod in modules))
     start_time = datetime.now()
@@ -212,7 +228,6 @@ def execute_modules(pipeline, modules, log, force_rerun=False, debug=False, exit
 
     for module in modules:
         module_name = module.module_name
-        module_error = False
 
         if error_modules:
             # Check (again) whether the module's ready
@@ -234,154 +249,9 @@ def execute_modules(pipeline, modules, log, force_rerun=False, debug=False, exit
             skipped_modules.append(module_name)
             continue
 
-        # Give some information to the stepper if we're in step mode
-        if pipeline.step:
-            pipeline._stepper.executing = True
-
-        try:
-            # If running multiple modules, output something between them so it's clear where they start and end
-            if len(modules) > 1:
-                mess = "Executing %s" % module_name
-                log.info("=" * (len(mess) + 4))
-                log.info("| %s |" % mess)
-                log.info("=" * (len(mess) + 4))
-
-            log.info("Executing module tree:")
-            execution_tree = module.get_execution_dependency_tree()
-            for line in format_execution_dependency_tree(execution_tree):
-                log.info("  %s" % line)
-
-            # Check the status of the module, so we don't accidentally overwrite module output that's already complete
-            if module.status == "COMPLETE":
-                # Should only get here in the case of force rerun
-                assert force_rerun
-                log.info("module '%s' already fully run, but forcing rerun. If you want to be sure of clearing old "
-                         "data, use the 'reset' command" % module_name)
-                # We're rerunning, but don't delete old data (i.e. reset module), as there may be something there
-                # that the user wants to keep, e.g. caches. They can, of course, reset the module manually if they want
-                module.status = "STARTED"
-            elif module.status == "UNEXECUTED":
-                # Not done anything on this yet
-                module.status = "STARTED"
-                module.add_execution_history_record("Starting execution from the beginning")
-            else:
-                log.warn("module '%s' has been partially completed before and left with status '%s'. Starting executor" %
-                         (module_name, module.status))
-                module.add_execution_history_record("Starting executor with status '%s'" % module.status)
-
-            # Tell the user where we put the output
-            for output_name in module.output_names:
-                output_dir = module.get_absolute_output_dir(output_name)
-                log.info("Outputting '%s' in %s" % (output_name, output_dir))
-
-            # Store a copy of all the config files from which the pipeline was loaded, so we can see exactly
-            # what we did later
-            config_store_path = os.path.join(module.get_module_output_dir(absolute=True), "pipeline_config.tar")
-            run_num = 1
-            while os.path.exists(config_store_path):
-                config_store_path = os.path.join(module.get_module_output_dir(absolute=True),
-                                                 "pipeline_config.%d.tar" % run_num)
-                run_num += 1
-            with TarFile(config_store_path, "w") as config_store_tar:
-                # There may be multiple config files due to includes: store them all
-                # To be able to recreate the pipeline easily, we should store the directory structure relative to the
-                # main config, but since this is mainly just for looking at, we just chuck all the files in
-                for config_filename in pipeline.all_filenames:
-                    config_store_tar.add(config_filename, recursive=False, arcname=os.path.basename(config_filename))
-            module.add_execution_history_record("Storing full pipeline config used to execute %s in %s" %
-                                                (module_name, config_store_path))
-
-            try:
-                module.lock()
-
-                try:
-                    # Get hold of an executor for this module
-                    executor = module.load_executor()
-                    try:
-                        # Give the module an initial in-progress status
-                        end_status = executor(module, debug=debug, force_rerun=force_rerun).execute()
-                    except Exception as e:
-                        # Catch all exceptions that occur within the executor and wrap them in a ModuleExecutionError
-                        # so they can be nicely handled by the error reporting below
-                        # Ideally, most expected exceptions will be one of these two types anyway, but of course
-                        # unexpected things can go wrong!
-                        #
-                        # Get traceback for the exception currently being handled
-                        # Include the formatted traceback as debugging info for the reraised exception
-                        debugging_info = "Uncaught exception in executor. Traceback from original exception: \n%s" % \
-                                         "".join(format_tb(sys.exc_info()[2]))
-                        raise_from(
-                            ModuleExecutionError(str(e), debugging_info=debugging_info),
-                            e
-                        )
-                except (ModuleInfoLoadError, ModuleExecutionError) as e:
-                    if type(e) is ModuleExecutionError:
-                        # If there's any error, note in the history that execution didn't complete
-                        module.add_execution_history_record("Error executing %s: %s" % (module_name, e))
-                        log.error("Error executing module '%s': %s" % (module_name, e))
-                        # Allow a different end status to be passed up in the exception
-                        # If the exception origin didn't specify anything, we just say the module failed
-                        end_status = e.end_status or "FAILED"
-                    else:
-                        module.add_execution_history_record("Error loading %s for execution: %s" % (module_name, e))
-                        log.error("Error loading %s for execution: %s" % (module_name, e))
-                        # If the module didn't even load, use unstarted status
-                        end_status = "UNEXECUTED"
-
-                    debug_mess = StringIO()
-                    print("Top-level error", file=debug_mess)
-                    print("---------------", file=debug_mess)
-                    print(str(format_exc()), file=debug_mess)
-                    print(format_execution_error(e), file=debug_mess)
-                    debug_mess = debug_mess.getvalue()
-
-                    # Put the whole error info into a file so we can see what went wrong
-                    error_filename = module.get_new_log_filename()
-                    with open(error_filename, "w") as error_file:
-                        error_file.write(debug_mess)
-
-                    if debug or exit_on_error:
-                        # In debug mode, also output the full info to the terminal
-                        # Do this also if we're dropping out after encountering an error
-                        print(debug_mess, file=sys.stderr)
-                    else:
-                        log.error("Full debug info output to %s" % error_filename)
-                        log.error("Append '-e' to run command to view the full log")
-
-                    # Only send email error report if this was an execution error, not a load error
-                    if type(e) is ModuleExecutionError and email == "modend":
-                        # Finer-grained email notifications have been requested
-                        # Send an error report now
-                        send_module_report_email(pipeline, module, str(e), debug_mess)
-
-                    module.add_execution_history_record("Debugging output in %s" % error_filename)
-                    module_error = True
-                except KeyboardInterrupt:
-                    module.add_execution_history_record("Execution of %s halted by user" % module_name)
-                    raise
-            finally:
-                # Always remove the lock at the end, even if something goes wrong
-                module.unlock()
-
-            if end_status is None or end_status == "COMPLETE":
-                # Update the module status so we know it's been completed
-                if preliminary:
-                    # Don't set status to COMPLETE if we were just doing a preliminary run, to avoid confusion
-                    module.status = "COMPLETE_PRELIMINARY"
-                    module.add_execution_history_record("Preliminary exectuion complete")
-                else:
-                    module.status = "COMPLETE"
-                    module.add_execution_history_record("Execution completed successfully")
-            else:
-                # Custom status was given
-                module.status = end_status
-                module.add_execution_history_record("Execution completed with status %s" % end_status)
-        except Exception as e:
-            # Intercept all exceptions to add the name of the module that they came from
-            e.module_name = module_name
-            module.add_execution_history_record("Execution interruption by %s exception" % type(e).__name__)
-            # Reraise the exception to be caught higher up
-            raise
+        module_error = execute_module(pipeline, module, log, force_rerun=force_rerun, debug=debug,
+                                      exit_on_error=exit_on_error, preliminary=preliminary, email=email,
+                                      show_header=len(modules) > 1, profile=profile)
 
         if module_error:
             # Module failed in one way or another
@@ -396,6 +266,17 @@ def execute_modules(pipeline, modules, log, force_rerun=False, debug=False, exit
     if pipeline.step:
         pipeline._stepper.executing = False
 
+    return report_execution(pipeline, log, modules, error_modules, success_modules, skipped_modules, start_time,
+                            email=email)
+
+
+def report_execution(pipeline, log, modules, error_modules, success_modules, skipped_modules, start_time, email=None):
+    """
+    Output a summary of the outcome of executing a list of modules at the end of execution and send
+    an email report, if requested.
+
+    :return: exit status to use: 1 if any modules failed, otherwise 0
+    """
     # Output a summary of what we succeeded and failed on
     if error_modules:
         if success_modules:
@@ -424,6 +305,240 @@ def execute_modules(pipeline, modules, log, force_rerun=False, debug=False, exit
         return 0
 
 
+def execute_module(pipeline, module, log, force_rerun=False, debug=False, exit_on_error=False, preliminary=False,
+                   email=None, show_header=False, profile=None):
+    """
+    Execute a single module, which is assumed to have passed all the checks and not already be complete
+    (unless `force_rerun=True`). Takes care of locking the module, setting its status, recording execution
+    history and reporting errors.
+
+    Used by `execute_modules` for each module in turn and by the parallel scheduler in the processes it
+    runs each module in.
+
+    :param show_header: output a banner before starting, so it's clear in the logs where each module's
+        execution starts
+    :param profile: profile the executor in the given mode, "sampling" or "deterministic"
+        (see :mod:`pimlico.core.modules.profiling`)
+    :return: True if the module's execution failed, False otherwise
+    """
+    module_name = module.module_name
+    module_error = False
+    executor_instance = None
+    profiler = None
+
+    # Give some information to the stepper if we're in step mode
+    if pipeline.step:
+        pipeline._stepper.executing = True
+
+    try:
+        # If running multiple modules, output something between them so it's clear where they start and end
+        if show_header:
+            mess = "Executing %s" % module_name
+            log.info("=" * (len(mess) + 4))
+            log.info("| %s |" % mess)
+            log.info("=" * (len(mess) + 4))
+
+        log.info("Executing module tree:")
+        execution_tree = module.get_execution_dependency_tree()
+        for line in format_execution_dependency_tree(execution_tree):
+            log.info("  %s" % line)
+
+        # Check the status of the module, so we don't accidentally overwrite module output that's already complete
+        if module.status == "COMPLETE":
+            # Should only get here in the case of force rerun
+            assert force_rerun
+            log.info("module '%s' already fully run, but forcing rerun. If you want to be sure of clearing old "
+                     "data, use the 'reset' command" % module_name)
+            # We're rerunning, but don't delete old data (i.e. reset module), as there may be something there
+            # that the user wants to keep, e.g. caches. They can, of course, reset the module manually if they want
+            module.status = "STARTED"
+        elif module.status == "UNEXECUTED":
+            # Not done anything on this yet
+            module.status = "STARTED"
+            module.add_execution_history_record("Starting execution from the beginning")
+        else:
+            log.warn("module '%s' has been partially completed before and left with status '%s'. Starting executor" %
+                     (module_name, module.status))
+            module.add_execution_history_record("Starting executor with status '%s'" % module.status)
+
+        # Tell the user where we put the output
+        for output_name in module.output_names:
+            output_dir = module.get_absolute_output_dir(output_name)
+            log.info("Outputting '%s' in %s" % (output_name, output_dir))
+
+        # Store a copy of all the config files from which the pipeline was loaded, so we can see exactly
+        # what we did later
+        config_store_path = os.path.join(module.get_module_output_dir(absolute=True), "pipeline_config.tar")
+        run_num = 1
+        while os.path.exists(config_store_path):
+            config_store_path = os.path.join(module.get_module_output_dir(absolute=True),
+                                             "pipeline_config.%d.tar" % run_num)
+            run_num += 1
+        with TarFile(config_store_path, "w") as config_store_tar:
+            # There may be multiple config files due to includes: store them all
+            # To be able to recreate the pipeline easily, we should store the directory structure relative to the
+            # main config, but since this is mainly just for looking at, we just chuck all the files in
+            for config_filename in pipeline.all_filenames:
+                config_store_tar.add(config_filename, recursive=False, arcname=os.path.basename(config_filename))
+        module.add_execution_history_record("Storing full pipeline config used to execute %s in %s" %
+                                            (module_name, config_store_path))
+
+        try:
+            module.lock()
+
+            try:
+                # Get hold of an executor for this module
+                executor = module.load_executor()
+                try:
+                    executor_instance = executor(module, debug=debug, force_rerun=force_rerun)
+                    # Measure the resources used by the run, whether or not it succeeds
+                    executor_instance.metrics.start()
+                    executor_instance.memory.start()
+                    if profile is not None:
+                        profiler = ModuleProfiler(profile, interval=pipeline.local_config.get("profile_interval"))
+                        profiler.start()
+                    try:
+                        # Give the module an initial in-progress status
+                        end_status = executor_instance.execute()
+                    finally:
+                        if profiler is not None:
+                            profiler.stop()
+                        executor_instance.memory.stop()
+                        executor_instance.metrics.finish()
+                except Exception as e:
+                    # Catch all exceptions that occur within the executor and wrap them in a ModuleExecutionError
+                    # so they can be nicely handled by the error reporting below
+                    # Ideally, most expected exceptions will be one of these two types anyway, but of course
+                    # unexpected things can go wrong!
+                    #
+                    # Get traceback for the exception currently being handled
+                    # Include the formatted traceback as debugging info for the reraised exception
+                    debugging_info = "Uncaught exception in executor. Traceback from original exception: \n%s" % \
+                                     "".join(format_tb(sys.exc_info()[2]))
+                    raise_from(
+                        ModuleExecutionError(str(e), debugging_info=debugging_info),
+                        e
+                    )
+            except (ModuleInfoLoadError, ModuleExecutionError) as e:
+                if type(e) is ModuleExecutionError:
+                    # If there's any error, note in the history that execution didn't complete
+                    module.add_execution_history_record("Error executing %s: %s" % (module_name, e))
+                    log.error("Error executing module '%s': %s" % (module_name, e))
+                    # Allow a different end status to be passed up in the exception
+                    # If the exception origin didn't specify anything, we just say the module failed
+                    end_status = e.end_status or "FAILED"
+                else:
+                    module.add_execution_history_record("Error loading %s for execution: %s" % (module_name, e))
+                    log.error("Error loading %s for execution: %s" % (module_name, e))
+                    # If the module didn't even load, use unstarted status
+                    end_status = "UNEXECUTED"
+
+                debug_mess = StringIO()
+                print("Top-level error", file=debug_mess)
+                print("---------------", file=debug_mess)
+                print(str(format_exc()), file=debug_mess)
+                print(format_execution_error(e), file=debug_mess)
+                debug_mess = debug_mess.getvalue()
+
+                # Put the whole error info into a file so we can see what went wrong
+                error_filename = module.get_new_log_filename()
+                with open(error_filename, "w") as error_file:
+                    error_file.write(debug_mess)
+
+                if debug or exit_on_error:
+                    # In debug mode, also output the full info to the terminal
+                    # Do this also if we're dropping out after encountering an error
+                    print(debug_mess, file=sys.stderr)
+                else:
+                    log.error("Full debug info output to %s" % error_filename)
+                    log.error("Append '-e' to run command to view the full log")
+
+                # Only send email error report if this was an execution error, not a load error
+                if type(e) is ModuleExecutionError and email == "modend":
+                    # Finer-grained email notifications have been requested
+                    # Send an error report now
+                    send_module_report_email(pipeline, module, str(e), debug_mess)
+
+                module.add_execution_history_record("Debugging output in %s" % error_filename)
+                module_error = True
+            except KeyboardInterrupt:
+                module.add_execution_history_record("Execution of %s halted by user" % module_name)
+                store_profile(module, executor_instance, profiler, log)
+                store_run_metrics(module, executor_instance, log, status="INTERRUPTED")
+                raise
+        finally:
+            # Always remove the lock at the end, even if something goes wrong
+            module.unlock()
+
+        if end_status is None or end_status == "COMPLETE":
+            # Update the module status so we know it's been completed
+            if preliminary:
+                # Don't set status to COMPLETE if we were just doing a preliminary run, to avoid confusion
+                module.status = "COMPLETE_PRELIMINARY"
+                module.add_execution_history_record("Preliminary exectuion complete")
+            else:
+                module.status = "COMPLETE"
+                module.add_execution_history_record("Execution completed successfully")
+        else:
+            # Custom status was given
+            module.status = end_status
+            module.add_execution_history_record("Execution completed with status %s" % end_status)
+        store_profile(module, executor_instance, profiler, log)
+        store_run_metrics(module, executor_instance, log)
+    except Exception as e:
+        # Intercept all exceptions to add the name of the module that they came from
+        e.module_name = module_name
+        module.add_execution_history_record("Execution interruption by %s exception" % type(e).__name__)
+        # Reraise the exception to be caught higher up
+        raise
+
+    return module_error
+
+
+def store_run_metrics(module, executor, log, status=None):
+    """
+    Add the performance metrics recorded by a module's executor during its run to the metrics
+    file in the module's output directory. See :mod:`pimlico.core.modules.metrics`.
+
+    Does nothing if the executor didn't get as far as starting. Failing to store the metrics
+    isn't treated as an execution error: we just log a warning.
+
+    :param status: status to record for the run, if not the module's current status
+    """
+    if executor is None or executor.metrics.end_time is None:
+        return
+    executor.memory.log_high_water_marks(log)
+    if executor.memory.available:
+        executor.metrics.extra["memory"] = executor.memory.summary()
+    try:
+        path = executor.metrics.save(module.get_module_output_dir(absolute=True), status=status or module.status)
+    except (IOError, OSError, ValueError) as e:
+        log.warning("Could not store performance metrics for %s: %s" % (module.module_name, e))
+    else:
+        log.info("Performance metrics for this run added to %s" % path)
+
+
+def store_profile(module, executor, profiler, log):
+    """
+    Merge the profiles collected from the processes that executed a module and store them in the
+    module's output directory. See :mod:`pimlico.core.modules.profiling`.
+
+    Like the metrics, failing to store the profile isn't treated as an execution error.
+
+    """
+    if profiler is None:
+        return
+    try:
+        paths = profiler.save(module.get_module_output_dir(absolute=True))
+    except (IOError, OSError, ValueError, EOFError) as e:
+        log.warning("Could not store profile for %s: %s" % (module.module_name, e))
+    else:
+        if paths:
+            log.info("Profile of this run stored in %s" % ", ".join(paths))
+            if executor is not None:
+                executor.metrics.extra["profile"] = paths[0]
+
+
 def format_execution_dependency_tree(tree):
     """
     Takes a tree structure of modules and their inputs, tracing where
@@ -534,5 +649,14 @@ class ModuleAlreadyCompletedError(ModuleExecutionError):
     pass
 
 
+class MemoryBudgetExceeded(ModuleExecutionError):
+    """
+    Raised when a module's execution uses more memory than its budget allows.
+    See :mod:`pimlico.core.modules.memory`.
+
+    """
+    pass
+
+
 class StopProcessing(Exception):
     pass
@@ -6,8 +6,12 @@ standard_library.install_aliases()
 from builtins import zip
 from builtins import object
 
+import os
+import signal
 import threading
+import time
 import warnings
+from collections import deque
 
 import tblib.pickling_support
 tblib.pickling_support.install()
@@ -20,13 +24,17 @@ from traceback import format_exc
 from pimlico.core.config import PipelineStructureError
 from pimlico.core.modules.base import BaseModuleInfo, BaseModuleExecutor, satisfies_typecheck
 from pimlico.core.modules.execute import ModuleExecutionError, StopProcessing
+from pimlico.core.modules.options import str_to_bool
 from pimlico.datatypes.corpora import is_invalid_doc, invalid_document
 from pimlico.datatypes.corpora.data_points import RawDocumentType
 from pimlico.datatypes.corpora.grouped import GroupedCorpus, AlignedGroupedCorpora
 from pimlico.utils.core import multiwith, raise_from
 from pimlico.utils.pipes import qget
 from pimlico.utils.progress import get_progress_bar
+from .batching import BatchSizer, document_bytes, document_tokens, split_batches
 from .benchmark import benchmarker
+from .preload import preload_modules, parse_preload_setting
+from .resources import SharedResources
 
 
 class DocumentMapModuleInfo(BaseModuleInfo):
@@ -57,6 +65,8 @@ class DocumentMapModuleInfo(BaseModuleInfo):
         # Cache the writers once we initialized them
         self._writers = None
         self._named_writers = None
+        # Set by the unordered_output module parameter: see DocumentMapper
+        self.unordered_output = False
 
     def _load_input_readers(self):
         # Prepare the list of document map inputs that will be fed into the executor
@@ -90,7 +100,11 @@ class DocumentMapModuleInfo(BaseModuleInfo):
         status_lines = super(DocumentMapModuleInfo, self).get_detailed_status()
         if self.status == "PARTIALLY_PROCESSED":
             status_lines.append("Processed %d documents" % self.get_metadata()["docs_completed"])
-            status_lines.append("Last doc completed: %s" % self.get_metadata()["last_doc_completed"])
+            if self.get_metadata().get("archives_completed") is not None:
+                # Processed in archive-parallel mode, so there's no single last doc
+                status_lines.append("Archives completed: %d" % len(self.get_metadata()["archives_completed"]))
+            else:
+                status_lines.append("Last doc completed: %s" % self.get_metadata()["last_doc_completed"])
         return status_lines
 
     def document(self, output_name=None, **kwargs):
@@ -120,14 +134,110 @@ class DocumentMapModuleExecutor(BaseModuleExecutor):
     case). However, sometimes parallelizing isn't so simple: in these cases, consider using the tools in
     :mod:.singleproc.
 
+    Executors that can run worker processes that each read and write whole archives themselves
+    set `ARCHIVE_PARALLEL_SUPPORTED` and implement `create_archive_pool()`. If the local config
+    setting `map_archive_parallel` is turned on, these use archive-parallel execution, where the
+    main process only hands out archives to the workers and keeps track of their progress, instead
+    of passing every document to and from the workers.
+
+    Packages that the workers use, but that are slow to import, may be listed in `PRELOAD_MODULES`.
+    They are imported in the main process before the workers are started, so that the workers of this
+    and any later modules in the same run don't need to import them again. See :mod:`.preload`.
+
+    Big read-only resources used by the workers, like models, should be loaded once in the main
+    process by `load_resources()`, instead of in each worker's set-up. See :mod:`.resources`.
+
+    A time limit per document may be set by `DOC_TIMEOUT`, or the local config setting
+    ``map_doc_timeout``. Documents that take longer than this are output as invalid documents,
+    if the pool is able to stop its workers. See :mod:`.timeouts`.
+
+    Executors whose document processing can be run by something other than their own workers
+    provide a worker type for doing so as `INLINE_WORKER_TYPE` (see :class:`InlineMapWorker`).
+    The executors created by the factory functions all do. If a module's input comes from a chain
+    of such modules used as filters, the filters' processing is fused into this module's workers
+    (see :func:`.filter.fuse_filter_chain`).
+
+    If the local config setting ``map_trace`` is turned on, a timeline of the execution is recorded
+    by `tracer` and stored in the module's output directory. See :mod:`.trace`.
+
+    If the module has a memory budget, input is held back and workers stopped when memory use gets
+    close to it, and execution stops, storing its progress, if it goes over. See :mod:`.memory`.
+
     """
     ALLOW_SKIP_OUTPUT = False
+    ARCHIVE_PARALLEL_SUPPORTED = False
+    #: Names of packages to import in the main process before starting the workers
+    PRELOAD_MODULES = []
+    #: Defaults for how often the processing status is checkpointed, if not set in the local config
+    #: (`map_checkpoint_docs` and `map_checkpoint_seconds`)
+    DEFAULT_CHECKPOINT_DOCS = 1000
+    DEFAULT_CHECKPOINT_SECONDS = 5.
+    #: Default maximum number of documents per process that may be in progress at once (`map_reorder_window`)
+    DEFAULT_REORDER_WINDOW = 1000
+    #: Defaults for adaptive batch sizing (see :mod:`~pimlico.core.modules.map.batching`): target time for
+    #: a worker to process a batch sent by the input feeder (`map_batch_seconds`), maximum time for
+    #: a batch processed at once by a worker (`map_worker_batch_seconds`) and maximum batch size in MB
+    #: (`map_max_batch_mb`)
+    DEFAULT_BATCH_SECONDS = 0.2
+    DEFAULT_WORKER_BATCH_SECONDS = 5.
+    DEFAULT_MAX_BATCH_MB = 16.
+    #: Most documents the input feeder will send to a worker in one batch
+    MAX_FEEDER_BATCH_SIZE = 1000
+    #: Time limit in seconds for processing a document, if not set in the local config (`map_doc_timeout`)
+    DOC_TIMEOUT = None
+    #: Subclass of :class:`InlineMapWorker` that does this module's processing, if it can be run in another
+    #: module's workers when the module is used as a filter
+    INLINE_WORKER_TYPE = None
 
     def __init__(self, module_instance_info, **kwargs):
         super(DocumentMapModuleExecutor, self).__init__(module_instance_info, **kwargs)
         self.input_corpora = self.info.input_corpora
         self.input_iterator = AlignedGroupedCorpora(self.input_corpora)
 
+        local_config = self.info.pipeline.local_config
+        self.checkpoint_docs = int(local_config.get("map_checkpoint_docs", self.DEFAULT_CHECKPOINT_DOCS))
+        self.checkpoint_seconds = float(local_config.get("map_checkpoint_seconds", self.DEFAULT_CHECKPOINT_SECONDS))
+        self.archive_parallel = self.ARCHIVE_PARALLEL_SUPPORTED and \
+            str_to_bool(local_config.get("map_archive_parallel", "false"))
+        # Limit on how many documents can be waiting for their results to be output, across all processes
+        self.reorder_window = int(local_config.get("map_reorder_window", self.DEFAULT_REORDER_WINDOW)) * \
+            max(self.processes, 1)
+        # Batch sizes are adapted to the documents unless we're told not to, or given a fixed size
+        self.adaptive_batches = str_to_bool(local_config.get("map_adaptive_batches", "true"))
+        self.feeder_batch_size = local_config.get("map_feeder_batch_size", None)
+        if self.feeder_batch_size is not None:
+            self.feeder_batch_size = int(self.feeder_batch_size)
+        self.batch_seconds = float(local_config.get("map_batch_seconds", self.DEFAULT_BATCH_SECONDS))
+        self.worker_batch_seconds = float(local_config.get("map_worker_batch_seconds",
+                                                           self.DEFAULT_WORKER_BATCH_SECONDS))
+        self.max_batch_bytes = int(float(local_config.get("map_max_batch_mb", self.DEFAULT_MAX_BATCH_MB)) * 1024 * 1024)
+        # More packages for the workers to import before they start, for all map modules
+        self.preload = parse_preload_setting(local_config.get("map_preload", None))
+        # Filled by load_resources() before the workers start
+        self.resources = SharedResources()
+        # Time limit for each document, if any
+        self.doc_timeout = local_config.get("map_doc_timeout", self.DOC_TIMEOUT)
+        if self.doc_timeout is not None:
+            self.doc_timeout = float(self.doc_timeout)
+            if self.doc_timeout <= 0.:
+                # Allows the local config to turn off a limit set by the executor
+                self.doc_timeout = None
+        self.fuse_filters = str_to_bool(local_config.get("map_fuse_filters", "true"))
+        # Filter modules whose processing is done in our workers, set by fuse_filter_chain()
+        self.fused_stages = []
+        # Whether to record a timeline of execution, which is done by a MapTracer set when execution starts
+        self.trace = str_to_bool(local_config.get("map_trace", "false"))
+        self.tracer = None
+        # Pool of workers, created when execution starts
+        self.pool = None
+        # Processing status that's been reached, but not yet stored in the metadata
+        self._pending_status = None
+        self._docs_since_checkpoint = 0
+        self._last_checkpoint_time = None
+        self.docs_completed_now = 0
+        # Set when we receive SIGTERM, so that we stop at the next document
+        self._terminated = False
+
     def preprocess(self):
         """
         Allows subclasses to define a set-up procedure to be called before corpus processing begins.
@@ -140,6 +250,80 @@ class DocumentMapModuleExecutor(BaseModuleExecutor):
         """
         pass
 
+    def load_resources(self, resources):
+        """
+        Allows subclasses to load read-only resources needed by the workers, like vocabularies or
+        models, once in the main process, after `preprocess()` and before the workers are started.
+        Add them to `resources`, a :class:`~pimlico.core.modules.map.resources.SharedResources` dict,
+        from which the workers can get them as their `resources` attribute. Big numpy arrays can be
+        put in shared memory using `resources.share_array()`.
+
+        """
+        pass
+
+    def prepare_resources(self):
+        """
+        Load the workers' resources and get them ready to be shared by forked workers.
+
+        """
+        self.load_resources(self.resources)
+        self.resources.freeze()
+
+    def release_resources(self):
+        """
+        Called once the workers have finished, to free the resources loaded by `load_resources()`.
+
+        """
+        self.resources.release()
+
+    def fuse_filter_chain(self):
+        """
+        If the input comes from a chain of filter modules that can be fused into this module's
+        workers, set them up to be run there and read the input from the start of the chain instead.
+        See :func:`.filter.fuse_filter_chain`. Called before execution begins, unless turned off
+        by the local config setting ``map_fuse_filters``.
+
+        """
+        if not self.fuse_filters:
+            return
+        from pimlico.core.modules.map.filter import fuse_filter_chain
+        self.fused_stages, input_corpora = fuse_filter_chain(self.input_corpora)
+        if len(self.fused_stages):
+            self.log.info("Running filter module(s) {} in the same workers".format(
+                ", ".join(stage.executor.info.module_name for stage in self.fused_stages)))
+            self.input_iterator = AlignedGroupedCorpora(input_corpora)
+
+    def start_fused_stages(self):
+        """
+        Called from the main process after `preprocess()`, to prepare the executors of any filter
+        modules fused into our workers, just as if they were being run on their own.
+
+        """
+        for stage in self.fused_stages:
+            stage.executor.preprocess()
+            stage.executor.preload_worker_modules()
+            stage.executor.prepare_resources()
+
+    def finish_fused_stages(self, error=False):
+        """
+        Called once the workers have finished, to finish off the executors of any fused filter modules.
+
+        """
+        for stage in self.fused_stages:
+            try:
+                stage.executor.postprocess(error=error)
+            finally:
+                stage.executor.release_resources()
+
+    def preload_worker_modules(self):
+        """
+        Import the packages given in `PRELOAD_MODULES` and the ``map_preload`` local config setting
+        in the main process, before starting the workers. Anything that's already been preloaded by
+        an earlier module in this run is not imported again.
+
+        """
+        preload_modules(list(self.PRELOAD_MODULES) + self.preload, log=self.log)
+
     def create_pool(self, processes):
         """
         Should return an instance of the pool to be used for document processing. Should generally be a
@@ -150,11 +334,58 @@ class DocumentMapModuleExecutor(BaseModuleExecutor):
         """
         raise NotImplementedError()
 
+    def create_feeder_batch_sizer(self):
+        """
+        Create a :class:`~pimlico.core.modules.map.batching.BatchSizer` to choose the number of
+        documents the input feeder sends to a worker at once.
+
+        """
+        if self.feeder_batch_size is not None:
+            return BatchSizer.fixed_size(self.feeder_batch_size)
+        elif not self.adaptive_batches:
+            return BatchSizer.fixed_size(InputQueueFeeder.DEFAULT_BATCH_SIZE)
+        # Don't let one batch take up more than a fraction of the docs allowed in progress at once
+        max_size = self.MAX_FEEDER_BATCH_SIZE
+        if self.reorder_window:
+            max_size = max(1, min(max_size, self.reorder_window // (4 * max(self.processes, 1))))
+        return BatchSizer(self.batch_seconds, max_size=max_size, max_bytes=self.max_batch_bytes,
+                          initial_size=InputQueueFeeder.DEFAULT_BATCH_SIZE)
+
+    def create_worker_batch_sizer(self):
+        """
+        Create a :class:`~pimlico.core.modules.map.batching.BatchSizer` for a worker to choose the
+        number of documents to process at once. The worker's `docs_per_batch` is used as the maximum.
+        Returns None if batch sizes shouldn't be adapted.
+
+        """
+        if not self.adaptive_batches:
+            return None
+        return BatchSizer(self.worker_batch_seconds, max_bytes=self.max_batch_bytes)
+
+    def create_archive_pool(self, processes):
+        """
+        Should return an instance of the pool to be used for archive-parallel processing, if
+        `ARCHIVE_PARALLEL_SUPPORTED` is set. The pool's workers take pairs `(archive name, docs to skip)`
+        from its input queue and put :class:`ArchiveProgress` updates on its output queue.
+        See :mod:`.archives`.
+
+        Always called after preprocess().
+
+        """
+        raise NotImplementedError()
+
     def wait_until_finished(self):
         raise NotImplementedError()
 
     def retrieve_processing_status(self):
         # Check the metadata to see whether we've already partially completed this
+        if self.info.status in ("FAILED", "PARTIALLY_PROCESSED") and \
+                self.info.get_metadata().get("archives_completed") is not None:
+            # Archives might have been completed in any order, so we can't just pick up after the last doc
+            raise ModuleExecutionError(
+                "module was partially executed in archive-parallel mode, so can only be resumed in the same "
+                "mode: set map_archive_parallel=true in the local config to continue"
+            )
         if self.info.status == "FAILED":
             # If we failed last time, we might have stored progress, but should be a bit more cautious
             start_after = None
@@ -189,29 +420,198 @@ class DocumentMapModuleExecutor(BaseModuleExecutor):
             start_after = None
         return docs_completed, start_after
 
-    def update_processing_status(self, docs_completed, archive_name, filename):
-        self.info.set_metadata_values({
+    def retrieve_archive_processing_status(self):
+        """
+        Like `retrieve_processing_status()`, for archive-parallel execution, where progress is
+        stored for each archive separately.
+
+        If the module was partially executed sequentially, the progress is converted: all archives
+        before the last document completed are complete and the one it's in is partially complete.
+
+        :return: tuple (docs completed, list of completed archives, dict of number of docs completed in
+            partially completed archives)
+        """
+        metadata = self.info.get_metadata()
+        if self.info.status not in ("FAILED", "PARTIALLY_PROCESSED") or metadata.get("docs_completed", 0) == 0:
+            return 0, [], {}
+
+        if metadata.get("archives_completed") is not None:
+            docs_completed = metadata["docs_completed"]
+            archives_completed = metadata["archives_completed"]
+            archive_docs_completed = metadata.get("archive_docs_completed") or {}
+        else:
+            docs_completed, start_after = self.retrieve_processing_status()
+            if start_after is None:
+                return 0, [], {}
+            archives_completed = self.input_iterator.archives[:self.input_iterator.archives.index(start_after[0])]
+            # Count how far through its archive the last doc completed was
+            archive_docs_completed = {start_after[0]: 0}
+            for archive_name, doc_name in self.input_corpora[0].list_archive_iter():
+                if archive_name == start_after[0]:
+                    archive_docs_completed[archive_name] += 1
+                    if doc_name == start_after[1]:
+                        break
+
+        self.log.info(
+            "Module has been partially executed already; picking up where we left off "
+            "({:,} archives completed, {:,} partially completed, {:,} docs to process)".format(
+                len(archives_completed), len(archive_docs_completed), len(self.input_iterator) - docs_completed
+            )
+        )
+        return docs_completed, archives_completed, archive_docs_completed
+
+    def update_processing_status(self, docs_completed, archive_name, filename, force=False):
+        """
+        Record that we've completed processing (and writing) a document, so that we can
+        pick up where we left off if processing is interrupted.
+
+        Writing the module metadata after every document is slow, so the status is only
+        checkpointed to the metadata every `checkpoint_docs` documents or every
+        `checkpoint_seconds` seconds, whichever comes first. Use `force=True` to write
+        it immediately, or `flush_processing_status()` to write any pending update.
+
+        """
+        self._set_pending_status({
             "status": "PARTIALLY_PROCESSED",
             "last_doc_completed": u"%s/%s" % (archive_name, filename),
             "docs_completed": docs_completed,
-        })
+            "archives_completed": None,
+            "archive_docs_completed": None,
+        }, force=force)
+
+    def update_archive_processing_status(self, docs_completed, archives_completed, archive_docs_completed,
+                                         force=False):
+        """
+        Record the progress of archive-parallel processing, so that we can pick up where we
+        left off if processing is interrupted. Checkpointed in the same way as
+        `update_processing_status()`.
+
+        :param docs_completed: total number of documents completed
+        :param archives_completed: list of archives that have been fully processed
+        :param archive_docs_completed: dict giving, for archives partially processed, how many
+            documents have been processed and written
+        """
+        self._set_pending_status({
+            "status": "PARTIALLY_PROCESSED",
+            "last_doc_completed": None,
+            "docs_completed": docs_completed,
+            "archives_completed": list(archives_completed),
+            "archive_docs_completed": dict(archive_docs_completed),
+        }, force=force)
+
+    def _set_pending_status(self, metadata_values, force=False):
+        self._pending_status = metadata_values
+        self._docs_since_checkpoint += 1
+        if self._last_checkpoint_time is None:
+            self._last_checkpoint_time = time.time()
+
+        if force or self._docs_since_checkpoint >= self.checkpoint_docs or \
+                time.time() - self._last_checkpoint_time >= self.checkpoint_seconds:
+            self.flush_processing_status()
+
+    def flush_processing_status(self):
+        """
+        Write out any processing status update that hasn't yet been checkpointed.
+
+        The output writers are flushed first, so that all the documents counted in the
+        stored status are on disk. Otherwise, documents still buffered in memory by the
+        writers would be lost if the process were killed, but recorded as completed.
+
+        """
+        if self._pending_status is not None:
+            for writer in self.info.get_writers():
+                writer.flush()
+            self.info.set_metadata_values(self._pending_status)
+            self._pending_status = None
+        self._docs_since_checkpoint = 0
+        self._last_checkpoint_time = time.time()
+
+    def _handle_sigterm(self, signum, frame):
+        if os.getpid() != self._sigterm_pid:
+            # We've been inherited by a forked worker process, which should just be terminated as normal
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+            return
+        # Don't stop here, since we could be part-way through writing a document. Just note that we've
+        #  been terminated, so that processing stops once the document's finished: see check_terminated()
+        self._terminated = True
+
+    def check_terminated(self):
+        """
+        Called between documents to check whether we've received SIGTERM. If so, raise an error,
+        so that processing stops in the same way as if an error had occurred: the processing
+        status gets stored and we can continue where we left off.
+
+        """
+        if self._terminated:
+            raise ModuleExecutionError("execution terminated by SIGTERM")
+
+    def write_outputs(self, writers, archive, doc_name, outputs, allow_duplicates=False):
+        """
+        Write the outputs produced for a document to the output corpora.
+
+        :param allow_duplicates: if True, don't raise an error if the document is already in an
+            output, just skip writing it there
+        :return: True if the document was already in an output
+        """
+        duplicate = False
+        for result, writer in zip(outputs, writers):
+            # If allowing skipping outputs, we don't try to write the output if None is returned
+            if result is not None or not self.ALLOW_SKIP_OUTPUT:
+                try:
+                    writer.add_document(archive, doc_name, result)
+                except DuplicateFilename:
+                    # If the first docs we try writing are already in the archive, don't worry,
+                    #  just skip them. This can happen if we dropped out of processing after
+                    #  writing, but before checkpointing the name of the last processed file.
+                    # However, if it happens after we've written something, it's more
+                    #  worrying: maybe a problem with the input data
+                    if not allow_duplicates:
+                        raise
+                    duplicate = True
+        return duplicate
 
     def execute(self):
+        self.fuse_filter_chain()
+        archive_parallel = self.archive_parallel and self.processes > 1 and \
+            len(self.input_iterator.archives) > 1 and self.input_iterator.shardable
         # Call the set-up routine, if one's been defined
-        self.log.info("Preparing parallel document map execution with %d processes" % self.processes)
+        self.log.info("Preparing parallel document map execution with %d processes%s" % (
+            self.processes, " (archive-parallel)" if archive_parallel else ""))
 
         complete = False
-        docs_completed_now = 0
+        self.docs_completed_now = 0
+        self.metrics.extra["archive_parallel"] = archive_parallel
+        if self.trace:
+            if archive_parallel:
+                self.log.warning("Execution timeline (map_trace) is not recorded in archive-parallel execution")
+            else:
+                from pimlico.core.modules.map.trace import MapTracer
+                self.tracer = MapTracer(name=self.info.module_name)
 
-        docs_completed_before, start_after = self.retrieve_processing_status()
+        if archive_parallel:
+            docs_completed_before, archives_completed, archive_docs_completed = \
+                self.retrieve_archive_processing_status()
+            resuming = docs_completed_before > 0
+        else:
+            docs_completed_before, start_after = self.retrieve_processing_status()
+            resuming = start_after is not None
         total_to_process = len(self.input_iterator) - docs_completed_before
 
-        # Note whether we're processing the first output, or have already output something
-        first_output = True
+        # Make sure that the processing status gets stored if we're killed, so we can resume later
+        # Signal handlers can only be set from the main thread
+        set_sigterm_handler = threading.current_thread() is threading.main_thread()
+        if set_sigterm_handler:
+            self._sigterm_pid = os.getpid()
+            old_sigterm_handler = signal.signal(signal.SIGTERM, self._handle_sigterm)
+        self._terminated = False
+        self._pending_status = None
+        self._docs_since_checkpoint = 0
+        self._last_checkpoint_time = None
 
         try:
             # Prepare a corpus writer for the output
-            with multiwith(*self.info.get_writers(append=start_after is not None)) as writers:
+            with multiwith(*self.info.get_writers(append=resuming)) as writers:
                 if total_to_process < 1:
                     # No input documents, don't go any further
                     # We've come in this far so that the writer gets created and finishing up is done:
@@ -221,52 +621,186 @@ class DocumentMapModuleExecutor(BaseModuleExecutor):
                     pbar = get_progress_bar(total_to_process, counter=True,
                                             title="%s map" % self.info.module_type_name.replace("_", " ").capitalize())
                     self.log.info("Starting execution on {:,} docs".format(total_to_process))
-                    # Inputs will be taken from this as they're needed
-                    input_iter = iter(self.input_iterator.archive_iter(start_after=start_after))
-
-                    # Set map processing going, using the generic function
-                    benchmarker.start()
-                    mapper = DocumentMapper(self, input_iter, processes=self.processes, pbar=pbar, benchmarker=benchmarker)
-                    for (archive, doc_name), next_output in mapper.map_documents():
-                        docs_completed_now += 1
-
-                        with benchmarker.write_output_timer:
-                            # Write the result to the output corpora
-                            for result, writer in zip(next_output, writers):
-                                # If allowing skipping outputs, we don't try to write the output if None is returned
-                                if result is not None or not self.ALLOW_SKIP_OUTPUT:
-                                    try:
-                                        writer.add_document(archive, doc_name, result)
-                                    except DuplicateFilename:
-                                        # If the first doc we try writing is already in the archive, don't worry,
-                                        #  just skip it. This can happen if we dropped out of processing after writing,
-                                        #  but before storing the name of the last processed file.
-                                        # However, if it happens after the first one, it's more worrying: maybe a
-                                        #  problem with the input data
-                                        if not first_output:
-                                            raise
-
-                            # Update the module's metadata to say that we've completed this document
-                            self.update_processing_status(docs_completed_before+docs_completed_now, archive, doc_name)
-                            if first_output:
-                                first_output = False
-
+                    if archive_parallel:
+                        self._map_archives(writers, pbar, docs_completed_before,
+                                           archives_completed, archive_docs_completed)
+                    else:
+                        self._map_documents(writers, pbar, docs_completed_before, start_after)
                     pbar.finish()
             complete = True
         except ModuleExecutionError as e:
+            # Make sure the status of everything we've processed is stored before we check it
+            self.flush_processing_status()
             if self.info.status == "PARTIALLY_PROCESSED":
                 self.log.info("Processed documents recorded: restart processing where you left off by calling run "
                               "again once you've fixed the problem (%d docs processed in this run, %d processed in "
-                              "total)" % (docs_completed_now, docs_completed_before+docs_completed_now))
+                              "total)" % (self.docs_completed_now, docs_completed_before+self.docs_completed_now))
                 # Set the end status so that the top-level routine doesn't replace it with a generic failure status
                 e.end_status = self.info.status
             raise
         finally:
+            # Store the status of anything processed since the last checkpoint, whatever happened
+            self.flush_processing_status()
+            if set_sigterm_handler:
+                signal.signal(signal.SIGTERM, old_sigterm_handler if old_sigterm_handler is not None else signal.SIG_DFL)
+            if getattr(self.pool, "timed_out_docs", None) is not None:
+                self.metrics.extra["timed_out_docs"] = self.pool.timed_out_docs
+            if getattr(self.pool, "memory_throttle", None) is not None:
+                self.metrics.extra["workers_retired"] = self.pool.memory_throttle.workers_retired
+            if self.tracer is not None:
+                self.export_trace()
+
             # Call the finishing-off routine, if one's been defined
             if complete:
                 self.log.info("Document mapping complete. Finishing off")
             else:
                 self.log.info("Document mapping failed. Finishing off")
+            if complete and self._terminated and set_sigterm_handler:
+                # We were terminated after the last document: now that everything's stored, pass the signal on
+                os.kill(os.getpid(), signal.SIGTERM)
+
+    def export_trace(self):
+        """
+        Store the timeline recorded by `tracer` in the module's output directory, once the workers have finished.
+
+        """
+        from pimlico.core.modules.map.trace import new_trace_path
+        tracer, self.tracer = self.tracer, None
+        path = new_trace_path(self.info.get_module_output_dir(absolute=True))
+        try:
+            dropped = tracer.export(path, metadata={"module": self.info.module_name, "processes": self.processes})
+        except (IOError, OSError) as e:
+            self.log.warning("Could not store execution timeline: {}".format(e))
+            tracer.discard()
+            return
+        self.log.info("Execution timeline stored in {}".format(path))
+        if dropped:
+            self.log.warning("{:,} events were left out of the timeline, because there were too many".format(dropped))
+        self.metrics.extra["trace"] = path
+
+    def _map_documents(self, writers, pbar, docs_completed_before, start_after):
+        """
+        Standard execution: documents are read in this process, sent to the workers and their
+        results written out in order.
+
+        """
+        # Until we've output something, it's not a problem if the docs we're outputting are already
+        # in the output. This can happen if we dropped out of processing after writing, but before
+        # storing the name of the last processed file
+        first_output = True
+        # If the outputs are unordered, docs from the same archive may also have been written out
+        #  of order before we dropped out, so once we're past the docs already written, we still allow
+        #  duplicates in that archive
+        unordered = self.info.unordered_output
+        resume_archive = None
+        if unordered or self.input_iterator.unordered:
+            # Record that the output docs aren't in the same order as the input
+            for writer in writers:
+                if "unordered" in writer.metadata:
+                    writer.metadata["unordered"] = True
+        # Inputs will be taken from this as they're needed
+        input_iter = iter(self.input_iterator.archive_iter(start_after=start_after))
+
+        # Set map processing going, using the generic function
+        benchmarker.start()
+        mapper = DocumentMapper(self, input_iter, processes=self.processes, pbar=pbar, benchmarker=benchmarker,
+                                unordered=unordered, metrics=self.metrics)
+        for (archive, doc_name), next_output in mapper.map_documents():
+            self.docs_completed_now += 1
+            self.metrics.add_docs(1, invalid=any(is_invalid_doc(output) for output in next_output))
+
+            with benchmarker.write_output_timer:
+                # Write the result to the output corpora
+                write_start = time.monotonic()
+                duplicate = self.write_outputs(writers, archive, doc_name, next_output,
+                                               allow_duplicates=first_output or archive == resume_archive)
+                if self.tracer is not None:
+                    self.tracer.span("write", write_start)
+
+                if mapper.last_completed is not None:
+                    # Update the module's metadata to say that we've completed everything up to this point
+                    self.update_processing_status(docs_completed_before+mapper.num_completed, *mapper.last_completed)
+                if first_output and not duplicate:
+                    first_output = False
+                    if unordered:
+                        resume_archive = archive
+            # Only stop now that everything's been written for this document
+            self.check_terminated()
+
+    def _map_archives(self, writers, pbar, docs_completed_before, archives_completed, archive_docs_completed):
+        """
+        Archive-parallel execution: each worker reads whole input archives and writes the corresponding
+        output archives itself. Here we just hand out the archives and keep track of progress.
+
+        The workers have their own copies of the writers, so the output archives are laid out exactly
+        as in the standard execution, but we need to keep count here of how many documents they've written.
+
+        """
+        archives_completed = list(archives_completed)
+        archive_docs_completed = dict(archive_docs_completed)
+        # Queue up an assignment for every archive not yet finished
+        assignments = deque(
+            (archive_name, archive_docs_completed.get(archive_name, 0))
+            for archive_name in self.input_iterator.archives if archive_name not in archives_completed
+        )
+        archives_remaining = len(assignments)
+        docs_completed = docs_completed_before
+        docs_processed = 0
+
+        self.preprocess()
+        self.start_fused_stages()
+        self.preload_worker_modules()
+        self.prepare_resources()
+        if self.doc_timeout is not None:
+            self.log.warning("Document time limit (map_doc_timeout) is not enforced in archive-parallel execution")
+        complete = False
+        try:
+            try:
+                self.pool = self.create_archive_pool(self.processes)
+            except WorkerStartupError as e:
+                raise_from(ModuleExecutionError(str(e), cause=e.cause, debugging_info=e.debugging_info), e)
+
+            while archives_remaining > 0:
+                # Give the workers as many archives as there's room for
+                while len(assignments):
+                    try:
+                        self.pool.input_queue.put_nowait(assignments[0])
+                    except Full:
+                        break
+                    else:
+                        assignments.popleft()
+
+                # Stop before going any further if we're using too much memory
+                self.memory.check()
+                # Wait for the workers to report some progress
+                progress = self.pool.get_output()
+                docs_processed += progress.processed
+                # Workers don't tell us which docs were invalid or how long they took
+                self.metrics.add_docs(progress.processed)
+                pbar.update(docs_processed)
+                for writer, written in zip(writers, progress.written):
+                    writer.doc_count += written
+
+                if progress.completed is not None:
+                    # Everything up to here has been written to disk, so we can checkpoint it
+                    docs_completed += progress.completed - archive_docs_completed.get(progress.archive, 0)
+                    self.docs_completed_now = docs_completed - docs_completed_before
+                    if progress.finished:
+                        archive_docs_completed.pop(progress.archive, None)
+                        archives_completed.append(progress.archive)
+                        archives_remaining -= 1
+                    else:
+                        archive_docs_completed[progress.archive] = progress.completed
+                    self.update_archive_processing_status(docs_completed, archives_completed, archive_docs_completed)
+                # The workers do the writing, so we can stop after any update
+                self.check_terminated()
+            complete = True
+        finally:
+            # Call the finishing-off routine, if one's been defined
+            self.postprocess(error=not complete)
+            self.wait_until_finished()
+            self.release_resources()
+            self.finish_fused_stages(error=not complete)
 
 
 def output_to_document(output, datatype):
@@ -291,8 +825,97 @@ def output_to_document(output, datatype):
         return output
 
 
+def get_output_datatypes(executor):
+    """
+    Get the data point types of the grouped corpus outputs of a document map module, which
+    are needed to convert the results returned by workers (see :func:`prepare_outputs`).
+
+    """
+    return [
+        executor.info.get_output_datatype(name)[1].data_point_type
+        for name in executor.info.get_grouped_corpus_output_names()
+    ]
+
+
+def prepare_outputs(executor, result, output_datatypes):
+    """
+    Convert the result returned by a worker for a single document to a tuple of documents,
+    one for each of the module's outputs.
+
+    :param executor: the module's executor
+    :param result: result returned by the worker's process_document()
+    :param output_datatypes: data point types of the outputs, see :func:`get_output_datatypes`
+    :return: tuple of output documents
+    """
+    num_outputs = len(output_datatypes)
+    if is_invalid_doc(result):
+        # Just got a single invalid document out: write it out to every output
+        result = [result] * num_outputs
+    elif type(result) is not tuple:
+        # If the processor produces a single result and there's only one output, fine
+        result = [result]
+    if len(result) != num_outputs:
+        raise ModuleExecutionError(
+            "%s executor's process_document() returned %d results for a document, but the "
+            "module has %d outputs" % (type(executor).__name__, len(result), num_outputs)
+        )
+
+    # Post-process the returned data to convert to the correct document type,
+    # if raw data or an internal data dict was given
+    return tuple([output_to_document(output, dt) for (output, dt) in zip(result, output_datatypes)])
+
+
+def check_worker_errors(pool):
+    """
+    Check whether any of a pool's workers has put an error on its exception queue and,
+    if so, raise it in this process as a ModuleExecutionError.
+
+    """
+    try:
+        error = pool.exception_queue.get_nowait()
+    except Empty:
+        # No error: just keep waiting
+        return
+    # Got an error from a process: raise it
+    # First empty the exception queue, in case there were multiple errors
+    sleep(0.05)
+    while not pool.exception_queue.empty():
+        qget(pool.exception_queue, timeout=0.1)
+    if isinstance(error, ExceptionWithTraceback):
+        # Attach the original traceback to the original error
+        error = error.exception_with_traceback()
+    # Sometimes, a traceback from within the process is included
+    debugging = error.traceback if hasattr(error, "traceback") else None
+    raise_from(ModuleExecutionError("error in worker process: %s" % str(error),
+                                    cause=error, debugging_info=debugging), error)
+
+
 class DocumentMapper(object):
-    def __init__(self, executor, input_iter, processes=1, record_invalid=False, pbar=None, benchmarker=None):
+    """
+    Runs the main mapping process for a document map module: see :meth:`map_documents`.
+
+    Results are yielded in the order the documents were input. To do this, results that come back
+    from the workers early are buffered until it's their turn. To stop the buffer growing without
+    limit (e.g. if one document takes a very long time to process), no more than `reorder_window`
+    documents are allowed to be in progress (sent to the workers, but not yet yielded) at once:
+    once this limit is reached, no more are sent until the document holding things up is done.
+    If `reorder_window` is not given, it is taken from the executor (see the `map_reorder_window`
+    local config setting). Use 0 for no limit.
+
+    If `unordered=True`, the order of documents within each archive is not preserved: results are
+    yielded as soon as they're available, as long as all the documents in previous archives have
+    been yielded. Only use this if whatever uses the results doesn't care about the order.
+
+    In both cases, `last_completed` gives the last document `(archive, doc_name)` such that
+    it and all the documents before it in the input have been yielded, and `num_completed`
+    the number of documents up to and including it. This is where processing can be resumed from.
+
+    If `metrics` is given, the time the workers took to process each document is recorded in it
+    (see :class:`~pimlico.core.modules.metrics.ModuleRunMetrics`).
+
+    """
+    def __init__(self, executor, input_iter, processes=1, record_invalid=False, pbar=None, benchmarker=None,
+                 reorder_window=None, unordered=False, metrics=None):
         # If pbar is given, it will be updated every time a document is received
         #  from worker processes
         self.pbar = pbar
@@ -302,6 +925,14 @@ class DocumentMapper(object):
         self.executor = executor
         self.input_feeder = None
         self.benchmarker = benchmarker
+        if reorder_window is None:
+            reorder_window = getattr(executor, "reorder_window", 0)
+        self.reorder_window = reorder_window
+        self.unordered = unordered
+        self.metrics = metrics
+
+        self.last_completed = None
+        self.num_completed = 0
 
     def map_documents(self):
         """
@@ -319,29 +950,44 @@ class DocumentMapper(object):
         executor = self.executor
         # Call the set-up routine, if one's been defined
         executor.preprocess()
+        executor.start_fused_stages()
+        executor.preload_worker_modules()
+        executor.prepare_resources()
 
         # Start up a pool
         try:
             executor.pool = executor.create_pool(self.processes)
         except WorkerStartupError as e:
             raise_from(ModuleExecutionError(str(e), cause=e.cause, debugging_info=e.debugging_info), e)
+        if getattr(executor, "doc_timeout", None) is not None and getattr(executor.pool, "doc_timeout", None) is None:
+            executor.log.warning("Document time limit (map_doc_timeout) can't be enforced by {}: documents "
+                                 "will be processed without one".format(type(executor.pool).__name__))
 
         complete = False
+        # Results that have come back, but can't be yielded yet
         result_buffer = {}
+        # If tracing, when each of them came back
+        tracer = getattr(executor, "tracer", None)
+        buffered_at = {}
+        # Documents that have been yielded ahead of their turn, in unordered mode
+        yielded_early = set()
 
         # Get the expected output datatypes, ready for any possible output type conversion when we get results
-        output_datatypes = [
-            executor.info.get_output_datatype(name)[1].data_point_type
-            for name in executor.info.get_grouped_corpus_output_names()
-        ]
-        num_outputs = len(output_datatypes)
+        output_datatypes = get_output_datatypes(executor)
 
         try:
             # Inputs will be taken from the input_iter as they're needed
             # Set a thread going to feed things onto the input queue
             self.input_feeder = InputQueueFeeder(executor.pool.input_queue, self.input_iter,
                                                  complete_callback=executor.pool.notify_no_more_inputs,
-                                                 record_invalid=self.record_invalid)
+                                                 record_invalid=self.record_invalid,
+                                                 transport=getattr(executor.pool, "input_transport", None),
+                                                 window=self.reorder_window,
+                                                 stalled_callback=executor.pool.flush_batches,
+                                                 batch_sizer=executor.create_feeder_batch_sizer(),
+                                                 in_flight=getattr(executor.pool, "in_flight", None),
+                                                 memory_throttle=getattr(executor.pool, "memory_throttle", None),
+                                                 tracer=tracer)
 
             # Wait to make sure the input feeder's fed something into the input queue
             self.input_feeder.started.wait()
@@ -350,79 +996,86 @@ class DocumentMapper(object):
             num_docs_received = 0
 
             while next_document is not None:
+                # Stop cleanly, before writing anything more, if we're using too much memory
+                executor.memory.check()
                 # Wait for a document coming off the output queue
                 with benchmarker.result_fetch_timer:
-                    while True:
-                        try:
-                            # Wait a little bit to see if there's a result available
-                            result = qget(executor.pool.output_queue, timeout=0.2)
-                        except Empty:
-                            # Timed out: check there's not been an error in one of the processes
-                            try:
-                                error = executor.pool.exception_queue.get_nowait()
-                            except Empty:
-                                # No error: just keep waiting
-                                pass
-                            else:
-                                # Got an error from a process: raise it
-                                # First empty the exception queue, in case there were multiple errors
-                                sleep(0.05)
-                                while not executor.pool.exception_queue.empty():
-                                    qget(executor.pool.exception_queue, timeout=0.1)
-                                if isinstance(error, ExceptionWithTraceback):
-                                    # Attach the original traceback to the original error
-                                    error = error.exception_with_traceback()
-                                # Sometimes, a traceback from within the process is included
-                                debugging = error.traceback if hasattr(error, "traceback") else None
-                                raise_from(ModuleExecutionError("error in worker process: %s" % str(error),
-                                                                cause=error, debugging_info=debugging), error)
-                        except:
-                            raise
-                        else:
-                            # Got a result from a process
-                            break
+                    fetch_start = time.monotonic()
+                    result = executor.pool.get_output()
+                    if tracer is not None:
+                        tracer.span("dequeue", fetch_start)
 
-                # We've got some result, but it might not be the one we're looking for
-                # Add it to a buffer, so we can potentially keep it and only output it when its turn comes up
-                result_buffer[(result.archive, result.filename)] = result.data
                 num_docs_received += 1
                 if self.pbar is not None:
                     self.pbar.update(num_docs_received)
+                if result.processing_time is not None:
+                    # Let the feeder know how long documents are taking, so it can adjust its batch size
+                    self.input_feeder.batch_sizer.record_time(result.processing_time)
+                    if self.metrics is not None:
+                        self.metrics.add_latency(result.processing_time)
+
+                # Collect the results that can be yielded now, in order, along with whether each one means
+                #  we've now completed everything up to that point in the input: (doc, result, completed)
+                ready = []
+                result_doc = (result.archive, result.filename)
+                if self.unordered and result_doc != next_document and result.archive == next_document[0]:
+                    # In the same archive as the next document we're waiting for, so we can output it now
+                    ready.append((result_doc, result.data, False))
+                    yielded_early.add(result_doc)
+                else:
+                    # We've got some result, but it might not be the one we're looking for
+                    # Add it to a buffer, so we can potentially keep it and only output it when its turn comes up
+                    result_buffer[result_doc] = result.data
+                    if tracer is not None:
+                        buffered_at[result_doc] = time.monotonic()
 
-                # Write out as many as we can of the docs that have been sent and whose output is available
+                # Output as many as we can of the docs that have been sent and whose output is available
                 #  while maintaining the order they were put in in
-                while next_document in result_buffer:
-                    archive, filename = next_document
-                    next_output = result_buffer.pop((archive, filename))
+                while next_document is not None:
+                    if next_document in yielded_early:
+                        # Already output: we can now move past it
+                        yielded_early.remove(next_document)
+                        ready.append((next_document, _ALREADY_YIELDED, True))
+                    elif next_document in result_buffer:
+                        ready.append((next_document, result_buffer.pop(next_document), True))
+                    else:
+                        break
+                    previous_archive = next_document[0]
 
-                    # Next document processed: output the result precisely as in the single-core case
-                    if is_invalid_doc(next_output):
-                        # Just got a single invalid document out: write it out to every output
-                        next_output = [next_output] * num_outputs
-                    elif type(next_output) is not tuple:
-                        # If the processor produces a single result and there's only one output, fine
-                        next_output = [next_output]
-                    if len(next_output) != num_outputs:
-                        raise ModuleExecutionError(
-                            "%s executor's process_document() returned %d results for a document, but the "
-                            "module has %d outputs" % (type(executor).__name__, len(next_output), num_outputs)
-                        )
+                    # Check what document we're waiting for now
+                    with benchmarker.get_next_doc_timer:
+                        next_document = self.input_feeder.get_next_output_document()
 
-                    # Post-process the returned data to convert to the correct document type,
-                    # if raw data or an internal data dict was given
-                    next_output = tuple(
-                        [output_to_document(output, dt) for (output, dt) in zip(next_output, output_datatypes)]
-                    )
+                    if self.unordered and next_document is not None and next_document[0] != previous_archive:
+                        # Moved onto a new archive: any results we've already got from it can go out now
+                        for doc in [doc for doc in result_buffer
+                                    if doc[0] == next_document[0] and doc != next_document]:
+                            ready.append((doc, result_buffer.pop(doc), False))
+                            yielded_early.add(doc)
+
+                for doc, next_output, completed in ready:
+                    if tracer is not None and doc in buffered_at:
+                        waited_since = buffered_at.pop(doc)
+                        if doc != result_doc:
+                            # This one had to wait for earlier docs to come back before it could be output
+                            tracer.async_span("reorder wait", waited_since, doc="{}/{}".format(*doc))
+                    if completed:
+                        # Everything up to this doc has now been yielded, or is about to be
+                        self.last_completed = doc
+                        self.num_completed += 1
+                    if next_output is _ALREADY_YIELDED:
+                        continue
+
+                    # Next document processed: output the result precisely as in the single-core case
+                    next_output = prepare_outputs(executor, next_output, output_datatypes)
                     # Provide the result(s) for writing, or passing on to some other process
                     # Note that this will block until the result is taken by whatever is using the generator
                     #   In the meantime, the background processes may be processing and queueing results
                     #   If processing is fast, the overall time may be dominated by this postprocessing
                     with benchmarker.yield_result_timer:
-                        yield next_document, next_output
-
-                    # Check what document we're waiting for now
-                    with benchmarker.get_next_doc_timer:
-                        next_document = self.input_feeder.get_next_output_document()
+                        yield doc, next_output
+                    # This doc is no longer in progress, so the feeder can send another
+                    self.input_feeder.release_window()
             complete = True
         finally:
             # Call the finishing-off routine, if one's been defined
@@ -433,6 +1086,12 @@ class DocumentMapper(object):
             if self.input_feeder is not None:
                 self.input_feeder.shutdown()
             executor.wait_until_finished()
+            executor.release_resources()
+            executor.finish_fused_stages(error=not complete)
+
+
+# Marks a result that has already been yielded by the document mapper
+_ALREADY_YIELDED = object()
 
 
 def skip_invalid(fn):
@@ -516,11 +1175,34 @@ def invalid_docs_on_error(fn):
 class ProcessOutput(object):
     """
     Wrapper for all result data coming out from a worker.
+
+    :param processing_time: time taken by the worker to process the document, in seconds, if measured.
+        If the document was processed in a batch, this is the batch's time divided between its documents
     """
-    def __init__(self, archive, filename, data):
+    def __init__(self, archive, filename, data, processing_time=None):
         self.data = data
         self.filename = filename
         self.archive = archive
+        self.processing_time = processing_time
+
+
+class ArchiveProgress(object):
+    """
+    Progress update sent by a worker during archive-parallel execution.
+
+    :param archive: name of the archive being processed
+    :param processed: number of documents processed since the last update
+    :param written: list giving the number of documents written to each output since the last update
+    :param completed: number of documents in the archive that have been processed and written to disk,
+        if the outputs have been flushed, so that this can be checkpointed. Otherwise None
+    :param finished: True if the whole archive is done
+    """
+    def __init__(self, archive, processed, written, completed=None, finished=False):
+        self.archive = archive
+        self.processed = processed
+        self.written = written
+        self.completed = completed
+        self.finished = finished
 
 
 class InputQueueFeeder(Thread):
@@ -532,9 +1214,46 @@ class InputQueueFeeder(Thread):
     If using this, check_invalid() should be called regularly during mapping. If it is not,
     the queue will just fill up.
 
+    If a transport is given (see :mod:`~pimlico.core.modules.map.shm`), each batch is passed
+    through its `encode_batch()` before being put on the queue.
+
+    If a `window` is given (>0), at most this many documents will be in progress at once: that is, fed,
+    but not yet released by a call to :meth:`release_window`. Once the limit is reached, feeding waits
+    until documents are released. Just before it starts waiting, any partial batch is sent and
+    `stalled_callback` is called (if given), so that workers can be told not to wait for more inputs
+    before processing what they've got.
+
+    The number of documents sent in each batch is chosen by `batch_sizer`
+    (a :class:`~pimlico.core.modules.map.batching.BatchSizer`). The feeder records the size of
+    the documents it sends: whoever gets the results should record processing times. If not
+    given, batches of `DEFAULT_BATCH_SIZE` are always used.
+
+    If `in_flight` is given, every document that is fed is added to it, keyed by `(archive, filename)`,
+    so that it can be sent again if need be. Whoever gets the results should remove them.
+
+    If a `memory_throttle` is given (see :mod:`~pimlico.core.modules.map.memory`), feeding is paused
+    while it says too much memory is in use. As when waiting for the window, any partial batch is
+    sent and `stalled_callback` called first.
+
+    If a `tracer` is given (see :mod:`~pimlico.core.modules.map.trace`), the time spent reading,
+    encoding and enqueuing each batch is recorded.
+
     """
-    def __init__(self, input_queue, iterator, complete_callback=None, record_invalid=False):
-        super(InputQueueFeeder, self).__init__()
+    DEFAULT_BATCH_SIZE = 10
+
+    def __init__(self, input_queue, iterator, complete_callback=None, record_invalid=False, transport=None,
+                 window=None, stalled_callback=None, batch_sizer=None, in_flight=None, memory_throttle=None,
+                 tracer=None):
+        super(InputQueueFeeder, self).__init__(name="InputQueueFeeder")
+        self.tracer = tracer
+        self.in_flight = in_flight
+        self.memory_throttle = memory_throttle
+        self.transport = transport
+        self.stalled_callback = stalled_callback
+        if window:
+            self._window = threading.Semaphore(window)
+        else:
+            self._window = None
         self.complete_callback = complete_callback
         self.daemon = True
         self.iterator = iterator
@@ -546,7 +1265,9 @@ class InputQueueFeeder(Thread):
         self.ended = threading.Event()
         self.exception_queue = Queue(1)
 
-        self.feeder_batch_size = 10
+        if batch_sizer is None:
+            batch_sizer = BatchSizer.fixed_size(self.DEFAULT_BATCH_SIZE)
+        self.batch_sizer = batch_sizer
 
         self.record_invalid = record_invalid
         if record_invalid:
@@ -623,56 +1344,81 @@ class InputQueueFeeder(Thread):
             return True
         return False
 
+    def release_window(self):
+        """
+        Called by the consumer of the outputs once it's finished with a document, so that another
+        can be fed in its place, if we're limiting the number of documents in progress.
+
+        """
+        if self._window is not None:
+            self._window.release()
+
     def run(self):
         try:
             # Accumulate docs in a batch to send in one package to the processor
             batch = []
+            batch_bytes = 0
+            max_bytes = self.batch_sizer.max_bytes
+            # Start of the time spent reading the current batch, if tracing
+            read_start = time.monotonic()
             # Keep feeding inputs onto the queue as long as we've got more
             for i, (archive, filename, docs) in enumerate(self.iterator):
                 if self.cancelled.is_set():
                     # Stop feeding right away
                     return
+                if self.memory_throttle is not None and self.memory_throttle.should_pause():
+                    # Using too much memory: send what we've got and hold back the rest for now
+                    if len(batch) > 0:
+                        if not self._send_batch(batch, read_start):
+                            return
+                        batch = []
+                        batch_bytes = 0
+                    if self.stalled_callback is not None:
+                        self.stalled_callback()
+                    wait_start = time.monotonic()
+                    if not self.memory_throttle.wait(self.cancelled):
+                        return
+                    if self.tracer is not None:
+                        self.tracer.span("memory wait", wait_start)
+                    read_start = time.monotonic()
+                if self._window is not None and not self._window.acquire(blocking=False):
+                    # Too many docs in progress: don't hold on to what we've got while we wait
+                    if len(batch) > 0:
+                        if not self._send_batch(batch, read_start):
+                            return
+                        batch = []
+                        batch_bytes = 0
+                        read_start = time.monotonic()
+                    if self.stalled_callback is not None:
+                        self.stalled_callback()
+                    wait_start = time.monotonic()
+                    while not self._window.acquire(timeout=0.1):
+                        if self.cancelled.is_set():
+                            return
+                    if self.tracer is not None:
+                        self.tracer.span("window wait", wait_start)
                 if self.record_invalid:
                     if any(is_invalid_doc(doc) for doc in docs):
                         self.invalid_docs.put((archive, filename))
 
                 batch.append((archive, filename, docs))
-                if len(batch) < self.feeder_batch_size:
+                doc_bytes = document_bytes(docs)
+                self.batch_sizer.record_bytes(doc_bytes)
+                batch_bytes += doc_bytes
+                if len(batch) < self.batch_sizer.size and (max_bytes is None or batch_bytes < max_bytes):
                     # Don't send this batch yet: get some more documents
                     continue
-                # If the queue is full, this will block until there's room to put the next one on
-                # It also blocks if the queue is closed/destroyed/something similar, so we need to check now and
-                #  again that we've not been asked to give up
-                while True:
-                    try:
-                        self.input_queue.put(batch, timeout=0.1)
-                    except Full:
-                        if self.cancelled.is_set():
-                            return
-                        # Otherwise try putting again
-                    else:
-                        break
-                # Record that we've sent this one off, so we can write the results out in the right order
-                for archive, filename, __ in batch:
-                    self._docs_processing.put((archive, filename))
-                # As soon as something's been fed, the output processor can get going
-                self.started.set()
+                if not self._send_batch(batch, read_start):
+                    return
                 # Start a new batch
                 batch = []
+                batch_bytes = 0
+                read_start = time.monotonic()
 
             # We may still need to send off the final batch
             if len(batch) > 0:
-                while True:
-                    try:
-                        self.input_queue.put(batch, timeout=0.1)
-                    except Full:
-                        if self.cancelled.is_set():
-                            return
-                    else:
-                        break
-                for archive, filename, __ in batch:
-                    self._docs_processing.put((archive, filename))
-                self.started.set()
+                if not self._send_batch(batch, read_start):
+                    return
 
             self.feeding_complete.set()
             if self.complete_callback is not None:
@@ -687,6 +1433,57 @@ class InputQueueFeeder(Thread):
             self.started.set()
             self.ended.set()
 
+    def _send_batch(self, batch, read_start=None):
+        """
+        Put a batch on the input queue and record that its docs are being processed. Returns
+        False if we were cancelled while waiting.
+
+        """
+        if self.tracer is not None and read_start is not None:
+            self.tracer.span("read", read_start, docs=len(batch))
+        if self.in_flight is not None:
+            # Keep hold of the docs until their results come back
+            for archive, filename, docs in batch:
+                self.in_flight[(archive, filename)] = docs
+        # If the queue is full, this will block until there's room to put the next one on
+        # It also blocks if the queue is closed/destroyed/something similar, so we need to check now and
+        #  again that we've not been asked to give up
+        if not self._put_batch(batch):
+            return False
+        # Record that we've sent this one off, so we can write the results out in the right order
+        for archive, filename, __ in batch:
+            self._docs_processing.put((archive, filename))
+        # As soon as something's been fed, the output processor can get going
+        self.started.set()
+        return True
+
+    def _put_batch(self, batch):
+        """
+        Put a batch on the input queue, waiting until there's room. Returns False if we were
+        cancelled while waiting.
+
+        """
+        if self.transport is not None:
+            encode_start = time.monotonic()
+            batch = self.transport.encode_batch(batch, cancelled=self.cancelled)
+            if batch is None:
+                # Cancelled while waiting for space to send the batch
+                return False
+            if self.tracer is not None:
+                self.tracer.span("encode", encode_start)
+        put_start = time.monotonic()
+        while True:
+            try:
+                self.input_queue.put(batch, timeout=0.1)
+            except Full:
+                if self.cancelled.is_set():
+                    return False
+                # Otherwise try putting again
+            else:
+                if self.tracer is not None:
+                    self.tracer.span("enqueue", put_start)
+                return True
+
     def check_for_error(self):
         """
         Can be called from the main thread to check whether an error has occurred in this thread and raise a
@@ -733,7 +1530,8 @@ class InputQueueFeeder(Thread):
                 while True:
                     try:
                         q.get_nowait()
-                    except Empty:
+                    except (Empty, ValueError):
+                        # ValueError if the queue's been closed
                         break
                     except OSError:
                         # Sometime get "handle is closed" on python 3
@@ -777,10 +1575,44 @@ class DocumentProcessorPool(object):
         self.exception_queue = self.create_queue()
         self.processes = processes
         self._queues = [self.output_queue, self.input_queue, self.exception_queue]
+        # Subclasses may set this to a transport (see :mod:`~pimlico.core.modules.map.shm`) to use
+        # to send input batches to workers
+        self.input_transport = None
+        # Subclasses that enforce the executor's time limit for each document set this to the limit
+        # and in_flight to a dict for the input feeder to keep the documents in (see InputQueueFeeder)
+        self.doc_timeout = None
+        self.in_flight = None
+        # Subclasses that can reduce their memory use set this to a MemoryThrottle for the input feeder
+        # (see :mod:`.memory`)
+        self.memory_throttle = None
 
     def notify_no_more_inputs(self):
         pass
 
+    def get_output(self):
+        """
+        Wait for the next output from the workers, usually a :class:`ProcessOutput`, and return it.
+        If a worker has an error while we're waiting, raises a :class:`ModuleExecutionError`.
+
+        Subclasses should override this to wait without polling, where their type of queue allows.
+
+        """
+        while True:
+            try:
+                return qget(self.output_queue, timeout=0.2)
+            except Empty:
+                # Timed out: check there's not been an error in one of the processes
+                check_worker_errors(self)
+
+    def flush_batches(self):
+        """
+        Called when no more inputs will be sent for the time being, so any workers that are waiting
+        to fill up a batch should process what they've got. Subclasses whose workers process
+        documents in batches should pass this on to them.
+
+        """
+        pass
+
     @staticmethod
     def create_queue(maxsize=None):
         """
@@ -803,7 +1635,8 @@ class DocumentProcessorPool(object):
             while True:
                 try:
                     q.get_nowait()
-                except Empty:
+                except (Empty, ValueError):
+                    # ValueError if the queue's been closed
                     break
                 except OSError:
                     # This happens sometimes when emptying the queue
@@ -817,11 +1650,189 @@ class DocumentMapProcessMixin(object):
     Mixin/base class that should be implemented by all worker processes for document map pools.
 
     """
+    #: If processing several documents at once (`docs_per_batch` > 1), limit on the total size
+    #: of each batch in bytes. Can be set by a subclass or in `set_up()`
+    batch_bytes = None
+    #: Likewise, limit on the total number of tokens in each batch. Documents whose type can't
+    #: count its tokens count their length in bytes instead
+    batch_tokens = None
+    #: If > 1, this many batches' worth of documents are collected before processing and divided
+    #: into batches of documents of similar sizes. The outputs are still in the input order
+    bucket_batches = 1
+
     def __init__(self, input_queue, output_queue, exception_queue, docs_per_batch=1):
         self.docs_per_batch = docs_per_batch
         self.exception_queue = exception_queue
         self.output_queue = output_queue
         self.input_queue = input_queue
+        # Subclasses may set this to adapt the batch size: see get_batch_size()
+        self.batch_sizer = None
+        # Sizes of the documents in the input buffer, if batches are limited by size
+        self._buffer_sizes = []
+        # Subclasses may set this to a WorkerProgress to record what's being processed (see timeouts)
+        self.progress = None
+        # Workers for any filter modules fused into this module, with their stages: see set_up_fused_stages()
+        self.fused_stage_workers = []
+
+    def get_batch_size(self):
+        """
+        Number of documents to buffer before processing them together with `process_documents()`.
+        This is `docs_per_batch`, unless the worker has a batch sizer
+        (see :meth:`DocumentMapModuleExecutor.create_worker_batch_sizer`), in which case fewer may be
+        used if batches are taking a long time to process or getting very big.
+
+        """
+        if self.batch_sizer is None or self.docs_per_batch <= 1:
+            return self.docs_per_batch
+        # Modules may set docs_per_batch in set_up(), so check it every time
+        self.batch_sizer.max_size = self.batch_sizer.initial_size = self.docs_per_batch
+        return self.batch_sizer.size
+
+    @property
+    def tracer(self):
+        """
+        The executor's :class:`~pimlico.core.modules.map.trace.MapTracer`, if it's recording a timeline.
+
+        """
+        return getattr(getattr(self, "executor", None), "tracer", None)
+
+    @property
+    def resources(self):
+        """
+        The read-only resources loaded once for all workers by the executor's `load_resources()`.
+
+        """
+        return self.executor.resources
+
+    def _sized_batches(self):
+        return self.docs_per_batch > 1 and (
+            self.batch_bytes is not None or self.batch_tokens is not None or self.bucket_batches > 1)
+
+    def _input_size(self, input_tuple):
+        docs = input_tuple[2:]
+        return document_bytes(docs), (document_tokens(docs) if self.batch_tokens is not None else 0)
+
+    def buffer_input(self, input_buffer, input_tuple):
+        """
+        Add an input tuple to the buffer of documents waiting to be processed and return True if
+        the buffer is now full, so should be processed.
+
+        The buffer is full when it has `get_batch_size()` documents or, if a limit is set on the
+        size of batches (`batch_bytes` or `batch_tokens`), when they reach that size. With
+        bucketing (`bucket_batches`), several batches' worth are collected.
+
+        """
+        input_buffer.append(input_tuple)
+        if not self._sized_batches():
+            return len(input_buffer) >= self.get_batch_size()
+
+        self._buffer_sizes.append(self._input_size(input_tuple))
+        buckets = max(self.bucket_batches, 1)
+        if len(input_buffer) >= self.get_batch_size() * buckets:
+            return True
+        for i, max_size in enumerate([self.batch_bytes, self.batch_tokens]):
+            if max_size is not None and sum(size[i] for size in self._buffer_sizes) >= max_size * buckets:
+                return True
+        return False
+
+    def _process_batch(self, input_buffer):
+        """
+        Process a batch of buffered input documents, measuring how long it takes, and return
+        a list of :class:`ProcessOutput` s, in the same order as the inputs.
+
+        If batches are limited by size or bucketed, the buffer is first divided into batches
+        (see :func:`~pimlico.core.modules.map.batching.split_batches`), which are processed in turn.
+
+        """
+        sizes = self._buffer_sizes
+        self._buffer_sizes = []
+        if not self._sized_batches():
+            return self._process_documents_timed(input_buffer)
+
+        if len(sizes) != len(input_buffer):
+            # The inputs weren't added with buffer_input(), so we've not seen their sizes yet
+            sizes = [self._input_size(input_tuple) for input_tuple in input_buffer]
+        outputs = [None] * len(input_buffer)
+        for batch in split_batches(sizes, self.get_batch_size(), (self.batch_bytes, self.batch_tokens),
+                                   bucket=self.bucket_batches > 1):
+            batch_outputs = self._process_documents_timed([input_buffer[position] for position in batch])
+            for position, output in zip(batch, batch_outputs):
+                outputs[position] = output
+        return outputs
+
+    def _process_documents_timed(self, input_buffer):
+        start_time = time.time()
+        if self.progress is None:
+            results = self._process_documents_fused(input_buffer)
+        else:
+            # Let the pool see what we're working on, in case we get stuck
+            self.progress.started([(input_tuple[0], input_tuple[1]) for input_tuple in input_buffer])
+            try:
+                results = self._process_documents_fused(input_buffer)
+            finally:
+                self.progress.finished()
+        time_per_doc = (time.time() - start_time) / max(len(input_buffer), 1)
+        if self.batch_sizer is not None:
+            self.batch_sizer.record_time(time_per_doc)
+            self.batch_sizer.record_bytes(sum(document_bytes(input_tuple[2:]) for input_tuple in input_buffer),
+                                          num_docs=len(input_buffer))
+        return [ProcessOutput(input_tuple[0], input_tuple[1], result, processing_time=time_per_doc)
+                for input_tuple, result in zip(input_buffer, results)]
+
+    def _process_documents_fused(self, input_buffer):
+        """
+        Pass the documents through the processing of any fused filter modules and then
+        our own `process_documents()`. Documents that come out of a filter invalid skip the
+        rest of the processing and are returned as they are.
+
+        """
+        if not self.fused_stage_workers:
+            return self.process_documents(input_buffer)
+        tracer = self.tracer
+        results = [None] * len(input_buffer)
+        positions = list(range(len(input_buffer)))
+        for stage, worker in self.fused_stage_workers:
+            next_buffer = []
+            next_positions = []
+            stage_start = time.monotonic()
+            stage_outputs = worker._process_batch(input_buffer)
+            if tracer is not None:
+                tracer.span("filter", stage_start, module=stage.executor.info.module_name, docs=len(input_buffer))
+            for position, output in zip(positions, stage_outputs):
+                doc = stage.output_document(output.data)
+                if is_invalid_doc(doc):
+                    results[position] = doc
+                else:
+                    next_buffer.append((output.archive, output.filename, doc))
+                    next_positions.append(position)
+            input_buffer, positions = next_buffer, next_positions
+            if len(input_buffer) == 0:
+                return results
+        for position, result in zip(positions, self.process_documents(input_buffer)):
+            results[position] = result
+        return results
+
+    def set_up_fused_stages(self):
+        """
+        Called by the worker after `set_up()`, to set up a worker for each filter module fused into
+        this module (see :meth:`DocumentMapModuleExecutor.fuse_filter_chain`).
+
+        """
+        stages = getattr(getattr(self, "executor", None), "fused_stages", None)
+        if not stages:
+            return
+        for stage in stages:
+            worker = stage.create_worker()
+            worker.set_up()
+            self.fused_stage_workers.append((stage, worker))
+        if self.docs_per_batch == 1:
+            # We don't process batches ourselves, but a fused filter might
+            self.docs_per_batch = max(worker.docs_per_batch for (stage, worker) in self.fused_stage_workers)
+
+    def tear_down_fused_stages(self):
+        for stage, worker in self.fused_stage_workers:
+            worker.tear_down()
+        self.fused_stage_workers = []
 
     def set_up(self):
         """
@@ -858,6 +1869,58 @@ class DocumentMapProcessMixin(object):
         """
         pass
 
+    def request_flush(self):
+        """
+        Called when there won't be any more inputs for a while, so any partially filled batch
+        should be processed without waiting for more.
+        """
+        pass
+
+
+class InlineMapWorker(DocumentMapProcessMixin):
+    """
+    Does a document map module's processing for another module's worker, in whatever thread
+    or process that worker's running in, instead of taking documents from a queue itself. Used
+    to run filter modules fused into the workers of the module that uses their output.
+
+    The worker is created, set up and torn down by the other worker, which calls `_process_batch()`
+    to process documents.
+
+    """
+    def __init__(self, executor, docs_per_batch=1):
+        DocumentMapProcessMixin.__init__(self, None, None, None, docs_per_batch=docs_per_batch)
+        self.executor = executor
+        self.info = executor.info
+
+
+def inline_worker_type(process_document_fn, worker_set_up_fn=None, worker_tear_down_fn=None, batch_docs=None,
+                       batch_bytes=None, batch_tokens=None, bucket_batches=1):
+    """
+    Define a subclass of :class:`InlineMapWorker` that processes documents in the same way as
+    the workers made by the executor factory functions, given the same arguments.
+
+    """
+    class FactoryMadeInlineWorker(InlineMapWorker):
+        def __init__(self, executor):
+            super(FactoryMadeInlineWorker, self).__init__(executor, docs_per_batch=batch_docs or 1)
+
+        def set_up(self):
+            if worker_set_up_fn is not None:
+                worker_set_up_fn(self)
+
+        def tear_down(self):
+            if worker_tear_down_fn is not None:
+                worker_tear_down_fn(self)
+
+    if batch_docs is not None:
+        FactoryMadeInlineWorker.process_documents = process_document_fn
+        FactoryMadeInlineWorker.batch_bytes = batch_bytes
+        FactoryMadeInlineWorker.batch_tokens = batch_tokens
+        FactoryMadeInlineWorker.bucket_batches = bucket_batches
+    else:
+        FactoryMadeInlineWorker.process_document = process_document_fn
+    return FactoryMadeInlineWorker
+
 
 class WorkerStartupError(Exception):
     def __init__(self, *args, **kwargs):
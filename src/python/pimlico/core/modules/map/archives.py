@@ -0,0 +1,188 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Archive-parallel execution of document map modules.
+
+In the standard execution of a document map module, every document passes through the main
+process: it's read from the input corpora, sent to a worker, and the result sent back
+to the main process to be written to the output. With many workers and fast processing,
+the main process becomes the bottleneck.
+
+In archive-parallel execution, each worker process is given whole input archives. It
+reads the documents itself, processes them and writes the corresponding output archives,
+so that no documents are sent between processes. The main process just hands out
+archives and records the workers' progress, so that execution can be resumed if it's
+interrupted.
+
+This is turned on by the local config setting ``map_archive_parallel``. It is used by
+executors that use multiprocessing workers (see :mod:`.multiproc`), whenever more
+than one process is being used and the input has more than one archive.
+
+"""
+from __future__ import absolute_import
+
+import signal
+import sys
+import time
+
+from pimlico.core.modules.map import ArchiveProgress, ExceptionWithTraceback, WorkerShutdownError, \
+    get_output_datatypes, prepare_outputs
+from pimlico.core.modules.map.multiproc import MultiprocessingMapPool
+from pimlico.core.modules.profiling import store_process_profile
+
+
+class ArchiveMapProcessMixin(object):
+    """
+    Mixin to turn a :class:`~.multiproc.MultiprocessingMapProcess` type into a worker for
+    archive-parallel execution. The worker's set-up, tear-down and document processing
+    are all used unchanged, but instead of taking documents from its input queue, it
+    takes pairs `(archive name, number of docs to skip)` and processes the whole archive,
+    writing the results to the outputs itself, using its (forked) copies of the module's writers.
+
+    Progress is reported on the output queue with :class:`~pimlico.core.modules.map.ArchiveProgress`
+    instances. The worker keeps waiting for more archives until the pool is shut down.
+
+    """
+    #: Send progress updates at most this often (seconds), unless we're checkpointing
+    PROGRESS_INTERVAL = 0.5
+
+    def run(self):
+        # Tell the worker process to ignore SIGINT (KeyboardInterrupt) and let the pool deal with stopping things
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Document time limits aren't enforced here, so there's no need to record what we're doing
+        self.progress = None
+        try:
+            self.set_up()
+            self.set_up_fused_stages()
+            self.initialized.set()
+            try:
+                while not self.stopped.is_set():
+                    assignment = self.input_waiter.get()
+                    if assignment is None:
+                        # Woken up: check whether we've been stopped
+                        continue
+                    # Once there are no more archives, we wait here until the pool shuts down,
+                    #  so that our progress updates don't get lost when the process ends
+                    archive_name, skip = assignment
+                    self.map_archive(archive_name, skip)
+            finally:
+                try:
+                    self.tear_down_fused_stages()
+                    self.tear_down()
+                except Exception as e:
+                    self.exception_queue.put(WorkerShutdownError("error in tear_down() call", cause=e), block=True)
+        except Exception as e:
+            error = ExceptionWithTraceback(e, sys.exc_info()[2])
+            self.exception_queue.put(error, block=True)
+        finally:
+            # We might get terminated once we've ended, before any profile is stored at exit
+            store_process_profile()
+            self.initialized.set()
+            self.ended.set()
+
+    def map_archive(self, archive_name, skip=0):
+        """
+        Process all the documents in an input archive, after the first `skip`, and write the
+        results to the output archives.
+
+        """
+        executor = self.executor
+        writers = executor.info.get_writers()
+        output_datatypes = get_output_datatypes(executor)
+        docs = executor.input_iterator.shard_iter((archive_name, skip, None))
+
+        completed = skip
+        processed = 0
+        docs_since_checkpoint = 0
+        last_checkpoint = last_update = time.time()
+        written_before = [writer.doc_count for writer in writers]
+        # If we're continuing an archive that was partially written, the first docs might already be there
+        first_output = True
+
+        def _send_progress(completed=None, finished=False):
+            written = [writer.doc_count - before for (writer, before) in zip(writers, written_before)]
+            self.output_queue.put(ArchiveProgress(archive_name, processed, written,
+                                                  completed=completed, finished=finished))
+            return [writer.doc_count for writer in writers]
+
+        try:
+            for input_buffer in _batches(docs, self):
+                if self.stopped.is_set():
+                    # Give up and leave the archive unfinished
+                    return
+                for output in self._process_batch(input_buffer):
+                    outputs = prepare_outputs(executor, output.data, output_datatypes)
+                    duplicate = executor.write_outputs(writers, archive_name, output.filename, outputs,
+                                                       allow_duplicates=first_output)
+                    if first_output and not duplicate:
+                        first_output = False
+                completed += len(input_buffer)
+                processed += len(input_buffer)
+                docs_since_checkpoint += len(input_buffer)
+
+                now = time.time()
+                if docs_since_checkpoint >= executor.checkpoint_docs or \
+                        now - last_checkpoint >= executor.checkpoint_seconds:
+                    # Make sure everything so far is on disk before telling the main process it can be recorded
+                    for writer in writers:
+                        writer.flush()
+                    written_before = _send_progress(completed=completed)
+                    processed = docs_since_checkpoint = 0
+                    last_checkpoint = last_update = now
+                elif now - last_update >= self.PROGRESS_INTERVAL:
+                    written_before = _send_progress()
+                    processed = 0
+                    last_update = now
+        finally:
+            for writer in writers:
+                writer.close_archive()
+        _send_progress(completed=completed, finished=True)
+
+
+def _batches(docs, worker):
+    """
+    Group the documents from an aligned corpus iterator into input tuples for process_documents(),
+    using the worker's `buffer_input()` to decide how many to put in each batch.
+
+    """
+    batch = []
+    for archive, doc_name, input_docs in docs:
+        if worker.buffer_input(batch, tuple([archive, doc_name] + input_docs)):
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+
+_archive_worker_types = {}
+
+
+def archive_worker_type(process_type):
+    """
+    Get a worker type for archive-parallel execution, based on the given
+    :class:`~.multiproc.MultiprocessingMapProcess` subclass.
+
+    """
+    if process_type not in _archive_worker_types:
+        _archive_worker_types[process_type] = type(
+            "Archive{}".format(process_type.__name__), (ArchiveMapProcessMixin, process_type), {}
+        )
+    return _archive_worker_types[process_type]
+
+
+class ArchiveMapPool(MultiprocessingMapPool):
+    """
+    Pool of workers for archive-parallel execution. Uses the same worker type as the executor's
+    normal multiprocessing pool, modified by :class:`ArchiveMapProcessMixin`.
+
+    """
+    USE_INPUT_TRANSPORT = False
+    ENFORCE_DOC_TIMEOUT = False
+    # The workers read their own input, so there's nothing to hold back
+    THROTTLE_MEMORY = False
+
+    def __init__(self, executor, processes, process_type):
+        self.PROCESS_TYPE = archive_worker_type(process_type)
+        super(ArchiveMapPool, self).__init__(executor, processes)
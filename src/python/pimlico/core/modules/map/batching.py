@@ -0,0 +1,175 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Adaptive sizing of the batches of documents that are passed around during document map execution.
+
+Documents are sent from the main process to the workers in batches, to reduce the overhead of the
+queue. Some workers also process several documents at once (see `docs_per_batch`). The best size
+for these batches depends on how long documents take to process and how big they are: with tiny
+documents, small batches spend most of their time in the queue, whilst with huge documents, big
+batches use a lot of memory and leave some workers idle while others finish big batches.
+
+A :class:`BatchSizer` measures the processing time and size of documents as they go past and
+chooses a batch size that should take about a target time to process, between some bounds.
+
+Adaptive sizing can be turned off with the local config setting ``map_adaptive_batches=false``,
+in which case the fixed defaults are used, which makes the batching reproducible.
+See :doc:`/core/local_config`.
+
+Workers that process several documents at once can also limit the total size of each batch, in
+bytes or tokens, and group documents of similar lengths into the same batch (see
+:func:`split_batches`). This helps with models that pad every document in a batch to the length
+of the longest.
+
+"""
+from __future__ import division
+
+from builtins import object
+
+
+class BatchSizer(object):
+    """
+    Chooses a batch size so that a batch should take about `target_seconds` to process, based
+    on measurements of the processing time per document, and so that it shouldn't be more than
+    `max_bytes` in size (if given), based on measurements of document size. The size is always
+    between `min_size` and `max_size`. Until there are any measurements, `initial_size` is used.
+
+    Measurements are smoothed, so that the size adapts to changes in the documents, but doesn't
+    jump about from one batch to the next.
+
+    Measurements may be recorded in one thread while the size is used in another.
+
+    """
+    def __init__(self, target_seconds, min_size=1, max_size=1000, max_bytes=None, initial_size=10, smoothing=0.2):
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.initial_size = initial_size
+        self.smoothing = smoothing
+        self.fixed = False
+
+        self.seconds_per_doc = None
+        self.bytes_per_doc = None
+
+    @staticmethod
+    def fixed_size(size):
+        """
+        Create a sizer that always gives the same size, ignoring any measurements.
+
+        """
+        sizer = BatchSizer(None, min_size=size, max_size=size, initial_size=size)
+        sizer.fixed = True
+        return sizer
+
+    def _update(self, old, new):
+        if old is None:
+            return new
+        return (1. - self.smoothing) * old + self.smoothing * new
+
+    def record_time(self, seconds, num_docs=1):
+        """
+        Record that `num_docs` documents were processed in `seconds` seconds.
+
+        """
+        if not self.fixed and num_docs > 0:
+            self.seconds_per_doc = self._update(self.seconds_per_doc, seconds / num_docs)
+
+    def record_bytes(self, num_bytes, num_docs=1):
+        """
+        Record that `num_docs` documents took up `num_bytes` bytes.
+
+        """
+        if not self.fixed and num_docs > 0:
+            self.bytes_per_doc = self._update(self.bytes_per_doc, num_bytes / num_docs)
+
+    @property
+    def size(self):
+        if self.fixed:
+            return self.initial_size
+        if self.seconds_per_doc is None:
+            size = self.initial_size
+        elif self.seconds_per_doc > 0.:
+            size = self.target_seconds / self.seconds_per_doc
+        else:
+            size = self.max_size
+        if self.max_bytes is not None and self.bytes_per_doc:
+            size = min(size, self.max_bytes / self.bytes_per_doc)
+        return int(max(self.min_size, min(self.max_size, size)))
+
+
+def document_bytes(docs):
+    """
+    Size of a list of documents (e.g. one from each input corpus) in bytes, counting only
+    documents whose raw data is already available, so that it's quick to compute.
+
+    """
+    total = 0
+    for doc in docs:
+        raw_data = getattr(doc, "_raw_data", None)
+        if raw_data is not None:
+            total += len(raw_data)
+    return total
+
+
+def document_tokens(docs):
+    """
+    Number of tokens in a list of documents (e.g. one from each input corpus), for documents
+    whose type can count them cheaply (see `count_tokens()` on the document). For any others,
+    the length in bytes is used instead, which is an overestimate for any text we're likely to
+    be processing, so a batch will never be larger than its token budget.
+
+    """
+    total = 0
+    for doc in docs:
+        try:
+            tokens = doc.count_tokens()
+        except AttributeError:
+            tokens = None
+        if tokens is None:
+            tokens = document_bytes([doc])
+        total += tokens
+    return total
+
+
+def split_batches(sizes, max_docs, max_sizes, bucket=False):
+    """
+    Divide a list of documents into batches, each containing no more than `max_docs` documents
+    and each of whose total size does not exceed the limits in `max_sizes`, unless a single
+    document is bigger than the limit, in which case it is put in a batch on its own.
+
+    If `bucket=True`, documents are first sorted by size, so that similar-sized documents are
+    put in the same batches. Otherwise, batches are formed from consecutive documents.
+
+    :param sizes: list giving the size of each document as a tuple, e.g. (bytes, tokens)
+    :param max_docs: maximum number of documents in a batch
+    :param max_sizes: tuple of the same length as each size, giving the limit on the total of that
+        measure in a batch, or None where there's no limit
+    :param bucket: sort by size before splitting
+    :return: list of batches, each a list of positions in `sizes`
+    """
+    positions = list(range(len(sizes)))
+    if bucket:
+        # Sort by whichever measures we have limits on, so that those are most even within batches
+        limited = [i for (i, max_size) in enumerate(max_sizes) if max_size is not None] or \
+            list(range(len(max_sizes)))
+        positions.sort(key=lambda p: tuple(sizes[p][i] for i in limited))
+
+    batches = []
+    batch = []
+    totals = [0] * len(max_sizes)
+    for position in positions:
+        new_totals = [total + size for (total, size) in zip(totals, sizes[position])]
+        if batch and (len(batch) >= max_docs or any(
+                max_size is not None and total > max_size for (total, max_size) in zip(new_totals, max_sizes))):
+            # This one doesn't fit: start a new batch
+            batches.append(batch)
+            batch = []
+            new_totals = list(sizes[position])
+        batch.append(position)
+        totals = new_totals
+    if batch:
+        batches.append(batch)
+    return batches
@@ -11,15 +11,32 @@ output to a corpus, this mode performs the document-level processing
 on the fly and yields the results in order, providing a new
 iterable (grouped) corpus for the next module, without storing anything.
 
+Since nothing is stored, the filter module is run again every time its output
+is iterated over. If the output is used by several modules, or iterated over
+several times by one module, this can be wasteful. The local config setting
+`filter_output_cache=true` turns on caching of filter outputs for the duration
+of a run: see :class:`FilterOutputCache`.
+
+When filter modules are chained, each one would normally be run by its own pool of
+workers, taking documents from the previous one. Instead, the chain is fused into the
+workers of the module that uses its output, so that each document passes through
+all of the filters' processing in one go: see :func:`fuse_filter_chain`.
+
 """
 from builtins import object
 
+import atexit
+import os
+import shutil
+import tempfile
+from collections import deque
 from traceback import format_exc
 
 from pimlico.core.config import PipelineStructureError
 from pimlico.core.modules.base import BaseModuleInfo, satisfies_typecheck
 from pimlico.core.modules.execute import ModuleExecutionError
-from pimlico.core.modules.map import DocumentMapModuleInfo, DocumentMapper
+from pimlico.core.modules.options import str_to_bool
+from pimlico.core.modules.map import DocumentMapModuleInfo, DocumentMapper, get_output_datatypes, prepare_outputs
 from pimlico.datatypes import IterableCorpus, DatatypeLoadError
 from pimlico.datatypes.corpora import is_invalid_doc
 from pimlico.datatypes.corpora.grouped import AlignedGroupedCorpora, GroupedCorpus
@@ -32,6 +49,8 @@ class FilterModuleOutputReader(GroupedCorpus.Reader):
 
     """
     metadata = {}
+    # Documents are produced on the fly by a single run of the wrapped module, so can't be processed in shards
+    shardable = False
 
     def __init__(self, datatype, setup, pipeline, **kwargs):
         # Don't call GroupedCorpus init, but jump up to IterableCorpus
@@ -56,12 +75,29 @@ class FilterModuleOutputReader(GroupedCorpus.Reader):
             yield archive, doc_name
 
     def archive_iter(self, start_after=None, skip=None, name_filter=None):
-        # Get hold of the outputs from the previous modules to iterate over them
         output_num = self.setup.output_num
+        cache = self.setup.output_cache
+        if cache is not None and cache.enabled:
+            # The cache decides whether to run the module or use its stored/shared outputs
+            outputs = cache.iter_outputs(self._run_wrapped_module, output_num,
+                                         start_after=start_after, skip=skip, name_filter=name_filter)
+        else:
+            outputs = self._run_wrapped_module(start_after=start_after, skip=skip, name_filter=name_filter)
+
+        for archive, doc_name, next_output in outputs:
+            # We only take one of the outputs, if there are multiple, and yield this
+            yield archive, doc_name, next_output[output_num]
+
+    def _run_wrapped_module(self, start_after=None, skip=None, name_filter=None):
+        """
+        Run the wrapped module's processing on the fly, yielding all of its outputs for each document.
 
+        """
         # Load an executor for the module we're wrapping, so we can use some of its functionality
         executor_cls = self.setup.wrapped_module_info.load_executor()
         executor = executor_cls(self.setup.wrapped_module_info)
+        # If our input comes from other filters, run them in the same workers
+        executor.fuse_filter_chain()
 
         # Call the set-up routine, if one's been defined
         executor.log.info(
@@ -73,7 +109,7 @@ class FilterModuleOutputReader(GroupedCorpus.Reader):
         try:
             # Inputs will be taken from this as they're needed
             input_iter = iter(
-                self.input_iterator.archive_iter(start_after=start_after, skip=skip, name_filter=name_filter)
+                executor.input_iterator.archive_iter(start_after=start_after, skip=skip, name_filter=name_filter)
             )
 
             # Set map processing going, using the generic function
@@ -86,8 +122,7 @@ class FilterModuleOutputReader(GroupedCorpus.Reader):
                 if mapper.input_feeder.check_invalid(archive, doc_name):
                     invalid_inputs += 1
 
-                # We only take one of the outputs, if there are multiple, and yield this
-                yield archive, doc_name, next_output[output_num]
+                yield archive, doc_name, next_output
         except Exception as e:
             # Any other uncaught exception should be passed up as a ModuleExecutionError, since we're actually
             #  executing a module here, even though we're pretending to iterate over data
@@ -109,9 +144,10 @@ class FilterModuleOutputReader(GroupedCorpus.Reader):
             ))
 
     class Setup(object):
-        def __init__(self, datatype, wrapped_module_info, output_name):
+        def __init__(self, datatype, wrapped_module_info, output_name, output_cache=None):
             self.wrapped_module_info = wrapped_module_info
             self.output_name = output_name
+            self.output_cache = output_cache
             self.datatype = datatype
             # Work out which index the named output is, among the outputs that will
             # be provided by each document's processing call
@@ -132,6 +168,61 @@ class FilterModuleOutputReader(GroupedCorpus.Reader):
         return
 
 
+class FusedFilterStage(object):
+    """
+    A filter module whose processing is done in the workers of the module that uses its output,
+    as one stage of a fused chain of filters. See :func:`fuse_filter_chain`.
+
+    :param executor: executor for the filter module, which is prepared and finished off by the
+        executor that uses it, but never executed itself
+    :param output_num: which of the module's outputs is used
+    """
+    def __init__(self, executor, output_num):
+        self.executor = executor
+        self.output_num = output_num
+        self.output_datatypes = get_output_datatypes(executor)
+
+    def create_worker(self):
+        return self.executor.INLINE_WORKER_TYPE(self.executor)
+
+    def output_document(self, result):
+        """
+        Convert the result of the filter's processing of a document to the output document that's used.
+
+        """
+        return prepare_outputs(self.executor, result, self.output_datatypes)[self.output_num]
+
+
+def fuse_filter_chain(input_corpora):
+    """
+    Work out which of the filter modules that provide a document map module's input can be fused into its
+    workers. If the module has a single input, which comes from a document map module used as a filter
+    that can do its processing in another module's workers (see
+    :class:`~pimlico.core.modules.map.InlineMapWorker`), its processing becomes a stage to be run in this
+    module's workers. If that module's input comes from another such filter, the chain continues.
+
+    The chain stops at any filter whose output is cached (see :class:`FilterOutputCache`), since the
+    cache needs to run the filter itself.
+
+    :param input_corpora: the module's input corpus readers
+    :return: the list of :class:`FusedFilterStage` s, in the order they should be applied, and the
+        input corpora to read instead, which are the inputs to the first filter in the chain
+    """
+    stages = []
+    while len(input_corpora) == 1 and isinstance(input_corpora[0], FilterModuleOutputReader):
+        setup = input_corpora[0].setup
+        if setup.output_cache is not None and setup.output_cache.enabled:
+            break
+        module_info = setup.wrapped_module_info
+        executor_cls = module_info.load_executor()
+        if getattr(executor_cls, "INLINE_WORKER_TYPE", None) is None:
+            # This module's processing can only be done by its own workers
+            break
+        stages.insert(0, FusedFilterStage(executor_cls(module_info), setup.output_num))
+        input_corpora = input_corpora[0].input_corpora
+    return stages, input_corpora
+
+
 def wrap_module_info_as_filter(module_info_instance):
     """
     Create a filter module from a document map module so that it gets executed on the fly to provide its
@@ -175,7 +266,8 @@ def wrap_module_info_as_filter(module_info_instance):
         module_supports_python2 = module_info_instance.module_supports_python2
 
         def instantiate_output_reader_setup(self, output_name, datatype):
-            return FilterModuleOutputReader.Setup(datatype, module_info_instance, output_name)
+            return FilterModuleOutputReader.Setup(datatype, module_info_instance, output_name,
+                                                  output_cache=self.output_cache)
 
     info = ModuleInfo(
         module_info_instance.module_name,
@@ -186,4 +278,216 @@ def wrap_module_info_as_filter(module_info_instance):
     )
     # Pass through module variables
     info.module_variables = module_info_instance.module_variables
+    # All readers of the filter's outputs share this, so that they can share the outputs
+    info.output_cache = FilterOutputCache(module_info_instance)
     return info
+
+
+class FilterOutputCache(object):
+    """
+    Memoises the outputs of a filter module for the duration of a run, so that the
+    filter's processing doesn't need to be repeated every time its output is used.
+
+    This is only used if `filter_output_cache=true` is given in the local config.
+    There are two parts to it:
+
+    - When multiple readers of the filter's outputs start iterating over them at
+      the same time (e.g. when a module takes two of the filter's outputs as
+      aligned inputs), they share a single run of the filter module: its outputs
+      are teed to all of them.
+    - The first time the filter's outputs are iterated over in full, all its outputs
+      are written to disk as Pimarc-based grouped corpora in a temporary directory.
+      Later iterations, by the same or other modules, read from here.
+
+    If the cached data grows bigger than `filter_output_cache_max_mb` (default 1024MB),
+    caching is abandoned and the partial cache deleted. The cache is stored under
+    `filter_output_cache_dir` (default: the system temporary directory) and is removed
+    at the end of the run.
+
+    """
+    #: Number of documents produced after which new readers can no longer join in iterating over a shared run
+    #: of the filter module. Joining is only needed to catch readers that start iterating at the same time, so
+    #: this can be small
+    JOIN_WINDOW = 100
+
+    def __init__(self, module_info):
+        self.module_info = module_info
+        local_config = module_info.pipeline.local_config
+        self.enabled = str_to_bool(local_config.get("filter_output_cache", "false"))
+        self.max_size = int(float(local_config.get("filter_output_cache_max_mb", 1024)) * 1024 * 1024)
+        self.cache_root = local_config.get("filter_output_cache_dir", None)
+
+        self.cache_dir = None
+        # Set once a complete set of outputs has been stored
+        self.complete = False
+        # Set if we go over the size limit, so we don't try again
+        self.abandoned = False
+        # Shared run of the module currently being iterated over, if any
+        self._tee = None
+
+    @property
+    def output_names(self):
+        return self.module_info.get_grouped_corpus_output_names()
+
+    def iter_outputs(self, run_fn, output_num, start_after=None, skip=None, name_filter=None):
+        """
+        Iterate over the filter module's outputs, using stored outputs if available,
+        joining an iteration that's just been started, or running the module.
+
+        :param run_fn: function to run the module, yielding (archive, doc_name, outputs)
+        :param output_num: output that the caller is interested in
+        """
+        if self.complete:
+            # Everything's already been computed: just read from the cache
+            # Only the output we need is read, so fill the others with None
+            num_outputs = len(self.output_names)
+            reader = self._get_cached_reader(output_num)
+            for archive, doc_name, doc in reader.archive_iter(start_after=start_after, skip=skip,
+                                                              name_filter=name_filter):
+                outputs = [None] * num_outputs
+                outputs[output_num] = doc
+                yield archive, doc_name, tuple(outputs)
+        elif start_after is not None or skip is not None or name_filter is not None:
+            # Not iterating over the whole output, so we can't share or store it
+            for item in run_fn(start_after=start_after, skip=skip, name_filter=name_filter):
+                yield item
+        else:
+            if self._tee is None or not self._tee.can_join():
+                # Start a new run of the module, storing the output as we go
+                self._tee = _FilterOutputTee(self._run_and_store(run_fn), self.JOIN_WINDOW)
+            for item in self._tee.new_consumer():
+                yield item
+
+    def _run_and_store(self, run_fn):
+        """
+        Run the module over all its input, storing all outputs in the cache if possible.
+
+        """
+        if self.abandoned:
+            # Already tried to store the output and it was too big, so don't bother this time
+            for item in run_fn():
+                yield item
+            return
+
+        cache_dir = tempfile.mkdtemp(prefix="pimlico_filter_{}_".format(self.module_info.module_name),
+                                     dir=self.cache_root)
+        # Make sure the cache is removed at the end, even if something goes wrong
+        atexit.register(shutil.rmtree, cache_dir, True)
+        writers = [
+            self.module_info.get_output_datatype(name)[1].get_writer(
+                os.path.join(cache_dir, name), self.module_info.pipeline
+            ) for name in self.output_names
+        ]
+        for writer in writers:
+            writer.__enter__()
+        storing = True
+        stored_size = 0
+        complete = False
+        try:
+            for archive, doc_name, outputs in run_fn():
+                if storing:
+                    for writer, doc in zip(writers, outputs):
+                        writer.add_document(archive, doc_name, doc)
+                        stored_size += len(doc.raw_data)
+                    if stored_size > self.max_size:
+                        self.module_info.pipeline.log.warning(
+                            "Filter output cache for {} exceeded the size limit ({:,}MB): no longer caching".format(
+                                self.module_info.module_name, self.max_size // (1024 * 1024)))
+                        storing = False
+                        self.abandoned = True
+                yield archive, doc_name, outputs
+            complete = True
+        finally:
+            for writer in writers:
+                writer.__exit__(None, None, None)
+            if storing and complete:
+                self.cache_dir = cache_dir
+                self.complete = True
+            else:
+                # Interrupted or too big: throw away the partial cache
+                shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def _get_cached_reader(self, output_num):
+        output_name = self.output_names[output_num]
+        datatype = self.module_info.get_output_datatype(output_name)[1]
+        return datatype([os.path.join(self.cache_dir, output_name)])(self.module_info.pipeline)
+
+    def cleanup(self):
+        """
+        Remove any stored outputs. This is done automatically at the end of the run.
+
+        """
+        if self.cache_dir is not None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.cache_dir = None
+        self.complete = False
+
+
+class _FilterOutputTee(object):
+    """
+    Shares a single iterator between multiple consumers, which may start iterating at
+    slightly different times. Consumers can join as long as no more than `join_window`
+    items have been produced, and get all items from the start.
+
+    Items are buffered for each consumer until it takes them, so consumers should
+    progress through the items at about the same rate (e.g. aligned iteration over
+    multiple outputs).
+
+    """
+    def __init__(self, source, join_window):
+        self.source = source
+        self.join_window = join_window
+        # Items produced so far, kept so that new consumers can catch up, until the join window is exceeded
+        self.history = []
+        self.buffers = []
+        self.finished = False
+        self.error = None
+
+    def can_join(self):
+        return self.history is not None and not self.finished and self.error is None
+
+    def new_consumer(self):
+        buffer = deque(self.history)
+        self.buffers.append(buffer)
+        return self._consume(buffer)
+
+    def _consume(self, buffer):
+        try:
+            while True:
+                if buffer:
+                    yield buffer.popleft()
+                elif self.error is not None:
+                    raise self.error
+                elif self.finished:
+                    return
+                else:
+                    self._advance()
+        finally:
+            self.buffers.remove(buffer)
+            if len(self.buffers) == 0 and not self.finished:
+                # Nobody's iterating any more: stop the source, so it can clean up
+                self.history = None
+                if hasattr(self.source, "close"):
+                    self.source.close()
+
+    def _advance(self):
+        try:
+            item = next(self.source)
+        except StopIteration:
+            self.finished = True
+            self.history = None
+            return
+        except Exception as e:
+            # Other consumers will get the same error
+            self.error = e
+            self.history = None
+            raise
+
+        for buffer in self.buffers:
+            buffer.append(item)
+        if self.history is not None:
+            if len(self.history) < self.join_window:
+                self.history.append(item)
+            else:
+                # Too late for new consumers to join now
+                self.history = None
@@ -0,0 +1,97 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+How document map modules keep within their memory budget.
+
+When a document map module has a memory budget (the special module parameter ``memory_budget``),
+its executor's :class:`~pimlico.core.modules.memory.MemoryMonitor` keeps track of the memory used by
+the main process and the workers. Multiprocessing pools respond in three steps:
+
+1. Once memory use reaches ``memory_pressure_fraction`` of the budget, the input feeder stops sending
+   documents to the workers. Documents waiting on the queues and in the reorder buffer, and the
+   workers' working memory, get freed as the documents already sent are finished and written.
+2. If memory use is still high once the workers have finished everything they were sent, the pool
+   stops one of its workers, freeing all of its memory, and carries on with the rest. This is repeated
+   as long as the pressure continues and there's more than one worker left. If there's nothing more
+   that can be done, feeding carries on as normal.
+3. If memory use goes over the budget, execution stops with a
+   :class:`~pimlico.core.modules.execute.MemoryBudgetExceeded` error before the next document is
+   written. As with any other error, the progress so far is stored, so that execution can be resumed
+   once the problem's been sorted out (e.g. with a bigger budget or fewer processes).
+
+Workers are only stopped once they're idle, so no documents are lost. Threaded pools and
+archive-parallel execution, where the workers read their own input, only take the last step.
+
+"""
+import time
+
+
+class MemoryThrottle(object):
+    """
+    Used by the input feeder to hold back input while the pool's workers are using too much
+    memory. Created by a pool whose workers can be stopped to reduce memory use.
+
+    :param pool: the pool, which must provide `retire_worker()` and a `workers` list
+    :param monitor: the executor's :class:`~pimlico.core.modules.memory.MemoryMonitor`
+    :param in_flight: dict of documents sent to the workers whose outputs haven't come back yet,
+        kept by the feeder and the pool (see :class:`~pimlico.core.modules.map.InputQueueFeeder`)
+    """
+    #: How often to check whether things have changed while waiting
+    WAIT_INTERVAL = 0.1
+
+    def __init__(self, pool, monitor, in_flight, log):
+        self.pool = pool
+        self.monitor = monitor
+        self.in_flight = in_flight
+        self.log = log
+        self.workers_retired = 0
+        # Set once we've done all we can about the current memory pressure, so we don't keep pausing
+        self._gave_up = False
+
+    def should_pause(self):
+        """
+        Checked by the feeder before every document it sends.
+
+        """
+        if not self.monitor.pressure:
+            self._gave_up = False
+            return False
+        return not self._gave_up
+
+    def wait(self, cancelled):
+        """
+        Called by the feeder once it's decided to pause: waits until the memory pressure goes away
+        or we've done what we can about it.
+
+        :param cancelled: event that's set if feeding is cancelled while we're waiting
+        :return: False if cancelled
+        """
+        self.log.info("Memory use ({:.0f}MB) is approaching the budget ({}MB): pausing input to the workers".format(
+            self.monitor.total, self.monitor.budget
+        ))
+        while True:
+            if cancelled.is_set():
+                return False
+            if not self.monitor.pressure:
+                self.log.info("Memory use back down to {:.0f}MB: resuming input".format(self.monitor.total))
+                return True
+            if len(self.in_flight) == 0:
+                # The workers have finished everything they were given and aren't holding anything
+                if self.monitor.exceeded:
+                    # Carry on, so that execution stops cleanly when the next document comes back
+                    return True
+                if len(self.pool.workers) > 1:
+                    self.pool.retire_worker()
+                    self.workers_retired += 1
+                    self.log.warning("Memory use still {:.0f}MB with no documents in progress: stopped a worker, "
+                                     "leaving {}".format(self.monitor.total, len(self.pool.workers)))
+                else:
+                    self.log.warning("Memory use still {:.0f}MB with no documents in progress and no more workers "
+                                     "can be stopped: carrying on".format(self.monitor.total))
+                    self._gave_up = True
+                # Give the monitor a chance to see the effect before we pause again
+                time.sleep(self.monitor.interval)
+                return True
+            time.sleep(self.WAIT_INTERVAL)
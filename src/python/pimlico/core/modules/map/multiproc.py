@@ -12,7 +12,9 @@ In particular, use :fun:.multiprocessing_executor_factory wherever possible.
 """
 from __future__ import absolute_import
 
+import os
 import sys
+import time
 
 from future import standard_library
 from future.utils import raise_from
@@ -22,26 +24,44 @@ from builtins import zip
 from builtins import range
 
 import multiprocessing
-from queue import Empty
+from collections import deque
+from multiprocessing.process import BaseProcess
+from queue import Empty, Full
+from time import sleep
 
 import signal
 
-from pimlico.core.modules.map import ProcessOutput, DocumentProcessorPool, DocumentMapProcessMixin, \
-    DocumentMapModuleExecutor, WorkerStartupError, WorkerShutdownError, ExceptionWithTraceback
+from pimlico.core.modules.execute import ModuleExecutionError
+from pimlico.core.modules.map import DocumentProcessorPool, DocumentMapProcessMixin, \
+    DocumentMapModuleExecutor, WorkerStartupError, WorkerShutdownError, ExceptionWithTraceback, check_worker_errors, \
+    ProcessOutput, inline_worker_type
+from pimlico.core.modules.map.memory import MemoryThrottle
+from pimlico.core.modules.map.shm import SharedMemoryBatch, create_input_transport
 from pimlico.core.modules.map.threaded import ThreadingMapThread
-from pimlico.utils.pipes import qget
+from pimlico.core.modules.map.timeouts import WorkerProgress, WorkerProgressUnknown, WorkerOutputPipe
+from pimlico.core.modules.profiling import store_process_profile
+from pimlico.datatypes.corpora import invalid_document
+from pimlico.utils.pipes import QueueWaiter, queue_wait_handle
 from .benchmark import benchmarker
 
+# Workers are always forked from the main process, whatever the default start method, so that
+#  they get a copy of its state, including the executor and anything preloaded (see preload)
+_fork_context = multiprocessing.get_context("fork")
 
-class MultiprocessingMapProcess(multiprocessing.Process, DocumentMapProcessMixin):
+
+class MultiprocessingMapProcess(_fork_context.Process, DocumentMapProcessMixin):
     """
     A base implementation of document map parallelization using multiprocessing. Note that not all document
     map modules will want to use this: e.g. if you call a background service that provides parallelization
     itself (like the CoreNLP module) there's no need for multiprocessing in the Python code.
 
     """
+    #: Set by the pool, in the main process, if the worker sends its outputs over its own pipe instead
+    #: of the output queue (see :mod:`.timeouts`)
+    output_pipe = None
+
     def __init__(self, input_queue, output_queue, exception_queue, executor, docs_per_batch=1):
-        multiprocessing.Process.__init__(self)
+        _fork_context.Process.__init__(self)
         DocumentMapProcessMixin.__init__(self, input_queue, output_queue, exception_queue,
                                          docs_per_batch=docs_per_batch)
         self.executor = executor
@@ -50,12 +70,28 @@ class MultiprocessingMapProcess(multiprocessing.Process, DocumentMapProcessMixin
         self.stopped = multiprocessing.Event()
         self.initialized = multiprocessing.Event()
         self.no_more_inputs = multiprocessing.Event()
+        self.flush_requested = multiprocessing.Event()
         self.ended = multiprocessing.Event()
+        self.batch_sizer = executor.create_worker_batch_sizer()
+        # Lets us wait for inputs without polling, but still be woken up when one of the above is set
+        self.input_waiter = QueueWaiter(input_queue)
+        if executor.doc_timeout is not None:
+            # Keep a record of what we're doing, so the pool can tell if we get stuck
+            self.progress = WorkerProgress()
 
         self.start()
 
     def notify_no_more_inputs(self):
         self.no_more_inputs.set()
+        self.input_waiter.wake()
+
+    def request_flush(self):
+        self.flush_requested.set()
+        self.input_waiter.wake()
+
+    def shutdown(self):
+        self.stopped.set()
+        self.input_waiter.wake()
 
     def run(self):
         # Tell the worker process to ignore SIGINT (KeyboardInterrupt) and let the pool deal with stopping things
@@ -64,33 +100,49 @@ class MultiprocessingMapProcess(multiprocessing.Process, DocumentMapProcessMixin
         try:
             # Run any startup routine that the subclass has defined
             self.set_up()
+            self.set_up_fused_stages()
             # Notify waiting processes that we've finished initialization
             self.initialized.set()
             input_buffer = []
             try:
                 while not self.stopped.is_set():
-                    try:
-                        # Timeout and go round the loop again to check whether we're supposed to have stopped
-                        # The queue feeds us multiple documents at a time: we don't know how many it will be
-                        with bm.wait_for_input_timer:
-                            inputs = qget(self.input_queue, timeout=0.05)
-                    except Empty:
-                        # Don't worry if the queue is empty: just keep waiting for more until we're shut down
-                        pass
+                    # Wait until there are some inputs, or the pool wakes us up to tell us something
+                    # The queue feeds us multiple documents at a time: we don't know how many it will be
+                    with bm.wait_for_input_timer:
+                        wait_start = time.monotonic()
+                        inputs = self.input_waiter.get()
+                        if self.tracer is not None:
+                            self.tracer.span("dequeue", wait_start)
+                    if inputs is None:
+                        # Woken up: go round the loop again to check whether we're supposed to have stopped
+                        # If there are no more inputs to come, don't wait to fill up the batch we've started
+                        # Likewise if the feeder's waiting for us to finish what we've got
+                        if len(input_buffer) and (self.no_more_inputs.is_set() or self.flush_requested.is_set()):
+                            self.flush_requested.clear()
+                            self._process_input_buffer(input_buffer, bm)
+                            input_buffer = []
                     else:
+                        if isinstance(inputs, SharedMemoryBatch):
+                            # The documents' data was sent via shared memory: read them out
+                            decode_start = time.monotonic()
+                            inputs = inputs.read()
+                            if self.tracer is not None:
+                                self.tracer.span("decode", decode_start, docs=len(inputs))
+                        if self.progress is not None:
+                            self.progress.received([(archive, filename) for (archive, filename, __) in inputs])
                         for archive, filename, docs in inputs:
                             # Buffer input documents, so that we can process multiple at once if requested
-                            input_buffer.append(tuple([archive, filename] + docs))
-                            if len(input_buffer) >= self.docs_per_batch or self.no_more_inputs.is_set():
-                                with bm.process_doc_timer:
-                                    results = self.process_documents(input_buffer)
-
-                                with bm.queue_output_timer:
-                                    for input_tuple, result in zip(input_buffer, results):
-                                        self.output_queue.put(ProcessOutput(input_tuple[0], input_tuple[1], result))
+                            if self.buffer_input(input_buffer, tuple([archive, filename] + docs)):
+                                self._process_input_buffer(input_buffer, bm)
                                 input_buffer = []
+                        if len(input_buffer) and (self.no_more_inputs.is_set() or self.flush_requested.is_set()):
+                            # These may be the last inputs, or the last before the feeder waits for us
+                            self.flush_requested.clear()
+                            self._process_input_buffer(input_buffer, bm)
+                            input_buffer = []
             finally:
                 try:
+                    self.tear_down_fused_stages()
                     self.tear_down()
                 except Exception as e:
                     self.exception_queue.put(WorkerShutdownError("error in tear_down() call", cause=e), block=True)
@@ -101,10 +153,32 @@ class MultiprocessingMapProcess(multiprocessing.Process, DocumentMapProcessMixin
             self.exception_queue.put(error, block=True)
         finally:
             bm_callback()
+            if self.tracer is not None:
+                # Leave our part of the timeline for the main process to collect
+                self.tracer.flush()
+            # We might get terminated once we've ended, before any profile is stored at exit
+            store_process_profile()
             # Even there was an error, set initialized so that the main process can wait on it
             self.initialized.set()
             self.ended.set()
 
+    def _process_input_buffer(self, input_buffer, bm):
+        tracer = self.tracer
+        with bm.process_doc_timer:
+            process_start = time.monotonic()
+            outputs = self._process_batch(input_buffer)
+            if tracer is not None:
+                tracer.span("process", process_start, docs=len(input_buffer))
+
+        with bm.queue_output_timer:
+            send_start = time.monotonic()
+            for output in outputs:
+                self.output_queue.put(output)
+            if tracer is not None:
+                tracer.span("send", send_start)
+        if self.progress is not None:
+            self.progress.sent(len(outputs))
+
 
 class MultiprocessingMapPool(DocumentProcessorPool):
     """
@@ -114,10 +188,40 @@ class MultiprocessingMapPool(DocumentProcessorPool):
     PROCESS_TYPE = None
     # Can specify an alternative implementation of the process type when we only need a single process
     SINGLE_PROCESS_TYPE = None
+    # Whether to send input documents to the workers using a shared-memory transport, if possible
+    USE_INPUT_TRANSPORT = True
+    # Whether to enforce the executor's time limit for each document, if it has one
+    ENFORCE_DOC_TIMEOUT = True
+    # Whether to hold back input and stop workers to keep within the executor's memory budget, if it has one
+    THROTTLE_MEMORY = True
 
     def __init__(self, executor, processes):
         super(MultiprocessingMapPool, self).__init__(processes)
         self.executor = executor
+        self._output_waiter = None
+        self._no_more_inputs = False
+        if self.ENFORCE_DOC_TIMEOUT and executor.doc_timeout is not None:
+            self.doc_timeout = executor.doc_timeout
+            self.in_flight = {}
+        # Number of docs that have timed out, outputs waiting to be returned (for them and any others
+        #  read out of stopped workers' pipes) and batches of docs recovered from timed-out workers
+        #  that need to be sent again
+        self.timed_out_docs = 0
+        self._timed_out_outputs = deque()
+        self._resend_batches = deque()
+        # Memory monitor, if there's a budget to keep within
+        self.memory = getattr(executor, "memory", None)
+        if self.memory is not None and self.memory.budget is None:
+            self.memory = None
+        if self.THROTTLE_MEMORY and self.memory is not None:
+            if self.in_flight is None:
+                # Lets us tell when the workers have nothing in progress
+                self.in_flight = {}
+            self.memory_throttle = MemoryThrottle(self, self.memory, self.in_flight, executor.log)
+        if self.USE_INPUT_TRANSPORT and not self._use_single_process_type():
+            # Send input documents to the worker processes via shared memory, if possible,
+            # instead of pickling them
+            self.input_transport = create_input_transport(executor, processes)
         if executor.SEQUENTIAL_START:
             self.workers = []
             for i in range(processes):
@@ -145,16 +249,54 @@ class MultiprocessingMapPool(DocumentProcessorPool):
                 # Retrieve the original exception with its traceback
                 e = e.exception_with_traceback()
 
+            if self.input_transport is not None:
+                self.input_transport.close()
             raise_from(
                 WorkerStartupError("error starting up worker process: %s" % e, cause=e, debugging_info=debugging_info),
                 e
             )
 
+    def _use_single_process_type(self):
+        # A thread can't be stopped if it takes too long over a document, so use a process if there's a time limit
+        return self.processes == 1 and self.SINGLE_PROCESS_TYPE is not None and self.doc_timeout is None
+
     def start_worker(self):
-        if self.processes == 1 and self.SINGLE_PROCESS_TYPE is not None:
+        if self._use_single_process_type():
             return self.SINGLE_PROCESS_TYPE(self.input_queue, self.output_queue, self.exception_queue, self.executor)
+        if self.doc_timeout is not None:
+            # Use a pipe for this worker's outputs, so that none are lost if it has to be killed
+            output_pipe = WorkerOutputPipe()
+            worker = self.PROCESS_TYPE(self.input_queue, output_pipe, self.exception_queue, self.executor)
+            output_pipe.worker_started()
+            worker.output_pipe = output_pipe
         else:
-            return self.PROCESS_TYPE(self.input_queue, self.output_queue, self.exception_queue, self.executor)
+            worker = self.PROCESS_TYPE(self.input_queue, self.output_queue, self.exception_queue, self.executor)
+        memory = getattr(self.executor, "memory", None)
+        if memory is not None:
+            # Identify the worker in the memory high-water marks
+            memory.name_process(worker.pid, worker.name)
+        return worker
+
+    def retire_worker(self):
+        """
+        Stop one of the workers, to reduce memory use, and carry on with the rest. Called by the
+        memory throttle from the input feeder's thread, only when no documents are in progress,
+        so the worker isn't holding any. See :mod:`.memory`.
+
+        """
+        worker = self.workers[-1]
+        # Take it out of the pool before stopping it, so it doesn't look like it's ended unexpectedly
+        self.workers = self.workers[:-1]
+        if self._output_waiter is not None:
+            self._update_output_waiter()
+        # It's idle, so it's already done everything we'll measure
+        self.record_worker_usage(worker)
+        worker.shutdown()
+        worker.join(timeout=3.)
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+        self._take_piped_outputs(worker)
 
     @staticmethod
     def create_queue(maxsize=0):
@@ -163,10 +305,13 @@ class MultiprocessingMapPool(DocumentProcessorPool):
         return q
 
     def shutdown(self):
+        # Measure the workers while they're still there: they've finished all their work by now
+        for worker in self.workers:
+            self.record_worker_usage(worker)
         # Tell all the threads to stop
         # Although the worker's shutdown does this too, do it to all now so they can be finishing up in the background
         for worker in self.workers:
-            worker.stopped.set()
+            worker.shutdown()
         # Empty the pool's queues, so they don't cause threads not to shut down
         self.empty_all_queues()
 
@@ -194,11 +339,194 @@ class MultiprocessingMapPool(DocumentProcessorPool):
                 self.executor.log.warn("Multiprocessing document map worker process has taken a long time to shut "
                                        "down, even after being terminated: giving up waiting. "
                                        "You may need to forcibly kill the main process")
+            if getattr(worker, "output_pipe", None) is not None:
+                worker.output_pipe.close()
+        if self.input_transport is not None:
+            # Free the shared memory
+            self.input_transport.close()
+            self.input_transport = None
+        if self.timed_out_docs:
+            self.executor.log.warning("{:,} documents timed out (time limit {}s per document) and were output as "
+                                      "invalid documents".format(self.timed_out_docs, self.doc_timeout))
+        elif self.doc_timeout is not None:
+            self.executor.log.info("No documents timed out (time limit {}s per document)".format(self.doc_timeout))
 
     def notify_no_more_inputs(self):
+        self._no_more_inputs = True
         for worker in self.workers:
             worker.notify_no_more_inputs()
 
+    def flush_batches(self):
+        for worker in self.workers:
+            worker.request_flush()
+
+    def get_output(self):
+        if self._output_waiter is None:
+            # As well as outputs, wake up if there's an error, or if a worker process ends
+            self._output_waiter = QueueWaiter(self.output_queue)
+            self._update_output_waiter()
+        if self.doc_timeout is None:
+            check_interval = None
+        else:
+            # Wake up now and again to check whether workers are taking too long
+            check_interval = min(max(self.doc_timeout / 10., 0.05), 1.)
+        if self.memory is not None:
+            # Also check whether the memory budget's been exceeded while we're waiting
+            check_interval = min(check_interval or self.memory.interval, self.memory.interval)
+        while True:
+            if len(self._timed_out_outputs):
+                output = self._timed_out_outputs.popleft()
+            else:
+                self._resend_recovered()
+                # If the workers send outputs over their own pipes, the waiter wakes up when one's ready
+                output = self._get_piped_output()
+                if output is None:
+                    output = self._output_waiter.get(timeout=check_interval)
+            if output is not None:
+                if self.in_flight is not None:
+                    self.in_flight.pop((output.archive, output.filename), None)
+                return output
+            check_worker_errors(self)
+            if self.doc_timeout is not None:
+                self.check_timeouts()
+            if self.memory is not None:
+                self.memory.check()
+            if any(isinstance(worker, BaseProcess) and not worker.is_alive() for worker in self.workers):
+                # Workers don't stop until we tell them to: give any error from it a moment to come through
+                sleep(0.5)
+                check_worker_errors(self)
+                raise ModuleExecutionError("worker process ended before processing was complete")
+
+    def record_worker_usage(self, worker):
+        """
+        Record the CPU time and peak memory use of a worker process in the executor's metrics for
+        the run. Called once it's finished its work, or is about to be killed, while it's still there
+        to measure.
+
+        """
+        metrics = getattr(self.executor, "metrics", None)
+        if metrics is not None and isinstance(worker, BaseProcess):
+            metrics.add_worker(worker.name, worker.pid)
+
+    def _update_output_waiter(self):
+        self._output_waiter.others = [queue_wait_handle(self.exception_queue)] + \
+            [worker.sentinel for worker in self.workers if isinstance(worker, BaseProcess)] + \
+            [worker.output_pipe.reader for worker in self.workers
+             if isinstance(worker, BaseProcess) and worker.output_pipe is not None and not worker.output_pipe.closed]
+
+    def _get_piped_output(self):
+        for worker in self.workers:
+            if isinstance(worker, BaseProcess) and worker.output_pipe is not None:
+                output = worker.output_pipe.get()
+                if output is not None:
+                    return output
+        return None
+
+    def _take_piped_outputs(self, worker):
+        """
+        Once a worker that sends its outputs over its own pipe has been stopped, read out
+        any outputs that are still in the pipe, to be returned before anything else.
+
+        """
+        if getattr(worker, "output_pipe", None) is not None:
+            self._timed_out_outputs.extend(worker.output_pipe.get_available())
+            worker.output_pipe.close()
+
+    def check_timeouts(self):
+        """
+        Check whether any worker has exceeded the time limit for the documents it's processing
+        and, if so, kill it and start a new one in its place. See :mod:`.timeouts`.
+
+        """
+        timed_out = []
+        for i, worker in enumerate(self.workers):
+            # Don't use the same time for all of them, since stopping each one to check takes a moment
+            if worker.progress is None or not worker.progress.overdue(self.doc_timeout):
+                continue
+            # Stop the worker while we check, so it can't finish the batch and start sending outputs
+            #  after we've decided it's timed out
+            os.kill(worker.pid, signal.SIGSTOP)
+            __, status = os.waitpid(worker.pid, os.WUNTRACED)
+            if not os.WIFSTOPPED(status):
+                raise ModuleExecutionError("worker process ended before processing was complete")
+            if worker.progress.overdue(self.doc_timeout):
+                self.kill_timed_out_worker(i)
+                timed_out.append(i)
+            else:
+                # Got there just in time
+                os.kill(worker.pid, signal.SIGCONT)
+        if len(timed_out):
+            self.replace_workers(timed_out)
+
+    def kill_timed_out_worker(self, i):
+        """
+        Kill the i-th worker, which has taken too long over its documents. The documents it was
+        processing are output as invalid, and any others it had taken from the input queue are sent
+        again. Outputs it had already sent are still returned. It should then be replaced using
+        :meth:`replace_workers`.
+
+        """
+        worker = self.workers[i]
+        self.record_worker_usage(worker)
+        worker.kill()
+        worker.join()
+        # Anything it sent before it was killed is still waiting in its pipe
+        self._take_piped_outputs(worker)
+        try:
+            timed_out, unprocessed = worker.progress.recover()
+        except WorkerProgressUnknown as e:
+            raise ModuleExecutionError("worker process timed out and was killed, but its documents could not be "
+                                       "recovered: {}".format(e))
+        self.executor.log.warning(
+            "Worker process took too long over {} (time limit {}s per document): killing it and starting "
+            "another".format(
+                ", ".join("{}/{}".format(archive, filename) for (archive, filename) in timed_out),
+                self.doc_timeout,
+            )
+        )
+        self.timed_out_docs += len(timed_out)
+        tracer = getattr(self.executor, "tracer", None)
+        if tracer is not None:
+            tracer.instant("worker timed out", pid=worker.pid, docs=len(timed_out))
+        for archive, filename in timed_out:
+            self._timed_out_outputs.append(ProcessOutput(archive, filename, invalid_document(
+                self.executor.info.module_name,
+                "Timed out: processing took longer than the time limit of {}s per document".format(self.doc_timeout)
+            )))
+        if len(unprocessed):
+            self._resend_batches.append(
+                [(archive, filename, self.in_flight[(archive, filename)]) for (archive, filename) in unprocessed]
+            )
+
+    def replace_workers(self, indices):
+        """
+        Start new workers in place of those at the given positions in the pool, which have been
+        stopped. They're all started before we wait for any of them to be set up.
+
+        """
+        for i in indices:
+            self.workers[i] = self.start_worker()
+        for i in indices:
+            self.workers[i].initialized.wait()
+        check_worker_errors(self)
+        if self._no_more_inputs:
+            for i in indices:
+                self.workers[i].notify_no_more_inputs()
+        if self._output_waiter is not None:
+            self._update_output_waiter()
+
+    def _resend_recovered(self):
+        # Send any docs recovered from timed-out workers back to the workers, if there's space on the queue
+        while len(self._resend_batches):
+            try:
+                self.input_queue.put_nowait(self._resend_batches[0])
+            except Full:
+                # Try again later: the workers will need us to take their outputs before they take more inputs
+                return
+            self._resend_batches.popleft()
+            # Don't let the workers wait for more before processing these
+            self.flush_batches()
+
     def empty_all_queues(self):
         for q in self._queues:
             q.close()
@@ -208,21 +536,30 @@ class MultiprocessingMapPool(DocumentProcessorPool):
 class MultiprocessingMapModuleExecutor(DocumentMapModuleExecutor):
     POOL_TYPE = None
     SEQUENTIAL_START = False
+    ARCHIVE_PARALLEL_SUPPORTED = True
 
     def create_pool(self, processes):
         return self.POOL_TYPE(self, processes)
 
+    def create_archive_pool(self, processes):
+        from pimlico.core.modules.map.archives import ArchiveMapPool
+        return ArchiveMapPool(self, processes, self.POOL_TYPE.PROCESS_TYPE)
+
     def postprocess(self, error=False):
-        self.pool.shutdown()
+        # There's no pool if we're only used as a stage fused into another module's workers
+        if self.pool is not None:
+            self.pool.shutdown()
 
     def wait_until_finished(self):
-        self.pool.wait_until_finished()
+        if self.pool is not None:
+            self.pool.wait_until_finished()
 
 
 def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, postprocess_fn=None,
                                      worker_set_up_fn=None, worker_tear_down_fn=None, batch_docs=None,
                                      multiprocessing_single_process=False, allow_skip_output=False,
-                                     sequential_start=False):
+                                     sequential_start=False, batch_bytes=None, batch_tokens=None, bucket_batches=1,
+                                     preload_modules=None, load_resources_fn=None, doc_timeout=None):
     """
     Factory function for creating an executor that uses the multiprocessing-based implementations of document-map
     pools and worker processes.
@@ -242,6 +579,10 @@ def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, po
     If postprocess_fn is given, it is called from the main process at the end of execution, including on the way
     out after an error, with the executor as an argument and a kwarg *error* which is True if execution failed.
 
+    If `load_resources_fn` is given, it is called from the main process after `preprocess_fn`, with the executor
+    and a dict to add resources to, to load read-only resources once for all workers, which the workers get as
+    their `resources` attribute. See :mod:`~pimlico.core.modules.map.resources`.
+
     If worker_set_up_fn is given, it is called within each worker before execution begins, with the worker process
     instance as an argument.
     Likewise, worker_tear_down_fn is called from within the worker process before it exits.
@@ -255,6 +596,11 @@ def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, po
     `docs_per_batch` is set on the worker processes, so that the given number of docs are collected from the input
     and passed into `process_documents()` at once.
 
+    With `batch_docs`, batches can also be limited to a total size of `batch_bytes` bytes or `batch_tokens` tokens,
+    so that `batch_docs` is just the maximum number of documents. If `bucket_batches` is greater than 1, this many
+    batches' worth of documents are collected at once and divided into batches of similar-sized documents.
+    See :class:`~pimlico.core.modules.map.DocumentMapProcessMixin`.
+
     By default, if only a single process is needed, we use the threaded implementation of a map process instead of
     multiprocessing. If this doesn't work out in your case, for some reason, specify
     `multiprocessing_single_process=True` and a mutiprocessing process will be used even when only creating one.
@@ -269,12 +615,20 @@ def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, po
     at once.
     Default behaviour is to set all workers running, then wait until they've all initialized.
 
+    `preload_modules` may list packages that the workers use that are slow to import. They are imported
+    once in the main process, before the workers are started (see :mod:`~pimlico.core.modules.map.preload`).
+
+    `doc_timeout` sets a default time limit in seconds for processing each document, which can be
+    overridden by the local config setting ``map_doc_timeout``. Workers that take longer are killed and
+    replaced and the documents output as invalid (see :mod:`~pimlico.core.modules.map.timeouts`).
+
     """
     if isinstance(process_document_fn, type):
         if not issubclass(process_document_fn, MultiprocessingMapProcess):
             raise TypeError("called multiprocessing_executor_factory with a worker type that's not a subclass of "
                             "MultiprocessingMapProcess: got %s" % process_document_fn.__name__)
         worker_type = process_document_fn
+        single_worker_type = inline_type = None
     else:
         # Define a worker process type
         class FactoryMadeMapProcess(MultiprocessingMapProcess):
@@ -292,6 +646,9 @@ def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, po
 
         if batch_docs is not None:
             FactoryMadeMapProcess.process_documents = process_document_fn
+            FactoryMadeMapProcess.batch_bytes = batch_bytes
+            FactoryMadeMapProcess.batch_tokens = batch_tokens
+            FactoryMadeMapProcess.bucket_batches = bucket_batches
         else:
             FactoryMadeMapProcess.process_document = process_document_fn
         worker_type = FactoryMadeMapProcess
@@ -302,6 +659,10 @@ def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, po
         else:
             # Also define a different worker thread type for use when we only need a single process
             class FactoryMadeMapSingleProcess(ThreadingMapThread):
+                def __init__(self, input_queue, output_queue, exception_queue, executor):
+                    super(FactoryMadeMapSingleProcess, self).__init__(input_queue, output_queue, exception_queue,
+                                                                      executor, docs_per_batch=batch_docs or 1)
+
                 def process_document(self, archive, filename, *docs):
                     return process_document_fn(self, archive, filename, *docs)
 
@@ -315,10 +676,18 @@ def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, po
 
             if batch_docs is not None:
                 FactoryMadeMapSingleProcess.process_documents = process_document_fn
+                FactoryMadeMapSingleProcess.batch_bytes = batch_bytes
+                FactoryMadeMapSingleProcess.batch_tokens = batch_tokens
+                FactoryMadeMapSingleProcess.bucket_batches = bucket_batches
             else:
                 FactoryMadeMapSingleProcess.process_document = process_document_fn
             single_worker_type = FactoryMadeMapSingleProcess
 
+        # Also define a worker type for running the processing in another module's workers, if used as a filter
+        inline_type = inline_worker_type(process_document_fn, worker_set_up_fn, worker_tear_down_fn,
+                                         batch_docs=batch_docs, batch_bytes=batch_bytes, batch_tokens=batch_tokens,
+                                         bucket_batches=bucket_batches)
+
     # Define a pool type to use this worker process type
     class FactoryMadeMapPool(MultiprocessingMapPool):
         PROCESS_TYPE = worker_type
@@ -329,12 +698,20 @@ def multiprocessing_executor_factory(process_document_fn, preprocess_fn=None, po
         POOL_TYPE = FactoryMadeMapPool
         ALLOW_SKIP_OUTPUT = allow_skip_output
         SEQUENTIAL_START = sequential_start
+        PRELOAD_MODULES = list(preload_modules or [])
+        DOC_TIMEOUT = doc_timeout
+        INLINE_WORKER_TYPE = inline_type
 
         def preprocess(self):
             super(ModuleExecutor, self).preprocess()
             if preprocess_fn is not None:
                 preprocess_fn(self)
 
+        def load_resources(self, resources):
+            super(ModuleExecutor, self).load_resources(resources)
+            if load_resources_fn is not None:
+                load_resources_fn(self, resources)
+
         def postprocess(self, error=False):
             super(ModuleExecutor, self).postprocess(error=error)
             if postprocess_fn is not None:
@@ -0,0 +1,75 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Preloading, in the main process, of heavy Python packages that document map workers use.
+
+The worker processes of a document map module are forked from the main process when the
+module starts and end when it finishes. Forking itself is cheap, and anything that's
+already been imported in the main process is available in the workers straight away,
+shared copy-on-write. But packages that are only imported when a worker is set up
+(for example, gensim when a worker loads a model) are imported again by every worker
+of every module that uses them.
+
+When `pimlico run` executes several modules, the main process is therefore used as a
+warm parent for all of their pools: before any workers are started, the packages
+that the module's executor names in `PRELOAD_MODULES`, plus any given in the local config
+setting ``map_preload``, are imported in the main process, where they stay for the rest of
+the run. The workers of this and any later module are forked with them already loaded.
+Module-specific state, like models, is still set up by each module's workers.
+
+This is only preloading of imports: worker processes are not kept and reused from one module
+to the next. Each module still starts its own pool and stops it when it's finished. A module's
+workers get its executor's state, including anything its preprocessing has loaded, by being
+forked once that's been done, so reusing processes would mean sending all of that to them.
+
+"""
+import importlib
+import time
+
+# Modules we've already imported in this process
+_preloaded = set()
+
+
+def preload_modules(module_names, log=None):
+    """
+    Import the named modules in this process, unless they've already been preloaded.
+    Modules that can't be imported are skipped, with a warning if a log is given: if they're
+    really needed, the module will fail when the workers try to use them.
+
+    :param module_names: names of modules to import, as you would pass to `import`
+    :param log: logger to output information about what's preloaded
+    :return: list of the names of the modules that were newly imported
+    """
+    imported = []
+    for module_name in module_names:
+        if module_name in _preloaded:
+            continue
+        # Don't try again, even if it fails
+        _preloaded.add(module_name)
+        start_time = time.time()
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            if log is not None:
+                log.warning("Could not preload {} for document map workers: {}".format(module_name, e))
+            continue
+        imported.append(module_name)
+        if log is not None:
+            log.info("Preloaded {} for document map workers in {:.1f}s".format(module_name, time.time() - start_time))
+    return imported
+
+
+def parse_preload_setting(value):
+    """
+    Parse the value of the ``map_preload`` local config setting: a comma-separated list of module names.
+
+    """
+    if value is None:
+        return []
+    module_names = [name.strip() for name in value.split(",") if name.strip()]
+    for name in module_names:
+        if not all(part.isidentifier() for part in name.split(".")):
+            raise ValueError("invalid module name in map_preload setting: '{}'".format(name))
+    return module_names
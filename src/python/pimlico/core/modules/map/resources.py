@@ -0,0 +1,97 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Read-only resources, like vocabularies, embedding matrices or models, that are loaded once
+in the main process and shared by all the workers of a document map module.
+
+If every worker loads a big resource in its set-up, it uses the memory for it once per
+process and each worker has to wait for it to load before it can start. Instead, an executor
+can load its resources once, in `load_resources()`, before the workers are started. Since the
+workers are forked from the main process, they all see the same copy, shared copy-on-write,
+so adding workers costs almost no extra memory. Workers get the resources from their
+`resources` attribute.
+
+Two things are done to stop the shared copy gradually getting copied into every worker:
+
+ - Python objects in the resources (and everything else loaded so far) are moved out of the
+   reach of the garbage collector (:func:`gc.freeze`) before the workers are forked, so that
+   collections in the workers don't write to their memory.
+ - Big numpy arrays may be put in shared memory, using :meth:`SharedResources.share_array`,
+   which returns a read-only array backed by a :mod:`multiprocessing.shared_memory` block.
+   Nothing a worker does to its Python objects then causes their data to be copied.
+
+Requires Python 3.8 or later to use shared memory. If it's not available, arrays are just
+made read-only and shared copy-on-write.
+
+"""
+import gc
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Py<3.8: arrays are shared copy-on-write instead
+    shared_memory = None
+
+
+class SharedResources(dict):
+    """
+    Dictionary of the resources loaded for a document map module's workers, which also keeps
+    track of any shared memory used by them. Call `release()` once the workers have finished.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(SharedResources, self).__init__(*args, **kwargs)
+        self._blocks = []
+        self._frozen = False
+
+    def share_array(self, array):
+        """
+        Copy a numpy array into shared memory and return a read-only array backed by it, which
+        can be used in place of the original. If shared memory isn't available, the original
+        array is made read-only and returned, to be shared copy-on-write.
+
+        """
+        import numpy
+
+        if shared_memory is None or array.nbytes == 0:
+            array.setflags(write=False)
+            return array
+        block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+        self._blocks.append(block)
+        shared = numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[...] = array
+        shared.setflags(write=False)
+        return shared
+
+    def freeze(self):
+        """
+        Called just before the workers are forked: stops the garbage collector touching
+        everything loaded so far.
+
+        """
+        if len(self) and hasattr(gc, "freeze") and not self._frozen:
+            # Collect first, so that we don't freeze garbage
+            gc.collect()
+            gc.freeze()
+            self._frozen = True
+
+    def release(self):
+        """
+        Free the shared memory and let the garbage collector deal with the resources again.
+        The resources should not be used after this.
+
+        """
+        self.clear()
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:
+                # Something still refers to an array in it: it'll be freed when that's gone
+                pass
+            block.unlink()
+        self._blocks = []
+        if self._frozen:
+            gc.unfreeze()
+            self._frozen = False
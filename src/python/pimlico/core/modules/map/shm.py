@@ -0,0 +1,194 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Shared-memory transport for sending input documents from the main process to
+multiprocessing document map workers.
+
+Normally, the input feeder puts whole batches of documents onto a multiprocessing
+queue. Every document gets pickled in the main process, sent down a pipe and
+unpickled in the worker. For large documents, the main process can end up spending
+most of its time doing this, so the workers are left waiting.
+
+Instead, the transport copies each document's raw data (the bytes read from the
+input corpus) into a block of shared memory and only puts a small descriptor onto
+the queue, saying where to find each document. The worker reads the raw data out of
+the shared memory and instantiates the document of the right type from it, so any
+decoding of the raw data happens lazily in the worker, just as it would have in
+the main process.
+
+The shared memory is split into a fixed number of slots, each of which holds one
+batch. The first bytes of the block are flags marking which slots are in use: the
+feeder sets a slot's flag when it fills it and the worker clears it once it has
+read the documents out. If there's no free slot, the feeder waits for one.
+
+Documents that don't have raw data available (e.g. those coming from filter modules
+that produce internal data) or are too big to fit in a slot are sent on the queue
+in the usual way, as are invalid documents.
+
+Requires Python 3.8 or later (for :mod:`multiprocessing.shared_memory`). If it's
+not available, the transport is not used. It can also be disabled using the local
+config setting `map_shared_memory=false`.
+
+"""
+from time import sleep
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Py<3.8: we'll just not use shared memory
+    shared_memory = None
+
+from pimlico.core.modules.options import str_to_bool
+from pimlico.datatypes.corpora import is_invalid_doc
+
+
+class SharedMemoryInputTransport(object):
+    """
+    Created in the main process by a multiprocessing pool, to pass input batches to its workers.
+    Call `close()` once the workers have finished, to free the shared memory.
+
+    """
+    DEFAULT_SLOT_SIZE = 1024 * 1024
+
+    def __init__(self, num_slots, slot_size=None):
+        self.num_slots = num_slots
+        self.slot_size = slot_size or self.DEFAULT_SLOT_SIZE
+        # The first num_slots bytes are the in-use flags, which start as zeros
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots + num_slots * self.slot_size)
+        self._next_slot = 0
+
+    def _acquire_slot(self, cancelled=None):
+        """
+        Find a free slot and mark it as in use. Waits if there are none free. If `cancelled` is given,
+        it should be an event that is set if the caller should give up waiting, in which case
+        None is returned.
+
+        """
+        flags = self.shm.buf
+        wait = 0.0005
+        while True:
+            # Start looking from where we got to last time, so slots get used in turn
+            for i in range(self.num_slots):
+                slot = (self._next_slot + i) % self.num_slots
+                if flags[slot] == 0:
+                    flags[slot] = 1
+                    self._next_slot = (slot + 1) % self.num_slots
+                    return slot
+            if cancelled is not None and cancelled.is_set():
+                return None
+            # All slots are in use: wait for a worker to finish with one
+            sleep(wait)
+            wait = min(wait * 2, 0.01)
+
+    def encode_batch(self, batch, cancelled=None):
+        """
+        Prepare a batch of documents to be put on the input queue. If any of the
+        documents can be sent via the shared memory, they're copied into a slot and
+        a `SharedMemoryBatch` is returned. Otherwise, the batch is returned as it is.
+
+        :param batch: list of `(archive, filename, docs)`, as produced by the input feeder
+        :param cancelled: event to check while waiting for a free slot. If it's set, None is returned
+        """
+        raw_docs = [
+            [None if is_invalid_doc(doc) else getattr(doc, "_raw_data", None) for doc in docs]
+            for (archive, filename, docs) in batch
+        ]
+        if not any(raw is not None for doc_raws in raw_docs for raw in doc_raws):
+            # None of the docs can be sent as raw data, so send the batch in the normal way
+            return batch
+
+        slot = self._acquire_slot(cancelled=cancelled)
+        if slot is None:
+            return None
+        buf = self.shm.buf
+        slot_start = self.num_slots + slot * self.slot_size
+        slot_end = slot_start + self.slot_size
+        pos = slot_start
+
+        items = []
+        for (archive, filename, docs), doc_raws in zip(batch, raw_docs):
+            doc_specs = []
+            for doc, raw in zip(docs, doc_raws):
+                if raw is not None and pos + len(raw) <= slot_end:
+                    # Copy the raw data into the shared memory and just send its location
+                    buf[pos:pos+len(raw)] = raw
+                    doc_specs.append((doc.data_point_type, pos, len(raw)))
+                    pos += len(raw)
+                else:
+                    # Doesn't fit, or isn't available as raw data: send the document itself
+                    doc_specs.append(doc)
+            items.append((archive, filename, doc_specs))
+        return SharedMemoryBatch(self.shm.name, slot, items)
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+# Shared memory blocks that have been attached to in this process, by name
+_attached_blocks = {}
+
+
+def _attach(name):
+    if name not in _attached_blocks:
+        _attached_blocks[name] = shared_memory.SharedMemory(name=name)
+    return _attached_blocks[name]
+
+
+class SharedMemoryBatch(object):
+    """
+    Descriptor for a batch of documents sent via a :class:`SharedMemoryInputTransport`.
+    This is what gets put on the input queue. Call `read()` in the worker to get the
+    documents.
+
+    Each document is given either as a tuple `(data point type, start byte, length)`,
+    referring to its raw data in the shared memory, or as the document itself.
+
+    """
+    def __init__(self, shm_name, slot, items):
+        self.shm_name = shm_name
+        self.slot = slot
+        self.items = items
+
+    def read(self):
+        """
+        Read the documents out of the shared memory and free up the slot for reuse.
+
+        :return: list of `(archive, filename, docs)`, just as was given to `encode_batch()`
+        """
+        buf = _attach(self.shm_name).buf
+        batch = []
+        for archive, filename, doc_specs in self.items:
+            docs = []
+            for doc_spec in doc_specs:
+                if type(doc_spec) is tuple:
+                    data_point_type, start, length = doc_spec
+                    # Copy out of the shared memory, so the slot can be reused
+                    docs.append(data_point_type(raw_data=bytes(buf[start:start+length])))
+                else:
+                    docs.append(doc_spec)
+            batch.append((archive, filename, docs))
+        # We've got everything we need out of the slot, so the feeder can use it again
+        buf[self.slot] = 0
+        return batch
+
+
+def create_input_transport(executor, processes):
+    """
+    Create a shared-memory transport for a multiprocessing pool's input batches, if it's
+    available and hasn't been disabled in the local config. Otherwise returns None.
+
+    """
+    if shared_memory is None:
+        return None
+    local_config = executor.info.pipeline.local_config
+    if not str_to_bool(local_config.get("map_shared_memory", "true")):
+        return None
+    slot_size = local_config.get("map_shared_memory_slot_size", None)
+    # Enough slots to keep all the workers busy, with a few batches waiting for each
+    return SharedMemoryInputTransport(4 * processes, slot_size=int(slot_size) if slot_size is not None else None)
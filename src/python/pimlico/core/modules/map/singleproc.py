@@ -8,6 +8,7 @@ This module provides an equivalent set of implementations and convenience functi
 multiprocessing, but conform to the pool-based execution pattern by creating a single-thread pool.
 
 """
+from . import inline_worker_type
 from .threaded import ThreadingMapModuleExecutor, ThreadingMapThread, ThreadingMapPool
 
 
@@ -18,7 +19,8 @@ class SingleThreadMapModuleExecutor(ThreadingMapModuleExecutor):
 
 def single_process_executor_factory(process_document_fn, preprocess_fn=None, postprocess_fn=None,
                                     worker_set_up_fn=None, worker_tear_down_fn=None, batch_docs=None,
-                                    allow_skip_output=False):
+                                    allow_skip_output=False, batch_bytes=None, batch_tokens=None, bucket_batches=1,
+                                    load_resources_fn=None):
     """
     Factory function for creating an executor that uses the single-process implementations of document-map
     pools and workers. This is an easy way to implement a non-parallelized executor
@@ -35,6 +37,14 @@ def single_process_executor_factory(process_document_fn, preprocess_fn=None, pos
     If postprocess_fn is given, it is called at the end of execution, including on the way out after an error,
     with the executor as an argument and a kwarg *error* which is True if execution failed.
 
+    If `load_resources_fn` is given, it is called after `preprocess_fn`, with the executor and a dict to add
+    resources to, which the worker gets as its `resources` attribute. See :mod:`~pimlico.core.modules.map.resources`.
+
+    If `batch_docs` is not None, `process_document_fn` supplies the worker's `process_documents()`
+    instead, which receives a list of the argument tuples for `batch_docs` documents at once, as with
+    :func:`~pimlico.core.modules.map.multiproc.multiprocessing_executor_factory`. Likewise, `batch_bytes`,
+    `batch_tokens` and `bucket_batches` limit the size of batches and group similar-sized documents.
+
     If ``allow_skip_output==True`` and the process document function returns None as one of
     its outputs, that document will simply not be written to that output.
 
@@ -44,11 +54,13 @@ def single_process_executor_factory(process_document_fn, preprocess_fn=None, pos
             raise TypeError("called threading_executor_factory with a worker type that's not a subclass of "
                             "ThreadingMapThread: got %s" % process_document_fn.__name__)
         worker_type = process_document_fn
+        inline_type = None
     else:
         # Define a worker thread type
         class FactoryMadeMapThread(ThreadingMapThread):
-            def process_document(self, archive, filename, *docs):
-                return process_document_fn(self, archive, filename, *docs)
+            def __init__(self, input_queue, output_queue, exception_queue, executor):
+                super(FactoryMadeMapThread, self).__init__(input_queue, output_queue, exception_queue, executor,
+                                                           docs_per_batch=batch_docs or 1)
 
             def set_up(self):
                 if worker_set_up_fn is not None:
@@ -57,7 +69,19 @@ def single_process_executor_factory(process_document_fn, preprocess_fn=None, pos
             def tear_down(self):
                 if worker_tear_down_fn is not None:
                     worker_tear_down_fn(self)
+
+        if batch_docs is not None:
+            FactoryMadeMapThread.process_documents = process_document_fn
+            FactoryMadeMapThread.batch_bytes = batch_bytes
+            FactoryMadeMapThread.batch_tokens = batch_tokens
+            FactoryMadeMapThread.bucket_batches = bucket_batches
+        else:
+            FactoryMadeMapThread.process_document = process_document_fn
         worker_type = FactoryMadeMapThread
+        # Also define a worker type for running the processing in another module's workers, if used as a filter
+        inline_type = inline_worker_type(process_document_fn, worker_set_up_fn, worker_tear_down_fn,
+                                         batch_docs=batch_docs, batch_bytes=batch_bytes, batch_tokens=batch_tokens,
+                                         bucket_batches=bucket_batches)
 
     # Define a pool type to use this worker process type
     class FactoryMadeMapPool(ThreadingMapPool):
@@ -67,12 +91,18 @@ def single_process_executor_factory(process_document_fn, preprocess_fn=None, pos
     class ModuleExecutor(SingleThreadMapModuleExecutor):
         POOL_TYPE = FactoryMadeMapPool
         ALLOW_SKIP_OUTPUT = allow_skip_output
+        INLINE_WORKER_TYPE = inline_type
 
         def preprocess(self):
             super(ModuleExecutor, self).preprocess()
             if preprocess_fn is not None:
                 preprocess_fn(self)
 
+        def load_resources(self, resources):
+            super(ModuleExecutor, self).load_resources(resources)
+            if load_resources_fn is not None:
+                load_resources_fn(self, resources)
+
         def postprocess(self, error=False):
             super(ModuleExecutor, self).postprocess(error=error)
             if postprocess_fn is not None:
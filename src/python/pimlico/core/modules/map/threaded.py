@@ -10,6 +10,7 @@ multiprocessing.
 from __future__ import absolute_import
 
 import sys
+import time
 
 from future import standard_library
 
@@ -18,46 +19,58 @@ from builtins import zip
 from builtins import range
 
 import threading
-from queue import Empty, Queue
+from queue import Empty
 
-from pimlico.core.modules.map import ProcessOutput, DocumentProcessorPool, DocumentMapProcessMixin, \
-    DocumentMapModuleExecutor, WorkerStartupError, ExceptionWithTraceback
-from pimlico.utils.pipes import qget
+from pimlico.core.modules.execute import ModuleExecutionError
+from pimlico.core.modules.map import DocumentProcessorPool, DocumentMapProcessMixin, \
+    DocumentMapModuleExecutor, WorkerStartupError, ExceptionWithTraceback, check_worker_errors, inline_worker_type
+from pimlico.utils.pipes import QueueWaiter, WakeableQueue
 from pimlico.utils.core import raise_from
 
 
 class ThreadingMapThread(threading.Thread, DocumentMapProcessMixin):
-    def __init__(self, input_queue, output_queue, exception_queue, executor):
+    def __init__(self, input_queue, output_queue, exception_queue, executor, docs_per_batch=1):
         threading.Thread.__init__(self)
-        DocumentMapProcessMixin.__init__(self, input_queue, output_queue, exception_queue)
+        DocumentMapProcessMixin.__init__(self, input_queue, output_queue, exception_queue,
+                                         docs_per_batch=docs_per_batch)
         self.executor = executor
         self.info = executor.info
         self.daemon = True
         self.stopped = threading.Event()
         self.initialized = threading.Event()
         self.no_more_inputs = threading.Event()
+        self.flush_requested = threading.Event()
         self.ended = threading.Event()
+        self.batch_sizer = executor.create_worker_batch_sizer()
+        # Lets us wait for inputs without polling, but still be woken up when one of the above is set
+        self.input_waiter = QueueWaiter(input_queue)
 
         self.start()
 
     def notify_no_more_inputs(self):
         self.no_more_inputs.set()
+        self.input_waiter.wake()
+
+    def request_flush(self):
+        self.flush_requested.set()
+        self.input_waiter.wake()
 
     def run(self):
         try:
             # Run any startup routine that the subclass has defined
             self.set_up()
+            self.set_up_fused_stages()
             # Notify waiting processes that we've finished initialization
             self.initialized.set()
             input_buffer = []
             try:
                 while not self.stopped.is_set():
                     try:
-                        # Timeout and go round the loop again to check whether we're supposed to have stopped
-                        inputs = qget(self.input_queue, timeout=0.05)
-                    except Empty:
-                        # Don't worry if the queue is empty: just keep waiting for more until we're shut down
-                        pass
+                        # Wait until there are some inputs, or the pool wakes us up to tell us something
+                        wait_start = time.monotonic()
+                        inputs = self.input_waiter.get()
+                        if self.tracer is not None:
+                            self.tracer.span("dequeue", wait_start)
                     except IOError as e:
                         # This gives different messages on Py2 and 3
                         if e.args[0] == "handle is closed" or e.args[0] == "poll() gave POLLNVAL or POLLERR":
@@ -65,15 +78,33 @@ class ThreadingMapThread(threading.Thread, DocumentMapProcessMixin):
                             # Stopped should have been set by now: we continue and check that
                             continue
                         raise
+                    except ValueError:
+                        # A multiprocessing queue raises this if it's been closed
+                        if self.stopped.is_set():
+                            continue
+                        raise
+                    if inputs is None:
+                        # Woken up: go round the loop again to check whether we're supposed to have stopped
+                        # If there are no more inputs to come, don't wait to fill up the batch we've started
+                        # Likewise if the feeder's waiting for us to finish what we've got
+                        if len(input_buffer) and (self.no_more_inputs.is_set() or self.flush_requested.is_set()):
+                            self.flush_requested.clear()
+                            self._process_input_buffer(input_buffer)
+                            input_buffer = []
                     else:
                         for archive, filename, docs in inputs:
-                            input_buffer.append(tuple([archive, filename] + docs))
-                        if len(input_buffer) >= self.docs_per_batch or self.no_more_inputs.is_set():
-                            results = self.process_documents(input_buffer)
-                            for input_tuple, result in zip(input_buffer, results):
-                                self.output_queue.put(ProcessOutput(input_tuple[0], input_tuple[1], result))
-                            input_buffer = []
+                            # Process each batch as soon as it's full, so batches are never bigger than asked for
+                            if self.buffer_input(input_buffer, tuple([archive, filename] + docs)):
+                                self._process_input_buffer(input_buffer)
+                                input_buffer = []
+                        if self.no_more_inputs.is_set() or self.flush_requested.is_set():
+                            # Don't wait to fill up the last batch
+                            self.flush_requested.clear()
+                            if len(input_buffer):
+                                self._process_input_buffer(input_buffer)
+                                input_buffer = []
             finally:
+                self.tear_down_fused_stages()
                 self.tear_down()
         except Exception as e:
             # If there's any uncaught exception, make it available to the main process
@@ -84,6 +115,29 @@ class ThreadingMapThread(threading.Thread, DocumentMapProcessMixin):
             # Even there was an error, set initialized so that the main process can wait on it
             self.initialized.set()
             self.ended.set()
+            if isinstance(self.output_queue, WakeableQueue):
+                # Make sure the main thread isn't left waiting for outputs from us
+                self.output_queue.wake()
+
+    def _process_input_buffer(self, input_buffer):
+        tracer = self.tracer
+        process_start = time.monotonic()
+        outputs = self._process_batch(input_buffer)
+        if tracer is not None:
+            tracer.span("process", process_start, docs=len(input_buffer))
+
+        send_start = time.monotonic()
+        for output in outputs:
+            try:
+                self.output_queue.put(output)
+            except ValueError:
+                # A multiprocessing queue raises this if it's been closed
+                # If the pool's shut down while we were processing, nobody wants the outputs any more
+                if self.stopped.is_set():
+                    return
+                raise
+        if tracer is not None:
+            tracer.span("send", send_start)
 
     def terminate(self):
         self.shutdown()
@@ -91,6 +145,7 @@ class ThreadingMapThread(threading.Thread, DocumentMapProcessMixin):
     def shutdown(self):
         # This may have been done by the pool, but it doesn't hurt to set it again
         self.stopped.set()
+        self.input_waiter.wake()
 
     def wait_until_finished(self):
         # Now wait for the process to shut down
@@ -119,6 +174,7 @@ class ThreadingMapPool(DocumentProcessorPool):
     def __init__(self, executor, processes):
         super(ThreadingMapPool, self).__init__(processes)
         self.executor = executor
+        self._output_waiter = None
         if executor.SEQUENTIAL_START:
             self.workers = []
             for i in range(processes):
@@ -146,17 +202,37 @@ class ThreadingMapPool(DocumentProcessorPool):
     def start_worker(self):
         return self.THREAD_TYPE(self.input_queue, self.output_queue, self.exception_queue, self.executor)
 
+    def notify_no_more_inputs(self):
+        for worker in self.workers:
+            worker.notify_no_more_inputs()
+
+    def flush_batches(self):
+        for worker in self.workers:
+            worker.request_flush()
+
+    def get_output(self):
+        if self._output_waiter is None:
+            self._output_waiter = QueueWaiter(self.output_queue)
+        while True:
+            output = self._output_waiter.get()
+            if output is not None:
+                return output
+            # A worker has ended: check whether it was because of an error
+            check_worker_errors(self)
+            if any(worker.ended.is_set() for worker in self.workers):
+                raise ModuleExecutionError("worker thread ended before processing was complete")
+
     @staticmethod
     def create_queue(maxsize=None):
         if maxsize is None:
             maxsize = 0
-        return Queue(maxsize)
+        return WakeableQueue(maxsize)
 
     def shutdown(self):
         # Tell all the threads to stop
         # Although the worker's shutdown does this too, do it to all now so they can be finishing up in the background
         for worker in self.workers:
-            worker.stopped.set()
+            worker.shutdown()
         self.empty_all_queues()
         # Now try to shut down every worker
         # Don't keep trying indefinitely: if we fail 5 times, just give up
@@ -177,15 +253,18 @@ class ThreadingMapModuleExecutor(DocumentMapModuleExecutor):
         return self.POOL_TYPE(self, processes)
 
     def postprocess(self, error=False):
-        self.pool.shutdown()
+        # There's no pool if we're only used as a stage fused into another module's workers
+        if self.pool is not None:
+            self.pool.shutdown()
 
     def wait_until_finished(self):
-        self.pool.wait_until_finished()
+        if self.pool is not None:
+            self.pool.wait_until_finished()
 
 
 def threading_executor_factory(process_document_fn, preprocess_fn=None, postprocess_fn=None,
                                worker_set_up_fn=None, worker_tear_down_fn=None, allow_skip_output=False,
-                               sequential_start=False):
+                               sequential_start=False, load_resources_fn=None):
     """
     Factory function for creating an executor that uses the threading-based implementations of document-map
     pools and worker processes.
@@ -203,6 +282,10 @@ def threading_executor_factory(process_document_fn, preprocess_fn=None, postproc
     If postprocess_fn is given, it is called from the main thread at the end of execution, including on the way
     out after an error, with the executor as an argument and a kwarg *error* which is True if execution failed.
 
+    If `load_resources_fn` is given, it is called from the main thread after `preprocess_fn`, with the executor
+    and a dict to add resources to, to load read-only resources once for all workers, which the workers get as
+    their `resources` attribute. See :mod:`~pimlico.core.modules.map.resources`.
+
     If worker_set_up_fn is given, it is called within each worker before execution begins, with the worker thread
     instance as an argument.
     Likewise, worker_tear_down_fn is called from within the worker thread before it exits.
@@ -226,6 +309,7 @@ def threading_executor_factory(process_document_fn, preprocess_fn=None, postproc
             raise TypeError("called threading_executor_factory with a worker type that's not a subclass of "
                             "ThreadingMapThread: got %s" % process_document_fn.__name__)
         worker_type = process_document_fn
+        inline_type = None
     else:
         # Define a worker thread type
         class FactoryMadeMapThread(ThreadingMapThread):
@@ -240,6 +324,8 @@ def threading_executor_factory(process_document_fn, preprocess_fn=None, postproc
                 if worker_tear_down_fn is not None:
                     worker_tear_down_fn(self)
         worker_type = FactoryMadeMapThread
+        # Also define a worker type for running the processing in another module's workers, if used as a filter
+        inline_type = inline_worker_type(process_document_fn, worker_set_up_fn, worker_tear_down_fn)
 
     # Define a pool type to use this worker process type
     class FactoryMadeMapPool(ThreadingMapPool):
@@ -250,12 +336,18 @@ def threading_executor_factory(process_document_fn, preprocess_fn=None, postproc
         POOL_TYPE = FactoryMadeMapPool
         ALLOW_SKIP_OUTPUT = allow_skip_output
         SEQUENTIAL_START = sequential_start
+        INLINE_WORKER_TYPE = inline_type
 
         def preprocess(self):
             super(ModuleExecutor, self).preprocess()
             if preprocess_fn is not None:
                 preprocess_fn(self)
 
+        def load_resources(self, resources):
+            super(ModuleExecutor, self).load_resources(resources)
+            if load_resources_fn is not None:
+                load_resources_fn(self, resources)
+
         def postprocess(self, error=False):
             super(ModuleExecutor, self).postprocess(error=error)
             if postprocess_fn is not None:
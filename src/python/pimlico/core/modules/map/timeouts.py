@@ -0,0 +1,213 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Per-document time limits for multiprocessing document map workers.
+
+A single document that makes a worker hang (for example, a call to an external tool that
+never returns, or a regular expression that takes forever on some unlucky input) would
+otherwise hold up the whole module: its output never comes back, so nothing after it
+can be written. If the local config setting ``map_doc_timeout`` is given (or the executor
+sets `DOC_TIMEOUT`), the pool checks how long each worker has been processing its current
+batch of documents. If it takes longer than the limit per document, the worker is killed and
+replaced by a new one. The documents it was processing are output as invalid documents,
+saying they timed out, and any others it had taken from the input queue are sent to the
+other workers again. The number of documents that timed out is reported at the end.
+Note that a killed worker doesn't get to run its `tear_down()`.
+
+Workers can't be killed from the outside in the middle of processing a document unless
+they are separate processes, so the limit is only enforced by multiprocessing pools.
+When it's set, a worker process is used even if there's only one.
+
+Each worker keeps a :class:`WorkerProgress` record in shared memory of the documents it's
+taken from the input queue and which it's processing right now, so that the main process
+can find out what it was holding once it's been killed.
+
+Each worker also sends its outputs back over its own pipe (:class:`WorkerOutputPipe`), instead
+of the queue shared by all the workers. Putting something on a multiprocessing queue just hands
+it to a background thread to send, so outputs the worker has recorded as sent could be lost
+when it's killed, or the thread could be killed part-way through sending one, holding up the
+other workers. Outputs are sent over the pipe before the worker goes on to anything else, and
+whatever's in the pipe when the worker's killed is still read out.
+
+"""
+import multiprocessing
+import pickle
+import time
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+
+class WorkerProgress(object):
+    """
+    Shared record, updated by a worker process, of what it's working on. Created in the main
+    process before the worker is started.
+
+    The worker calls `received()` when it takes documents from the input queue, `started()`
+    and `finished()` around each call to process a batch and `sent()` once it's put outputs on
+    the output queue. Since outputs are always sent in the order the inputs were received, the
+    documents the worker's holding are those it's received, minus the number it's sent.
+
+    The main process should only read the record (`recover()`) once the worker has been stopped.
+
+    """
+    #: Space for the names of the documents a worker's holding, in bytes
+    DEFAULT_CAPACITY = 4 * 1024 * 1024
+    #: Space for the names of the documents in the batch being processed
+    DEFAULT_BATCH_CAPACITY = 256 * 1024
+
+    def __init__(self, capacity=None, batch_capacity=None):
+        # Time the current batch was started, or 0 if not processing
+        self.busy_since = RawValue("d", 0.)
+        self.busy_docs = RawValue("l", 0)
+        # Number of the docs in _held that have been sent
+        self.sent_docs = RawValue("l", 0)
+        self._held = RawArray("c", capacity or self.DEFAULT_CAPACITY)
+        self._held_length = RawValue("l", 0)
+        self._batch = RawArray("c", batch_capacity or self.DEFAULT_BATCH_CAPACITY)
+        self._batch_length = RawValue("l", 0)
+        # Worker-side copy of the documents we're holding
+        self._held_docs = []
+
+    def received(self, docs):
+        """
+        Called by the worker when it takes documents `(archive, filename)` from the input queue.
+
+        """
+        # Forget the docs that have already been sent
+        self._held_docs = self._held_docs[self.sent_docs.value:] + list(docs)
+        self.sent_docs.value = 0
+        _store(self._held, self._held_length, self._held_docs)
+
+    def started(self, docs):
+        """
+        Called by the worker just before it starts processing a batch of documents `(archive, filename)`.
+
+        """
+        _store(self._batch, self._batch_length, docs)
+        self.busy_docs.value = len(docs)
+        self.busy_since.value = time.time()
+
+    def finished(self):
+        self.busy_since.value = 0.
+
+    def sent(self, num_docs):
+        """
+        Called by the worker once it has put the outputs for `num_docs` documents on the output queue.
+
+        """
+        self.sent_docs.value += num_docs
+
+    def overdue(self, doc_timeout, now=None):
+        """
+        True if the worker's been processing its current batch for longer than `doc_timeout`
+        seconds per document in the batch.
+
+        """
+        busy_since = self.busy_since.value
+        if busy_since == 0.:
+            return False
+        if now is None:
+            now = time.time()
+        return now - busy_since > doc_timeout * max(self.busy_docs.value, 1)
+
+    def recover(self):
+        """
+        Called from the main process once the worker has been stopped, to find out what documents
+        it had. Returns a pair: the documents in the batch it was processing (empty if it wasn't
+        processing anything) and the other documents it had taken from the input queue and not sent
+        outputs for.
+
+        :raise WorkerProgressUnknown: if the worker had too many documents to keep a record of them
+        """
+        held = _load(self._held, self._held_length)[self.sent_docs.value:]
+        if self.busy_since.value == 0.:
+            return [], held
+        batch = _load(self._batch, self._batch_length)
+        batch_set = set(batch)
+        return batch, [doc for doc in held if doc not in batch_set]
+
+
+class WorkerProgressUnknown(Exception):
+    pass
+
+
+class WorkerOutputPipe(object):
+    """
+    A single worker process's channel for sending outputs back to the main process, which the
+    worker uses in place of the pool's output queue. Unlike a multiprocessing queue, `put()`
+    only returns once the output's been written to the pipe, so it won't be lost if the worker
+    is killed afterwards. Created in the main process before the worker is started.
+
+    """
+    def __init__(self):
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.closed = False
+
+    def put(self, item, block=True):
+        """
+        Called by the worker to send an output. Waits until the output's been written, which,
+        for a big output, may mean waiting for the main process to read some of it.
+
+        """
+        self.writer.send(item)
+
+    def worker_started(self):
+        """
+        Called by the main process once the worker's been started. The main process doesn't
+        need the writing end and, with it closed, we can tell if the worker has gone away
+        part-way through sending.
+
+        """
+        self.writer.close()
+
+    def poll(self):
+        return not self.closed and self.reader.poll()
+
+    def get(self):
+        """
+        Get the next output, or None if there wasn't one, either because nothing has been sent
+        or because the worker went away before finishing sending it.
+
+        """
+        if not self.poll():
+            return None
+        try:
+            return self.reader.recv()
+        except EOFError:
+            self.closed = True
+            return None
+
+    def get_available(self):
+        """
+        Get all the outputs that have been sent and not read yet. Used once the worker's stopped.
+
+        """
+        outputs = []
+        while True:
+            output = self.get()
+            if output is None:
+                return outputs
+            outputs.append(output)
+
+    def close(self):
+        self.closed = True
+        self.reader.close()
+
+
+def _store(array, length, docs):
+    data = pickle.dumps(docs, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) > len(array):
+        # Too much to store: we won't be able to recover the docs
+        length.value = -1
+    else:
+        array[:len(data)] = data
+        length.value = len(data)
+
+
+def _load(array, length):
+    if length.value < 0:
+        raise WorkerProgressUnknown("worker was holding too many documents to keep a record of them")
+    if length.value == 0:
+        return []
+    return pickle.loads(array[:length.value])
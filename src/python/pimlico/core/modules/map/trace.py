@@ -0,0 +1,253 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Timeline tracing of document map execution.
+
+When a document map module is slow, it's not always clear what's holding it up: reading the
+input, sending documents to the workers, the processing itself, or writing the output. If the
+local config setting ``map_trace`` is turned on, the executor records spans of time spent on
+each step of the execution, in every thread and worker process, and stores them in the module's
+output directory as ``trace.json`` (``trace.1.json``, etc, on later runs). This is in Chrome's
+trace event format, so can be viewed in ``chrome://tracing`` or `Perfetto <https://ui.perfetto.dev>`_.
+
+The spans recorded are:
+
+- in the input feeder thread: ``read`` (reading and decoding a batch of documents from the input corpora,
+  including any filter modules), ``window wait`` (waiting because too many documents are already in progress),
+  ``memory wait`` (input held back because too much memory is in use), ``encode`` (copying the batch to shared memory) and ``enqueue`` (waiting to put it on the input queue)
+- in each worker: ``dequeue`` (waiting for input), ``decode`` (reading documents out of shared memory),
+  ``process`` (processing a batch, within which any fused filter modules' processing is shown too) and
+  ``send`` (putting the outputs on the output queue)
+- in the main thread: ``dequeue`` (waiting for an output from the workers), ``reorder wait`` (how long a
+  document's result was held back waiting for earlier documents, shown as an async event) and
+  ``write`` (writing a document's outputs)
+
+Recording an event takes a few microseconds, so tracing can be left on for runs over a sample of the data.
+Every process writes its events to a temporary file now and again, and they're all collected at the end
+of the run. To stop the trace getting too big to view on big runs, each process stops recording after
+:attr:`MapTracer.MAX_EVENTS` events. A worker killed because it timed out loses any events it hasn't
+written out yet.
+
+Tracing isn't done in archive-parallel execution.
+
+"""
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+
+class MapTracer(object):
+    """
+    Records spans of time in the main process and its workers. Created in the main process before the
+    workers are started: forked worker processes get a copy, which records their events separately.
+
+    All timings use :func:`time.monotonic`, which is the same clock in every process on Linux,
+    so events in different processes line up.
+
+    """
+    #: Most events to record in each process
+    MAX_EVENTS = 1000000
+    #: Events are written out to a temporary file whenever this many have been recorded
+    FLUSH_EVENTS = 50000
+
+    def __init__(self, name="main"):
+        self.name = name
+        self.origin = time.monotonic()
+        # Each process writes the events it's recorded here
+        self.events_dir = tempfile.mkdtemp(prefix="pimlico-trace-")
+        self._main_pid = os.getpid()
+        self._reset()
+        _tracers.add(self)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # Another thread might have held the lock when we were forked, so we always need a new one
+        self._lock = threading.Lock()
+        self._events = []
+        self._thread_names = {}
+        self._recorded = 0
+        self._dropped = 0
+
+    def now(self):
+        return time.monotonic()
+
+    def _add(self, event):
+        tid = threading.get_ident()
+        with self._lock:
+            if self._recorded >= self.MAX_EVENTS:
+                self._dropped += 1
+                return
+            if tid not in self._thread_names:
+                self._thread_names[tid] = threading.current_thread().name
+            self._events.append((tid,) + event)
+            self._recorded += 1
+            if len(self._events) < self.FLUSH_EVENTS:
+                return
+        self.flush()
+
+    def span(self, name, start, end=None, **args):
+        """
+        Record a span of time, from `start` (given by `now()`) to `end` (default: now).
+        Any kwargs are shown as the span's arguments.
+
+        """
+        if end is None:
+            end = time.monotonic()
+        self._add(("X", name, start, end - start, args or None))
+
+    @contextmanager
+    def timed(self, name, **args):
+        """
+        Context manager to record the span of time spent in the block.
+
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.span(name, start, **args)
+
+    def async_span(self, name, start, end=None, **args):
+        """
+        Record a span of time that may overlap with other spans in the same thread, like the time a
+        document spent waiting for its turn to be output.
+
+        """
+        if end is None:
+            end = time.monotonic()
+        self._add(("async", name, start, end - start, args or None))
+
+    def instant(self, name, **args):
+        """
+        Record that something happened at this moment.
+
+        """
+        self._add(("i", name, time.monotonic(), 0., args or None))
+
+    def flush(self):
+        """
+        Write out the events recorded in this process. Called by worker processes when they finish,
+        so the main process can collect them.
+
+        """
+        with self._lock:
+            events, self._events = self._events, []
+            dropped, self._dropped = self._dropped, 0
+            chunk = {
+                "pid": self._pid,
+                "process": self.name if self._pid == self._main_pid else multiprocessing.current_process().name,
+                "threads": dict(self._thread_names),
+                "dropped": dropped,
+                "events": events,
+            }
+            # Pickled, since it's much quicker than JSON and we only read it back at the end
+            path = os.path.join(self.events_dir, "{}.events".format(self._pid))
+            with open(path, "ab") as f:
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def export(self, path, metadata=None):
+        """
+        Called in the main process once the workers have finished, to collect all the events and write
+        them out to `path` in Chrome's trace event format. The temporary files used to collect the events
+        are removed.
+
+        :param metadata: dict of values to include as the trace's metadata
+        """
+        self.flush()
+        trace_events = []
+        dropped = 0
+        async_id = 0
+        named = set()
+        for filename in sorted(os.listdir(self.events_dir)):
+            for chunk in _load_chunks(os.path.join(self.events_dir, filename)):
+                pid = chunk["pid"]
+                dropped += chunk["dropped"]
+                # Name the processes and threads, just once each
+                if pid not in named:
+                    named.add(pid)
+                    trace_events.append({"ph": "M", "name": "process_name", "pid": pid, "tid": 0,
+                                         "args": {"name": chunk["process"]}})
+                for tid, thread_name in chunk["threads"].items():
+                    if (pid, tid) not in named:
+                        named.add((pid, tid))
+                        trace_events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": tid,
+                                             "args": {"name": thread_name}})
+                for tid, ph, name, start, duration, args in chunk["events"]:
+                    event = {"name": name, "pid": pid, "tid": tid, "ts": self._micros(start)}
+                    if args is not None:
+                        event["args"] = args
+                    if ph == "async":
+                        # A pair of begin and end events, matched by an id
+                        async_id += 1
+                        trace_events.append(dict(event, ph="b", cat="async", id=async_id))
+                        trace_events.append(dict(event, ph="e", cat="async", id=async_id,
+                                                 ts=self._micros(start + duration)))
+                    else:
+                        event["ph"] = ph
+                        if ph == "X":
+                            event["dur"] = duration * 1e6
+                        else:
+                            event["s"] = "t"
+                        trace_events.append(event)
+        shutil.rmtree(self.events_dir, ignore_errors=True)
+
+        metadata = dict(metadata or {})
+        metadata["dropped_events"] = dropped
+        with open(path, "w") as f:
+            # dumps() is much faster than dump() on big structures
+            f.write(json.dumps({"traceEvents": trace_events, "displayTimeUnit": "ms", "otherData": metadata}))
+        return dropped
+
+    def discard(self):
+        """
+        Remove the temporary files without exporting the events.
+
+        """
+        shutil.rmtree(self.events_dir, ignore_errors=True)
+
+    def _micros(self, timestamp):
+        return (timestamp - self.origin) * 1e6
+
+
+# Tracers that have been created in this process, which need to know if it forks
+_tracers = weakref.WeakSet()
+
+
+def _after_fork():
+    # We're in a newly forked process: any tracers should start recording this process' own events
+    for tracer in list(_tracers):
+        tracer._reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _load_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def new_trace_path(output_dir):
+    """
+    Path to store a new trace in a module's output directory, without overwriting earlier ones.
+
+    """
+    path = os.path.join(output_dir, "trace.json")
+    run_num = 1
+    while os.path.exists(path):
+        path = os.path.join(output_dir, "trace.%d.json" % run_num)
+        run_num += 1
+    return path
@@ -0,0 +1,219 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Monitoring of the memory used by a module's execution, and enforcement of its memory budget.
+
+While a module runs, its executor's :class:`MemoryMonitor` measures, every
+``memory_check_interval`` seconds (local config setting, default 1), the resident memory (RSS)
+of the main process and of every process it's started, such as document map workers. At the
+end of the run, the high-water mark of each process is logged and recorded in the run's
+performance metrics (see :mod:`~pimlico.core.modules.metrics`).
+
+If the module has a memory budget, given in MB by the special module parameter ``memory_budget``,
+the total used by all the processes is compared to it. Since forked workers share much of their
+memory with the main process, the total counts shared pages only once, using the proportional
+set size (PSS) of each process where available. Once the total reaches ``memory_pressure_fraction``
+of the budget (local config setting, default 0.9), the module is under memory pressure, which document
+map modules respond to by pausing the input feeder and, if that's not enough, stopping some of their
+workers (see :mod:`~pimlico.core.modules.map.memory`). If the total goes over the budget, the next
+call to :meth:`MemoryMonitor.check` raises a :class:`~pimlico.core.modules.execute.MemoryBudgetExceeded`
+error, so that execution stops cleanly, instead of the process being killed by the system when it
+runs out of memory. Document map modules check regularly and store their progress, so that execution
+can be resumed later. Other executors that build up big data structures should call `check()` now and
+again themselves.
+
+Memory is measured using ``/proc``, so is only monitored on Linux.
+
+"""
+import os
+import threading
+
+
+class MemoryMonitor(object):
+    """
+    Background monitoring of the memory used by this process and its children, started
+    by `start()` and stopped by `stop()`.
+
+    :param budget: memory budget in MB, or None to just monitor
+    :param pressure_fraction: fraction of the budget above which `pressure` is True
+    :param interval: seconds between measurements
+    """
+    DEFAULT_INTERVAL = 1.
+    DEFAULT_PRESSURE_FRACTION = 0.9
+
+    def __init__(self, budget=None, pressure_fraction=None, interval=None):
+        self.budget = budget
+        self.pressure_fraction = float(pressure_fraction or self.DEFAULT_PRESSURE_FRACTION)
+        self.interval = float(interval or self.DEFAULT_INTERVAL)
+        #: Whether memory can be measured here
+        self.available = os.path.exists("/proc/self/statm")
+        #: Total memory used by all the processes at the last measurement, in MB
+        self.total = None
+        #: Highest total measured
+        self.peak_total = None
+        # Highest RSS measured for each process, in MB, keyed by pid
+        self._peaks = {}
+        self._names = {}
+        self._thread = None
+        self._stopped = threading.Event()
+        self._main_pid = None
+
+    def start(self):
+        self._main_pid = os.getpid()
+        self._names[self._main_pid] = "main"
+        if not self.available:
+            return
+        self.measure()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="MemoryMonitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            # Include anything that happened since the last measurement
+            self.measure()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.measure()
+
+    def name_process(self, pid, name):
+        """
+        Give a name to a child process, e.g. a worker, to identify it in the high-water marks.
+        Other processes are named by their pid.
+
+        """
+        self._names[pid] = name
+
+    def measure(self):
+        """
+        Measure the memory used by this process and its descendants now. Called regularly by
+        the monitoring thread.
+
+        """
+        total = 0.
+        for pid in [self._main_pid] + _descendants(self._main_pid):
+            rss, pss = _process_memory(pid)
+            if rss is None:
+                # Process has ended
+                continue
+            if rss > self._peaks.get(pid, 0.):
+                self._peaks[pid] = rss
+            total += pss if pss is not None else rss
+        self.total = total
+        if self.peak_total is None or total > self.peak_total:
+            self.peak_total = total
+
+    @property
+    def peaks(self):
+        """
+        Highest RSS measured for each process, in MB, keyed by process name.
+
+        """
+        return dict((self._names.get(pid) or "pid {}".format(pid), peak) for (pid, peak) in list(self._peaks.items()))
+
+    @property
+    def pressure(self):
+        """
+        True if there's a budget and the last measurement was close to it, or over it.
+
+        """
+        return self.budget is not None and self.total is not None and \
+            self.total >= self.pressure_fraction * self.budget
+
+    @property
+    def exceeded(self):
+        """
+        True if there's a budget and the last measurement was over it.
+
+        """
+        return self.budget is not None and self.total is not None and self.total > self.budget
+
+    def check(self):
+        """
+        Raise a :class:`~pimlico.core.modules.execute.MemoryBudgetExceeded` if the memory budget
+        has been exceeded. Cheap enough to call for every document.
+
+        """
+        if self.exceeded:
+            from pimlico.core.modules.execute import MemoryBudgetExceeded
+            raise MemoryBudgetExceeded("memory budget exceeded: using {:.0f}MB, with a budget of {}MB".format(
+                self.total, self.budget
+            ))
+
+    def summary(self):
+        """
+        High-water marks to include in the performance metrics for the run.
+
+        """
+        return {
+            "budget_mb": self.budget,
+            "peak_total_mb": self.peak_total,
+            "peak_rss_mb": self.peaks,
+        }
+
+    def log_high_water_marks(self, log):
+        if not self.available:
+            return
+        log.info("Peak memory use: {:.0f}MB in total{}".format(
+            self.peak_total or 0., " (budget {}MB)".format(self.budget) if self.budget is not None else ""
+        ))
+        for name, peak in sorted(self.peaks.items(), key=lambda x: -x[1]):
+            log.info("  {}: {:.0f}MB".format(name, peak))
+
+
+_PAGE_MB = (os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096) / (1024. * 1024.)
+
+
+def _process_memory(pid):
+    """
+    RSS and PSS of a process in MB. PSS is None if it can't be read. Both are None if the
+    process no longer exists.
+
+    """
+    try:
+        with open("/proc/{}/statm".format(pid), "r") as f:
+            rss = int(f.read().split()[1]) * _PAGE_MB
+    except (IOError, OSError, IndexError, ValueError):
+        return None, None
+    pss = None
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid), "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1]) / 1024.
+                    break
+    except (IOError, OSError, ValueError):
+        pass
+    return rss, pss
+
+
+def _descendants(pid):
+    """
+    Pids of all the descendants of a process, from ``/proc``.
+
+    """
+    descendants = []
+    to_check = [pid]
+    while to_check:
+        parent = to_check.pop()
+        # Children are listed under the thread that started them
+        try:
+            threads = os.listdir("/proc/{}/task".format(parent))
+        except (IOError, OSError):
+            continue
+        for thread in threads:
+            try:
+                with open("/proc/{}/task/{}/children".format(parent, thread), "r") as f:
+                    children = [int(child) for child in f.read().split()]
+            except (IOError, OSError, ValueError):
+                continue
+            descendants.extend(children)
+            to_check.extend(children)
+    return descendants
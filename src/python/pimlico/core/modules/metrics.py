@@ -0,0 +1,398 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Performance metrics recorded for every execution of a module.
+
+Each time a module is run, its executor's :class:`ModuleRunMetrics` measures the wall time,
+CPU time and peak memory use of the main process and of the worker processes it started,
+the number of bytes read and written and, if the executor counts them, the number of
+documents processed and how many were invalid. Document map modules also record how long
+each document took to process in the workers, from which the median and 95th and 99th
+percentile latency are given.
+
+A record for the run is added to ``metrics.json`` in the module's output directory, which keeps
+the records of all runs since the module was last reset, so that performance can be compared
+from one run to the next. The file contains a dict with a single key ``runs``, a list of records,
+oldest first. See :meth:`ModuleRunMetrics.to_dict` for what's in a record.
+
+Resource usage is measured using :mod:`resource` and, on Linux, ``/proc``. The CPU time of
+child processes only includes those that have finished. The system only keeps a high-water
+mark of memory use for the whole life of a process, so the main process' peak for the run
+is found by measuring its memory use every `RSS_SAMPLE_INTERVAL` seconds while the module runs.
+Each worker's CPU time and peak memory use are read by the pool just before the worker exits
+(see :meth:`ModuleRunMetrics.add_worker`). Times are in seconds and memory in MB.
+
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: no resource usage is recorded
+    resource = None
+
+
+METRICS_FILENAME = "metrics.json"
+
+
+class ModuleRunMetrics(object):
+    """
+    Measures the resources used by a single execution of a module. `start()` is called
+    just before the executor starts and `finish()` once it's done.
+
+    Executors that process documents should call `add_docs()` as they go, and `add_latency()`
+    if they know how long individual documents took. Executors that start worker processes
+    should call `add_worker()` for each one just before it exits. Any other values worth
+    recording can be put in the dict `extra`, which is included in the record as it is.
+
+    """
+    #: Most per-document latencies to keep: beyond this, a random sample is kept to compute percentiles
+    MAX_LATENCY_SAMPLE = 100000
+    #: Seconds between measurements of the main process' memory use, to find its peak
+    RSS_SAMPLE_INTERVAL = 0.5
+
+    def __init__(self, processes=1):
+        self.processes = processes
+        self.docs_processed = None
+        self.invalid_docs = None
+        self.latencies = LatencySample(self.MAX_LATENCY_SAMPLE)
+        self.extra = {}
+        #: CPU time and peak memory use of each worker process, keyed by name
+        self.workers = {}
+
+        self.start_time = None
+        self.end_time = None
+        self._start_clock = None
+        self._wall_time = None
+        self._start_usage = None
+        self._usage = None
+        self._start_io = None
+        self._io = None
+        self._rss_sampler = None
+        self._peak_rss = None
+
+    def start(self):
+        self.start_time = datetime.now()
+        self._start_clock = time.time()
+        self._start_usage = _get_usage()
+        self._start_io = _get_io_counters()
+        self._rss_sampler = PeakRssSampler(self.RSS_SAMPLE_INTERVAL)
+        self._rss_sampler.start()
+
+    def finish(self):
+        if self._start_clock is None:
+            raise ValueError("run metrics finished before they were started")
+        self.end_time = datetime.now()
+        self._wall_time = time.time() - self._start_clock
+        self._usage = _get_usage()
+        self._io = _get_io_counters()
+        self._peak_rss = self._rss_sampler.stop()
+
+    def add_docs(self, num_docs=1, invalid=None):
+        """
+        Count documents processed.
+
+        :param num_docs: number of documents
+        :param invalid: number of them that were invalid, or None if unknown
+        """
+        self.docs_processed = (self.docs_processed or 0) + num_docs
+        if invalid is not None:
+            self.invalid_docs = (self.invalid_docs or 0) + int(invalid)
+
+    def add_latency(self, seconds):
+        """
+        Record the time it took to process a single document.
+
+        """
+        self.latencies.add(seconds)
+
+    def add_worker(self, name, pid):
+        """
+        Record the CPU time and peak memory use of a worker process. These can't be read once it's
+        gone, so this should be called just before it exits, once it's done all its work, or
+        before it's killed.
+
+        Does nothing if the process' usage can't be read (only Linux is supported).
+
+        :param name: name to identify the worker by
+        :param pid: its process ID
+        """
+        usage = read_process_usage(pid)
+        if usage is not None:
+            usage["pid"] = pid
+            self.workers[name] = usage
+
+    def to_dict(self, status=None):
+        """
+        Produce the record of the run that's stored in the metrics file. Contains:
+
+        - ``start``, ``end``: timestamps
+        - ``status``: the module's status at the end of the run
+        - ``host``, ``processes``
+        - ``wall_time``
+        - ``cpu_time``: user and system time for the ``main`` process and all its ``children``
+          that have finished (including workers), and the ``total``
+        - ``peak_rss_mb``: peak memory use during the run of the ``main`` process and the biggest of
+          the ``workers``. None where it couldn't be measured
+        - ``workers``: the ``pid``, ``user`` and ``system`` time and ``peak_rss_mb`` of each worker process
+          recorded with `add_worker()`, keyed by name, or None if there weren't any
+        - ``io``: ``bytes_read`` and ``bytes_written`` by all read and write calls (including pipes
+          between processes), and ``storage_bytes_read`` and ``storage_bytes_written`` actually fetched
+          from or sent to the storage layer
+        - ``docs_processed``, ``invalid_docs``, ``docs_per_second``: None if the executor didn't count them
+        - ``latency``: number of documents measured (``docs``), ``mean``, ``p50``, ``p95``, ``p99`` and
+          ``max`` time to process a single document, or None if not measured
+        - anything in `extra`
+
+        """
+        if self._wall_time is None:
+            raise ValueError("run metrics haven't been finished")
+        record = {
+            "start": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "end": self.end_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "status": status,
+            "host": socket.gethostname(),
+            "processes": self.processes,
+            "wall_time": self._wall_time,
+        }
+
+        if self._usage is not None:
+            (main_start, children_start), (main_end, children_end) = self._start_usage, self._usage
+            cpu_time = {
+                "main": {"user": main_end.ru_utime - main_start.ru_utime,
+                         "system": main_end.ru_stime - main_start.ru_stime},
+                "children": {"user": children_end.ru_utime - children_start.ru_utime,
+                             "system": children_end.ru_stime - children_start.ru_stime},
+            }
+            cpu_time["total"] = sum(sum(times.values()) for times in cpu_time.values())
+            record["cpu_time"] = cpu_time
+        else:
+            record["cpu_time"] = None
+        worker_peaks = [usage["peak_rss_mb"] for usage in self.workers.values() if usage["peak_rss_mb"] is not None]
+        record["peak_rss_mb"] = {
+            "main": self._peak_rss,
+            "workers": max(worker_peaks) if len(worker_peaks) else None,
+        }
+        record["workers"] = dict(self.workers) if len(self.workers) else None
+
+        if self._io is not None and self._start_io is not None:
+            record["io"] = dict((key, self._io[key] - self._start_io[key]) for key in self._io)
+        else:
+            record["io"] = None
+
+        record["docs_processed"] = self.docs_processed
+        record["invalid_docs"] = self.invalid_docs
+        if self.docs_processed is not None and self._wall_time > 0.:
+            record["docs_per_second"] = self.docs_processed / self._wall_time
+        else:
+            record["docs_per_second"] = None
+        record["latency"] = self.latencies.summary()
+
+        record.update(self.extra)
+        return record
+
+    def save(self, output_dir, status=None):
+        """
+        Add the record of this run to the metrics file in `output_dir`, keeping those of earlier runs.
+
+        :return: path to the metrics file
+        """
+        path = os.path.join(output_dir, METRICS_FILENAME)
+        runs = load_metrics_history(output_dir)
+        runs.append(self.to_dict(status=status))
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # Write to a temporary file and move it into place, so we never leave the history half-written
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump({"runs": runs}, f, indent=2)
+        os.replace(tmp_path, path)
+        return path
+
+
+def load_metrics_history(output_dir):
+    """
+    Load the records of previous runs from the metrics file in a module's output directory.
+
+    :return: list of run records, oldest first, empty if there's no metrics file
+    """
+    path = os.path.join(output_dir, METRICS_FILENAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return json.load(f).get("runs", [])
+
+
+class LatencySample(object):
+    """
+    Per-document processing times, from which percentiles are computed. Once more than
+    `max_size` have been added, a uniform random sample of them is kept (reservoir sampling),
+    so memory use doesn't grow with the size of the corpus.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.sample = []
+        # Seeded, so that the same times give the same percentiles
+        self._random = random.Random(0)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.sample) < self.max_size:
+            self.sample.append(seconds)
+        else:
+            i = self._random.randrange(self.count)
+            if i < self.max_size:
+                self.sample[i] = seconds
+
+    def summary(self):
+        if self.count == 0:
+            return None
+        ordered = sorted(self.sample)
+        return {
+            "docs": self.count,
+            "mean": self.total / self.count,
+            "p50": _nearest_rank(ordered, 50),
+            "p95": _nearest_rank(ordered, 95),
+            "p99": _nearest_rank(ordered, 99),
+            "max": self.max,
+        }
+
+
+def _nearest_rank(ordered, percent):
+    # Smallest value such that at least this percentage of the values are no greater than it
+    rank = max(-(-percent * len(ordered) // 100), 1)
+    return ordered[rank - 1]
+
+
+def _get_usage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+class PeakRssSampler(object):
+    """
+    Finds the peak memory use (RSS) of this process over a period, between `start()` and
+    `stop()`, by measuring it every `interval` seconds in a background thread. Peaks shorter
+    than the interval may be missed.
+
+    Memory is measured using ``/proc``, so only on Linux.
+
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.peak = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if _read_rss() is None:
+            # Can't measure memory here
+            return
+        self.measure()
+        self._thread = threading.Thread(target=self._run, name="PeakRssSampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.measure()
+
+    def measure(self):
+        rss = _read_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def stop(self):
+        """
+        :return: the peak RSS in MB, or None if it couldn't be measured
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            self.measure()
+        return self.peak
+
+
+_PAGE_MB = (os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096) / (1024. * 1024.)
+
+
+def _read_rss():
+    # Current RSS of this process in MB
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * _PAGE_MB
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def read_process_usage(pid):
+    """
+    Read the CPU time and peak memory use of a running process from ``/proc``.
+
+    :return: dict containing ``user`` and ``system`` time and ``peak_rss_mb``, the process' high-water
+        mark (``VmHWM``), or None if they can't be read (not on Linux, or the process has gone)
+    """
+    try:
+        with open("/proc/{}/stat".format(pid), "r") as f:
+            # The command name, in brackets, comes before the fields we want and may contain spaces
+            fields = f.read().rpartition(")")[2].split()
+        ticks_per_second = float(os.sysconf("SC_CLK_TCK"))
+        # Fields 14 and 15: utime and stime
+        usage = {
+            "user": int(fields[11]) / ticks_per_second,
+            "system": int(fields[12]) / ticks_per_second,
+            "peak_rss_mb": None,
+        }
+        with open("/proc/{}/status".format(pid), "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    # Given in kB
+                    usage["peak_rss_mb"] = int(line.split()[1]) / 1024.
+                    break
+    except (IOError, OSError, IndexError, ValueError, AttributeError):
+        return None
+    return usage
+
+
+def _get_io_counters():
+    """
+    Read the process' I/O counters from ``/proc/self/io``. These include those of child processes
+    once they've been waited for. Where it's not available, just the storage counts are estimated
+    from the blocks reported by :mod:`resource`.
+
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(":", 1) for line in f if ":" in line)
+        return {
+            "bytes_read": int(counters["rchar"]),
+            "bytes_written": int(counters["wchar"]),
+            "storage_bytes_read": int(counters["read_bytes"]),
+            "storage_bytes_written": int(counters["write_bytes"]),
+        }
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    usage = _get_usage()
+    if usage is None:
+        return None
+    # Blocks are 512 bytes
+    return {
+        "storage_bytes_read": 512 * sum(u.ru_inblock for u in usage),
+        "storage_bytes_written": 512 * sum(u.ru_oublock for u in usage),
+    }
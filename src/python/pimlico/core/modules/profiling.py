@@ -0,0 +1,297 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Profiling of module execution, used by the `run` command's ``--profile`` option.
+
+While a module's executor runs, a profile is collected in the main process and in every
+worker process it starts, so that the time spent by the workers is included as well as that
+spent reading and writing data in the main process. At the end, the profiles from all the
+processes are merged and stored in the module's output directory:
+
+- ``profile.pstats``: function-level statistics, which can be read with :mod:`pstats`
+  (e.g. ``python -m pstats profile.pstats``) or a viewer like SnakeViz
+- ``profile.collapsed``: in sampling mode, the call stacks sampled, one per line with the number of
+  times it was seen, in the collapsed-stack format read by flame graph tools (``flamegraph.pl``,
+  speedscope, etc). Each stack starts with the process and thread it was seen in
+
+Later runs are stored as ``profile.1.pstats``, etc.
+
+There are two modes:
+
+- ``sampling`` (the default): a background thread in each process records the call stack of every
+  thread in the process (the main thread, the input feeder, any worker threads) every
+  ``profile_interval`` seconds (local config setting, default 0.01). This costs very little, so can be
+  used on full-size inputs. Time is wall-clock time, so includes time threads spend waiting: in the
+  pstats output, every sample counts as a call, so call counts are sample counts.
+- ``deterministic``: every function call is recorded using :mod:`cProfile`, which gives exact call counts,
+  but slows execution down a lot. Only the main thread of each process is profiled and no collapsed stacks
+  are produced.
+
+Worker processes are picked up when they're started by :mod:`multiprocessing` and store their profile
+when they exit. Workers that might be terminated once they've finished their work, like document map
+workers, should call :func:`store_process_profile` first. A worker that's killed (e.g. because it timed
+out) doesn't get to store its profile.
+
+"""
+import cProfile
+import marshal
+import multiprocessing
+import os
+import pickle
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+from collections import Counter
+from multiprocessing import util
+
+
+PROFILE_MODES = ["sampling", "deterministic"]
+
+# The profiler running in this process, if any
+_active_profiler = None
+
+
+class ModuleProfiler(object):
+    """
+    Profiles the main process from `start()` to `stop()`, and any process started by
+    :mod:`multiprocessing` in between, until it exits. Use `save()` once everything's finished
+    to merge the profiles.
+
+    """
+    DEFAULT_INTERVAL = 0.01
+    #: Deepest stack recorded by the sampler: anything deeper is cut off at the root end
+    MAX_DEPTH = 200
+
+    def __init__(self, mode="sampling", interval=None):
+        if mode not in PROFILE_MODES:
+            raise ValueError("unknown profiling mode '{}': choose from {}".format(mode, ", ".join(PROFILE_MODES)))
+        self.mode = mode
+        # May come from the local config as a string
+        self.interval = float(interval) if interval else self.DEFAULT_INTERVAL
+        self.profiles_dir = None
+        self.active = False
+        self._main_pid = None
+        self._sampler = None
+        self._cprofile = None
+
+    def start(self):
+        global _active_profiler
+        self.profiles_dir = tempfile.mkdtemp(prefix="pimlico-profile-")
+        self._main_pid = os.getpid()
+        self.active = True
+        _active_profiler = self
+        # Start profiling any processes that are forked
+        util.register_after_fork(self, ModuleProfiler._start_in_child)
+        self._start_process()
+
+    def stop(self):
+        """
+        Stop profiling the main process and write out its profile. Any other processes still
+        running will write theirs when they exit.
+
+        """
+        global _active_profiler
+        if not self.active:
+            return
+        self.active = False
+        _active_profiler = None
+        self._stop_process()
+
+    def _start_process(self):
+        if self.mode == "sampling":
+            self._sampler = StackSampler(self.interval, self.MAX_DEPTH)
+            self._sampler.start()
+        else:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def _stop_process(self):
+        # Does nothing if this process' profile has already been stored
+        path = os.path.join(self.profiles_dir, "{}.profile".format(os.getpid()))
+        if self.mode == "sampling":
+            sampler, self._sampler = self._sampler, None
+            if sampler is None:
+                return
+            sampler.stop()
+            process = "main" if os.getpid() == self._main_pid else multiprocessing.current_process().name
+            with open(path, "wb") as f:
+                pickle.dump({"process": process, "samples": sampler.samples}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            profile, self._cprofile = self._cprofile, None
+            if profile is None:
+                return
+            profile.disable()
+            profile.dump_stats(path)
+
+    @staticmethod
+    def _start_in_child(profiler):
+        # Called in a newly started multiprocessing process
+        if not profiler.active:
+            return
+        # The parent's profile is still recording in this process: we start again with a new one
+        if profiler._cprofile is not None:
+            profiler._cprofile.disable()
+        # Any sampler thread we've got a copy of isn't running in this process
+        profiler._sampler = profiler._cprofile = None
+        profiler._start_process()
+        # Store the profile when the process exits
+        util.Finalize(None, profiler._stop_process, exitpriority=100)
+
+    def save(self, output_dir):
+        """
+        Merge the profiles of all the processes and store them in `output_dir`. Should be called once
+        all the processes have ended.
+
+        :return: list of paths of files written
+        """
+        profile_paths = [os.path.join(self.profiles_dir, filename) for filename in sorted(os.listdir(self.profiles_dir))]
+        stats_path = new_profile_path(output_dir, "pstats")
+        paths = [stats_path]
+        try:
+            if self.mode == "sampling":
+                samples = Counter()
+                for path in profile_paths:
+                    with open(path, "rb") as f:
+                        process_profile = pickle.load(f)
+                    for (thread, stack), count in process_profile["samples"].items():
+                        samples[(process_profile["process"], thread, stack)] += count
+                with open(stats_path, "wb") as f:
+                    marshal.dump(samples_to_stats(samples, self.interval), f)
+                collapsed_path = "{}.collapsed".format(stats_path[:-len(".pstats")])
+                with open(collapsed_path, "w") as f:
+                    for line in collapsed_stacks(samples):
+                        f.write(line)
+                        f.write("\n")
+                paths.append(collapsed_path)
+            else:
+                if not profile_paths:
+                    return []
+                pstats.Stats(*profile_paths).dump_stats(stats_path)
+        finally:
+            self.discard()
+        return paths
+
+    def discard(self):
+        if self.profiles_dir is not None:
+            shutil.rmtree(self.profiles_dir, ignore_errors=True)
+
+
+def store_process_profile():
+    """
+    Stop profiling this process, if it's a worker process being profiled, and store its profile
+    for the main process to collect. Otherwise, it's only stored when the process exits.
+
+    """
+    profiler = _active_profiler
+    if profiler is not None and os.getpid() != profiler._main_pid:
+        profiler._stop_process()
+
+
+class StackSampler(threading.Thread):
+    """
+    Thread that records the stacks of all the other threads in the process every `interval`
+    seconds, until stopped. `samples` counts the times each stack has been seen, keyed by
+    `(thread name, stack)`, where the stack is a tuple of functions `(filename, line, name)`,
+    starting from the outermost.
+
+    """
+    def __init__(self, interval, max_depth):
+        super(StackSampler, self).__init__(name="StackSampler")
+        self.daemon = True
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread_names = {}
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                thread_name = self._thread_names.get(ident)
+                if thread_name is None:
+                    self._thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+                    thread_name = self._thread_names.get(ident, "thread-{}".format(ident))
+                self.samples[(thread_name, self._stack(frame))] += 1
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def samples_to_stats(samples, interval):
+    """
+    Build function statistics in the format used by :mod:`pstats` from sampled stacks,
+    counting each sample as a call taking `interval` seconds.
+
+    :param samples: dict counting samples, keyed by `(process, thread, stack)`
+    :return: dict of stats, which can be stored using :mod:`marshal` and loaded by :class:`pstats.Stats`
+    """
+    # Each function's [primitive calls, calls, own time, cumulative time, {caller: [same for calls from caller]}]
+    stats = {}
+    for (process, thread, stack), count in samples.items():
+        time = count * interval
+        seen = set()
+        for depth, func in enumerate(stack):
+            leaf = depth == len(stack) - 1
+            # Don't count the cumulative time twice for recursive calls
+            recursive = func in seen
+            seen.add(func)
+            func_stats = stats.setdefault(func, [0, 0, 0., 0., {}])
+            _add_sample(func_stats, count, time, leaf, recursive)
+            if depth > 0:
+                caller_stats = func_stats[4].setdefault(stack[depth - 1], [0, 0, 0., 0.])
+                _add_sample(caller_stats, count, time, leaf, recursive)
+    return dict(
+        (func, (cc, nc, tt, ct, dict((caller, tuple(caller_stats)) for (caller, caller_stats) in callers.items())))
+        for func, (cc, nc, tt, ct, callers) in stats.items()
+    )
+
+
+def _add_sample(func_stats, count, time, leaf, recursive):
+    if not recursive:
+        func_stats[0] += count
+        func_stats[3] += time
+    func_stats[1] += count
+    if leaf:
+        func_stats[2] += time
+
+
+def collapsed_stacks(samples):
+    """
+    Format sampled stacks in the collapsed-stack format used by flame graph tools: one line per stack,
+    giving the frames separated by semicolons, then a space and the number of samples.
+
+    :param samples: dict counting samples, keyed by `(process, thread, stack)`
+    """
+    for (process, thread, stack), count in sorted(samples.items(), key=lambda x: (x[0][0], x[0][1], x[0][2])):
+        frames = [process, thread] + ["{} ({}:{})".format(name, filename, line) for (filename, line, name) in stack]
+        yield "{} {}".format(";".join(frame.replace(";", ":") for frame in frames), count)
+
+
+def new_profile_path(output_dir, ext):
+    """
+    Path to store a new profile in a module's output directory, without overwriting earlier ones.
+
+    """
+    path = os.path.join(output_dir, "profile.{}".format(ext))
+    run_num = 1
+    while os.path.exists(path):
+        path = os.path.join(output_dir, "profile.{}.{}".format(run_num, ext))
+        run_num += 1
+    return path
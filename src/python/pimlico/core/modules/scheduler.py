@@ -0,0 +1,318 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""Parallel execution of modules
+
+When several modules are executed by a single `run` command (e.g. using `--all-deps` or `--all`), they are
+normally run one after another, in the order they're given. If the `run` command is given `--jobs` (`-j`)
+with a number greater than 1, the modules are instead executed by a scheduler, which starts each module
+as soon as all of the modules it depends on (among those being run) have been completed, running up to
+that number of modules at once.
+
+Each module is executed in its own process, exactly as it would be if it were run on its own, so it
+takes its usual lock, gets its status updated, etc.
+
+The number of modules run at once is also limited by the resources they use. Each module uses the
+number of processes set for the pipeline (in the local config or with `--processes`), unless this is
+overridden for the module using the special module parameter `processes`. Modules may also be given
+a memory budget (in MB), using the special module parameter `memory_budget`. A module is only started if
+the total processes and memory of all modules running at once would not exceed the limits given by the
+local config settings `max_processes` (by default, the number of CPUs) and `max_memory` (in MB; by
+default, unlimited). A module that on its own requires more than these limits will still be run,
+but not at the same time as any other module.
+
+"""
+from __future__ import unicode_literals
+
+from builtins import object
+
+import multiprocessing
+import sys
+
+from datetime import datetime
+from multiprocessing.connection import wait
+
+
+class ModuleScheduler(object):
+    """
+    Keeps track of which of a list of modules have been run and works out which can be started next,
+    according to their dependencies and resource requirements. Doesn't do any executing itself:
+    that's done by :func:`execute_modules_parallel`.
+
+    :param modules: loaded ModuleInfo instances, in an order in which they could be executed sequentially
+    :param jobs: maximum number of modules to run at once
+    :param max_processes: maximum total processes to be used by the modules running at once. None for no limit
+    :param max_memory: maximum total memory budget (in MB) of the modules running at once. None for no limit
+    """
+    def __init__(self, modules, jobs, max_processes=None, max_memory=None):
+        self.jobs = jobs
+        self.max_processes = max_processes
+        self.max_memory = max_memory
+
+        self.pending = list(modules)
+        self.running = []
+        self.completed = []
+        self.failed = []
+
+        # We only need to wait for dependencies that are among the modules we're running:
+        # others have been checked already to have their outputs ready
+        module_names = set(module.module_name for module in modules)
+        self.dependencies = dict(
+            (module.module_name, [dep for dep in module.get_transitive_dependencies() if dep in module_names])
+            for module in modules
+        )
+
+    @staticmethod
+    def requirements(module):
+        """
+        Resources that a module will use while running.
+
+        :return: tuple (processes, memory in MB)
+        """
+        return max(module.get_processes(), 1), module.get_memory_budget() or 0
+
+    def resources_in_use(self):
+        processes, memory = 0, 0
+        for module in self.running:
+            mod_processes, mod_memory = self.requirements(module)
+            processes += mod_processes
+            memory += mod_memory
+        return processes, memory
+
+    def dependencies_finished(self, module):
+        finished = set(self.completed) | set(self.failed)
+        return all(dep in finished for dep in self.dependencies[module.module_name])
+
+    def failed_dependencies(self, module):
+        """
+        :return: list of names of modules this one depends on that have failed
+        """
+        return [dep for dep in self.dependencies[module.module_name] if dep in self.failed]
+
+    def fits(self, module):
+        """
+        Check whether there are enough resources free to start this module now. If nothing's running, any
+        module can be started, even if it needs more than the limits.
+
+        """
+        if len(self.running) == 0:
+            return True
+        if len(self.running) >= self.jobs:
+            return False
+        processes, memory = self.requirements(module)
+        processes_in_use, memory_in_use = self.resources_in_use()
+        if self.max_processes is not None and processes_in_use + processes > self.max_processes:
+            return False
+        if self.max_memory is not None and memory_in_use + memory > self.max_memory:
+            return False
+        return True
+
+    def start_next(self):
+        """
+        Choose the next module to be started, if any can be. It is moved into the list of
+        running modules.
+
+        Modules are considered in the order they were given, but if the first one waiting can't be
+        started yet for lack of resources, a later one that needs fewer may be.
+
+        :return: module info, or None if no module can be started now
+        """
+        for module in self.pending:
+            if self.dependencies_finished(module) and self.fits(module):
+                self.pending.remove(module)
+                self.running.append(module)
+                return module
+        return None
+
+    def finish(self, module, success=True):
+        """
+        Record that a module that was started has finished running, successfully or not.
+
+        """
+        self.running.remove(module)
+        if success:
+            self.completed.append(module.module_name)
+        else:
+            self.failed.append(module.module_name)
+
+    def cancel_pending(self):
+        """
+        Don't start any more modules.
+
+        :return: the modules that were still waiting to be started
+        """
+        cancelled, self.pending = self.pending, []
+        return cancelled
+
+    @property
+    def done(self):
+        return len(self.pending) == 0 and len(self.running) == 0
+
+
+def get_resource_limits(pipeline):
+    """
+    Read the limits on resources that modules running in parallel may use from the local config.
+
+    :return: tuple (max processes, max memory in MB). Max memory is None if there's no limit
+    """
+    max_processes = pipeline.local_config.get("max_processes", None)
+    if max_processes is not None:
+        max_processes = int(max_processes)
+    else:
+        max_processes = multiprocessing.cpu_count()
+    max_memory = pipeline.local_config.get("max_memory", None)
+    if max_memory is not None:
+        max_memory = int(max_memory)
+    return max_processes, max_memory
+
+
+def execute_modules_parallel(pipeline, modules, log, jobs, force_rerun=False, debug=False, exit_on_error=False,
+                             preliminary=False, email=None, profile=None):
+    """
+    Execute a list of modules, running modules in parallel where their dependencies and resource limits
+    allow. Called by `execute_modules` when more than one job is requested. We assume that all checks have
+    been run and that the modules are ready to be executed.
+
+    :param jobs: maximum number of modules to execute at once
+    :return: exit status: 1 if any modules failed, otherwise 0
+    """
+    from pimlico.core.modules.execute import report_execution
+
+    max_processes, max_memory = get_resource_limits(pipeline)
+    scheduler = ModuleScheduler(modules, jobs, max_processes=max_processes, max_memory=max_memory)
+    log.info("Executing modules in parallel, up to %d at once, using up to %d processes%s: %s" % (
+        jobs, max_processes, " and %dMB of memory" % max_memory if max_memory is not None else "",
+        ", ".join(mod.module_name for mod in modules)
+    ))
+    start_time = datetime.now()
+    context = _get_fork_context()
+
+    error_modules = []
+    success_modules = []
+    skipped_modules = []
+    # Processes currently executing modules, keyed by their sentinels
+    running = {}
+
+    try:
+        while not scheduler.done:
+            # Start as many modules as we can
+            module = scheduler.start_next()
+            while module is not None:
+                module_name = module.module_name
+                failed_deps = scheduler.failed_dependencies(module)
+                # If a module we depend on failed, we might be unable to run this one, even though it passed the
+                # checks when we assumed the previous one had been run
+                missing_inputs = module.missing_data(assume_failed=error_modules) if failed_deps else []
+                if missing_inputs:
+                    log.warning("Cannot execute module '%s', since its inputs are not all ready (%s), "
+                                "after previous modules failed: %s" %
+                                (module_name, ", ".join(missing_inputs), "; ".join(failed_deps)))
+                    error_modules.append(module_name)
+                    scheduler.finish(module, success=False)
+                elif module.status == "COMPLETE" and not force_rerun:
+                    log.warning("module '%s' has already been run to completion. Use --force-rerun if you want to "
+                                "run it again and overwrite the output. Rerun not forced, so skipping module" %
+                                module_name)
+                    skipped_modules.append(module_name)
+                    scheduler.finish(module, success=True)
+                elif module.is_locked():
+                    # Something else has started executing the module since we checked it
+                    log.error("Cannot execute module '%s', since it is locked: is it currently being executed? "
+                              "If not, remove the lock using the 'unlock' command" % module_name)
+                    error_modules.append(module_name)
+                    scheduler.finish(module, success=False)
+                else:
+                    processes, memory = scheduler.requirements(module)
+                    log.info("Starting execution of module '%s', using %d process%s%s" % (
+                        module_name, processes, "es" if processes > 1 else "",
+                        " and %dMB of memory" % memory if memory else ""
+                    ))
+                    process = context.Process(
+                        target=_execute_module_process, name="pimlico-{}".format(module_name),
+                        args=(pipeline, module, log.getChild(module_name)),
+                        kwargs=dict(force_rerun=force_rerun, debug=debug, exit_on_error=exit_on_error,
+                                    preliminary=preliminary, email=email, profile=profile),
+                    )
+                    process.start()
+                    running[process.sentinel] = (process, module)
+
+                if exit_on_error and error_modules:
+                    break
+                module = scheduler.start_next()
+
+            if exit_on_error and error_modules:
+                _cancel_remaining(scheduler, log)
+            if not running:
+                # Everything's either finished or been cancelled
+                break
+
+            # Wait until one of the running modules finishes
+            for sentinel in wait(list(running.keys())):
+                process, module = running.pop(sentinel)
+                process.join()
+                module_name = module.module_name
+                # The module's status has been updated by the other process, so make sure we don't use a cached value
+                module._metadata = None
+                module._history = None
+
+                if process.exitcode == 0:
+                    log.info("Module '%s' finished executing" % module_name)
+                    success_modules.append(module_name)
+                    scheduler.finish(module, success=True)
+                else:
+                    if process.exitcode != 1:
+                        # Not the normal failure exit status: the process must have been killed
+                        log.error("Process executing module '%s' exited unexpectedly (exit code %s)" %
+                                  (module_name, process.exitcode))
+                        _release_lock(module)
+                    error_modules.append(module_name)
+                    scheduler.finish(module, success=False)
+                    if exit_on_error:
+                        _cancel_remaining(scheduler, log)
+    except KeyboardInterrupt:
+        # The modules' processes will also have received the interrupt
+        log.warning("Execution interrupted: waiting for running modules to stop")
+        for process, module in running.values():
+            process.join(10.)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            _release_lock(module)
+        raise
+
+    return report_execution(pipeline, log, modules, error_modules, success_modules, skipped_modules, start_time,
+                            email=email)
+
+
+def _execute_module_process(pipeline, module, log, **kwargs):
+    """
+    Target of the processes that each execute a single module.
+
+    """
+    from pimlico.core.modules.execute import execute_module
+
+    module_error = execute_module(pipeline, module, log, show_header=True, **kwargs)
+    sys.exit(1 if module_error else 0)
+
+
+def _cancel_remaining(scheduler, log):
+    cancelled = scheduler.cancel_pending()
+    if cancelled:
+        log.warning("Not executing remaining modules after error: %s" % ", ".join(m.module_name for m in cancelled))
+
+
+def _release_lock(module):
+    """
+    If a module's process was killed, it won't have had a chance to remove the module's execution lock,
+    so do that now.
+
+    """
+    if module.is_locked():
+        module.unlock()
+        module.add_execution_history_record("Execution of %s killed" % module.module_name)
+
+
+def _get_fork_context():
+    # Each module's process needs a copy of the loaded pipeline, so we fork
+    return multiprocessing.get_context("fork")
@@ -183,6 +183,11 @@ class IterableCorpus(PimlicoDatatype):
         browse_data(reader, formatter, skip_invalid=opts.skip_invalid)
 
     class Reader(object):
+        #: Whether the corpus can be split up into shards that are read independently (see
+        #: :class:`~pimlico.datatypes.corpora.grouped.GroupedCorpus`). An iterable corpus can
+        #: only be read from start to finish
+        shardable = False
+
         def __init__(self, *args, **kwargs):
             super(IterableCorpus.Reader, self).__init__(*args, **kwargs)
             # Call the data point type's reader_init() method to allow it to do anything
@@ -225,6 +230,25 @@ class IterableCorpus(PimlicoDatatype):
             for doc_name, doc in self:
                 yield doc_name
 
+        def map_reduce(self, map_fn, reduce_fn, processes=1, shard_size=None, progress=None):
+            """
+            Apply `map_fn` to an iterator over shards of the corpus, in parallel where possible,
+            and combine the results of the shards using `reduce_fn`. See
+            :meth:`GroupedCorpus.Reader.map_reduce() <pimlico.datatypes.corpora.grouped.GroupedCorpus.Reader.map_reduce>`,
+            which splits the corpus up by archive.
+
+            The default implementation, if not overridden by subclasses of IterableCorpus, has
+            no way of splitting up the corpus, so simply applies `map_fn` to the whole corpus
+            in this process.
+
+            :param progress: title of a progress bar to show while processing, or None not to show one
+            """
+            doc_iter = iter(self)
+            if progress is not None:
+                # The progress bar follows the documents as they're read
+                doc_iter = get_progress_bar(len(self), title=progress)(doc_iter)
+            return map_fn(doc_iter)
+
         def data_to_document(self, data, metadata=None):
             """
             Applies the corpus' datatype's processing to the raw data, given as a
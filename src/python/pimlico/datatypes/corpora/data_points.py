@@ -379,6 +379,18 @@ class DataPointType(with_metaclass(DataPointTypeMeta, object)):
         def __repr__(self):
             return "{}()".format(self.__class__.__name__)
 
+        def count_tokens(self):
+            """
+            Number of tokens in the document, if it makes sense for the document type and can be
+            computed cheaply. Otherwise None, which is the default.
+
+            This is stored in the index of archives that the document is written to, so that
+            readers can use it without reading the document, and is used by document map modules
+            that form batches under a token budget.
+
+            """
+            return None
+
         @property
         def raw_data(self):
             if self._raw_data is None:
@@ -8,6 +8,8 @@ from __future__ import print_function
 from future import standard_library
 
 from pimlico.utils.pimarc import PimarcReader, PimarcWriter
+from pimlico.utils.pimarc.compression import get_codec, PimarcCompressionError
+from pimlico.utils.pimarc.index import FilenameNotInArchive
 from pimlico.utils.pimarc.reader import StartAfterFilenameNotFound
 from pimlico.utils.pimarc.tar import PimarcTarBackend
 
@@ -18,13 +20,18 @@ from builtins import object
 from builtins import bytes
 
 import gzip
+import multiprocessing
 import os
 import zlib
+from collections import OrderedDict
+from functools import partial, reduce
+from itertools import islice
 from io import StringIO, BytesIO
 
-from pimlico.datatypes.base import DynamicOutputDatatype
+from pimlico.datatypes.base import DynamicOutputDatatype, DatatypeWriteError
 from pimlico.datatypes.corpora import IterableCorpus, DataPointType
 from pimlico.datatypes.corpora.data_points import is_invalid_doc
+from pimlico.utils.progress import get_progress_bar
 
 __all__ = [
     "GroupedCorpus", "AlignedGroupedCorpora",
@@ -39,6 +46,15 @@ class GroupedCorpus(IterableCorpus):
     document_preprocessors = []
 
     class Reader(object):
+        #: Number of open archives kept by `get_archive()` for random access, if not set
+        #: in the local config (`archive_cache_size`)
+        default_archive_cache_size = 8
+        #: Whether the corpus can be split up into shards that are read independently, using
+        #: `get_shards()` and `shard_iter()`, which read the archives from disk directly. Readers
+        #: that override `archive_iter()` to produce documents some other way, without archive
+        #: files, must set this to False
+        shardable = True
+
         class Setup(object):
             def data_ready(self, base_dir):
                 # Run the superclass check -- that the data dir exists
@@ -104,35 +120,81 @@ class GroupedCorpus(IterableCorpus):
             # Whether this corpus uses Pimarc (prc) files or tar
             self.uses_tar = not self.setup._uses_prc(self.data_dir)
 
-            # Cache the last-used archive
-            self._last_used_archive = None
-            self._last_used_archive_name = None
+            # Cache recently used archives, so that random access doesn't need to reopen them and reload the index
+            # Ordered from least to most recently used
+            self._archive_cache = OrderedDict()
+            if self.pipeline is not None and "archive_cache_size" in self.pipeline.local_config:
+                self.archive_cache_size = int(self.pipeline.local_config["archive_cache_size"])
+            else:
+                self.archive_cache_size = self.default_archive_cache_size
+            # Keep count of cache usage, to help tune the cache size
+            self.archive_cache_hits = 0
+            self.archive_cache_misses = 0
+
+        def _open_archive(self, archive_name):
+            archive_filename = self.archive_to_archive_filename[archive_name]
+            archive_path = os.path.join(self.data_dir, archive_filename)
+            if archive_filename.endswith(".tar"):
+                # Use the tar backend for backwards compatibility
+                return PimarcTarBackend(archive_path)
+            else:
+                return PimarcReader(archive_path)
 
         def get_archive(self, archive_name):
             """
             Return a `PimarcReader` for the named archive, or, if using the tar backend, a
             PimarcTarBackend.
 
+            The reader keeps the most recently used archives open (up to `archive_cache_size`,
+            which can be set in the local config), so that repeated access to the same archives
+            doesn't require them to be reopened. When an archive is dropped from the cache,
+            it is closed, so you should not hold on to the returned archive for a long time
+            while calling this method for other archives.
+
             """
-            if self._last_used_archive_name is None or self._last_used_archive_name != archive_name or \
-                    self._last_used_archive.closed:
-                archive_filename = self.archive_to_archive_filename[archive_name]
-                archive_path = os.path.join(self.data_dir, archive_filename)
-                if archive_filename.endswith(".tar"):
-                    # Use the tar backend for backwards compatibility
-                    arc = PimarcTarBackend(archive_path)
-                else:
-                    arc = PimarcReader(archive_path)
+            arc = self._archive_cache.get(archive_name, None)
+            if arc is not None and not arc.closed:
+                self.archive_cache_hits += 1
+                # Mark as most recently used
+                self._archive_cache.pop(archive_name)
+                self._archive_cache[archive_name] = arc
+                return arc
+
+            self.archive_cache_misses += 1
+            if arc is not None:
+                # It's been closed since it was cached: remove it
+                del self._archive_cache[archive_name]
+            arc = self._open_archive(archive_name)
+            if self.archive_cache_size > 0:
+                # Close the least recently used archives to make space
+                while len(self._archive_cache) >= self.archive_cache_size:
+                    __, old_arc = self._archive_cache.popitem(last=False)
+                    old_arc.close()
+                self._archive_cache[archive_name] = arc
+            return arc
+
+        def archive_cache_stats(self):
+            """
+            Statistics about the use of the cache of open archives, which may be useful for
+            choosing `archive_cache_size`.
 
-                # Close the cached archive
-                if self._last_used_archive is not None:
-                    self._last_used_archive.close()
-                # Replace it with the new one
-                self._last_used_archive_name = archive_name
-                self._last_used_archive = arc
+            :return: dict containing the cache size, number of archives open, hits and misses
+            """
+            return {
+                "size": self.archive_cache_size,
+                "open": len(self._archive_cache),
+                "hits": self.archive_cache_hits,
+                "misses": self.archive_cache_misses,
+            }
+
+        def close_archives(self):
+            """
+            Close all archives kept open in the cache.
 
-            # Used the cached archive
-            return self._last_used_archive
+            """
+            for arc in self._archive_cache.values():
+                arc.close()
+            self._archive_cache.clear()
 
         def extract_file(self, archive_name, filename):
             """
@@ -147,8 +209,9 @@ class GroupedCorpus(IterableCorpus):
             better approach is to load an archive and extract all the files from it you
             need before loading another.
 
-            The reader will cache the most recently used archive, so if you use this method
-            multiple times with the same archive name, it won't reload the index in between.
+            The reader will cache the most recently used archives (see `get_archive()`),
+            so if you use this method multiple times with the same archive names, it won't
+            reload the index in between.
 
             """
             __, file_data = self.get_archive(archive_name)[filename]
@@ -168,13 +231,18 @@ class GroupedCorpus(IterableCorpus):
 
             :param name_filter: if given, should be a callable that takes two args, an archive name and
                 document name, and returns True if the document should be yielded and False if it should be skipped.
-                This can be preferable to filtering the yielded documents, as it skips all document pre-processing
-                for skipped documents, so speeds up things like random subsampling of a corpus, where the
-                document content never needs to be read in skipped cases
+                This can be preferable to filtering the yielded documents, as the filter is applied using the
+                archives' indexes, so skipped documents are never read from disk and none of their pre-processing
+                is done. This speeds up things like random subsampling of a corpus or selecting a few documents
+                by name
             :param start_after: skip over the first portion of the corpus, until the given document
                 is reached. Should be specified as a pair (archive name, doc name)
             :param skip: skips over the first portion of the corpus, until this number of documents have
                 been seen
+
+            Both `start_after` and `skip` use the archives' indexes to jump straight to the first document
+            required, so resuming iteration deep into a large corpus does not require reading everything
+            before it.
             """
             gzipped = self.metadata.get("gzip", False)
             if skip is not None and skip < 1:
@@ -199,7 +267,9 @@ class GroupedCorpus(IterableCorpus):
                         continue
 
                 # Now we're either reading the whole of this archive, or starting after a filename in it
-                with self.get_archive(archive_name) as archive:
+                # We open the archive separately from the cache used for random access, so that
+                # random access during iteration doesn't disturb the iteration
+                with self._open_archive(archive_name) as archive:
                     skip_in_archive = None
                     start_after_in_archive = None
                     # Allow the first portion of the corpus to be skipped
@@ -223,35 +293,19 @@ class GroupedCorpus(IterableCorpus):
                             # Don't skip at all in future archives
                             skipped = -1
 
+                    if name_filter is not None:
+                        # If subsampling or filtering, the archive decides whether to read each file from its
+                        # name alone, so rejected files are never read
+                        archive_name_filter = partial(_filter_archive_filename, name_filter, archive_name, gzipped)
+                    else:
+                        archive_name_filter = None
+
                     try:
                         # Iterate over the files in the archive
                         for metadata, raw_data in archive.iter_files(
-                                skip=skip_in_archive, start_after=start_after_in_archive):
-                            filename = metadata["name"]
-                            # By default, doc name is just the same as filename
-                            doc_name = filename
-                            if gzipped and doc_name.endswith(".gz"):
-                                # If we used the .gz extension while writing the file, remove it to get the doc name
-                                doc_name = doc_name[:-3]
-
-                            # If subsampling or filtering, decide whether to extract this file
-                            if name_filter is not None and not name_filter(archive_name, doc_name):
-                                # Reject this file
-                                continue
-
-                            if gzipped:
-                                if doc_name.endswith(".gz"):
-                                    # Gzipped document
-                                    with gzip.GzipFile(fileobj=BytesIO(raw_data), mode="rb") as gzip_file:
-                                        raw_data = gzip_file.read()
-                                else:
-                                    # For backwards-compatibility, where gzip=True, but the gz extension wasn't used, we
-                                    #  just decompress with zlib, without trying to parse the gzip headers
-                                    raw_data = zlib.decompress(raw_data)
-
-                            # Apply subclass-specific post-processing and produce a document instance
-                            document = self.data_to_document(raw_data)
-
+                                skip=skip_in_archive, start_after=start_after_in_archive,
+                                name_filter=archive_name_filter):
+                            doc_name, document = self._read_archive_file(metadata, raw_data, gzipped)
                             yield archive_name, doc_name, document
 
                     except StartAfterFilenameNotFound:
@@ -264,10 +318,169 @@ class GroupedCorpus(IterableCorpus):
                             (start_after_req[0], start_after_req[1], start_after_req[1], archive_name)
                         )
 
+        def get_document(self, archive_name, doc_name):
+            """
+            Read a single document by archive name and document name, using random access
+            to the archive (see `extract_file()`).
+
+            :return: document instance
+            """
+            gzipped = self.metadata.get("gzip", False)
+            archive = self.get_archive(archive_name)
+            filenames = ["{}.gz".format(doc_name), doc_name] if gzipped else [doc_name]
+            for filename in filenames:
+                try:
+                    metadata, raw_data = archive[filename]
+                except (FilenameNotInArchive, KeyError):
+                    continue
+                return self._read_archive_file(metadata, raw_data, gzipped)[1]
+            raise FilenameNotInArchive(doc_name)
+
+        def get_document_size(self, archive_name, doc_name):
+            """
+            Size of a document, as recorded in its archive's index when it was written, without
+            reading the document. The length is of the data as stored, so is the compressed
+            length if the corpus is gzipped. The token count is only available for document
+            types that can count their tokens (see `count_tokens()` on the document type).
+
+            :return: tuple (length in bytes, token count), either of which may be None if unknown
+            """
+            archive = self.get_archive(archive_name)
+            if isinstance(archive, PimarcTarBackend):
+                # Tar archives don't record sizes
+                return None, None
+            filename = "{}.gz".format(doc_name) if self.metadata.get("gzip", False) else doc_name
+            if filename not in archive.index and doc_name in archive.index:
+                # For backwards-compatibility, where gzip=True, but the gz extension wasn't used
+                filename = doc_name
+            return archive.index.get_size(filename)
+
+        def _read_archive_file(self, metadata, raw_data, gzipped):
+            """
+            Process a file read from one of the corpus' archives to get the document name and
+            the document instance.
+
+            :return: tuple (doc name, document)
+            """
+            filename = metadata["name"]
+            # By default, doc name is just the same as filename
+            doc_name = filename
+            if gzipped and doc_name.endswith(".gz"):
+                # If we used the .gz extension while writing the file, remove it to get the doc name
+                doc_name = doc_name[:-3]
+
+            if gzipped:
+                if filename.endswith(".gz"):
+                    # Gzipped document
+                    with gzip.GzipFile(fileobj=BytesIO(raw_data), mode="rb") as gzip_file:
+                        raw_data = gzip_file.read()
+                else:
+                    # For backwards-compatibility, where gzip=True, but the gz extension wasn't used, we
+                    #  just decompress with zlib, without trying to parse the gzip headers
+                    raw_data = zlib.decompress(raw_data)
+
+            # Apply subclass-specific post-processing and produce a document instance
+            return doc_name, self.data_to_document(raw_data)
+
+        def get_shards(self, shard_size=None):
+            """
+            Split the corpus into shards that can be processed independently, e.g. by
+            `map_reduce()`. By default, each archive is a shard. If `shard_size` is given,
+            archives are further split into ranges of documents, using the archives' indexes,
+            so that no shard contains more than this number of documents.
+
+            :param shard_size: maximum number of documents in a shard
+            :return: list of shards, each a tuple (archive name, start position, end position), where the end
+                is None to read to the end of the archive
+            """
+            shards = []
+            for archive_name in self.archives:
+                if shard_size is None:
+                    shards.append((archive_name, 0, None))
+                else:
+                    with self._open_archive(archive_name) as archive:
+                        archive_length = len(archive)
+                    for start in range(0, archive_length, shard_size):
+                        shards.append((archive_name, start, min(start + shard_size, archive_length)))
+            return shards
+
+        def shard_iter(self, shard):
+            """
+            Iterate over the documents in one shard of the corpus, as returned by `get_shards()`,
+            yielding pairs `(doc_name, doc)`, like iterating over the whole corpus.
+
+            """
+            archive_name, start, end = shard
+            gzipped = self.metadata.get("gzip", False)
+            with self._open_archive(archive_name) as archive:
+                file_iter = archive.iter_files(skip=start)
+                if end is not None:
+                    file_iter = islice(file_iter, end - start)
+                for metadata, raw_data in file_iter:
+                    yield self._read_archive_file(metadata, raw_data, gzipped)
+
+        def map_reduce(self, map_fn, reduce_fn, processes=1, shard_size=None, progress=None):
+            """
+            Process the corpus in shards (see `get_shards()`), in parallel using a pool of
+            `processes` worker processes, and combine the results.
+
+            `map_fn` is called for each shard with an iterator over the shard's documents
+            (pairs `(doc_name, doc)`, as when iterating over the corpus) and should return the
+            result of processing them, which must be picklable. `reduce_fn` takes two such
+            results and returns the combination of them (e.g. the sum of two Counters).
+            Results are combined in the order of the shards, as they become available.
+
+            Since the worker processes are forked, `map_fn` and `reduce_fn` need not be
+            picklable, so may be lambdas or closures.
+
+            This allows any module that aggregates something over a corpus to use all of the
+            available processes, without the per-document overhead of document map modules.
+
+            :param map_fn: function to apply to an iterator over each shard's documents
+            :param reduce_fn: function to combine the results of two shards
+            :param processes: number of worker processes. If 1, the shards are all processed in this process
+            :param shard_size: maximum number of documents in a shard. By default, each archive is one shard
+            :param progress: title of a progress bar to show while processing, or None not to show one.
+                Progress is counted in completed shards
+            :return: the combined result of all shards
+            """
+            if not self.shardable:
+                # Fall back to processing the whole corpus in one go
+                return IterableCorpus.Reader.map_reduce(self, map_fn, reduce_fn, progress=progress)
+
+            shards = self.get_shards(shard_size=shard_size)
+            if len(shards) == 0:
+                # Still apply the map function, so we get an empty result
+                return map_fn(iter([]))
+
+            def _progress(results):
+                if progress is None:
+                    return results
+                return get_progress_bar(len(shards), title=progress)(results)
+
+            if processes <= 1 or len(shards) == 1:
+                results = (map_fn(self.shard_iter(shard)) for shard in shards)
+                return reduce(reduce_fn, _progress(results))
+
+            global _map_reduce_job
+            # The workers get the reader and function when they're forked, so they don't need to be pickled
+            _map_reduce_job = (self, map_fn)
+            try:
+                pool = multiprocessing.get_context("fork").Pool(min(processes, len(shards)))
+                try:
+                    result = reduce(reduce_fn, _progress(pool.imap(_map_shard, shards)))
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+            finally:
+                _map_reduce_job = None
+            return result
+
         def list_archive_iter(self):
             gzipped = self.metadata.get("gzip", False)
             for archive_name in self.archives:
-                with self.get_archive(archive_name) as archive:
+                with self._open_archive(archive_name) as archive:
                     for filename in archive.iter_filenames():
                         # Do the same name preprocessing that archive_iter does
                         doc_name = filename
@@ -307,7 +520,25 @@ class GroupedCorpus(IterableCorpus):
                 False,
                 "Gzip each document before adding it to the archive. Not the same as creating a tarball, "
                 "since the docs are gzipped *before* adding them, not the whole archive together, but means "
-                "we can easily iterate over the documents, unzipping them as required"
+                "we can easily iterate over the documents, unzipping them as required. Ignored if "
+                "compression is used"
+            ),
+            "compression": (
+                None,
+                "Block-compress the Pimarc archives using the given codec: zlib, lzma or zstd (if "
+                "available). Documents are compressed together in blocks, which is faster and much more "
+                "effective than gzipping each document. Typically set using the special module parameters "
+                "compression or compression_<output> in the config file"
+            ),
+            "compression_level": (
+                None,
+                "Compression level to use with the codec given by compression. By default, the codec's default"
+            ),
+            "unordered": (
+                False,
+                "The documents within each archive are not necessarily in the same order as in the corpus "
+                "this one was produced from (see the unordered_output module parameter). Aligned corpora are "
+                "then read by matching up document names"
             ),
         }
         writer_param_defaults = {
@@ -322,6 +553,16 @@ class GroupedCorpus(IterableCorpus):
         def __init__(self, *args, **kwargs):
             super(GroupedCorpus.Writer, self).__init__(*args, **kwargs)
 
+            self.compression = self.metadata["compression"]
+            self.compression_level = self.metadata["compression_level"]
+            if self.compression is not None:
+                # Check now that the codec is available, so we don't fail once we've started writing
+                try:
+                    get_codec(self.compression, self.compression_level)
+                except PimarcCompressionError as e:
+                    raise DatatypeWriteError("cannot write compressed corpus: {}".format(e))
+                # There's no point in gzipping documents before compressing them
+                self.metadata["gzip"] = False
             # Set "gzip" in the metadata, so we know to unzip when reading
             self.gzip = self.metadata["gzip"]
             self.append = self.params["append"]
@@ -357,6 +598,8 @@ class GroupedCorpus(IterableCorpus):
             :param doc_name: name of document
             :param doc: document instance or bytes object containing document's raw data
             """
+            # The number of tokens in the doc is stored in the index if the document type can count them
+            tokens = None
             # A document instance provides access to the raw data for a document as a bytes (Py3) or string (Py2)
             # If it's not directly available, it will be converted when we try to retrieve the raw data
             try:
@@ -366,7 +609,9 @@ class GroupedCorpus(IterableCorpus):
                 # is the right thing to use
                 # If it's a dict, we can instantiate a Document object to convert to raw bytes
                 if type(doc) is dict:
-                    data = self.datatype.data_point_type(**doc).raw_data
+                    doc = self.datatype.data_point_type(**doc)
+                    data = doc.raw_data
+                    tokens = doc.count_tokens()
                 # If a bytes object is given, we assume that's the doc's raw data
                 elif type(doc) is bytes:
                     data = doc
@@ -387,6 +632,8 @@ class GroupedCorpus(IterableCorpus):
                 if metadata is not None:
                     doc_metadata.update(metadata)
                 metadata = doc_metadata
+                if isinstance(doc, DataPointType.Document):
+                    tokens = doc.count_tokens()
 
             if data is None:
                 # For an empty result, signified by None, output an empty file
@@ -414,7 +661,9 @@ class GroupedCorpus(IterableCorpus):
                 arc_filename = os.path.join(self.data_dir, "{}.prc".format(archive_name))
                 # If we're appending a corpus and the archive already exists, append to it
                 self.current_archive = PimarcWriter(arc_filename,
-                                                    mode="a" if self.append and os.path.exists(arc_filename) else "w")
+                                                    mode="a" if self.append and os.path.exists(arc_filename) else "w",
+                                                    compression=self.compression,
+                                                    compression_level=self.compression_level)
 
             # Add a new document to archive
             if self.gzip:
@@ -429,7 +678,7 @@ class GroupedCorpus(IterableCorpus):
                 filename = doc_name
 
             # Append this document's data to the Pimarc
-            self.current_archive.write_file(data, name=filename, metadata=metadata)
+            self.current_archive.write_file(data, name=filename, metadata=metadata, tokens=tokens)
             # We used to flush after every write, but it's very slow
             # See note in flush() docstring
             #self.flush()
@@ -451,9 +700,25 @@ class GroupedCorpus(IterableCorpus):
             if self.current_archive is not None:
                 self.current_archive.flush()
 
+        def close_archive(self):
+            """
+            Finish writing the archive currently being written, if any, so that it's complete on
+            disk. If further documents are added to the same archive, it will be overwritten, or
+            appended to if the writer is in append mode.
+
+            Used when separate processes write different archives of the same corpus, each
+            using a copy of the writer.
+
+            """
+            if self.current_archive is not None:
+                self.current_archive.close()
+            self.current_archive = None
+            self.current_archive_name = None
+
         def __exit__(self, exc_type, exc_val, exc_tb):
             if self.current_archive is not None:
                 self.current_archive.close()
+                self.current_archive = None
             self.metadata["length"] = self.doc_count
             del self.metadata["writing"]
             super(GroupedCorpus.Writer, self).__exit__(exc_type, exc_val, exc_tb)
@@ -489,6 +754,27 @@ class GroupedCorpus(IterableCorpus):
                 PimarcWriter.delete(archive_filename)
 
 
+# Set while map_reduce() is running, so that forked workers can access the reader and map function
+_map_reduce_job = None
+
+
+def _map_shard(shard):
+    """ Function executed by `map_reduce()` workers. """
+    reader, map_fn = _map_reduce_job
+    return map_fn(reader.shard_iter(shard))
+
+
+def _filter_archive_filename(name_filter, archive_name, gzipped, filename):
+    """
+    Apply a name filter given to `GroupedCorpus.Reader.archive_iter()` to a filename in an
+    archive, converting the filename to a doc name in the same way as when documents are read.
+
+    """
+    if gzipped and filename.endswith(".gz"):
+        filename = filename[:-3]
+    return name_filter(archive_name, filename)
+
+
 def exclude_invalid(doc_iter):
     """
     Generator that skips any invalid docs when iterating over a document dataset.
@@ -514,11 +800,34 @@ class AlignedGroupedCorpora(object):
         if not all(c.archives == self.archives for c in self.readers):
             raise CorpusAlignmentError("not all corpora have the same archives in them, cannot align")
 
+        # If some corpora were written with documents out of order within their archives, we can't just
+        #  iterate over them all together. Instead, one corpus gives the order (one that's not out of
+        #  order, if possible) and documents are looked up by name in the others
+        unordered = [reader.metadata.get("unordered", False) for reader in self.readers]
+        if any(unordered):
+            self.order_reader = self.readers[unordered.index(False)] if not all(unordered) else self.readers[0]
+        else:
+            self.order_reader = None
+
+    @property
+    def unordered(self):
+        """
+        True if iterating over the corpora does not give the documents in the order of the
+        corpus they were originally produced from.
+
+        """
+        return self.order_reader is not None and self.order_reader.metadata.get("unordered", False)
+
     def __iter__(self):
         for archive, filename, docs in self.archive_iter():
             yield filename, docs
 
     def archive_iter(self, start_after=None, skip=None, name_filter=None):
+        if self.order_reader is not None:
+            for item in self._archive_iter_by_name(start_after=start_after, skip=skip, name_filter=name_filter):
+                yield item
+            return
+
         # Iterate over all grouped corpora at once
         for corpus_items in zip(
                 *[corpus.archive_iter(start_after=start_after, skip=skip)
@@ -537,6 +846,52 @@ class AlignedGroupedCorpora(object):
 
             yield corpus_items[0][0], corpus_items[0][1], [corpus_item[2] for corpus_item in corpus_items]
 
+    def shard_iter(self, shard):
+        """
+        Iterate over one shard of all the corpora at once, yielding the same as `archive_iter()`.
+        See :meth:`GroupedCorpus.Reader.get_shards()`.
+
+        """
+        archive_name = shard[0]
+        if self.order_reader is not None:
+            for doc_name, doc in self.order_reader.shard_iter(shard):
+                yield archive_name, doc_name, [
+                    doc if reader is self.order_reader else self._get_document(reader, archive_name, doc_name)
+                    for reader in self.readers
+                ]
+            return
+
+        for corpus_items in zip(*[corpus.shard_iter(shard) for corpus in self.readers]):
+            if not all(corpus_item[0] == corpus_items[0][0] for corpus_item in corpus_items[1:]):
+                raise CorpusAlignmentError(
+                    "filenames within archive %s in grouped corpora do not correspond: %s" %
+                    (archive_name, ", ".join(corpus_item[0] for corpus_item in corpus_items))
+                )
+            yield archive_name, corpus_items[0][0], [corpus_item[1] for corpus_item in corpus_items]
+
+    def _archive_iter_by_name(self, start_after=None, skip=None, name_filter=None):
+        """
+        Iterate in the order of `order_reader`, looking up documents by name in the other corpora.
+
+        """
+        for archive_name, doc_name, doc in self.order_reader.archive_iter(
+                start_after=start_after, skip=skip, name_filter=name_filter):
+            yield archive_name, doc_name, [
+                doc if reader is self.order_reader else self._get_document(reader, archive_name, doc_name)
+                for reader in self.readers
+            ]
+
+    def _get_document(self, reader, archive_name, doc_name):
+        try:
+            return reader.get_document(archive_name, doc_name)
+        except FilenameNotInArchive:
+            raise CorpusAlignmentError("document %s/%s not found in all grouped corpora" % (archive_name, doc_name))
+
+    @property
+    def shardable(self):
+        # Readers that don't say whether they can be split up are assumed not to be
+        return all(getattr(reader, "shardable", False) for reader in self.readers)
+
     def __len__(self):
         return len(self.readers[0])
 
@@ -7,6 +7,12 @@ Corpora consisting of lists of ints. These data point types are useful,
 for example, for encoding text or other sequence data as integer IDs.
 They are designed to be fast to read.
 
+If Numpy is installed, the ints are read and written as whole arrays, which is
+much faster than handling one int at a time. Otherwise, we fall back to
+using :mod:`struct` for each int. The stored format is the same either way.
+Documents also provide access to their ints directly as Numpy arrays, which
+avoids building Python lists if you're going to use Numpy anyway.
+
 """
 from __future__ import absolute_import
 
@@ -18,10 +24,52 @@ from builtins import bytes
 
 import struct
 from io import StringIO, BytesIO
+from itertools import chain
+
+try:
+    import numpy
+except ImportError:
+    # Numpy isn't a core dependency: without it, we read and write one int at a time
+    numpy = None
 
 from pimlico.datatypes.corpora.data_points import RawDocumentType
 from pimlico.utils.core import cached_property
-from .table import get_struct
+from .table import get_struct, BYTE_FORMATS
+
+
+def get_dtype(bytes, signed):
+    """
+    Numpy equivalent of :func:`~pimlico.datatypes.corpora.table.get_struct`: get the dtype
+    for reading and writing single ints in the same format.
+
+    """
+    if (bytes, signed) not in BYTE_FORMATS:
+        raise ValueError("invalid specification for int format: signed=%s, bytes=%s. signed must be bool, "
+                         "bytes in [1, 2, 4, 8]" % (signed, bytes))
+    # The struct format always uses little-endian, standard-sized ints
+    return numpy.dtype("<%s%d" % ("i" if signed else "u", bytes))
+
+
+def ints_to_array(ints, dtype):
+    """
+    Convert a sequence of ints to a Numpy array of the given dtype, checking that they
+    can all be represented in it.
+
+    :raises ValueError: if the values aren't all ints, or some are out of range
+    """
+    try:
+        arr = numpy.asarray(ints)
+    except OverflowError as e:
+        raise ValueError("ints out of range: %s" % e)
+    if arr.size == 0:
+        return numpy.zeros(0, dtype=dtype)
+    if arr.dtype.kind not in "biu":
+        raise ValueError("expected ints, but got values of type %s" % arr.dtype)
+    info = numpy.iinfo(dtype)
+    if arr.min() < info.min or arr.max() > info.max:
+        raise ValueError("ints out of range for %d-byte %s ints" %
+                         (info.bits // 8, "signed" if info.kind == "i" else "unsigned"))
+    return arr.astype(dtype)
 
 
 class IntegerListsDocumentType(RawDocumentType):
@@ -89,6 +137,14 @@ class IntegerListsDocumentType(RawDocumentType):
         # We use a separate struct for the row lengths
         return get_struct(self.row_length_bytes, False, 1)
 
+    @cached_property
+    def dtype(self):
+        return get_dtype(self.bytes, self.signed)
+
+    @cached_property
+    def length_dtype(self):
+        return get_dtype(self.row_length_bytes, False)
+
     def __getstate__(self):
         # Don't pickle the prepared structs, as they don't pickle nicely
         # They get recreated on demand anyway
@@ -103,8 +159,15 @@ class IntegerListsDocumentType(RawDocumentType):
         keys = ["lists"]
 
         def raw_to_internal(self, raw_data):
-            reader = BytesIO(raw_data)
-            lists = list(self.read_rows(reader))
+            if numpy is not None:
+                values, offsets = self.decode_arrays(raw_data)
+                # Converting the whole array to a list at once is much faster than converting each row
+                values = values.tolist()
+                offsets = offsets.tolist()
+                lists = [values[start:end] for (start, end) in zip(offsets[:-1], offsets[1:])]
+            else:
+                reader = BytesIO(raw_data)
+                lists = list(self.read_rows(reader))
             return {
                 "lists": lists,
             }
@@ -113,6 +176,106 @@ class IntegerListsDocumentType(RawDocumentType):
         def lists(self):
             return self.internal_data["lists"]
 
+        @cached_property
+        def arrays(self):
+            """
+            The document's ints as Numpy arrays, instead of the lists of lists given by `lists`.
+            If the document has been read from a corpus, this reads the data straight into an
+            array, without building any Python lists.
+
+            Requires Numpy.
+
+            :return: tuple `(values, offsets)`. `values` is a 1D array of all the ints in the document.
+                `offsets` is a 1D array with one more element than there are lists, giving the positions
+                in `values` where each list starts and ends: list `i` is `values[offsets[i]:offsets[i+1]]`
+            """
+            if numpy is None:
+                raise ImportError("Numpy is required to get integer lists as arrays")
+            if self._raw_data is not None:
+                return self.decode_arrays(self._raw_data)
+            else:
+                return self.lists_to_arrays(self.lists)
+
+        @property
+        def array_lists(self):
+            """
+            The document's ints as a list of Numpy arrays, one for each list. The arrays are views
+            of the `values` array in `arrays`.
+
+            """
+            values, offsets = self.arrays
+            return [values[start:end] for (start, end) in zip(offsets[:-1], offsets[1:])]
+
+        def decode_arrays(self, raw_data):
+            """
+            Read raw data into Numpy arrays. See `arrays` for the form of the result.
+
+            """
+            length_unpacker = self.data_point_type.length_struct
+            length_size = length_unpacker.size
+            int_size = self.data_point_type.int_size
+            data_size = len(raw_data)
+
+            # The length of each row comes before the row, so we have to step through them to find them
+            length_positions = []
+            lengths = []
+            pos = 0
+            while pos < data_size:
+                if pos + length_size > data_size:
+                    raise IOError("file ended mid-row")
+                row_length = length_unpacker.unpack_from(raw_data, pos)[0]
+                length_positions.append(pos)
+                lengths.append(row_length)
+                pos += length_size + row_length * int_size
+            if pos > data_size:
+                raise IOError("file ended mid-row")
+
+            offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+            numpy.cumsum(lengths, out=offsets[1:])
+            if len(lengths) == 0:
+                return numpy.zeros(0, dtype=self.data_point_type.dtype), offsets
+
+            # Cut out all the lengths and read all the rest of the data as a single array of ints
+            data = numpy.frombuffer(raw_data, dtype=numpy.uint8)
+            is_int = numpy.ones(data_size, dtype=bool)
+            is_int[(numpy.array(length_positions)[:, numpy.newaxis] + numpy.arange(length_size)).ravel()] = False
+            values = data[is_int].view(self.data_point_type.dtype)
+            return values, offsets
+
+        def lists_to_arrays(self, lists):
+            """
+            Convert lists of ints to the array form used by `arrays`.
+
+            :raises ValueError: if the lists can't be encoded using the data point type's int format
+            """
+            lists = list(lists)
+            lengths = [len(row) for row in lists]
+            offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+            numpy.cumsum(lengths, out=offsets[1:])
+            values = ints_to_array(list(chain.from_iterable(lists)), self.data_point_type.dtype)
+            return values, offsets
+
+        def encode_arrays(self, values, offsets):
+            """
+            Produce raw data from Numpy arrays in the form used by `arrays`.
+
+            """
+            length_size = self.data_point_type.length_size
+            int_size = self.data_point_type.int_size
+            lengths = ints_to_array(numpy.diff(offsets), self.data_point_type.length_dtype)
+            num_rows = len(lengths)
+
+            data = numpy.empty(num_rows * length_size + len(values) * int_size, dtype=numpy.uint8)
+            # Work out where each row's length goes: after all the previous rows and their lengths
+            length_positions = numpy.arange(num_rows) * length_size + offsets[:-1] * int_size
+            is_int = numpy.ones(len(data), dtype=bool)
+            length_bytes = (length_positions[:, numpy.newaxis] + numpy.arange(length_size)).ravel()
+            is_int[length_bytes] = False
+            # Fill in the lengths and put all the ints in the gaps between them
+            data[length_bytes] = lengths.view(numpy.uint8)
+            data[is_int] = numpy.ascontiguousarray(values, dtype=self.data_point_type.dtype).view(numpy.uint8)
+            return data.tobytes()
+
         def read_rows(self, reader):
             unpacker = self.data_point_type.struct
             int_size = self.data_point_type.int_size
@@ -140,6 +303,13 @@ class IntegerListsDocumentType(RawDocumentType):
                 yield list(_read_row(row_length))
 
         def internal_to_raw(self, internal_data):
+            if numpy is not None:
+                try:
+                    return self.encode_arrays(*self.lists_to_arrays(internal_data["lists"]))
+                except ValueError as e:
+                    raise ValueError("error encoding int rows using format %s: %s" %
+                                     (self.data_point_type.dtype, e))
+
             raw_data = BytesIO()
             for row in internal_data["lists"]:
                 # Should be rows of ints
@@ -192,6 +362,10 @@ class IntegerListDocumentType(RawDocumentType):
     def struct(self):
         return get_struct(self.bytes, self.signed, 1)
 
+    @cached_property
+    def dtype(self):
+        return get_dtype(self.bytes, self.signed)
+
     def __getstate__(self):
         # Don't pickle the prepared struct, as it doesn't pickle nicely
         # It gets recreated on demand anyway
@@ -204,8 +378,11 @@ class IntegerListDocumentType(RawDocumentType):
         keys = ["list"]
 
         def raw_to_internal(self, raw_data):
-            reader = BytesIO(raw_data)
-            lst = list(self.read_rows(reader))
+            if numpy is not None:
+                lst = self.decode_array(raw_data).tolist()
+            else:
+                reader = BytesIO(raw_data)
+                lst = list(self.read_rows(reader))
             return {
                 "list": lst,
             }
@@ -214,6 +391,31 @@ class IntegerListDocumentType(RawDocumentType):
         def list(self):
             return self.internal_data["list"]
 
+        @cached_property
+        def array(self):
+            """
+            The document's ints as a 1D Numpy array, instead of the list given by `list`.
+            If the document has been read from a corpus, this reads the data straight into
+            an array, without building a Python list. In this case, the array is a read-only
+            view of the raw data: copy it if you need to modify it.
+
+            Requires Numpy.
+
+            """
+            if numpy is None:
+                raise ImportError("Numpy is required to get integer lists as arrays")
+            if self._raw_data is not None:
+                return self.decode_array(self._raw_data)
+            else:
+                return ints_to_array(self.list, self.data_point_type.dtype)
+
+        def decode_array(self, raw_data):
+            dtype = self.data_point_type.dtype
+            if len(raw_data) % dtype.itemsize != 0:
+                raise IOError("error interpreting int data: got %d bytes, which is not a multiple of the int size "
+                              "(%d)" % (len(raw_data), dtype.itemsize))
+            return numpy.frombuffer(raw_data, dtype=dtype)
+
         def read_rows(self, reader):
             while True:
                 # Read the whole document, one int at a time
@@ -227,6 +429,12 @@ class IntegerListDocumentType(RawDocumentType):
                 yield num
 
         def internal_to_raw(self, internal_data):
+            if numpy is not None:
+                try:
+                    return ints_to_array(internal_data["list"], self.data_point_type.dtype).tobytes()
+                except ValueError as e:
+                    raise ValueError("error encoding int data using format %s: %s" % (self.data_point_type.dtype, e))
+
             raw_data = BytesIO()
             # Doc should be a list of ints
             for num in internal_data["list"]:
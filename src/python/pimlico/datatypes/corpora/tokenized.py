@@ -43,6 +43,18 @@ class TokenizedDocumentType(TextDocumentType):
         def internal_to_raw(self, internal_data):
             return bytes("\n".join(" ".join(sentence) for sentence in internal_data["sentences"]).encode("utf-8"))
 
+        def count_tokens(self):
+            if self._internal_data is not None:
+                return sum(len(sentence) for sentence in self.internal_data["sentences"])
+            elif not self._raw_data:
+                return 0
+            else:
+                return self._count_raw_tokens(self._raw_data)
+
+        def _count_raw_tokens(self, raw_data):
+            # Tokens are separated by spaces and sentences by newlines
+            return raw_data.count(b" ") + raw_data.count(b"\n") + 1
+
 
 class TokenizedDocumentFormatter(DocumentBrowserFormatter):
     """
@@ -91,6 +103,10 @@ class CharacterTokenizedDocumentType(TokenizedDocumentType):
         def internal_to_raw(self, internal_data):
             return bytes("\n".join("".join(sentence) for sentence in internal_data["sentences"]).encode("utf-8"))
 
+        def _count_raw_tokens(self, raw_data):
+            # Every character apart from the newlines between sentences is a token
+            return len(raw_data.decode("utf-8")) - raw_data.count(b"\n")
+
 
 class SegmentedLinesDocumentType(TokenizedDocumentType):
     """
@@ -130,3 +146,6 @@ class SegmentedLinesDocumentType(TokenizedDocumentType):
                 "/".join(el.replace("/", "@slash@") for el in line).replace("\n", "")
                 for line in internal_data["sentences"]
             ).encode("utf-8"))
+
+        def _count_raw_tokens(self, raw_data):
+            return raw_data.count(b"/") + raw_data.count(b"\n") + 1
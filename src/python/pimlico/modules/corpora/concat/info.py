@@ -140,6 +140,22 @@ class ConcatenatedGroupedCorpusReader(GroupedCorpus.Reader):
                 started = True
                 yield u"{}{}".format(corpus_prefix, archive_name), doc_name, doc
 
+    @property
+    def shardable(self):
+        return all(getattr(reader, "shardable", False) for reader in self.input_readers)
+
+    def get_shards(self, shard_size=None):
+        return [
+            (u"{}{}".format(prx, archive_name), start, end)
+            for (prx, reader) in zip(self.corpus_prefixes, self.input_readers)
+            for (archive_name, start, end) in reader.get_shards(shard_size=shard_size)
+        ]
+
+    def shard_iter(self, shard):
+        # Trace the archive back to the input readers and pass over to them to read the shard
+        reader, old_archive_name = self.archive_name_map[shard[0]]
+        return reader.shard_iter((old_archive_name, shard[1], shard[2]))
+
     def list_archive_iter(self):
         for corpus_num, reader in enumerate(self.input_readers):
             corpus_prefix = "corpus{}_".format(corpus_num)
@@ -7,32 +7,17 @@ from collections import Counter
 
 from pimlico.core.modules.base import BaseModuleExecutor
 from pimlico.datatypes.corpora import is_invalid_doc
-from pimlico.utils.progress import get_progress_bar
 
 
 class ModuleExecutor(BaseModuleExecutor):
     def execute(self):
         corpus = self.info.get_input("corpus")
 
-        self.log.info("Collecting stats")
-        token_counter = Counter()
-        sents_per_doc = StatCollector()
-        tokens_per_doc = StatCollector()
-        chars_per_sent = StatCollector()
-        tokens_per_sent = StatCollector()
-
-        pbar = get_progress_bar(len(corpus), title="Counting")
-        for __, doc in pbar(corpus):
-            if not is_invalid_doc(doc):
-                sents_per_doc.count(len(doc.sentences))
-                tokens_per_doc.count(sum(len(sent) for sent in doc.sentences))
-
-                for sent in doc.sentences:
-                    # Add counts of each word
-                    token_counter.update(sent)
-                    # Count the characters in the tokens, plus spaces between them
-                    chars_per_sent.count(sum(len(token) for token in sent) + len(sent) - 1)
-                    tokens_per_sent.count(len(sent))
+        processes = self.info.get_processes()
+        self.log.info("Collecting stats{}".format(" using {} processes".format(processes) if processes > 1 else ""))
+        # Count in parallel over shards of the corpus and combine the counts
+        token_counter, sents_per_doc, tokens_per_doc, chars_per_sent, tokens_per_sent = \
+            corpus.map_reduce(collect_stats, merge_stats, processes=processes, progress="Counting")
 
         character_count = chars_per_sent.total
         self.log.info("{:,} characters".format(character_count))
@@ -75,6 +60,38 @@ class ModuleExecutor(BaseModuleExecutor):
             self.log.info("Stats output to %s" % writer.absolute_path)
 
 
+def collect_stats(doc_iter):
+    """
+    Collect stats from some documents, which may be a shard of the corpus.
+
+    :return: tuple of collected statistics, which can be merged with those from other shards using `merge_stats()`
+    """
+    token_counter = Counter()
+    sents_per_doc = StatCollector()
+    tokens_per_doc = StatCollector()
+    chars_per_sent = StatCollector()
+    tokens_per_sent = StatCollector()
+
+    for __, doc in doc_iter:
+        if not is_invalid_doc(doc):
+            sents_per_doc.count(len(doc.sentences))
+            tokens_per_doc.count(sum(len(sent) for sent in doc.sentences))
+
+            for sent in doc.sentences:
+                # Add counts of each word
+                token_counter.update(sent)
+                # Count the characters in the tokens, plus spaces between them
+                chars_per_sent.count(sum(len(token) for token in sent) + len(sent) - 1)
+                tokens_per_sent.count(len(sent))
+    return token_counter, sents_per_doc, tokens_per_doc, chars_per_sent, tokens_per_sent
+
+
+def merge_stats(stats1, stats2):
+    token_counter1, token_counter2 = stats1[0], stats2[0]
+    token_counter1.update(token_counter2)
+    return (token_counter1,) + tuple(coll1.merge(coll2) for (coll1, coll2) in zip(stats1[1:], stats2[1:]))
+
+
 class StatCollector:
     def __init__(self):
         self.total = 0
@@ -90,5 +107,15 @@ class StatCollector:
         if self.max is None or val > self.max:
             self.max = val
 
+    def merge(self, other):
+        """ Combine with the stats collected by another collector, returning self. """
+        self.total += other.total
+        self.n += other.n
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
     def mean(self):
         return float(self.total) / self.n
\ No newline at end of file
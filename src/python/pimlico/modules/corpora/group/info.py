@@ -94,6 +94,9 @@ class CorpusGroupReader(PimlicoDatatype.Reader):
     producing a corresponding grouped corpus.
 
     """
+    # The archives only exist as the documents are grouped while iterating, so can't be read independently
+    shardable = False
+
     class Setup(object):
         def __init__(self, datatype, input_reader_setup, options):
             self.options = options
@@ -193,6 +196,10 @@ class CorpusGroupReader(PimlicoDatatype.Reader):
         for tar_name, doc_name, doc in self.archive_iter():
             yield tar_name, doc_name
 
+    def map_reduce(self, map_fn, reduce_fn, processes=1, shard_size=None, progress=None):
+        # Can't be split into shards: process the whole corpus in one go, like any iterable corpus
+        return IterableCorpus.Reader.map_reduce(self, map_fn, reduce_fn, progress=progress)
+
 
 class ModuleInfo(BaseModuleInfo):
     module_type_name = "group"
@@ -39,6 +39,7 @@ class ModuleInfo(BaseModuleInfo):
             "help": "Documents are regrouped into new archives. "
                     "Number of documents to include in each archive (default: 1k)",
             "default": 1000,
+            "type": int,
         },
         "archive_basename": {
             "help": "Documents are regrouped into new archives. "
@@ -66,6 +67,8 @@ class InterleavedGroupedCorpusReader(GroupedCorpus.Reader):
 
     """
     metadata = {}
+    # The archives only exist as the documents are interleaved, so can't be read independently
+    shardable = False
 
     def __init__(self, datatype, setup, pipeline, **kwargs):
         # Don't call GroupedCorpus init, but jump up to IterableCorpus
@@ -7,8 +7,6 @@ from __future__ import division
 from future import standard_library
 
 from pimlico.datatypes import GroupedCorpus
-from pimlico.utils.pimarc import PimarcReader
-from pimlico.utils.pimarc.reader import read_doc_from_pimarc
 
 standard_library.install_aliases()
 
@@ -41,29 +39,37 @@ class ModuleExecutor(BaseModuleExecutor):
 
         # Prepare an index of all the documents, as archive ids and doc ids
         # Use IDs instead of names to improve memory efficiency with large corpora
-        archive_filenames = input_corpus.archive_filenames
-        # Read the index for each archive to check where each file's data starts
+        archives = input_corpus.archives
+        # Read the index for each archive to get the number of documents in it
         self.log.info("Reading in document indices")
-        archive_doc_starts = [
-            (archive_num, metadata_start) for (archive_num, archive_filename) in enumerate(archive_filenames)
-            for (metadata_start, data_start) in PimarcReader(archive_filename).index.filenames.values()
+        archive_sizes = [len(input_corpus.get_archive(archive_name).index) for archive_name in archives]
+        archive_doc_ids = [
+            (archive_num, position) for archive_num, size in enumerate(archive_sizes) for position in range(size)
         ]
+        if archives and input_corpus.get_archive(archives[0]).compressed:
+            # Random access works, but each document read may require a whole block to be decompressed
+            self.log.warning("input corpus is block-compressed, so random access to its documents is slow. "
+                             "Consider using the 'shuffle_linear' module instead")
         self.log.info("Shuffling documents")
         # Seed the RNG
         random.seed(rng_seed)
         # Shuffle these indices in place to get their order in the output corpus
-        random.shuffle(archive_doc_starts)
+        random.shuffle(archive_doc_ids)
 
         self.log.info("Writing randomly shuffled output corpus")
         # Check the max length of an archive
-        max_archive_size = max(len(PimarcReader(archive_filename).index) for archive_filename in archive_filenames)
+        max_archive_size = max(archive_sizes)
         with self.info.get_output_writer("corpus") as writer:
             grouper = IterableCorpusGrouper(max_archive_size, len(input_corpus), archive_basename=archive_basename)
             # Iterate over each bin in turn
-            pbar = get_progress_bar(len(archive_doc_starts), title="Writing")
-            for archive_num, metadata_start in pbar(archive_doc_starts):
-                metadata, data = read_doc_from_pimarc(archive_filenames[archive_num], metadata_start)
+            pbar = get_progress_bar(len(archive_doc_ids), title="Writing")
+            for archive_num, position in pbar(archive_doc_ids):
+                # Read the document through the archive's random access, which takes care of decompression
+                # Works with both the text and binary index
+                archive = input_corpus.get_archive(archives[archive_num])
+                metadata, data = archive[archive.index.get_entry(position)[0]]
 
                 archive_name = grouper.next_document()
                 # Add this document to the end of the output corpus
                 writer.add_document(archive_name, metadata["name"], data, metadata=metadata)
+        input_corpus.close_archives()
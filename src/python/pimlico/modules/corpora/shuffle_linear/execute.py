@@ -94,7 +94,7 @@ class ModuleExecutor(BaseModuleExecutor):
                 bin_reader = PimarcReader(bin_fn)
                 # Shuffle randomly within the bin, as they're currently
                 # just in the order we read them from the input corpus
-                bin_doc_list = list(bin_reader.index.filenames.keys())
+                bin_doc_list = list(bin_reader.index)
                 random.shuffle(bin_doc_list)
 
                 for doc_name in bin_doc_list:
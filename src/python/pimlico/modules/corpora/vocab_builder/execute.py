@@ -34,7 +34,8 @@ class ModuleExecutor(BaseModuleExecutor):
             # Input is given for every document in a corpus
             # Update the term vocab with all terms in each doc
             vocab_writer.add_documents(
-                (sum(doc.sentences, []) for doc_name, doc in pbar(input_docs) if not is_invalid_doc(doc)),
+                (sum(doc.sentences, []) for doc_name, doc in self._check_memory(pbar(input_docs))
+                 if not is_invalid_doc(doc)),
                 prune_at=prune_at
             )
 
@@ -91,3 +92,10 @@ class ModuleExecutor(BaseModuleExecutor):
         self.log.info("Final list of {:,} stopwords".format(len(stopwords)))
         with self.info.get_output_writer("stopwords") as stopwords_writer:
             stopwords_writer.write_list(stopwords)
+
+    def _check_memory(self, docs):
+        # The counts can get very big: stop with an error if they go over the memory budget,
+        #  instead of getting killed
+        for doc in docs:
+            self.memory.check()
+            yield doc
@@ -8,7 +8,6 @@ from collections import Counter
 import numpy
 from pimlico.core.modules.base import BaseModuleExecutor
 from pimlico.datatypes.corpora import InvalidDocument, is_invalid_doc
-from pimlico.utils.progress import get_progress_bar
 
 
 class ModuleExecutor(BaseModuleExecutor):
@@ -17,13 +16,11 @@ class ModuleExecutor(BaseModuleExecutor):
         vocab = self.info.get_input("vocab").get_data()
         dist_len = len(vocab)+1 if self.info.options["oov_excluded"] else len(vocab)
 
-        self.log.info("Counting token frequencies in corpus")
-        pbar = get_progress_bar(len(corpus))
-        # Iterate over the whole corpus, counting up tokens
-        counts = Counter(
-            token for doc_name, doc in pbar(corpus) if not is_invalid_doc(doc)
-            for line in doc.lists for token in line
-        )
+        processes = self.info.get_processes()
+        self.log.info("Counting token frequencies in corpus{}".format(
+            " using {} processes".format(processes) if processes > 1 else ""))
+        # Count up tokens in parallel over shards of the corpus and sum the counts
+        counts = corpus.map_reduce(count_tokens, add_counts, processes=processes, progress="Counting")
         self.log.info("Counts collected")
         # Put the result in a numpy array
         dist = numpy.array([counts.get(i, 0) for i in range(dist_len)])
@@ -37,3 +34,15 @@ class ModuleExecutor(BaseModuleExecutor):
         _id2token = lambda i: "OOV" if i >= len(vocab) else vocab.id2token[i]
         _fmt_ids = lambda ids: u", ".join(u"{} ({})".format(_id2token(i), dist[i]) for i in ids)
         self.log.info(u"{}, ..., {}".format(_fmt_ids(ordered_ids[:5]), _fmt_ids(ordered_ids[-5:])))
+
+
+def count_tokens(doc_iter):
+    return Counter(
+        token for doc_name, doc in doc_iter if not is_invalid_doc(doc)
+        for line in doc.lists for token in line
+    )
+
+
+def add_counts(counts1, counts2):
+    counts1.update(counts2)
+    return counts1
@@ -6,24 +6,25 @@ from pimlico.core.modules.map import skip_invalid
 from pimlico.core.modules.map.multiproc import multiprocessing_executor_factory
 
 
-def preprocess(executor):
-    # Load the dictionary
-    executor.vocab = executor.info.get_input("vocab").get_data()
+def load_resources(executor, resources):
+    # Load the dictionary once, to be shared by all the workers
+    vocab = executor.info.get_input("vocab").get_data()
     oov_token = executor.info.options["oov"]
     if oov_token == "skip":
         oov = None
     elif oov_token is not None:
-        oov = executor.vocab.token2id[oov_token]
+        oov = vocab.token2id[oov_token]
     else:
         # Use the next unused ID after the vocab to represent OOV words
-        oov = len(executor.vocab)
-    executor.oov = oov
+        oov = len(vocab)
+    resources["vocab"] = vocab
+    resources["oov"] = oov
 
 
 @skip_invalid
 def process_document(worker, archive_name, doc_name, doc):
-    vocab = worker.executor.vocab
-    oov = worker.executor.oov
+    vocab = worker.resources["vocab"]
+    oov = worker.resources["oov"]
 
     if oov is None:
         # Special value that causes us to skip over OOVs
@@ -36,4 +37,4 @@ def process_document(worker, archive_name, doc_name, doc):
     return worker.info.document(lists=lsts)
 
 
-ModuleExecutor = multiprocessing_executor_factory(process_document, preprocess_fn=preprocess)
+ModuleExecutor = multiprocessing_executor_factory(process_document, load_resources_fn=load_resources)
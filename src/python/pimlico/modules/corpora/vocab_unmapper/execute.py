@@ -6,25 +6,25 @@ from pimlico.core.modules.map import skip_invalid
 from pimlico.core.modules.map.multiproc import multiprocessing_executor_factory
 
 
-def preprocess(executor):
-    # Load the dictionary
-    executor.vocab = executor.info.get_input("vocab").get_data()
-    id2token = executor.vocab.id2token
+def load_resources(executor, resources):
+    # Load the dictionary once, to be shared by all the workers
+    vocab = executor.info.get_input("vocab").get_data()
+    id2token = vocab.id2token
 
     oov_token = executor.info.options["oov"]
     if oov_token == "skip":
         # A mapping to None signals that this word should be skipped
-        id2token[len(executor.vocab)] = None
+        id2token[len(vocab)] = None
     elif oov_token is not None:
-        id2token[len(executor.vocab)] = oov_token
+        id2token[len(vocab)] = oov_token
     # Otherwise we add no special mapping for OOVs
 
-    executor.id2token = id2token
+    resources["id2token"] = id2token
 
 
 @skip_invalid
 def process_document(worker, archive_name, doc_name, doc):
-    id2token = worker.executor.id2token
+    id2token = worker.resources["id2token"]
 
     doc_tokens = [
         [id2token[i] for i in sent if id2token[i] is not None] for sent in doc.lists
@@ -32,4 +32,4 @@ def process_document(worker, archive_name, doc_name, doc):
     return {"sentences": doc_tokens}
 
 
-ModuleExecutor = multiprocessing_executor_factory(process_document, preprocess_fn=preprocess)
+ModuleExecutor = multiprocessing_executor_factory(process_document, load_resources_fn=load_resources)
@@ -9,8 +9,12 @@ from pimlico.core.modules.map import skip_invalid
 from pimlico.core.modules.map.multiproc import multiprocessing_executor_factory
 
 
-def worker_set_up(worker):
-    worker.model = worker.info.get_input("model").load_model()
+def load_resources(executor, resources):
+    # Load the model once, to be shared by all the workers
+    model = executor.info.get_input("model").load_model()
+    # This is the big matrix that's used for inference
+    model.expElogbeta = resources.share_array(model.expElogbeta)
+    resources["model"] = model
 
 
 @skip_invalid
@@ -18,9 +22,11 @@ def process_document(worker, archive_name, doc_name, doc):
     # Get a bag of words for the document
     bow = list(Counter(word for sentence in doc.lists for word in sentence).items())
     # Use the LDA model to infer a topic vector for the document
-    topic_weights = dict(worker.model[bow])
+    model = worker.resources["model"]
+    topic_weights = dict(model[bow])
     # The weights are a sparse vector: fill in the relevant values and leave the rest as 0
-    return {"vector": [topic_weights.get(i, 0.) for i in range(worker.model.num_topics)]}
+    return {"vector": [topic_weights.get(i, 0.) for i in range(model.num_topics)]}
 
 
-ModuleExecutor = multiprocessing_executor_factory(process_document, worker_set_up_fn=worker_set_up)
+ModuleExecutor = multiprocessing_executor_factory(process_document, load_resources_fn=load_resources,
+                                                  preload_modules=["gensim"])
@@ -51,28 +51,29 @@ def process_document(worker, archive_name, doc_name, doc, label_doc):
     # Get a bag of words for the document
     bow = list(Counter(word for sentence in doc.lists for word in sentence).items())
     # Work out what slice this doc should use
-    slice = worker.label_to_slice[label_doc.label]
+    slice = worker.resources["label_to_slice"][label_doc.label]
     # Get the LDA model for this time slice
     #lda_model = worker.slice_ldas[slice]
     # Use the LDA model to infer a topic vector for the document
     #topic_weights = dict(lda_model[bow])
     # Infer doc topics for just this time slice
-    topic_weights = get_doc_topics(worker.model, worker.slice_ldas[slice], bow, slice)
+    topic_weights = get_doc_topics(worker.resources["model"], worker.resources["slice_ldas"][slice], bow, slice)
     ## The weights are a sparse vector: fill in the relevant values and leave the rest as 0
     #return {"vector": [topic_weights.get(i, 0.) for i in range(worker.model.num_topics)]}
     return {"vector": topic_weights}
 
 
-def worker_set_up(worker):
-    model_reader = worker.info.get_input("model")
-    worker.model = model_reader.load_model()
-    worker.labels = model_reader.load_labels()
+def load_resources(executor, resources):
+    # Load the model and prepare the slice models once, to be shared by all the workers
+    model_reader = executor.info.get_input("model")
+    resources["model"] = model_reader.load_model()
+    labels = model_reader.load_labels()
     # Load the labels for the time slices and prepare the mapping to slice indices
-    worker.label_to_slice = dict((label, slice) for (slice, label) in enumerate(worker.labels))
+    resources["label_to_slice"] = dict((label, slice) for (slice, label) in enumerate(labels))
     # Before creating LDAModels, silence the ldamodel logger, so we don't get loads of output
     logging.getLogger("gensim.models.ldamodel").setLevel(logging.ERROR)
     # Prepare LDA models for each time slice
-    worker.slice_ldas = get_slice_ldas(worker.model)
+    resources["slice_ldas"] = get_slice_ldas(resources["model"])
 
 
-ModuleExecutor = multiprocessing_executor_factory(process_document, worker_set_up_fn=worker_set_up)
+ModuleExecutor = multiprocessing_executor_factory(process_document, load_resources_fn=load_resources)
@@ -2,29 +2,44 @@
 # Copyright (C) 2020 Mark Granroth-Wilding
 # Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
 
-from pimlico.core.modules.map import skip_invalid
-from pimlico.core.modules.map.singleproc import single_process_executor_factory
+from pimlico.core.modules.map import skip_invalids
+from pimlico.core.modules.map.multiproc import multiprocessing_executor_factory
 from ..utils import load_spacy_model
 
 
 def preprocess(executor):
+    # Load the model once in the main process: the workers all use the same one
     model = executor.info.options["model"]
     nlp = load_spacy_model(model, executor.log, local=executor.info.options["on_disk"])
-    executor.tokenizer = nlp.Defaults.create_tokenizer(nlp)
-    executor.sentencizer = nlp.create_pipe("sentencizer")
-
-
-@skip_invalid
-def process_document(worker, archive, filename, doc):
-    # Apply tokenization to the raw text
-    doc = worker.executor.tokenizer(doc.text)
-    # Apply sentence segmentation to the doc
-    doc = worker.executor.sentencizer(doc)
+    # We only need tokenization and sentence segmentation, so get rid of any other components in the model,
+    # so they don't slow down processing
+    for pipe_name in nlp.pipe_names:
+        nlp.remove_pipe(pipe_name)
+    nlp.add_pipe(nlp.create_pipe("sentencizer"))
+    executor.nlp = nlp
+
+
+def set_up_worker(worker):
+    # Collect this many docs from the input to stream through spaCy's pipeline together
+    worker.docs_per_batch = worker.info.options["batch_size"]
+    # Stop filling a batch early if the texts get big
+    worker.batch_bytes = worker.info.options["batch_bytes"] or None
+
+
+@skip_invalids
+def process_documents(worker, input_tuples):
+    texts = [doc.text for (archive, filename, doc) in input_tuples]
+    # Apply tokenization and sentence segmentation to the whole batch of raw texts
+    # The docs come out in the same order they went in
     # Now doc.sents contains the separated sentences
     # Filter out any empty sentences or tokens
-    sentences = [[token.text for token in sent if len(token.text.strip())] for sent in doc.sents]
-
-    return {"sentences": sentences}
+    return [
+        {"sentences": [[token.text for token in sent if len(token.text.strip())] for sent in doc.sents]}
+        for doc in worker.executor.nlp.pipe(texts, batch_size=worker.docs_per_batch)
+    ]
 
 
-ModuleExecutor = single_process_executor_factory(process_document, preprocess_fn=preprocess)
+# The batch size is set from the module's options when each worker starts up
+ModuleExecutor = multiprocessing_executor_factory(
+    process_documents, preprocess_fn=preprocess, worker_set_up_fn=set_up_worker, batch_docs=1
+)
@@ -5,6 +5,11 @@
 """
 Tokenization using spaCy.
 
+Documents are streamed through spaCy's pipeline in batches, using only its tokenizer
+and sentence segmentation, so any other components in the model are not run.
+Processing can be parallelized across multiple processes using Pimlico's usual
+`processes` setting.
+
 """
 from pimlico.core.dependencies.python import spacy_dependency
 from pimlico.core.modules.map import DocumentMapModuleInfo
@@ -29,7 +34,20 @@ class ModuleInfo(DocumentMapModuleInfo):
         "on_disk": {
             "help": "Load the specified model from a location on disk (the model parameter gives the path)",
             "type": str_to_bool,
-        }
+        },
+        "batch_size": {
+            "help": "Number of documents to pass through spaCy's pipeline at once. Larger batches are "
+                    "generally faster, but use more memory. Default: 100",
+            "type": int,
+            "default": 100,
+        },
+        "batch_bytes": {
+            "help": "Limit on the total size of the texts in a batch, in bytes. Batches stop short of batch_size "
+                    "documents if they reach this size, so that batches of long documents don't use too much "
+                    "memory. Default: 0, no limit",
+            "type": int,
+            "default": 0,
+        },
     }
     module_supports_python2 = True
 
@@ -42,6 +42,11 @@ The standard filename for a Pimarc file is `.prc`. This file contains the archiv
 data. A second file is always stored in the same location, with an identical filename,
 except the extension `.prci`.
 
+Archives may optionally be block-compressed, using zlib, lzma or zstd: groups of files
+are compressed together, which is much more effective than compressing each file
+individually, while the index still allows fast random access. See
+:mod:`~pimlico.utils.pimarc.compression`.
+
 Some basic command-line utilities for working with Pimarc archives are provided.
 Run `pimlico.utils.pimarc` with one of the various sub-commands.
 
@@ -50,10 +55,10 @@ from .reader import PimarcReader
 from .writer import PimarcWriter
 
 
-def open_archive(path, mode="r"):
+def open_archive(path, mode="r", use_mmap=False, compression=None, compression_level=None):
     if mode == "r":
-        return PimarcReader(path)
+        return PimarcReader(path, use_mmap=use_mmap)
     elif mode in ("w", "a"):
-        return PimarcWriter(path, mode=mode)
+        return PimarcWriter(path, mode=mode, compression=compression, compression_level=compression_level)
     else:
         raise ValueError("unknown mode '{}'".format(mode))
@@ -0,0 +1,294 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""
+Binary, memory-mappable index for Pimarc archives.
+
+The standard Pimarc index (`.prci`) is a text file that has to be read and parsed
+in full every time an archive is opened. For archives containing very many files,
+this can take a noticeable amount of time before the first file can be read.
+
+The binary index is an alternative, stored alongside the archive with the extension
+`.prcx`. It can be used instead of, or as well as, the text index: if a binary index
+is found for an archive (and is not older than the text index), readers will use it.
+It is opened by memory-mapping the file, so opening takes constant time, regardless
+of how many files are in the archive. Lookups by name and by position read directly
+from the mapped file, without building any Python data structures.
+
+The file is laid out as follows (all integers little-endian):
+
+ - Header: magic bytes `PRCX`, format version, size of each entry in the offset
+   table, number of files, number of hash slots and the start byte of each of the
+   following sections.
+ - Offset table: one fixed-width entry per file, in archive order, giving the start
+   byte of the file's metadata, the start byte of its data, the location of its
+   name in the name table and (from version 2) the file's length in bytes and token
+   count, with the maximum integer value standing for unknown.
+ - Sorted table: the position of every file, ordered by (UTF-8 encoded) filename.
+ - Hash table: open-addressing table (linear probing) mapping a hash of the filename
+   to the file's position (plus one, so that zero marks an empty slot).
+ - Name table: the UTF-8 encoded filenames, concatenated in archive order.
+
+Use :func:`build_binary_index` to convert an existing `.prci` index, or the
+`binindex` command-line tool.
+
+"""
+import mmap
+import os
+import struct
+import zlib
+
+from .index import FilenameNotInArchive, DuplicateFilename, IndexWriteError
+
+BINARY_INDEX_MAGIC = b"PRCX"
+BINARY_INDEX_VERSION = 2
+
+# Magic, version, entry size, num files, hash slots, then start bytes of offsets, sorted, hash and name sections
+HEADER_STRUCT = struct.Struct("<4sHHQQQQQQ")
+# Metadata start, data start, name start (within name table), name length
+# This is the whole of an entry in version 1
+POINTERS_STRUCT = struct.Struct("<QQQI")
+# Length and token count, following the pointers in version 2 entries
+SIZES_STRUCT = struct.Struct("<QQ")
+ENTRY_STRUCT = struct.Struct("<QQQIQQ")
+# Stored as a size that wasn't recorded
+UNKNOWN_SIZE = 2 ** 64 - 1
+# Used for each position in the sorted table and the hash table
+POSITION_STRUCT = struct.Struct("<Q")
+
+
+def binary_index_filename(archive_filename):
+    return "{}x".format(archive_filename)
+
+
+def _name_hash(name_bytes):
+    return zlib.crc32(name_bytes)
+
+
+class PimarcBinaryIndex(object):
+    """
+    Read-only binary index for a Pimarc, opened by memory-mapping a `.prcx` file.
+
+    Provides the same interface as :class:`~pimlico.utils.pimarc.index.PimarcIndex`,
+    so can be used by a reader in its place. Unlike `PimarcIndex`, nothing is read
+    from the file until it is needed, so it is fast to open even for very large
+    archives.
+
+    Should be closed when no longer needed, to release the memory map.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, self._entry_size, self._num_files, self._hash_slots, \
+                self._offsets_start, self._sorted_start, self._hash_start, self._names_start = \
+                HEADER_STRUCT.unpack_from(self._mmap, 0)
+        except struct.error:
+            self._mmap.close()
+            raise BinaryIndexFormatError("binary index file {} is too short to contain a header".format(path))
+        if magic != BINARY_INDEX_MAGIC:
+            self._mmap.close()
+            raise BinaryIndexFormatError("{} is not a Pimarc binary index".format(path))
+        if version > BINARY_INDEX_VERSION:
+            self._mmap.close()
+            raise BinaryIndexFormatError("binary index {} uses format version {}, but only versions up to {} "
+                                         "can be read".format(path, version, BINARY_INDEX_VERSION))
+        self._has_sizes = version >= 2
+
+    @staticmethod
+    def open(path):
+        return PimarcBinaryIndex(path)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_entry(self, position):
+        return POINTERS_STRUCT.unpack_from(self._mmap, self._offsets_start + position * self._entry_size)
+
+    def _read_sizes(self, position):
+        if not self._has_sizes:
+            return None, None
+        sizes = SIZES_STRUCT.unpack_from(self._mmap, self._offsets_start + position * self._entry_size +
+                                         POINTERS_STRUCT.size)
+        return tuple(None if size == UNKNOWN_SIZE else size for size in sizes)
+
+    def _read_name_bytes(self, name_start, name_length):
+        start = self._names_start + name_start
+        return self._mmap[start:start+name_length]
+
+    def _lookup(self, filename):
+        """
+        Find the position of the named file using the hash table. Returns None if it's not found.
+
+        """
+        if self._num_files == 0:
+            return None
+        name_bytes = filename.encode("utf-8")
+        slot = _name_hash(name_bytes) % self._hash_slots
+        while True:
+            position = POSITION_STRUCT.unpack_from(self._mmap, self._hash_start + slot * POSITION_STRUCT.size)[0]
+            if position == 0:
+                # Empty slot: the name isn't in the index
+                return None
+            position -= 1
+            __, __, name_start, name_length = self._read_entry(position)
+            if name_length == len(name_bytes) and self._read_name_bytes(name_start, name_length) == name_bytes:
+                return position
+            # Collision: try the next slot
+            slot = (slot + 1) % self._hash_slots
+
+    def get_position(self, filename):
+        """ Position of the named file in the archive (i.e. the number of files before it). """
+        position = self._lookup(filename)
+        if position is None:
+            raise FilenameNotInArchive(filename)
+        return position
+
+    def get_entry(self, position):
+        """
+        Look up a file by its position in the archive.
+
+        :return: tuple (filename, metadata start byte, data start byte)
+        """
+        if position < 0:
+            position += self._num_files
+        if not 0 <= position < self._num_files:
+            raise IndexError("position {} out of range for index of {} files".format(position, self._num_files))
+        metadata_start, data_start, name_start, name_length = self._read_entry(position)
+        return self._read_name_bytes(name_start, name_length).decode("utf-8"), metadata_start, data_start
+
+    def get_size(self, filename):
+        """
+        Size of the named file, if it was recorded when the file was written.
+
+        :return: tuple (length in bytes, token count), either of which may be None if unknown
+        """
+        return self._read_sizes(self.get_position(filename))
+
+    def get_metadata_start_byte(self, filename):
+        return self[filename][0]
+
+    def get_data_start_byte(self, filename):
+        return self[filename][1]
+
+    def __getitem__(self, item):
+        """ Returns a pair containing the metadata start byte and the data start byte. """
+        position = self._lookup(item)
+        if position is None:
+            raise FilenameNotInArchive(item)
+        return self._read_entry(position)[:2]
+
+    def __iter__(self):
+        """ Simply iterate over the filenames, in the order they're stored in the archive. """
+        for position in range(self._num_files):
+            __, __, name_start, name_length = self._read_entry(position)
+            yield self._read_name_bytes(name_start, name_length).decode("utf-8")
+
+    def __len__(self):
+        return self._num_files
+
+    def __contains__(self, item):
+        return self._lookup(item) is not None
+
+    def keys(self):
+        return iter(self)
+
+    def iter_sorted_filenames(self):
+        """ Iterate over the filenames in sorted order (by their UTF-8 encoding), using the sorted name table. """
+        for i in range(self._num_files):
+            position = POSITION_STRUCT.unpack_from(self._mmap, self._sorted_start + i * POSITION_STRUCT.size)[0]
+            yield self.get_entry(position)[0]
+
+
+def write_binary_index(path, entries, sizes=None):
+    """
+    Write out a binary index.
+
+    :param path: path to write the index to (usually the archive's filename with extension `.prcx`)
+    :param entries: iterable of `(filename, (metadata start byte, data start byte))`, in archive order,
+        as given by `PimarcIndex.filenames.items()`
+    :param sizes: dict mapping filenames to `(length, token count)`, as given by `PimarcIndex.sizes`.
+        Files not in it, or sizes given as None, are stored as unknown
+    """
+    if sizes is None:
+        sizes = {}
+    offsets = []
+    name_data = []
+    names_length = 0
+    seen = set()
+    for filename, (metadata_start, data_start) in entries:
+        if filename in seen:
+            raise DuplicateFilename(filename)
+        seen.add(filename)
+        name_bytes = filename.encode("utf-8")
+        length, tokens = sizes.get(filename, (None, None))
+        offsets.append((metadata_start, data_start, names_length, len(name_bytes),
+                        UNKNOWN_SIZE if length is None else length, UNKNOWN_SIZE if tokens is None else tokens))
+        name_data.append(name_bytes)
+        names_length += len(name_bytes)
+    num_files = len(offsets)
+
+    # Positions ordered by the encoded filename
+    sorted_positions = sorted(range(num_files), key=lambda p: name_data[p])
+
+    # Keep the hash table no more than half full, so probe sequences stay short
+    hash_slots = max(1, 2 * num_files)
+    hash_table = [0] * hash_slots
+    for position, name_bytes in enumerate(name_data):
+        slot = _name_hash(name_bytes) % hash_slots
+        while hash_table[slot] != 0:
+            slot = (slot + 1) % hash_slots
+        hash_table[slot] = position + 1
+
+    offsets_start = HEADER_STRUCT.size
+    sorted_start = offsets_start + num_files * ENTRY_STRUCT.size
+    hash_start = sorted_start + num_files * POSITION_STRUCT.size
+    names_start = hash_start + hash_slots * POSITION_STRUCT.size
+
+    # Write to a temporary file and move it into place, so a reader never sees a partial index
+    tmp_path = "{}.tmp".format(path)
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER_STRUCT.pack(BINARY_INDEX_MAGIC, BINARY_INDEX_VERSION, ENTRY_STRUCT.size,
+                                       num_files, hash_slots, offsets_start, sorted_start, hash_start, names_start))
+            f.write(b"".join(ENTRY_STRUCT.pack(*entry) for entry in offsets))
+            f.write(b"".join(POSITION_STRUCT.pack(p) for p in sorted_positions))
+            f.write(b"".join(POSITION_STRUCT.pack(p) for p in hash_table))
+            f.write(b"".join(name_data))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def build_binary_index(pimarc_path):
+    """
+    Create a binary index (.prcx) for a Pimarc archive from its existing text index (.prci).
+    If the archive already has a binary index, it is overwritten.
+
+    :param pimarc_path: path to the .prc file
+    :return: number of files in the index
+    """
+    from .index import PimarcIndex
+
+    if not pimarc_path.endswith(".prc"):
+        raise IndexWriteError("input pimarc path does not have the correct extension (.prc)")
+    index = PimarcIndex.load("{}i".format(pimarc_path))
+    write_binary_index(binary_index_filename(pimarc_path), index.filenames.items(), sizes=index.sizes)
+    return len(index)
+
+
+class BinaryIndexFormatError(Exception):
+    pass
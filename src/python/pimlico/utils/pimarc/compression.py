@@ -0,0 +1,214 @@
+# This file is part of Pimlico
+# Copyright (C) 2020 Mark Granroth-Wilding
+# Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
+
+"""Block compression for Pimarc archives
+
+A Pimarc archive may optionally be compressed. Rather than compressing each file
+on its own, which compresses small files (like most documents) poorly and is slow,
+files are grouped into blocks, each of which is compressed as a whole.
+
+A compressed archive starts with a short header: the magic bytes `PRCZ`, a format
+version byte and a byte identifying the codec. This can never be confused with the
+start of an uncompressed archive, which always starts with the length of the first
+file's JSON metadata, followed by the metadata itself, starting with `{`.
+
+The header is followed by a sequence of blocks, each stored as a varint giving its
+compressed length, followed by the compressed data. Decompressed, a block contains
+a sequence of files, in exactly the format they would be stored in an uncompressed
+archive.
+
+In the index of a compressed archive, the two values stored for each file are not
+the start bytes of its metadata and data, but the start byte of the block containing
+the file and the offset within the decompressed block of the start of the file's
+metadata. To read a single file, therefore, only its block needs to be decompressed.
+
+Available codecs are `zlib` and `lzma`, from the standard library, and `zstd`, if the
+`zstandard` package is installed.
+
+"""
+import lzma
+import zlib
+
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSED_MAGIC = b"PRCZ"
+FORMAT_VERSION = 1
+HEADER_LENGTH = len(COMPRESSED_MAGIC) + 2
+#: Size (in uncompressed bytes) that blocks are allowed to reach before they're compressed and written out
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+
+class Codec(object):
+    """
+    A compression method that can be used for the blocks of a Pimarc archive.
+
+    Subclasses should set the codec's name, a unique numeric ID (used to identify
+    the codec in an archive's header) and a default compression level.
+
+    """
+    name = None
+    codec_id = None
+    default_level = None
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    codec_id = 1
+    default_level = 6
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+    codec_id = 2
+    default_level = 6
+
+    def compress(self, data):
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=self.level)
+
+    def decompress(self, data):
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    codec_id = 3
+    default_level = 3
+
+    @classmethod
+    def is_available(cls):
+        return zstandard is not None
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = OrderedDict((codec.name, codec) for codec in [ZlibCodec, LzmaCodec, ZstdCodec])
+_CODECS_BY_ID = dict((codec.codec_id, codec) for codec in CODECS.values())
+
+
+def available_codecs():
+    """ Names of the codecs that can be used in this environment. """
+    return [name for (name, codec) in CODECS.items() if codec.is_available()]
+
+
+def get_codec(name, level=None):
+    """
+    Get a codec instance by name.
+
+    :param name: name of the codec: one of `CODECS`
+    :param level: compression level. If not given, the codec's default is used
+    :return: Codec instance
+    """
+    try:
+        codec_cls = CODECS[name]
+    except KeyError:
+        raise PimarcCompressionError("unknown Pimarc compression codec '{}'. Available codecs are: {}".format(
+            name, ", ".join(CODECS.keys())))
+    if not codec_cls.is_available():
+        raise PimarcCompressionError("Pimarc compression codec '{}' is not available: you probably need to "
+                                     "install the zstandard package".format(name))
+    return codec_cls(level)
+
+
+def parse_compression_spec(spec):
+    """
+    Parse a specification of a codec and, optionally, compression level, as given
+    in a config file: e.g. `zlib`, `lzma:9`. `none` may be given to specify no
+    compression. The codec's name is checked, but not whether it's available.
+
+    :return: tuple (codec name, level). The codec name is None for no compression and
+        the level is None if not specified
+    """
+    codec_name, __, level = spec.strip().partition(":")
+    codec_name = codec_name.strip().lower()
+    if codec_name in ("", "none"):
+        return None, None
+    if codec_name not in CODECS:
+        raise PimarcCompressionError("unknown Pimarc compression codec '{}'. Available codecs are: {}".format(
+            codec_name, ", ".join(CODECS.keys())))
+    if level.strip():
+        try:
+            level = int(level)
+        except ValueError:
+            raise PimarcCompressionError("compression level must be an integer, got '{}'".format(level))
+    else:
+        level = None
+    return codec_name, level
+
+
+def encode_header(codec):
+    """ The header that starts an archive compressed using the given codec. """
+    return COMPRESSED_MAGIC + bytes(bytearray([FORMAT_VERSION, codec.codec_id]))
+
+
+def decode_header(header):
+    """
+    Check whether the first bytes of an archive are the header of a compressed archive
+    and, if so, get the codec it uses.
+
+    :param header: bytes-like object containing at least the first `HEADER_LENGTH` bytes of the archive,
+        or the whole archive if it's shorter
+    :return: Codec instance, or None if the archive isn't compressed
+    """
+    header = bytes(header[:HEADER_LENGTH])
+    if len(header) < HEADER_LENGTH or header[:len(COMPRESSED_MAGIC)] != COMPRESSED_MAGIC:
+        return None
+    version, codec_id = bytearray(header[len(COMPRESSED_MAGIC):])
+    if version != FORMAT_VERSION:
+        raise PimarcCompressionError("unsupported compressed Pimarc format version: {}".format(version))
+    try:
+        codec_cls = _CODECS_BY_ID[codec_id]
+    except KeyError:
+        raise PimarcCompressionError("unknown codec ID in compressed Pimarc header: {}".format(codec_id))
+    if not codec_cls.is_available():
+        raise PimarcCompressionError("archive is compressed with '{}', which is not available: you probably "
+                                     "need to install the zstandard package".format(codec_cls.name))
+    return codec_cls()
+
+
+def read_header(archive_file):
+    """
+    Read the header of an open archive file, if it is compressed, leaving the
+    file positioned at the start of the first block. If it's not compressed,
+    the file is positioned at the start.
+
+    :return: Codec instance, or None if the archive isn't compressed
+    """
+    archive_file.seek(0)
+    codec = decode_header(archive_file.read(HEADER_LENGTH))
+    if codec is None:
+        archive_file.seek(0)
+    return codec
+
+
+class PimarcCompressionError(Exception):
+    pass
@@ -7,7 +7,8 @@ import os
 from collections import OrderedDict
 from builtins import *
 
-from .utils import _read_var_length_data, _skip_var_length_data
+from pimlico.utils.varint import decode_stream, decode_buffer
+from .utils import _read_var_length_data, _read_var_length_data_from_buffer
 
 
 class PimarcIndex(object):
@@ -18,9 +19,17 @@ class PimarcIndex(object):
 
     filenames is an OrderedDict mapping filename -> (metadata start byte, data start byte).
 
+    The index may also record the size of each file: its length in bytes and, optionally,
+    the number of tokens it contains. sizes is a dict mapping filename -> (length, token count).
+    Files whose size was not recorded (e.g. in indexes written by older versions) are not in it.
+
     """
     def __init__(self):
         self.filenames = OrderedDict()
+        self.sizes = {}
+        # Built the first time a lookup by position is needed
+        self._positions = None
+        self._filename_list = None
 
     def get_metadata_start_byte(self, filename):
         try:
@@ -34,6 +43,37 @@ class PimarcIndex(object):
         except KeyError:
             raise FilenameNotInArchive(filename)
 
+    def get_size(self, filename):
+        """
+        Size of the named file, if it was recorded when the file was written.
+
+        :return: tuple (length in bytes, token count), either of which may be None if unknown
+        """
+        if filename not in self.filenames:
+            raise FilenameNotInArchive(filename)
+        return self.sizes.get(filename, (None, None))
+
+    def get_position(self, filename):
+        """ Position of the named file in the archive (i.e. the number of files before it). """
+        if self._positions is None:
+            self._positions = dict((fn, i) for (i, fn) in enumerate(self.filenames))
+        try:
+            return self._positions[filename]
+        except KeyError:
+            raise FilenameNotInArchive(filename)
+
+    def get_entry(self, position):
+        """
+        Look up a file by its position in the archive.
+
+        :return: tuple (filename, metadata start byte, data start byte)
+        """
+        if self._filename_list is None:
+            self._filename_list = list(self.filenames)
+        filename = self._filename_list[position]
+        metadata_start, data_start = self.filenames[filename]
+        return filename, metadata_start, data_start
+
     def __getitem__(self, item):
         """ Returns a pair containing the metadata start byte and the data start byte. """
         return self.filenames[item]
@@ -51,28 +91,31 @@ class PimarcIndex(object):
     def keys(self):
         return self.filenames.keys()
 
-    def append(self, filename, metadata_start, data_start):
+    def append(self, filename, metadata_start, data_start, length=None, tokens=None):
         if filename in self.filenames:
             raise DuplicateFilename(filename)
         self.filenames[filename] = (metadata_start, data_start)
+        if length is not None or tokens is not None:
+            self.sizes[filename] = (length, tokens)
+        self._positions = self._filename_list = None
+
+    def close(self):
+        """ Nothing to release for a text index: provided for compatibility with the binary index. """
+        pass
 
     @staticmethod
     def load(filename):
         index = PimarcIndex()
         with open(filename, "r") as f:
             for line in f:
-                # Remove the newline char
-                line = line[:-1]
-                # There should be three tab-separated values: filename, metadata start and data start
-                doc_filename, metadata_start, data_start = line.split("\t")
-                metadata_start, data_start = int(metadata_start), int(data_start)
-                index.append(doc_filename, metadata_start, data_start)
+                index.append(*_parse_index_line(line))
         return index
 
     def save(self, path):
         with open(path, "w") as f:
             for doc_filename, (metadata_start, data_start) in self.filenames.items():
-                f.write(u"{}\t{}\t{}\n".format(doc_filename, metadata_start, data_start))
+                f.write(_format_index_line(doc_filename, metadata_start, data_start,
+                                           *self.sizes.get(doc_filename, (None, None))))
 
 
 class PimarcIndexAppender(object):
@@ -89,6 +132,7 @@ class PimarcIndexAppender(object):
     def __init__(self, store_path, mode="w"):
         self.store_path = store_path
         self.filenames = OrderedDict()
+        self.sizes = {}
         self.mode = mode
 
         if self.mode == "a":
@@ -105,12 +149,14 @@ class PimarcIndexAppender(object):
     def __contains__(self, item):
         return item in self.filenames
 
-    def append(self, filename, metadata_start, data_start):
+    def append(self, filename, metadata_start, data_start, length=None, tokens=None):
         if filename in self.filenames:
             raise DuplicateFilename(filename)
         self.filenames[filename] = (metadata_start, data_start)
+        if length is not None or tokens is not None:
+            self.sizes[filename] = (length, tokens)
         # Add a line to the end of the index
-        self.fileobj.write(u"{}\t{}\t{}\n".format(filename, metadata_start, data_start))
+        self.fileobj.write(_format_index_line(filename, metadata_start, data_start, length, tokens))
 
     def close(self):
         self.fileobj.close()
@@ -118,12 +164,10 @@ class PimarcIndexAppender(object):
     def _load(self):
         with open(self.store_path, "r") as f:
             for line in f:
-                # Remove the newline char
-                line = line[:-1]
-                # There should be three tab-separated values: filename, metadata start and data start
-                doc_filename, metadata_start, data_start = line.split("\t")
-                metadata_start, data_start = int(metadata_start), int(data_start)
+                doc_filename, metadata_start, data_start, length, tokens = _parse_index_line(line)
                 self.filenames[doc_filename] = (metadata_start, data_start)
+                if length is not None or tokens is not None:
+                    self.sizes[doc_filename] = (length, tokens)
 
     def flush(self):
         # First call flush(), which does a basic flush to RAM cache
@@ -132,13 +176,76 @@ class PimarcIndexAppender(object):
         os.fsync(self.fileobj.fileno())
 
 
-def reindex(pimarc_path):
+def _format_index_line(filename, metadata_start, data_start, length=None, tokens=None):
+    """
+    One line of a text index. The file's size is only included if it's known, so indexes
+    without sizes are written just as they were before sizes were recorded.
+
+    """
+    if length is None and tokens is None:
+        return u"{}\t{}\t{}\n".format(filename, metadata_start, data_start)
+    elif tokens is None:
+        return u"{}\t{}\t{}\t{}\n".format(filename, metadata_start, data_start, length)
+    else:
+        return u"{}\t{}\t{}\t{}\t{}\n".format(filename, metadata_start, data_start,
+                                                  "" if length is None else length, tokens)
+
+
+def _parse_index_line(line):
+    """
+    Parse a line of a text index.
+
+    :return: tuple (filename, metadata start byte, data start byte, length, token count),
+        where length and token count are None if they weren't recorded
+    """
+    # Remove the newline char
+    line = line[:-1]
+    # There should be three tab-separated values: filename, metadata start and data start,
+    #  optionally followed by the file's length and token count
+    values = line.split("\t")
+    if not 3 <= len(values) <= 5:
+        raise IndexFormatError("expected 3-5 tab-separated values in index line, got {}: {}".format(
+            len(values), line))
+    sizes = [int(val) if val else None for val in values[3:]]
+    sizes.extend([None] * (2 - len(sizes)))
+    return (values[0], int(values[1]), int(values[2])) + tuple(sizes)
+
+
+def load_index(archive_filename):
+    """
+    Load the index for a Pimarc archive. If the archive has a binary index (.prcx)
+    that is at least as recent as the text index (.prci), the binary index is
+    opened. Otherwise, the text index is loaded.
+
+    The writer removes the binary index when it appends to an archive and only
+    writes a new one once it's closed, so the modification times don't need to
+    be fine-grained for an out-of-date binary index to be ignored. The check on
+    the times just guards against the text index being changed some other way.
+
+    :param archive_filename: path to the .prc file
+    :return: PimarcIndex or PimarcBinaryIndex
+    """
+    from .binindex import PimarcBinaryIndex, binary_index_filename
+
+    index_filename = "{}i".format(archive_filename)
+    bin_index_filename = binary_index_filename(archive_filename)
+    if os.path.exists(bin_index_filename) and (
+            not os.path.exists(index_filename) or
+            os.path.getmtime(bin_index_filename) >= os.path.getmtime(index_filename)):
+        return PimarcBinaryIndex.open(bin_index_filename)
+    # No binary index, or it's stale: use the text index
+    return PimarcIndex.load(index_filename)
+
+
+def reindex(pimarc_path, binary=False):
     """
     Rebuild the index of a Pimarc archive from its data file (.prc).
 
     Stores the new index in the correct location (.prci), overwriting any existing index.
 
     :param pimarc_path: path to the .prc file
+    :param binary: also write a binary index (.prcx). If False, any existing binary
+        index is removed, since it may not match the rebuilt index
     :return: the PimarcIndex
     """
     if not pimarc_path.endswith(".prc"):
@@ -149,25 +256,19 @@ def reindex(pimarc_path):
     index = PimarcIndex()
     # Read in each file in turn, reading the metadata to get the name and skipping the file content
     with open(pimarc_path, "rb") as data_file:
-        try:
-            while True:
-                # Check where the metadata starts
-                metadata_start_byte = data_file.tell()
-                # First read the file's metadata block
-                metadata = json.loads(_read_var_length_data(data_file).decode("utf-8"))
-                # From that we can get the name
-                filename = metadata["name"]
-                # Now we're at the start of the file data
-                data_start_byte = data_file.tell()
-                # Skip over the data: we don't need to read that
-                _skip_var_length_data(data_file)
-                # Now add the entry to the index, with pointers to the start bytes
-                index.append(filename, metadata_start_byte, data_start_byte)
-        except EOFError:
-            # Reached the end of the file
-            pass
+        for filename, metadata_start_byte, data_start_byte, length in _iter_index_entries(data_file):
+            # Now add the entry to the index, with pointers to the start bytes
+            # Token counts aren't stored in the archive itself, so can't be recovered
+            index.append(filename, metadata_start_byte, data_start_byte, length=length)
 
     index.save(index_path)
+
+    from .binindex import write_binary_index, binary_index_filename
+    bin_index_path = binary_index_filename(pimarc_path)
+    if binary:
+        write_binary_index(bin_index_path, index.filenames.items(), sizes=index.sizes)
+    elif os.path.exists(bin_index_path):
+        os.remove(bin_index_path)
     return index
 
 
@@ -185,25 +286,15 @@ def check_index(pimarc_path):
 
     if not os.path.exists(index_path):
         raise IOError("pimarc does not have an index: cannot check it")
-    index = PimarcIndex.load(index_path)
+    # Check whichever index a reader would use
+    index = load_index(pimarc_path)
     index_it = iter(index)
     file_num = 0
 
-    # Read in each file in turn, reading the metadata to get the name and skipping the file content
-    with open(pimarc_path, "rb") as data_file:
-        try:
-            while True:
-                # Check where the metadata starts
-                metadata_start_byte = data_file.tell()
-                # First read the file's metadata block
-                metadata = json.loads(_read_var_length_data(data_file).decode("utf-8"))
-                # From that we can get the name
-                filename = metadata["name"]
-                # Now we're at the start of the file data
-                data_start_byte = data_file.tell()
-                # Skip over the data: we don't need to read that
-                _skip_var_length_data(data_file)
-
+    try:
+        # Read in each file in turn, reading the metadata to get the name and skipping the file content
+        with open(pimarc_path, "rb") as data_file:
+            for filename, metadata_start_byte, data_start_byte, length in _iter_index_entries(data_file):
                 # Get the expected values from the index
                 exp_filename = next(index_it)
                 exp_metadata_start_byte = index.get_metadata_start_byte(exp_filename)
@@ -221,11 +312,62 @@ def check_index(pimarc_path):
                     raise IndexCheckFailed("file {} expected to start its data at {}, got {}"
                                            .format(file_num, data_start_byte, exp_data_start_byte))
 
+                exp_length = index.get_size(exp_filename)[0]
+                if exp_length is not None and length != exp_length:
+                    raise IndexCheckFailed("file {} expected to have length {}, got {}"
+                                           .format(file_num, exp_length, length))
+
                 file_num += 1
+    finally:
+        index.close()
+    return file_num
+
+
+def _iter_index_entries(data_file):
+    """
+    Read through a Pimarc file, yielding the index entry that should be stored for each
+    file in it: a tuple (filename, metadata start byte, data start byte, length of data in bytes).
+
+    For a compressed archive, the two pointers are instead the start byte of the
+    block containing the file and the offset within the decompressed block of the
+    start of its metadata. The length is that of the uncompressed data.
+
+    """
+    from .compression import read_header
+
+    codec = read_header(data_file)
+    if codec is None:
+        try:
+            while True:
+                # Check where the metadata starts
+                metadata_start_byte = data_file.tell()
+                # First read the file's metadata block
+                metadata = json.loads(_read_var_length_data(data_file).decode("utf-8"))
+                # Now we're at the start of the file data
+                data_start_byte = data_file.tell()
+                # Skip over the data: we don't need to read that, just its length
+                length = decode_stream(data_file)
+                data_file.seek(length, 1)
+                # From the metadata we can get the name
+                yield metadata["name"], metadata_start_byte, data_start_byte, length
         except EOFError:
             # Reached the end of the file
             pass
-    return file_num
+    else:
+        while True:
+            block_start_byte = data_file.tell()
+            try:
+                block = codec.decompress(_read_var_length_data(data_file))
+            except EOFError:
+                # Reached the end of the file
+                break
+            pos = 0
+            while pos < len(block):
+                metadata_start = pos
+                raw_metadata, pos = _read_var_length_data_from_buffer(block, pos)
+                length, data_start = decode_buffer(block, pos)
+                pos = data_start + length
+                yield json.loads(raw_metadata.decode("utf-8"))["name"], block_start_byte, metadata_start, length
 
 
 class IndexCheckFailed(Exception):
@@ -246,3 +388,7 @@ class DuplicateFilename(Exception):
 
 class IndexWriteError(Exception):
     pass
+
+
+class IndexFormatError(Exception):
+    pass
@@ -3,34 +3,90 @@
 # Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
 
 import json
+import mmap
+import os
 
 from builtins import super, bytes
 
-from .utils import _read_var_length_data, _skip_var_length_data
-from .index import PimarcIndex
+from .utils import _read_var_length_data, _skip_var_length_data, _read_var_length_data_from_buffer, \
+    _skip_var_length_data_in_buffer
+from .index import load_index
+from .compression import read_header, decode_header, HEADER_LENGTH
 
 
 class PimarcReader(object):
     """
     The Pimlico Archive format: read-only archive.
 
+    If `use_mmap=True`, the archive file is memory-mapped and all reading is done
+    directly from the mapped buffer, instead of by many small reads from the file.
+    This avoids a system call and a copy for each record, so is faster for both
+    sequential and random access, particularly on large archives. In this mode,
+    file data is returned as `memoryview` slices of the mapped archive, not `bytes`.
+    These remain valid after the reader is closed (the mapping is only released once
+    they have all been garbage collected), but if you need to keep a lot of them
+    for a long time, or pass them to something that requires `bytes`, call `bytes()`
+    on them. Metadata is likewise decoded directly from the buffer when first accessed.
+
+    Block-compressed archives (see :mod:`~pimlico.utils.pimarc.compression`) are detected
+    automatically and read in just the same way. Random access decompresses the whole block
+    containing the file. The most recently decompressed block is kept, so reading files
+    stored close to one another doesn't require the block to be decompressed again. File
+    data from a compressed archive is always returned as `bytes`, even if `use_mmap=True`.
+
     """
-    def __init__(self, archive_filename):
+    def __init__(self, archive_filename, use_mmap=False):
         self.archive_filename = archive_filename
         if not archive_filename.endswith(".prc"):
             raise IOError("pimarc files should have the extension '.prc'")
         self.index_filename = "{}i".format(archive_filename)
 
         self.archive_file = open(self.archive_filename, mode="rb")
-        self.index = PimarcIndex.load(self.index_filename)
+        self.use_mmap = use_mmap
+        self._mmap = None
+        self._buffer = None
+        if use_mmap:
+            if os.fstat(self.archive_file.fileno()).st_size == 0:
+                # Can't map an empty file, but there's nothing to read anyway
+                self._buffer = memoryview(b"")
+            else:
+                self._mmap = mmap.mmap(self.archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._buffer = memoryview(self._mmap)
+        # Check whether the archive is block-compressed and, if so, what codec it uses
+        if self._buffer is not None:
+            self.codec = decode_header(self._buffer)
+        else:
+            self.codec = read_header(self.archive_file)
+        # The most recently decompressed block: (start byte, decompressed data)
+        self._cached_block = None
+        # Uses the binary index if the archive has an up-to-date one, otherwise the text index
+        self.index = load_index(self.archive_filename)
         self.closed = False
 
     def close(self):
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Some data slices that we returned are still in use: the mapping will be released
+                # when they're garbage collected
+                pass
+            self._mmap = None
         self.archive_file.close()
+        # Release the index: in the case of a binary index, this closes its memory map
+        if self.index is not None:
+            self.index.close()
         # Allow garbage collection of the index
         self.index = None
         self.closed = True
 
+    @property
+    def compressed(self):
+        return self.codec is not None
+
     def __enter__(self):
         return self
 
@@ -44,6 +100,11 @@ class PimarcReader(object):
         """
         # Look up the filename in the index and get pointers to its metadata and data
         metadata_start, data_start = self.index[item]
+        if self.compressed:
+            # For a compressed archive, the index gives us the block and the file's offset within it
+            return read_doc_from_pimarc_buffer(self._get_block(metadata_start), data_start)
+        if self._buffer is not None:
+            return read_doc_from_pimarc_buffer(self._buffer, metadata_start)
         # There's some redundancy in this case: we're now presumably at the start
         # of the data after reading the metadata, so don't need data_start
         # Assume that this is the case and continue reading from where we stopped
@@ -85,6 +146,15 @@ class PimarcReader(object):
         over the data.
 
         """
+        if self.compressed:
+            for metadata, __ in self._iter_compressed(read_data=False):
+                yield metadata
+            return
+        if self._buffer is not None:
+            for metadata, __ in _iter_buffer_files(self._buffer, 0, read_data=False):
+                yield metadata
+            return
+
         # Make sure we're at the start of the file
         self.archive_file.seek(0)
         while True:
@@ -98,65 +168,148 @@ class PimarcReader(object):
             self._skip_block()
             yield metadata
 
-    def iter_files(self, skip=None, start_after=None):
+    def iter_files(self, skip=None, start_after=None, name_filter=None):
         """
         Iterate over files, together with their JSON metadata, which includes their name (as "name").
 
+        The index is used to jump straight to the first file required, so skipped files are
+        never read.
+
         :param start_after: skips all files before that with the given name, which is
             expected to be in the archive
         :param skip: skips over the first portion of the archive, until this number of documents have
             been seen. Ignored is start_after is given.
+        :param name_filter: if given, should be a callable that takes a filename and returns True if the
+            file should be yielded and False if it should be skipped. Filenames are taken from the index,
+            so the metadata and data of rejected files are never read
         """
         if start_after is not None:
             # Look up this filename in the index
             if start_after not in self.index:
                 raise StartAfterFilenameNotFound("filename '{}' not found in the Pimarc archive".format(start_after))
-            # Get the start byte of the file's data
-            start_after_start_byte = self.index.get_data_start_byte(start_after)
-            # Seek to this byte, then skip over the data, so we're at the start of the next file's metadata
-            self.archive_file.seek(start_after_start_byte)
-            self._skip_block()
-            # Don't skip any more files
-            started = True
+            # Start at the file after this one
+            position = self.index.get_position(start_after) + 1
+        elif skip is not None and skip > 0:
+            position = skip
         else:
-            # Make sure we're at the start of the file
-            self.archive_file.seek(0)
+            position = 0
+
+        if position > 0 and position >= len(self.index):
+            # Skipped everything
+            return
+
+        if name_filter is not None:
+            for doc in self._iter_filtered(position, name_filter):
+                yield doc
+            return
+
+        if self.compressed:
+            for doc in self._iter_compressed(position):
+                yield doc
+            return
+
+        # Jump straight to the first file we need, according to the index
+        start_byte = self.index.get_entry(position)[1] if position > 0 else 0
+        if self._buffer is not None:
+            for doc in _iter_buffer_files(self._buffer, start_byte):
+                yield doc
+            return
+
+        self.archive_file.seek(start_byte)
+        while True:
+            # Try reading the metadata of the next file
+            try:
+                metadata = self._read_metadata()
+            except EOFError:
+                # At this point, it's normal to get an EOF: we've just got to the end neatly
+                break
+            # This should be followed by the file's data immediately
+            # Read it in
+            # If there's an EOF here, something's wrong with the file
+            data = _read_var_length_data(self.archive_file)
 
-            if skip is not None and skip < 1:
-                skip = None
-            # Don't wait to start if skip is not given
-            started = skip is None
+            # Wrap in bytes
+            # In Py2, this converts the string to a bytes backport
+            # In Py3, this is a no-op
+            data = bytes(data)
 
-        skipped = 0
-        while True:
-            if not started:
-                # Skip this file's metadata
-                self._skip_block()
-                # And the file's data
-                self._skip_block()
-
-                skipped += 1
-                if skipped >= skip:
-                    # Skipped enough files: start reading at the next one
-                    started = True
+            yield metadata, data
+
+    def _iter_filtered(self, position, name_filter):
+        """
+        Iterate over the files from the given position in the index onwards, reading
+        only those whose names are accepted by the filter. Files accepted one after another
+        are still read sequentially: seeking to the position we're already at costs nothing.
+
+        """
+        for position in range(position, len(self.index)):
+            filename, metadata_start, data_start = self.index.get_entry(position)
+            if not name_filter(filename):
+                continue
+            if self.compressed:
+                # A block is only decompressed if some file in it is accepted
+                yield read_doc_from_pimarc_buffer(self._get_block(metadata_start), data_start)
+            elif self._buffer is not None:
+                yield read_doc_from_pimarc_buffer(self._buffer, metadata_start)
             else:
-                # Try reading the metadata of the next file
-                try:
-                    metadata = self._read_metadata()
-                except EOFError:
-                    # At this point, it's normal to get an EOF: we've just got to the end neatly
-                    break
-                # This should be followed by the file's data immediately
-                # Read it in
-                # If there's an EOF here, something's wrong with the file
-                data = _read_var_length_data(self.archive_file)
-
-                # Wrap in bytes
-                # In Py2, this converts the string to a bytes backport
-                # In Py3, this is a no-op
-                data = bytes(data)
-
-                yield metadata, data
+                metadata, data = read_doc_from_pimarc_file(self.archive_file, metadata_start)
+                yield metadata, bytes(data)
+
+    def _read_block(self, block_start):
+        """
+        Read and decompress a block of a compressed archive.
+
+        :return: tuple (decompressed data, start byte of the next block)
+        """
+        if self._buffer is not None:
+            compressed_data, next_block_start = _read_var_length_data_from_buffer(self._buffer, block_start)
+        else:
+            self.archive_file.seek(block_start)
+            compressed_data = _read_var_length_data(self.archive_file)
+            next_block_start = self.archive_file.tell()
+        return self.codec.decompress(compressed_data), next_block_start
+
+    def _get_block(self, block_start):
+        """
+        Get the decompressed data of the block starting at the given byte, using the
+        cached block if it's the same one as last time.
+
+        """
+        if self._cached_block is None or self._cached_block[0] != block_start:
+            block, __ = self._read_block(block_start)
+            self._cached_block = (block_start, block)
+        return self._cached_block[1]
+
+    def _iter_blocks(self, block_start=HEADER_LENGTH):
+        """
+        Iterate over the decompressed blocks of a compressed archive, starting with the one
+        starting at the given byte (by default, the first).
+
+        """
+        end = len(self._buffer) if self._buffer is not None else os.fstat(self.archive_file.fileno()).st_size
+        while block_start < end:
+            # We don't rely on the file position being kept between blocks, so random access is
+            # allowed during iteration
+            block, block_start = self._read_block(block_start)
+            yield block
+
+    def _iter_compressed(self, position=0, read_data=True):
+        """
+        Iteration over files, as in `iter_files()`, for a compressed archive, starting from the
+        given position in the index. We use the index to jump straight to the right block, so
+        only the blocks containing the files we need are decompressed.
+
+        """
+        if position > 0:
+            __, block_start, pos = self.index.get_entry(position)
+        else:
+            block_start, pos = HEADER_LENGTH, 0
+
+        for block in self._iter_blocks(block_start):
+            for doc in _iter_buffer_files(block, pos, read_data=read_data):
+                yield doc
+            # Subsequent blocks are read from the start
+            pos = 0
 
     def __iter__(self):
         return self.iter_files()
@@ -165,6 +318,25 @@ class PimarcReader(object):
         return len(self.index)
 
 
+def _iter_buffer_files(buffer, pos, read_data=True):
+    """
+    Iterate over the files stored in a buffer, starting from the given position, which
+    should be the start of a metadata block. The buffer might be a whole memory-mapped
+    archive, or a decompressed block of a compressed archive.
+
+    """
+    buffer_len = len(buffer)
+    while pos < buffer_len:
+        raw_metadata, pos = _read_var_length_data_from_buffer(buffer, pos)
+        if read_data:
+            # If there's an EOF here, something's wrong with the file
+            data, pos = _read_var_length_data_from_buffer(buffer, pos)
+        else:
+            data = None
+            pos = _skip_var_length_data_in_buffer(buffer, pos)
+        yield PimarcFileMetadata(raw_metadata), data
+
+
 def read_doc_from_pimarc(archive_filename, metadata_start_byte):
     """
     Read a single file's metadata and file data from a given start point in the
@@ -199,6 +371,22 @@ def read_doc_from_pimarc_file(archive_file, metadata_start_byte):
     return metadata, data
 
 
+def read_doc_from_pimarc_buffer(buffer, metadata_start_byte):
+    """
+    Same as `read_doc_from_pimarc`, but reads from a buffer containing the whole
+    archive, typically a memoryview of a memory-mapped archive file. The data
+    is returned as a slice of the buffer, so is not copied.
+
+    :param buffer: bytes-like object containing the archive
+    :param metadata_start_byte: byte from which metadata starts
+    :return: tuple (metadata, raw file data)
+    """
+    raw_metadata, pos = _read_var_length_data_from_buffer(buffer, metadata_start_byte)
+    # The data follows immediately after the metadata
+    data, __ = _read_var_length_data_from_buffer(buffer, pos)
+    return PimarcFileMetadata(raw_metadata), data
+
+
 def metadata_decode_decorator(fn):
     def _new_fn(self, *args, **kwargs):
         self.decode()
@@ -226,7 +414,8 @@ class PimarcFileMetadata(dict):
     def decode(self):
         if not self._decoded:
             # Decode the metadata and parse as JSON
-            self.update(json.loads(self.raw_data.decode("utf-8")))
+            # Using str() rather than decode() means this works directly on a memoryview, without copying it
+            self.update(json.loads(str(self.raw_data, "utf-8")))
             self._decoded = True
 
     __getitem__ = metadata_decode_decorator(dict.__getitem__)
@@ -88,7 +88,7 @@ class PimarcTarBackend(object):
         for filename in self.iter_filenames():
             yield self._get_metadata(filename)
 
-    def iter_files(self, skip=None, start_after=None):
+    def iter_files(self, skip=None, start_after=None, name_filter=None):
         """
         Iterate over files, together with their JSON metadata, which includes their name (as "name").
 
@@ -96,6 +96,8 @@ class PimarcTarBackend(object):
             expected to be in the archive
         :param skip: skips over the first portion of the archive, until this number of documents have
             been seen. Ignored is start_after is given.
+        :param name_filter: if given, should be a callable that takes a filename and returns True if the
+            file should be yielded and False if it should be skipped. Rejected files are not extracted
         """
         # Make sure we're at the start of the file
         self.archive_file.fileobj.seek(0)
@@ -126,6 +128,9 @@ class PimarcTarBackend(object):
                         started = True
                     continue
 
+                if name_filter is not None and not name_filter(filename):
+                    continue
+
                 # Extract the raw file data
                 self.archive_file.extract(tarinfo, tmp_dir)
                 # Read in the data
@@ -15,6 +15,8 @@ import sys
 
 from pimlico.utils.pimarc import PimarcReader, PimarcWriter
 from pimlico.utils.pimarc.index import check_index, IndexCheckFailed
+from .binindex import build_binary_index, binary_index_filename
+from .compression import CODECS
 from .index import reindex
 
 
@@ -94,7 +96,7 @@ def from_tar(opts):
         print("Creating {} from {}".format(out_path, tar_path))
 
         # Create a writer to add files to
-        with PimarcWriter(out_path) as arc:
+        with PimarcWriter(out_path, compression=opts.compression, compression_level=opts.level) as arc:
             # Read in the tar file
             tarfile = TarFile.open(tar_path, "r:")
             for tarinfo in tarfile:
@@ -116,10 +118,29 @@ def reindex_pimarcs(opts):
 
     for pimarc_path in opts.paths:
         print("Rebuilding index for {}".format(pimarc_path))
-        reindex(pimarc_path)
+        reindex(pimarc_path, binary=opts.binary)
         print("  Success")
 
 
+def binary_index_pimarcs(opts):
+    if not all(path.endswith(".prc") for path in opts.paths):
+        print("Pimarc files must have correct extension: .prc")
+        sys.exit(1)
+
+    for pimarc_path in opts.paths:
+        bin_index_path = binary_index_filename(pimarc_path)
+        if opts.delete:
+            if os.path.exists(bin_index_path):
+                print("Removing binary index for {}".format(pimarc_path))
+                os.remove(bin_index_path)
+            else:
+                print("No binary index for {}".format(pimarc_path))
+        else:
+            print("Building binary index for {}".format(pimarc_path))
+            length = build_binary_index(pimarc_path)
+            print("  Success ({:,d} members)".format(length))
+
+
 def check_pimarcs(opts):
     if not all(path.endswith(".prc") for path in opts.paths):
         print("Pimarc files must have correct extension: .prc")
@@ -154,8 +175,10 @@ def remove(opts):
     # Write to a temporary new archive
     tmp_arc = "{}.tmp".format(path)
     try:
-        with PimarcWriter(tmp_arc, mode="w") as writer:
-            with PimarcReader(path) as reader:
+        with PimarcReader(path) as reader:
+            # Use the same compression (if any) as the original archive
+            with PimarcWriter(tmp_arc, mode="w",
+                              compression=reader.codec.name if reader.compressed else None) as writer:
                 for metadata, data in reader:
                     name = metadata["name"]
                     if name in files_to_remove:
@@ -180,8 +203,12 @@ def remove(opts):
 
         # Replace the old archive with the new one
         print("Writing new archive to {}".format(path))
+        had_binary_index = os.path.exists(binary_index_filename(path))
         os.replace(tmp_arc, path)
         os.replace("{}i".format(tmp_arc), "{}i".format(path))
+        if had_binary_index:
+            # The old binary index no longer matches the archive
+            build_binary_index(path)
     finally:
         # Remove the temporary archive
         if os.path.exists(tmp_arc):
@@ -222,6 +249,9 @@ def run():
     subparser.add_argument("tars", nargs="+", help="Path to the tar archive(s)")
     subparser.add_argument("--out-path", "-o", help="Directory to output files to. Defaults to same as input")
     subparser.add_argument("--delete", "-d", action="store_true", help="Delete the tar files after creating pimarcs")
+    subparser.add_argument("--compression", "-c", choices=list(CODECS.keys()),
+                           help="Block-compress the pimarcs using the given codec")
+    subparser.add_argument("--level", "-l", type=int, help="Compression level. Defaults to the codec's default")
 
     subparser = subparsers.add_parser("reindex",
                                       help="Rebuild a pimarc's index (the .prci file) from its data (the .prc file). "
@@ -229,6 +259,17 @@ def run():
                                            "wrong during writing of the archive")
     subparser.set_defaults(func=reindex_pimarcs)
     subparser.add_argument("paths", nargs="+", help="Path to the pimarc(s) - .prc files")
+    subparser.add_argument("--binary", "-b", action="store_true",
+                           help="Also write a binary index (.prcx). Otherwise, any existing binary index is removed")
+
+    subparser = subparsers.add_parser("binindex",
+                                      help="Build a binary, memory-mappable index (the .prcx file) for pimarc(s) "
+                                           "from their text index (the .prci file). Readers will use the binary "
+                                           "index when it's available, which makes opening large archives faster")
+    subparser.set_defaults(func=binary_index_pimarcs)
+    subparser.add_argument("paths", nargs="+", help="Path to the pimarc(s) - .prc files")
+    subparser.add_argument("--delete", "-d", action="store_true",
+                           help="Remove the binary index instead of building it, so the text index is used")
 
     subparser = subparsers.add_parser("check",
                                       help="Check a pimarc's index (the .prci file) against its data (the .prc file). "
@@ -2,7 +2,7 @@
 # Copyright (C) 2020 Mark Granroth-Wilding
 # Licensed under the GNU LGPL v3.0 - https://www.gnu.org/licenses/lgpl-3.0.en.html
 
-from pimlico.utils.varint import decode_stream, encode
+from pimlico.utils.varint import decode_stream, encode, decode_buffer
 
 
 def _read_var_length_data(reader):
@@ -27,6 +27,31 @@ def _skip_var_length_data(reader):
     reader.seek(data_length, 1)
 
 
+def _read_var_length_data_from_buffer(buffer, pos):
+    """
+    Like read_var_length_data, but reads from a buffer (typically a memoryview of a
+    memory-mapped archive), starting at the given position, instead of a file-like object.
+    The data is returned as a slice of the buffer, so no copy is made if the buffer
+    is a memoryview.
+
+    :return: tuple (data, position just after the data)
+    """
+    data_length, pos = decode_buffer(buffer, pos)
+    end = pos + data_length
+    if end > len(buffer):
+        raise EOFError("Unexpected EOF while reading data")
+    return buffer[pos:end], end
+
+
+def _skip_var_length_data_in_buffer(buffer, pos):
+    """
+    Like skip_var_length_data, but for a buffer. Returns the position just after the data.
+
+    """
+    data_length, pos = decode_buffer(buffer, pos)
+    return pos + data_length
+
+
 def _write_var_length_data(writer, data):
     """
     Write some data to a file-like object by first writing a varint that says how many
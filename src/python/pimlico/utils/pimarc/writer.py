@@ -4,23 +4,44 @@
 
 import json
 import os
+from io import BytesIO
 
 from future.utils import raise_from
 
 from pimlico.utils.pimarc.index import DuplicateFilename
 from .utils import _write_var_length_data
 from .index import PimarcIndexAppender
+from .binindex import binary_index_filename, write_binary_index
+from .compression import get_codec, encode_header, read_header, DEFAULT_BLOCK_SIZE
 
 
 class PimarcWriter(object):
     """
     The Pimlico Archive format: writing new archives or appending existing ones.
 
+    If `binary_index=True`, a binary index (see :mod:`~pimlico.utils.pimarc.binindex`)
+    is written when the archive is closed, in addition to the usual text index.
+    When appending to an archive that already has a binary index, it is removed
+    and rebuilt when the archive is closed, so that an out-of-date binary index is
+    never left alongside the text index.
+
+    If `compression` is given, the archive is block-compressed using the named codec
+    (see :mod:`~pimlico.utils.pimarc.compression`). Files are collected into a block
+    until it reaches `block_size` bytes (uncompressed), then the block is compressed
+    and written out. When appending, the existing archive's codec is always used, if
+    it's compressed, and `compression` is ignored.
+
     """
-    def __init__(self, archive_filename, mode="w"):
+    def __init__(self, archive_filename, mode="w", binary_index=False, compression=None, compression_level=None,
+                 block_size=DEFAULT_BLOCK_SIZE):
         self.archive_filename = archive_filename
         self.index_filename = "{}i".format(archive_filename)
+        self.binary_index_filename = binary_index_filename(archive_filename)
         self.append = mode == "a"
+        self.binary_index = binary_index
+        self.block_size = block_size
+        # Validate the codec before we touch any files
+        self.codec = get_codec(compression, compression_level) if compression is not None else None
 
         if self.append:
             # Check the old archive already exists
@@ -28,21 +49,48 @@ class PimarcWriter(object):
                 raise IOError("cannot append to non-existent archive: {}".format(archive_filename))
             if not os.path.exists(self.index_filename):
                 raise IOError("cannot append to archive: index file doesn't exist: {}".format(self.index_filename))
+            if os.path.exists(self.binary_index_filename):
+                # Rebuild the binary index when we close. Remove the old one now, so that it can't
+                #  be used in place of the text index while it's out of date
+                self.binary_index = True
+                os.remove(self.binary_index_filename)
         else:
             # Remove any existing files
             if os.path.exists(archive_filename):
                 os.remove(archive_filename)
             if os.path.exists(self.index_filename):
                 os.remove(self.index_filename)
+            if os.path.exists(self.binary_index_filename):
+                os.remove(self.binary_index_filename)
+
+        if self.append and os.path.getsize(archive_filename) > 0:
+            # Continue in the same format as the existing archive
+            with open(self.archive_filename, mode="rb") as existing_file:
+                existing_codec = read_header(existing_file)
+            if existing_codec is None:
+                self.codec = None
+            elif self.codec is None or self.codec.name != existing_codec.name:
+                self.codec = existing_codec
 
         self.archive_file = open(self.archive_filename, mode="ab" if self.append else "wb")
         self.index = PimarcIndexAppender(self.index_filename, mode="a" if self.append else "w")
 
+        # Files written to the current block, which haven't yet been compressed and written to disk
+        self._block = BytesIO()
+        self._block_files = []
+        self._block_names = set()
+        if self.codec is not None and self.archive_file.tell() == 0:
+            self.archive_file.write(encode_header(self.codec))
+
+    @property
+    def compressed(self):
+        return self.codec is not None
+
     @staticmethod
     def delete(archive_filename):
         """
         Delete all files associated with the given archive. At the moment, this is
-        just the archive file itself and the associated index.
+        just the archive file itself and the associated indexes (text and binary).
 
         """
         if os.path.exists(archive_filename):
@@ -50,10 +98,17 @@ class PimarcWriter(object):
         index_filenam = "{}i".format(archive_filename)
         if os.path.exists(index_filenam):
             os.remove(index_filenam)
+        bin_index_filename = binary_index_filename(archive_filename)
+        if os.path.exists(bin_index_filename):
+            os.remove(bin_index_filename)
 
     def close(self):
+        self._write_block()
         self.archive_file.close()
         self.index.close()
+        if self.binary_index:
+            # The appender has kept all the filenames and pointers, so we can write them straight out
+            write_binary_index(self.binary_index_filename, self.index.filenames.items(), sizes=self.index.sizes)
 
     def __enter__(self):
         return self
@@ -61,7 +116,7 @@ class PimarcWriter(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def write_file(self, data, name=None, metadata=None):
+    def write_file(self, data, name=None, metadata=None, tokens=None):
         """
         Append a write to the end of the archive. The metadata should be a dictionary
         that can be encoded as JSON (which is how it will be stored). The data should
@@ -73,6 +128,10 @@ class PimarcWriter(object):
         Setting `name=X` is simply a shorthand for setting `metadata["name"]=X`.
         Either `name` or a metadata dict including the `name` key is required.
 
+        The length of the data is recorded in the index. If `tokens` is given, it is also
+        stored in the index as the number of tokens in the file, so that readers can know
+        how big the file is without reading it.
+
         """
         if metadata is None:
             metadata = {}
@@ -88,9 +147,13 @@ class PimarcWriter(object):
                 raise MetadataError("metadata should include 'name' key")
 
         # Check before we write anything that the filename isn't already used
-        if filename in self.index:
+        if filename in self.index or filename in self._block_names:
             raise DuplicateFilename(filename)
 
+        if self.compressed:
+            self._write_file_to_block(filename, data, metadata, tokens)
+            return
+
         # Check where we're up to in the file
         # This tells us where the metadata starts, which will be stored in the index
         metadata_start = self.archive_file.tell()
@@ -111,7 +174,7 @@ class PimarcWriter(object):
             _write_var_length_data(self.archive_file, data)
 
             # Add the file to the index
-            self.index.append(filename, metadata_start, data_start)
+            self.index.append(filename, metadata_start, data_start, length=len(data), tokens=tokens)
         except:
             # If anything goes wrong during writing or it's cancelled by an interrupt,
             # truncate the partial data that we've just written, so we don't leave the file
@@ -121,11 +184,65 @@ class PimarcWriter(object):
             # Re-raise the exception for handling further up
             raise
 
+    def _write_file_to_block(self, filename, data, metadata, tokens=None):
+        """
+        Add a file to the current block of a compressed archive. It is only written to
+        the archive and the index once the block is full, or the writer is flushed or closed.
+
+        """
+        metadata_start = self._block.tell()
+        try:
+            metadata_data = json.dumps(metadata).encode("utf-8")
+        except Exception as e:
+            raise_from(MetadataError("problem encoding metadata as JSON"), e)
+
+        try:
+            _write_var_length_data(self._block, metadata_data)
+            _write_var_length_data(self._block, data)
+        except:
+            # Remove the partial file from the block
+            self._block.truncate(metadata_start)
+            self._block.seek(metadata_start)
+            raise
+        self._block_files.append((filename, metadata_start, len(data), tokens))
+        self._block_names.add(filename)
+
+        if self._block.tell() >= self.block_size:
+            self._write_block()
+
+    def _write_block(self):
+        """
+        Compress the current block of a compressed archive and write it out, adding
+        its files to the index. Does nothing if the block is empty.
+
+        """
+        if not self._block_files:
+            return
+        block_start = self.archive_file.tell()
+        compressed_data = self.codec.compress(self._block.getvalue())
+        try:
+            _write_var_length_data(self.archive_file, compressed_data)
+        except:
+            # Don't leave a partial block in the file
+            self.archive_file.truncate(block_start)
+            self.archive_file.seek(block_start)
+            raise
+        # In the index, each file points to the start of its block and its offset within the decompressed block
+        for filename, offset, length, tokens in self._block_files:
+            self.index.append(filename, block_start, offset, length=length, tokens=tokens)
+        self._block = BytesIO()
+        self._block_files = []
+        self._block_names = set()
+
     def flush(self):
         """
         Flush the archive's data out to disk, archive and index.
 
+        For a compressed archive, this ends the current block, even if it's not full.
+        Flushing very often therefore makes the compression less effective.
+
         """
+        self._write_block()
         # First call flush(), which does a basic flush to RAM cache
         self.archive_file.flush()
         # Then we also need to force the system to write it to disk
@@ -6,9 +6,18 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import object
 
+import multiprocessing
+import multiprocessing.queues
+import time
 from queue import Queue, Empty
 from threading import Thread
 
+try:
+    from multiprocessing.connection import wait as wait_for_connections
+except ImportError:
+    # Not available on Python 2: we fall back to polling queues
+    wait_for_connections = None
+
 
 def qget(queue, *args, **kwargs):
     """
@@ -74,3 +83,147 @@ class OutputQueue(object):
         except Empty:
             pass
         return "\n".join(reversed(lines))
+
+
+class WakeableQueue(Queue):
+    """
+    A queue for use between threads that lets a consumer block waiting for an item and also be woken
+    up by another thread, e.g. to tell it to stop waiting, without having to poll.
+    Use it via a :class:`QueueWaiter`.
+
+    """
+    def __init__(self, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self.wakeups = 0
+
+    def wake(self):
+        """
+        Wake up everything that's waiting on the queue with `get_or_wake()`.
+
+        """
+        with self.not_empty:
+            self.wakeups += 1
+            self.not_empty.notify_all()
+
+    def get_or_wake(self, wakeups_seen, timeout=None):
+        """
+        Wait until there's an item on the queue, or until `wake()` is called, if it hasn't been
+        since the waiter last checked.
+
+        :param wakeups_seen: the value of `wakeups` returned from the waiter's last call
+        :param timeout: if given, give up waiting after this many seconds
+        :return: pair `(item, wakeups)`, where item is None if we were woken up or timed out
+        """
+        with self.not_empty:
+            while not self._qsize():
+                if self.wakeups != wakeups_seen:
+                    return None, self.wakeups
+                if not self.not_empty.wait(timeout):
+                    return None, wakeups_seen
+            item = self._get()
+            self.not_full.notify()
+            return item, wakeups_seen
+
+
+def queue_wait_handle(queue):
+    """
+    Get an object that can be passed to :func:`multiprocessing.connection.wait` to wait until there's
+    something to read from a multiprocessing queue. Returns None for other types of queue.
+
+    This relies on a private attribute of :class:`multiprocessing.queues.Queue`, `_reader`, the
+    connection the queue is always read through, since there's no public way to get it. It has been
+    there in every version of Python 3 so far. If it's ever missing or isn't something we can wait on,
+    we return None and :class:`QueueWaiter` falls back to polling.
+
+    """
+    if not isinstance(queue, multiprocessing.queues.Queue):
+        return None
+    reader = getattr(queue, "_reader", None)
+    if reader is None or not hasattr(reader, "fileno"):
+        return None
+    return reader
+
+
+class QueueWaiter(object):
+    """
+    Lets a consumer of a queue block until there's something on the queue, or until it's woken up
+    by a call to `wake()`, from any thread or process. This means that items are taken from the queue
+    as soon as they're available, with no polling.
+
+    Works with multiprocessing queues and :class:`WakeableQueue`. Create the waiter before
+    starting any processes that need to use it. With any other type of queue, it falls back to
+    polling the queue.
+
+    With multiprocessing queues, `others` may give a list of other objects to wait on, as accepted
+    by :func:`multiprocessing.connection.wait`, e.g. process sentinels or the handles of other
+    queues (see :func:`queue_wait_handle`). If any of these is ready, the waiter wakes up. They
+    may be changed at any time by updating `others`.
+
+    """
+    def __init__(self, queue, others=None):
+        self.queue = queue
+        self.others = list(others or [])
+        self._wakeups = 0
+        self._handle = self._wake_reader = self._wake_writer = None
+        if isinstance(queue, WakeableQueue):
+            self._wakeups = queue.wakeups
+        else:
+            if wait_for_connections is not None:
+                self._handle = queue_wait_handle(queue)
+            if self._handle is not None:
+                self._wake_reader, self._wake_writer = multiprocessing.Pipe(duplex=False)
+
+    def get(self, poll_timeout=0.05, timeout=None):
+        """
+        Wait for the next item on the queue.
+
+        :param poll_timeout: only used if we have to fall back to polling the queue
+        :param timeout: if given, give up waiting after this many seconds
+        :return: the item, or None if we were woken up or timed out before there was one
+        """
+        if isinstance(self.queue, WakeableQueue):
+            item, self._wakeups = self.queue.get_or_wake(self._wakeups, timeout=timeout)
+            return item
+        elif self._handle is None:
+            try:
+                return qget(self.queue, timeout=poll_timeout if timeout is None else min(poll_timeout, timeout))
+            except Empty:
+                return None
+
+        # Keep to the timeout overall, even if we have to go back to waiting
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0.)
+            ready = wait_for_connections([self._handle, self._wake_reader] + self.others, timeout)
+            if not ready:
+                # Timed out
+                return None
+            if self._handle in ready:
+                try:
+                    # Don't block: the item could be gone already
+                    return qget(self.queue, block=False)
+                except Empty:
+                    # Another consumer got there first, or is reading from the queue now
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return None
+                    if len(ready) == 1:
+                        continue
+            if self._wake_reader in ready:
+                while self._wake_reader.poll():
+                    self._wake_reader.recv_bytes()
+            return None
+
+    def wake(self):
+        """
+        Wake up the waiter, if it's waiting, or make its next call to `get()` return
+        immediately, if not. Whoever calls this should first set whatever state the waiter should
+        check when it wakes up.
+
+        """
+        if isinstance(self.queue, WakeableQueue):
+            self.queue.wake()
+        elif self._wake_writer is not None:
+            # Only one wake-up is needed: don't fill up the pipe if the waiter's not reading it
+            if not self._wake_reader.poll():
+                self._wake_writer.send_bytes(b"")
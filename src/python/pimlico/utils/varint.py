@@ -71,6 +71,32 @@ def decode_bytes(buf):
     return decode_stream(BytesIO(buf))
 
 
+def decode_buffer(buf, pos=0):
+    """Read a varint from `buf` (any object supporting indexing to get integer
+    byte values, such as bytes, memoryview or mmap), starting at `pos`.
+
+    Unlike `decode_bytes`, this doesn't wrap the buffer in a stream, so is much
+    faster when reading many varints from a large buffer.
+
+    Returns a tuple of the decoded value and the position just after the varint.
+    Raises EOFError if the buffer ends while reading bytes.
+    """
+    shift = 0
+    result = 0
+    buf_len = len(buf)
+    while True:
+        if pos >= buf_len:
+            raise EOFError("Unexpected EOF while reading bytes")
+        i = buf[pos]
+        pos += 1
+        result |= (i & 0x7f) << shift
+        shift += 7
+        if not (i & 0x80):
+            break
+
+    return result, pos
+
+
 def _read_one(stream):
     """Read a byte from the file (as an integer)
 
@@ -0,0 +1,150 @@
+"""
+Tests for sharing filter module outputs between multiple readers and caching them within a run.
+
+"""
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+
+PIPELINE = """\
+[pipeline]
+name=filter_cache
+release=latest
+
+[europarl]
+type=pimlico.datatypes.corpora.GroupedCorpus
+data_point_type=TokenizedDocumentType
+dir=%(test_data_dir)s/datasets/corpora/tokenized_longer
+
+[vocab]
+type=pimlico.datatypes.dictionary.Dictionary
+dir=%(test_data_dir)s/datasets/vocab
+
+[ids]
+type=pimlico.modules.corpora.vocab_mapper
+input_vocab=vocab
+input_text=europarl
+filter=T
+"""
+
+
+class FilterOutputTeeTest(unittest.TestCase):
+    def test_shared_iteration(self):
+        from pimlico.core.modules.map.filter import _FilterOutputTee
+
+        produced = []
+
+        def source():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        tee = _FilterOutputTee(source(), 5)
+        consumer1 = tee.new_consumer()
+        self.assertEqual(next(consumer1), 0)
+        # A second consumer can still join and gets everything from the start
+        self.assertTrue(tee.can_join())
+        consumer2 = tee.new_consumer()
+        self.assertListEqual(list(zip(consumer1, consumer2)), [(i+1, i) for i in range(9)])
+        self.assertListEqual(list(consumer2), [9])
+        # The source was only iterated over once
+        self.assertListEqual(produced, list(range(10)))
+        self.assertFalse(tee.can_join())
+
+    def test_join_window(self):
+        from pimlico.core.modules.map.filter import _FilterOutputTee
+
+        tee = _FilterOutputTee(iter(range(10)), 2)
+        consumer1 = tee.new_consumer()
+        for __ in range(3):
+            next(consumer1)
+        # Too late to join now
+        self.assertFalse(tee.can_join())
+
+
+class FilterOutputCacheTest(unittest.TestCase):
+    def setUp(self):
+        from pimlico.modules.corpora.vocab_mapper.execute import ModuleExecutor
+
+        self.storage_dir = mkdtemp()
+        self.cache_dir = os.path.join(self.storage_dir, "cache")
+        os.makedirs(self.cache_dir)
+        # Count how many times the filter processes a document: filters run in a single process
+        self.worker_type = ModuleExecutor.POOL_TYPE.SINGLE_PROCESS_TYPE
+        self.process_document = self.worker_type.process_document
+        self.processed = []
+        process_document = self.process_document
+
+        def _counting(worker, archive, doc_name, doc):
+            self.processed.append(doc_name)
+            return process_document(worker, archive, doc_name, doc)
+
+        self.worker_type.process_document = _counting
+
+    def tearDown(self):
+        self.worker_type.process_document = self.process_document
+        shutil.rmtree(self.storage_dir)
+
+    def _load_pipeline(self, **local_config):
+        from pimlico.core.config import PipelineConfig
+
+        path = os.path.join(self.storage_dir, "pipeline.conf")
+        with open(path, "w") as f:
+            f.write(PIPELINE)
+        local_config.update({
+            "store": self.storage_dir,
+            "filter_output_cache": "true",
+            "filter_output_cache_dir": self.cache_dir,
+        })
+        return PipelineConfig.load(path, override_local_config=local_config, only_override_config=True)
+
+    def _read(self, pipeline):
+        return [(doc_name, doc.lists) for (doc_name, doc) in pipeline["ids"].get_output("ids")]
+
+    def test_cached(self):
+        pipeline = self._load_pipeline()
+        first = self._read(pipeline)
+        self.assertEqual(len(first), 50)
+        self.assertEqual(len(self.processed), 50)
+        # Stored on the first full iteration
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # Read back from the cache the second time, without running the filter again
+        self.assertEqual(self._read(pipeline), first)
+        self.assertEqual(len(self.processed), 50)
+
+        pipeline["ids"].output_cache.cleanup()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_size_limit(self):
+        pipeline = self._load_pipeline(filter_output_cache_max_mb="0.0001")
+        first = self._read(pipeline)
+        # Too big to store: the partial cache is removed and the filter is run again every time
+        self.assertTrue(pipeline["ids"].output_cache.abandoned)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertEqual(self._read(pipeline), first)
+        self.assertEqual(len(self.processed), 100)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_stop_early(self):
+        pipeline = self._load_pipeline()
+        docs = iter(pipeline["ids"].get_output("ids"))
+        for __ in range(5):
+            next(docs)
+        docs.close()
+        # Not a full iteration: the partial cache is removed
+        self.assertFalse(pipeline["ids"].output_cache.complete)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        # Stored properly on the next full iteration, then used
+        processed_before = len(self.processed)
+        first = self._read(pipeline)
+        self.assertEqual(self._read(pipeline), first)
+        self.assertEqual(len(self.processed), processed_before + 50)
+        pipeline["ids"].output_cache.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Tests for archive-parallel execution of document map modules, in which each worker reads and
+writes whole archives.
+
+"""
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+
+PIPELINE = """\
+[pipeline]
+name=archive_parallel
+release=latest
+
+[europarl]
+type=pimlico.datatypes.corpora.GroupedCorpus
+data_point_type=TokenizedDocumentType
+dir=%(test_data_dir)s/datasets/corpora/tokenized_longer
+
+[europarl2]
+type=pimlico.datatypes.corpora.GroupedCorpus
+data_point_type=TokenizedDocumentType
+dir=%(test_data_dir)s/datasets/corpora/tokenized
+
+[vocab]
+type=pimlico.datatypes.dictionary.Dictionary
+dir=%(test_data_dir)s/datasets/vocab
+
+[ids]
+type=pimlico.modules.corpora.vocab_mapper
+input_vocab=vocab
+input_text=europarl
+processes=2
+
+# Input produced on the fly, which can't be read archive by archive
+[interleave]
+type=pimlico.modules.corpora.interleave
+input_corpora=europarl2,europarl2
+archive_size=3
+
+[interleaved_ids]
+type=pimlico.modules.corpora.vocab_mapper
+input_vocab=vocab
+input_text=interleave
+processes=2
+"""
+
+
+class ArchiveParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.dirs = []
+
+    def tearDown(self):
+        for d in self.dirs:
+            shutil.rmtree(d)
+
+    def _load_pipeline(self, archive_parallel, storage_dir=None):
+        from pimlico.core.config import PipelineConfig
+
+        if storage_dir is None:
+            storage_dir = mkdtemp()
+            self.dirs.append(storage_dir)
+        path = os.path.join(storage_dir, "pipeline.conf")
+        with open(path, "w") as f:
+            f.write(PIPELINE)
+        return PipelineConfig.load(path, override_local_config={
+            "store": storage_dir,
+            "map_archive_parallel": "true" if archive_parallel else "false",
+            # Checkpoint after every batch, so that an interrupted run leaves archives partially completed
+            "map_checkpoint_docs": "1",
+        }, only_override_config=True)
+
+    def _run(self, pipeline, module_name):
+        import logging
+        from pimlico.core.modules.execute import check_and_execute_modules
+
+        return check_and_execute_modules(pipeline, [module_name], log=logging.getLogger("test"))
+
+    def _output(self, pipeline, module_name):
+        corpus = pipeline[module_name].get_output("ids")
+        return [(doc_name, doc.lists) for (doc_name, doc) in corpus]
+
+    def test_same_output(self):
+        from pimlico.core.modules.metrics import load_metrics_history
+
+        sequential = self._load_pipeline(False)
+        self.assertEqual(self._run(sequential, "ids"), 0)
+        parallel = self._load_pipeline(True)
+        self.assertEqual(self._run(parallel, "ids"), 0)
+        # Progress was recorded archive by archive
+        self.assertEqual(sorted(parallel["ids"].get_metadata()["archives_completed"]),
+                         sorted(parallel["europarl"].get_output().archives))
+        runs = load_metrics_history(parallel["ids"].get_module_output_dir(absolute=True))
+        self.assertTrue(runs[-1]["archive_parallel"])
+
+        expected = self._output(sequential, "ids")
+        self.assertEqual(len(expected), 50)
+        self.assertEqual(self._output(parallel, "ids"), expected)
+
+    def test_resume(self):
+        from pimlico.modules.corpora.vocab_mapper.execute import ModuleExecutor
+
+        sequential = self._load_pipeline(False)
+        self.assertEqual(self._run(sequential, "ids"), 0)
+        expected = self._output(sequential, "ids")
+
+        parallel = self._load_pipeline(True)
+        # Fail part-way through one of the archives: the workers are forked, so get the patched method
+        fail_on = [name for (archive, name) in parallel["europarl"].get_output().list_archive_iter()
+                   if archive == "archive-6"][2]
+        worker_type = ModuleExecutor.POOL_TYPE.PROCESS_TYPE
+        process_document = worker_type.process_document
+
+        def _failing(worker, archive, doc_name, doc):
+            if archive == "archive-6" and doc_name == fail_on:
+                raise ValueError("failed on purpose")
+            return process_document(worker, archive, doc_name, doc)
+
+        worker_type.process_document = _failing
+        try:
+            self.assertNotEqual(self._run(parallel, "ids"), 0)
+        finally:
+            worker_type.process_document = process_document
+        metadata = parallel["ids"].get_metadata()
+        self.assertIn(metadata["status"], ("FAILED", "PARTIALLY_PROCESSED"))
+        self.assertGreater(metadata["docs_completed"], 0)
+        self.assertLess(metadata["docs_completed"], 50)
+        # Stopped part-way through the archive that failed
+        self.assertNotIn("archive-6", metadata["archives_completed"])
+
+        # Pick up where we left off, loading the pipeline again as a new run would
+        parallel = self._load_pipeline(True, storage_dir=self.dirs[-1])
+        self.assertEqual(self._run(parallel, "ids"), 0)
+        self.assertEqual(self._output(parallel, "ids"), expected)
+
+    def test_unshardable_input(self):
+        # Falls back to standard execution when the input can't be read archive by archive
+        sequential = self._load_pipeline(False)
+        self.assertEqual(self._run(sequential, "interleaved_ids"), 0)
+        parallel = self._load_pipeline(True)
+        self.assertEqual(self._run(parallel, "interleaved_ids"), 0)
+        self.assertEqual(self._output(parallel, "interleaved_ids"), self._output(sequential, "interleaved_ids"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Tests for adaptive sizing of document map batches, and for workers processing documents in batches.
+
+"""
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+
+PIPELINE = """\
+[pipeline]
+name=map_batching
+release=latest
+
+[europarl]
+type=pimlico.datatypes.corpora.GroupedCorpus
+data_point_type=TokenizedDocumentType
+dir=%(test_data_dir)s/datasets/corpora/tokenized_longer
+
+[vocab]
+type=pimlico.datatypes.dictionary.Dictionary
+dir=%(test_data_dir)s/datasets/vocab
+
+[ids]
+type=pimlico.modules.corpora.vocab_mapper
+input_vocab=vocab
+input_text=europarl
+"""
+
+
+def process_documents(worker, input_tuples):
+    # Output the size of the batch each document was processed in
+    return [worker.info.document(lists=[[len(input_tuples)]]) for input_tuple in input_tuples]
+
+
+class MapBatchingTest(unittest.TestCase):
+    """
+    Run a few documents through workers with `batch_docs=3`, so that the last batch is only
+    partly full and must be processed once there are no more inputs.
+
+    """
+    def setUp(self):
+        from pimlico.core.config import PipelineConfig
+
+        self.storage_dir = mkdtemp()
+        path = os.path.join(self.storage_dir, "pipeline.conf")
+        with open(path, "w") as f:
+            f.write(PIPELINE)
+        # Fixed-size batches, so we know what to expect
+        self.pipeline = PipelineConfig.load(path, override_local_config={
+            "store": self.storage_dir,
+            "map_adaptive_batches": "false",
+        }, only_override_config=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def _map(self, executor_cls, processes=1):
+        from itertools import islice
+        from pimlico.core.modules.map import DocumentMapper
+
+        executor = executor_cls(self.pipeline["ids"])
+        input_iter = islice(executor.input_iterator.archive_iter(), 7)
+        mapper = DocumentMapper(executor, input_iter, processes=processes)
+        try:
+            outputs = [(doc_name, result[0].lists[0][0]) for (archive, doc_name), result in mapper.map_documents()]
+        finally:
+            executor.postprocess()
+            executor.wait_until_finished()
+        return outputs
+
+    def _check(self, outputs, single_worker=True):
+        from itertools import islice
+
+        expected = [doc_name for (doc_name, doc) in islice(self.pipeline["europarl"].get_output(), 7)]
+        self.assertListEqual([doc_name for (doc_name, batch_size) in outputs], expected)
+        batch_sizes = [batch_size for (doc_name, batch_size) in outputs]
+        if single_worker:
+            # Two full batches, then the last document on its own
+            self.assertListEqual(batch_sizes, [3] * 6 + [1])
+        else:
+            # How the documents are shared between the workers varies
+            self.assertLessEqual(max(batch_sizes), 3)
+            self.assertGreater(max(batch_sizes), 1)
+
+    def test_single_process(self):
+        from pimlico.core.modules.map.singleproc import single_process_executor_factory
+
+        self._check(self._map(single_process_executor_factory(process_documents, batch_docs=3)))
+
+    def test_threaded(self):
+        from pimlico.core.modules.map.multiproc import multiprocessing_executor_factory
+
+        # Only one process: uses a thread
+        self._check(self._map(multiprocessing_executor_factory(process_documents, batch_docs=3)))
+
+    def test_multiprocessing(self):
+        from pimlico.core.modules.map.multiproc import multiprocessing_executor_factory
+
+        self._check(self._map(multiprocessing_executor_factory(process_documents, batch_docs=3), processes=2),
+                    single_worker=False)
+
+
+class BatchSizerTest(unittest.TestCase):
+    def test_adapt(self):
+        from pimlico.core.modules.map.batching import BatchSizer
+
+        sizer = BatchSizer(0.5, max_size=200, max_bytes=10000, initial_size=10, smoothing=1.)
+        self.assertEqual(sizer.size, 10)
+        # Slow documents: small batches
+        sizer.record_time(1., num_docs=10)
+        self.assertEqual(sizer.size, 5)
+        sizer.record_time(2.)
+        self.assertEqual(sizer.size, 1)
+        # Fast documents: big batches, up to the limit
+        sizer.record_time(0.01, num_docs=10)
+        self.assertEqual(sizer.size, 200)
+        # Big documents: limited by the size in bytes
+        sizer.record_bytes(1000)
+        self.assertEqual(sizer.size, 10)
+
+    def test_smoothing(self):
+        from pimlico.core.modules.map.batching import BatchSizer
+
+        sizer = BatchSizer(1., smoothing=0.5)
+        sizer.record_time(0.01)
+        sizer.record_time(0.03)
+        self.assertEqual(sizer.size, 50)
+
+    def test_fixed(self):
+        from pimlico.core.modules.map.batching import BatchSizer
+
+        sizer = BatchSizer.fixed_size(7)
+        sizer.record_time(10.)
+        sizer.record_bytes(10 ** 9)
+        self.assertEqual(sizer.size, 7)
+
+
+
+class SizedBatchesTest(unittest.TestCase):
+    def test_split(self):
+        from pimlico.core.modules.map.batching import split_batches
+
+        sizes = [(10, 2), (50, 10), (5, 1), (60, 12), (20, 4), (100, 20)]
+        # Just limited by number
+        self.assertEqual(split_batches(sizes, 4, (None, None)), [[0, 1, 2, 3], [4, 5]])
+        # Limited by bytes: a document too big on its own gets a batch to itself
+        self.assertEqual(split_batches(sizes, 4, (70, None)), [[0, 1, 2], [3], [4], [5]])
+        # Limited by tokens
+        self.assertEqual(split_batches(sizes, 4, (None, 14)), [[0, 1, 2], [3], [4], [5]])
+        # Bucketed: similar sizes together
+        self.assertEqual(split_batches(sizes, 2, (None, None), bucket=True), [[2, 0], [4, 1], [3, 5]])
+
+    def test_worker(self):
+        from pimlico.core.modules.map import DocumentMapProcessMixin
+        from pimlico.datatypes.corpora.data_points import RawDocumentType
+
+        class Worker(DocumentMapProcessMixin):
+            def __init__(self):
+                super(Worker, self).__init__(None, None, None, docs_per_batch=3)
+                self.batches = []
+
+            def process_documents(self, doc_tuples):
+                self.batches.append([doc_tuple[1] for doc_tuple in doc_tuples])
+                return [doc_tuple[1] for doc_tuple in doc_tuples]
+
+        datatype = RawDocumentType()
+        lengths = [40, 3, 35, 5, 30]
+        inputs = [("arc", "doc_{}".format(i), datatype(raw_data=b"x" * length)) for i, length in enumerate(lengths)]
+
+        worker = Worker()
+        worker.batch_bytes = 50
+        worker.bucket_batches = 2
+        input_buffer = []
+        # Two batches' worth of bytes fills the buffer
+        self.assertEqual([worker.buffer_input(input_buffer, input_tuple) for input_tuple in inputs[:5]],
+                         [False, False, False, False, True])
+        outputs = worker._process_batch(input_buffer)
+        # Batches of similar-sized documents, each under the limits
+        self.assertEqual(worker.batches, [["doc_1", "doc_3", "doc_4"], ["doc_2"], ["doc_0"]])
+        # The outputs are in the input order
+        names = ["doc_{}".format(i) for i in range(5)]
+        self.assertEqual([output.filename for output in outputs], names)
+        self.assertEqual([output.data for output in outputs], names)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Tests for checkpointing the processing status of document map modules, so that we can
+pick up where we left off if processing is interrupted.
+
+"""
+import os
+import shutil
+import unittest
+from glob import glob
+from tempfile import mkdtemp
+
+
+PIPELINE = """\
+[pipeline]
+name=map_checkpoint
+release=latest
+
+[europarl]
+type=pimlico.datatypes.corpora.GroupedCorpus
+data_point_type=TokenizedDocumentType
+dir=%(test_data_dir)s/datasets/corpora/tokenized_longer
+
+[vocab]
+type=pimlico.datatypes.dictionary.Dictionary
+dir=%(test_data_dir)s/datasets/vocab
+
+[ids]
+type=pimlico.modules.corpora.vocab_mapper
+input_vocab=vocab
+input_text=europarl
+"""
+
+
+class MapCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def _load_pipeline(self, storage_dir=None, compression=None):
+        from pimlico.core.config import PipelineConfig
+
+        storage_dir = storage_dir or self.storage_dir
+        path = os.path.join(storage_dir, "pipeline.conf")
+        with open(path, "w") as f:
+            f.write(PIPELINE)
+            if compression is not None:
+                f.write("compression={}\n".format(compression))
+        return PipelineConfig.load(path, override_local_config={
+            "store": storage_dir,
+            "map_checkpoint_docs": "1",
+        }, only_override_config=True)
+
+    def _run(self, pipeline):
+        import logging
+        from pimlico.core.modules.execute import check_and_execute_modules
+
+        return check_and_execute_modules(pipeline, ["ids"], log=logging.getLogger("test"))
+
+    def _output(self, pipeline):
+        return [(doc_name, doc.lists) for (doc_name, doc) in pipeline["ids"].get_output("ids")]
+
+    def test_output_on_disk(self):
+        self._check_output_on_disk()
+
+    def test_output_on_disk_compressed(self):
+        # Compressed archives hold documents back to fill a block, so they have to be flushed too
+        self._check_output_on_disk(compression="zlib")
+
+    def _check_output_on_disk(self, compression=None):
+        from pimlico.utils.pimarc import PimarcReader
+
+        pipeline = self._load_pipeline(compression=compression)
+        module = pipeline["ids"]
+        data_dir = os.path.join(module.get_absolute_output_dir("ids"), "data")
+        set_metadata_values = module.set_metadata_values
+        checkpoints = []
+
+        def _check_on_disk(val_dict):
+            if val_dict.get("status") == "PARTIALLY_PROCESSED":
+                # Everything recorded as completed should already be readable from the output archives,
+                #  not held in the writers' buffers
+                on_disk = 0
+                for archive_filename in glob(os.path.join(data_dir, "*.prc")):
+                    with PimarcReader(archive_filename) as archive:
+                        on_disk += len(archive.index)
+                checkpoints.append((val_dict["docs_completed"], on_disk))
+            set_metadata_values(val_dict)
+
+        module.set_metadata_values = _check_on_disk
+        self.assertEqual(self._run(pipeline), 0)
+        self.assertGreater(len(checkpoints), 0)
+        for docs_completed, on_disk in checkpoints:
+            self.assertGreaterEqual(on_disk, docs_completed)
+
+    def test_sigterm(self):
+        self._check_sigterm()
+
+    def test_sigterm_compressed(self):
+        self._check_sigterm(compression="zlib")
+
+    def _check_sigterm(self, compression=None):
+        import signal
+        from pimlico.datatypes.corpora.grouped import GroupedCorpus
+
+        expected_dir = mkdtemp()
+        try:
+            expected_pipeline = self._load_pipeline(expected_dir, compression=compression)
+            self.assertEqual(self._run(expected_pipeline), 0)
+            expected = self._output(expected_pipeline)
+        finally:
+            shutil.rmtree(expected_dir)
+
+        # Get terminated in the middle of writing the outputs
+        add_document = GroupedCorpus.Writer.add_document
+        added = []
+
+        def _terminate(writer, *args, **kwargs):
+            add_document(writer, *args, **kwargs)
+            added.append(args[1])
+            if len(added) == 10:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        pipeline = self._load_pipeline(compression=compression)
+        GroupedCorpus.Writer.add_document = _terminate
+        try:
+            self.assertNotEqual(self._run(pipeline), 0)
+        finally:
+            GroupedCorpus.Writer.add_document = add_document
+        # Stopped once the document had been written, and recorded it as completed
+        metadata = pipeline["ids"].get_metadata()
+        self.assertIn(metadata["status"], ("FAILED", "PARTIALLY_PROCESSED"))
+        self.assertEqual(metadata["docs_completed"], 10)
+        self.assertEqual(len(added), 10)
+        self.assertEqual(metadata["last_doc_completed"].partition("/")[2], added[-1])
+
+        # Pick up where we left off, loading the pipeline again as a new run would
+        pipeline = self._load_pipeline(compression=compression)
+        self.assertEqual(self._run(pipeline), 0)
+        self.assertEqual(self._output(pipeline), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Tests for fusing chains of filter modules into the workers of the module that uses their output.
+
+"""
+import unittest
+
+
+class FusedStagesTest(unittest.TestCase):
+    def test_fused(self):
+        from pimlico.core.modules.map import DocumentMapProcessMixin, inline_worker_type
+        from pimlico.datatypes.corpora import invalid_document, is_invalid_doc
+
+        seen = []
+
+        def _check(worker, archive, filename, doc):
+            if doc == "bad":
+                return invalid_document("check", "bad document")
+            return doc
+
+        def _upper(worker, doc_tuples):
+            seen.extend(doc for (archive, filename, doc) in doc_tuples)
+            return [doc.upper() for (archive, filename, doc) in doc_tuples]
+
+        class Stage(object):
+            # Stands in for the stage's executor too
+            info = None
+
+            def __init__(self, worker_type):
+                self.worker_type = worker_type
+
+            def create_worker(self):
+                return self.worker_type(self)
+
+            def output_document(self, result):
+                return result
+
+        class Executor(object):
+            info = None
+            fused_stages = [Stage(inline_worker_type(_check)), Stage(inline_worker_type(_upper, batch_docs=4))]
+
+        class Worker(DocumentMapProcessMixin):
+            def process_document(self, archive, filename, doc):
+                return "{}!".format(doc)
+
+        worker = Worker(None, None, None)
+        worker.executor = Executor()
+        worker.set_up_fused_stages()
+        # We don't process in batches, but one of the stages does
+        self.assertEqual(worker.docs_per_batch, 4)
+
+        outputs = worker._process_batch([("arc", "doc_{}".format(i), doc) for (i, doc) in enumerate(["a", "bad", "c"])])
+        self.assertEqual([output.filename for output in outputs], ["doc_0", "doc_1", "doc_2"])
+        self.assertEqual(outputs[0].data, "A!")
+        self.assertTrue(is_invalid_doc(outputs[1].data))
+        self.assertEqual(outputs[2].data, "C!")
+        # The invalid doc skipped the later stages
+        self.assertEqual(seen, ["a", "c"])
+        worker.tear_down_fused_stages()
+
+
+if __name__ == "__main__":
+    unittest.main()
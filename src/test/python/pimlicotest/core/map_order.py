@@ -0,0 +1,101 @@
+"""
+Tests for limiting the number of documents in progress in document map modules and for reading
+corpora whose documents were output in a different order.
+
+"""
+import shutil
+import unittest
+from queue import Queue, Empty
+from tempfile import mkdtemp
+
+
+class InputQueueFeederWindowTest(unittest.TestCase):
+    def test_window(self):
+        from pimlico.core.modules.map import InputQueueFeeder
+
+        input_queue = Queue()
+        stalls = []
+        docs = [("arc", "doc_{}".format(i), []) for i in range(30)]
+        feeder = InputQueueFeeder(input_queue, iter(docs), window=12, stalled_callback=lambda: stalls.append(1))
+        try:
+            def _fed(expected):
+                fed = []
+                while len(fed) < expected:
+                    fed.extend(input_queue.get(timeout=2.))
+                # Nothing more should be sent until some are released
+                with self.assertRaises(Empty):
+                    input_queue.get(timeout=0.3)
+                return fed
+
+            # The first full batch is sent, then the partial batch that fills the window
+            self.assertEqual(_fed(12), docs[:12])
+            self.assertEqual(len(stalls), 1)
+            for i in range(12):
+                self.assertEqual(feeder.get_next_output_document(), ("arc", "doc_{}".format(i)))
+            for i in range(5):
+                feeder.release_window()
+            self.assertEqual(_fed(5), docs[12:17])
+            for i in range(13):
+                feeder.release_window()
+            fed = []
+            while len(fed) < 13:
+                fed.extend(input_queue.get(timeout=2.))
+            self.assertEqual(fed, docs[17:])
+            feeder.feeding_complete.wait(2.)
+            self.assertTrue(feeder.feeding_complete.is_set())
+        finally:
+            feeder.shutdown()
+
+
+class UnorderedAlignmentTest(unittest.TestCase):
+    def setUp(self):
+        from pimlico.core.config import PipelineConfig
+        from pimlico.datatypes.corpora.data_points import TextDocumentType
+        from pimlico.datatypes.corpora.grouped import GroupedCorpus
+
+        self.pipeline = PipelineConfig.empty()
+        self.datatype = GroupedCorpus(TextDocumentType())
+        self.dirs = []
+        names = ["doc_{}".format(i) for i in range(12)]
+        self.ordered = self._write([(name, "ordered {}".format(name)) for name in names])
+        # Same docs, but in a different order within each archive
+        shuffled = names[:6][::-1] + names[6:][::-1]
+        self.unordered = self._write([(name, "unordered {}".format(name)) for name in shuffled], unordered=True)
+
+    def tearDown(self):
+        for d in self.dirs:
+            shutil.rmtree(d)
+
+    def _write(self, docs, unordered=False):
+        output_dir = mkdtemp()
+        self.dirs.append(output_dir)
+        with self.datatype.get_writer(output_dir, self.pipeline) as writer:
+            writer.metadata["unordered"] = unordered
+            for i, (name, text) in enumerate(docs):
+                writer.add_document("archive_{}".format(i // 6), name, self.datatype.data_point_type(text=text))
+        return self.datatype([output_dir]).get_reader(self.pipeline)
+
+    def test_aligned_by_name(self):
+        from pimlico.datatypes.corpora.grouped import AlignedGroupedCorpora
+
+        # Whichever order the corpora are given in, the ordered one gives the order
+        for readers in [[self.unordered, self.ordered], [self.ordered, self.unordered]]:
+            aligned = AlignedGroupedCorpora(readers)
+            self.assertFalse(aligned.unordered)
+            items = list(aligned.archive_iter())
+            self.assertEqual([name for (__, name, __) in items], ["doc_{}".format(i) for i in range(12)])
+            for archive, name, docs in items:
+                self.assertEqual(sorted(doc.text for doc in docs), ["ordered {}".format(name),
+                                                                    "unordered {}".format(name)])
+            self.assertEqual([name for (__, name, __) in aligned.archive_iter(start_after=("archive_0", "doc_3"))],
+                             ["doc_{}".format(i) for i in range(4, 12)])
+
+        # Only unordered corpora: use the order of the first
+        aligned = AlignedGroupedCorpora([self.unordered])
+        self.assertTrue(aligned.unordered)
+        self.assertEqual([name for (__, name, __) in aligned.shard_iter(("archive_1", 2, None))],
+                         ["doc_9", "doc_8", "doc_7", "doc_6"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+"""
+Tests for preloading packages for document map workers in the main process.
+
+"""
+import sys
+import unittest
+
+
+class PreloadTest(unittest.TestCase):
+    def test_preload(self):
+        from pimlico.core.modules.map.preload import preload_modules
+
+        sys.modules.pop("wave", None)
+        self.assertEqual(preload_modules(["wave", "no_such_module_here"]), ["wave"])
+        self.assertIn("wave", sys.modules)
+        # Already preloaded: nothing more to do
+        self.assertEqual(preload_modules(["wave"]), [])
+
+    def test_parse_setting(self):
+        from pimlico.core.modules.map.preload import parse_preload_setting
+
+        self.assertEqual(parse_preload_setting(None), [])
+        self.assertEqual(parse_preload_setting("numpy, gensim.models,"), ["numpy", "gensim.models"])
+        with self.assertRaises(ValueError):
+            parse_preload_setting("numpy gensim")
+
+    def test_forked_workers(self):
+        from pimlico.core.modules.map.multiproc import MultiprocessingMapProcess
+
+        # Workers must be forked to share what's been preloaded, whatever the default start method
+        self.assertEqual(MultiprocessingMapProcess._start_method, "fork")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+"""
+Tests for resources loaded once and shared by document map workers.
+
+"""
+import multiprocessing
+import unittest
+
+
+def _sum_array(resources, results):
+    results.put(float(resources["matrix"].sum()))
+
+
+class SharedResourcesTest(unittest.TestCase):
+    def test_share_array(self):
+        import numpy
+        from pimlico.core.modules.map.resources import SharedResources
+
+        resources = SharedResources()
+        original = numpy.arange(1000, dtype=numpy.float64).reshape(100, 10)
+        resources["matrix"] = resources.share_array(original)
+        self.assertTrue(numpy.array_equal(resources["matrix"], original))
+        # Workers mustn't write to shared resources
+        with self.assertRaises(ValueError):
+            resources["matrix"][0, 0] = 1.
+
+        resources.freeze()
+        try:
+            # A forked worker sees the same data
+            results = multiprocessing.Queue()
+            process = multiprocessing.get_context("fork").Process(target=_sum_array, args=(resources, results))
+            process.start()
+            self.assertEqual(results.get(timeout=10.), float(original.sum()))
+            process.join()
+        finally:
+            resources.release()
+        self.assertEqual(len(resources), 0)
+
+    def test_worker_resources(self):
+        from pimlico.core.modules.map import DocumentMapProcessMixin
+        from pimlico.core.modules.map.resources import SharedResources
+
+        class Executor(object):
+            resources = SharedResources(vocab={"a": 0})
+
+        worker = DocumentMapProcessMixin(None, None, None)
+        worker.executor = Executor()
+        self.assertEqual(worker.resources["vocab"], {"a": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
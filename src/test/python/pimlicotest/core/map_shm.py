@@ -0,0 +1,51 @@
+"""
+Tests for the shared-memory transport used to send documents to document map workers.
+
+"""
+import unittest
+
+
+class SharedMemoryTransportTest(unittest.TestCase):
+    def setUp(self):
+        from pimlico.core.modules.map.shm import shared_memory
+        if shared_memory is None:
+            self.skipTest("shared memory not available")
+
+    def test_round_trip(self):
+        from pimlico.core.modules.map.shm import SharedMemoryInputTransport, SharedMemoryBatch
+        from pimlico.datatypes.corpora.data_points import TextDocumentType, invalid_document
+
+        doc_type = TextDocumentType()
+        transport = SharedMemoryInputTransport(2, slot_size=100)
+        try:
+            batch = [
+                ("arc", "doc0", [doc_type(raw_data=u"First document".encode("utf-8"))]),
+                # Only internal data: should be sent as it is
+                ("arc", "doc1", [doc_type(text=u"Second document")]),
+                ("arc", "doc2", [invalid_document("test_module", "some error")]),
+                # Too big to fit in the slot
+                ("arc", "doc3", [doc_type(raw_data=b"x" * 200)]),
+            ]
+            encoded = transport.encode_batch(batch)
+            self.assertIsInstance(encoded, SharedMemoryBatch)
+            self.assertIsInstance(encoded.items[0][2][0], tuple)
+            # The slot is now in use
+            self.assertEqual(transport.shm.buf[encoded.slot], 1)
+
+            decoded = encoded.read()
+            self.assertEqual(transport.shm.buf[encoded.slot], 0)
+            self.assertListEqual([(a, f) for (a, f, d) in decoded], [(a, f) for (a, f, d) in batch])
+            self.assertEqual(decoded[0][2][0].text, u"First document")
+            self.assertEqual(decoded[1][2][0].text, u"Second document")
+            self.assertEqual(decoded[2][2][0].error_info, u"some error")
+            self.assertEqual(decoded[3][2][0].raw_data, b"x" * 200)
+
+            # A batch with nothing that can go through shared memory is just sent as it is
+            internal_batch = [("arc", "doc1", [doc_type(text=u"Second document")])]
+            self.assertIs(transport.encode_batch(internal_batch), internal_batch)
+        finally:
+            transport.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
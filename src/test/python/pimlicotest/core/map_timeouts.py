@@ -0,0 +1,145 @@
+"""
+Tests for time limits on processing documents in document map workers.
+
+"""
+import logging
+import threading
+import time
+import unittest
+
+
+def _process_document(worker, archive, filename, doc):
+    if doc == "hang":
+        # Never finishes in time
+        time.sleep(60.)
+    elif doc == "big":
+        # Too big to fit in a pipe's buffer, so takes a while to send
+        return "B" * (1024 * 1024)
+    return doc.upper()
+
+
+class _ModuleInfo(object):
+    module_name = "timeout_test"
+
+    class pipeline(object):
+        local_config = {"map_shared_memory": "false"}
+
+
+class WorkerProgressTest(unittest.TestCase):
+    def test_recover(self):
+        from pimlico.core.modules.map.timeouts import WorkerProgress
+
+        progress = WorkerProgress()
+        self.assertEqual(progress.recover(), ([], []))
+        progress.received([("arc", "doc_0"), ("arc", "doc_1"), ("arc", "doc_2")])
+        progress.started([("arc", "doc_0")])
+        progress.finished()
+        progress.sent(1)
+        progress.received([("arc", "doc_3")])
+        progress.started([("arc", "doc_1"), ("arc", "doc_2")])
+        self.assertFalse(progress.overdue(10.))
+        self.assertTrue(progress.overdue(10., now=time.time() + 25.))
+        self.assertEqual(progress.recover(), ([("arc", "doc_1"), ("arc", "doc_2")], [("arc", "doc_3")]))
+        progress.finished()
+        self.assertFalse(progress.overdue(10., now=time.time() + 25.))
+        self.assertEqual(progress.recover(), ([], [("arc", "doc_1"), ("arc", "doc_2"), ("arc", "doc_3")]))
+
+    def test_too_many(self):
+        from pimlico.core.modules.map.timeouts import WorkerProgress, WorkerProgressUnknown
+
+        progress = WorkerProgress(capacity=100)
+        progress.received([("arc", "doc_{}".format(i)) for i in range(100)])
+        with self.assertRaises(WorkerProgressUnknown):
+            progress.recover()
+
+
+class PoolTimeoutTest(unittest.TestCase):
+    def _create_pool(self, processes):
+        from pimlico.core.modules.map.resources import SharedResources
+        from pimlico.core.modules.map.multiproc import multiprocessing_executor_factory
+
+        executor_type = multiprocessing_executor_factory(_process_document, doc_timeout=0.5)
+
+        class Executor(object):
+            info = _ModuleInfo()
+            doc_timeout = executor_type.DOC_TIMEOUT
+            log = logging.getLogger("timeout_test")
+            resources = SharedResources()
+            SEQUENTIAL_START = False
+
+            def create_worker_batch_sizer(self):
+                return None
+
+        return executor_type.POOL_TYPE(Executor(), processes)
+
+    def _send(self, pool, batches):
+        for batch in batches:
+            for archive, filename, docs in batch:
+                pool.in_flight[(archive, filename)] = docs
+            pool.input_queue.put(batch)
+        pool.notify_no_more_inputs()
+
+    def test_timeout(self):
+        from pimlico.datatypes.corpora import is_invalid_doc
+
+        # Even with one process, a worker process is used, so that it can be killed
+        pool = self._create_pool(1)
+        try:
+            self.assertEqual(pool.doc_timeout, 0.5)
+            # The doc after the one that hangs is taken by the worker at the same time, so has to be sent again
+            self._send(pool, [[("arc", "doc_0", ["a"])], [("arc", "doc_1", ["hang"]), ("arc", "doc_2", ["b"])],
+                              [("arc", "doc_3", ["c"])]])
+
+            outputs = {}
+            for i in range(4):
+                output = pool.get_output()
+                outputs[output.filename] = output.data
+            self.assertEqual(outputs["doc_0"], "A")
+            self.assertTrue(is_invalid_doc(outputs["doc_1"]))
+            self.assertIn("Timed out", outputs["doc_1"].error_info)
+            self.assertEqual(outputs["doc_2"], "B")
+            self.assertEqual(outputs["doc_3"], "C")
+            self.assertEqual(pool.timed_out_docs, 1)
+            self.assertEqual(pool.in_flight, {})
+        finally:
+            pool.shutdown()
+            pool.wait_until_finished()
+
+    def test_big_outputs(self):
+        """ Workers killed after sending big outputs shouldn't lose them or hold up the other workers """
+        from pimlico.datatypes.corpora import is_invalid_doc
+
+        pool = self._create_pool(2)
+        try:
+            self._send(pool, [[("arc", "doc_0", ["big"])], [("arc", "doc_1", ["big"])],
+                              [("arc", "doc_2", ["hang"])], [("arc", "doc_3", ["hang"])], [("arc", "doc_4", ["c"])]])
+            # Give both workers time to get stuck before we read anything
+            time.sleep(1.5)
+            pool.check_timeouts()
+
+            outputs = {}
+
+            def _get_outputs():
+                for i in range(5):
+                    output = pool.get_output()
+                    outputs[output.filename] = output.data
+            getter = threading.Thread(target=_get_outputs)
+            getter.daemon = True
+            getter.start()
+            getter.join(30.)
+            self.assertFalse(getter.is_alive(), "outputs not received: got {}".format(sorted(outputs)))
+
+            self.assertEqual(outputs["doc_0"], "B" * (1024 * 1024))
+            self.assertEqual(outputs["doc_1"], "B" * (1024 * 1024))
+            self.assertTrue(is_invalid_doc(outputs["doc_2"]))
+            self.assertTrue(is_invalid_doc(outputs["doc_3"]))
+            self.assertEqual(outputs["doc_4"], "C")
+            self.assertEqual(pool.timed_out_docs, 2)
+            self.assertEqual(pool.in_flight, {})
+        finally:
+            pool.shutdown()
+            pool.wait_until_finished()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests for recording timelines of document map execution.
+
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class MapTracerTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_export(self):
+        import multiprocessing
+        from pimlico.core.modules.map.trace import MapTracer, new_trace_path
+
+        tracer = MapTracer(name="trace_test")
+
+        def _worker():
+            # Recorded in a forked process, which has its own copy of the tracer
+            with tracer.timed("process", docs=2):
+                pass
+            tracer.flush()
+
+        start = tracer.now()
+        worker = multiprocessing.get_context("fork").Process(target=_worker)
+        worker.start()
+        worker.join()
+        tracer.span("dequeue", start)
+        tracer.async_span("reorder wait", start, doc="arc/doc_0")
+        events_dir = tracer.events_dir
+
+        path = new_trace_path(self.output_dir)
+        self.assertEqual(os.path.basename(path), "trace.json")
+        self.assertEqual(tracer.export(path, metadata={"module": "trace_test"}), 0)
+        # The temporary files have gone
+        self.assertFalse(os.path.exists(events_dir))
+        # Another trace wouldn't overwrite this one
+        self.assertEqual(os.path.basename(new_trace_path(self.output_dir)), "trace.1.json")
+
+        with open(path, "r") as f:
+            trace = json.load(f)
+        self.assertEqual(trace["otherData"]["module"], "trace_test")
+        events = trace["traceEvents"]
+        process_names = dict((event["pid"], event["args"]["name"]) for event in events
+                             if event["ph"] == "M" and event["name"] == "process_name")
+        self.assertEqual(process_names[os.getpid()], "trace_test")
+        self.assertIn(worker.pid, process_names)
+
+        spans = dict((event["name"], event) for event in events if event["ph"] == "X")
+        self.assertEqual(spans["process"]["pid"], worker.pid)
+        self.assertEqual(spans["process"]["args"], {"docs": 2})
+        self.assertEqual(spans["dequeue"]["pid"], os.getpid())
+        # The worker's span was within the main process' one
+        self.assertGreaterEqual(spans["process"]["ts"], spans["dequeue"]["ts"])
+        self.assertLessEqual(spans["process"]["ts"] + spans["process"]["dur"],
+                             spans["dequeue"]["ts"] + spans["dequeue"]["dur"])
+        self.assertEqual(sorted(event["ph"] for event in events if event["name"] == "reorder wait"), ["b", "e"])
+
+    def test_max_events(self):
+        from pimlico.core.modules.map.trace import MapTracer
+
+        tracer = MapTracer()
+        tracer.MAX_EVENTS = 10
+        tracer.FLUSH_EVENTS = 4
+        for i in range(15):
+            tracer.instant("event")
+        path = os.path.join(self.output_dir, "trace.json")
+        self.assertEqual(tracer.export(path), 5)
+        with open(path, "r") as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(len([event for event in events if event["name"] == "event"]), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
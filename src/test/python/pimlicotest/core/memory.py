@@ -0,0 +1,128 @@
+"""
+Tests for memory monitoring and the enforcement of memory budgets.
+
+"""
+import logging
+import threading
+import unittest
+
+
+class MemoryMonitorTest(unittest.TestCase):
+    def test_high_water_marks(self):
+        import multiprocessing
+        from pimlico.core.modules.memory import MemoryMonitor
+
+        monitor = MemoryMonitor(interval=0.05)
+        if not monitor.available:
+            self.skipTest("memory can't be measured on this system")
+        stop = multiprocessing.get_context("fork").Event()
+        worker = multiprocessing.get_context("fork").Process(target=stop.wait)
+        worker.start()
+        try:
+            monitor.start()
+            monitor.name_process(worker.pid, "worker-1")
+            monitor.measure()
+            monitor.stop()
+        finally:
+            stop.set()
+            worker.join()
+
+        summary = monitor.summary()
+        self.assertIsNone(summary["budget_mb"])
+        # Other children, like multiprocessing's helper processes, are included too
+        self.assertTrue({"main", "worker-1"}.issubset(summary["peak_rss_mb"]))
+        self.assertGreater(summary["peak_rss_mb"]["main"], 0.)
+        self.assertGreater(summary["peak_total_mb"], 0.)
+        # No budget: never any pressure
+        self.assertFalse(monitor.pressure)
+        monitor.check()
+
+    def test_budget(self):
+        from pimlico.core.modules.execute import MemoryBudgetExceeded, ModuleExecutionError
+        from pimlico.core.modules.memory import MemoryMonitor
+
+        monitor = MemoryMonitor(budget=100, pressure_fraction=0.8)
+        monitor.total = 50.
+        self.assertFalse(monitor.pressure)
+        monitor.check()
+        monitor.total = 90.
+        self.assertTrue(monitor.pressure)
+        self.assertFalse(monitor.exceeded)
+        monitor.check()
+        monitor.total = 110.
+        self.assertTrue(monitor.exceeded)
+        with self.assertRaises(MemoryBudgetExceeded) as cm:
+            monitor.check()
+        # Handled like any other execution error
+        self.assertIsInstance(cm.exception, ModuleExecutionError)
+
+
+class FakePool(object):
+    def __init__(self, workers):
+        self.workers = list(range(workers))
+        self.retired = 0
+
+    def retire_worker(self):
+        self.workers.pop()
+        self.retired += 1
+
+
+class MemoryThrottleTest(unittest.TestCase):
+    def _throttle(self, workers):
+        from pimlico.core.modules.map.memory import MemoryThrottle
+        from pimlico.core.modules.memory import MemoryMonitor
+
+        monitor = MemoryMonitor(budget=100, interval=0.01)
+        monitor.total = 95.
+        pool = FakePool(workers)
+        in_flight = {}
+        throttle = MemoryThrottle(pool, monitor, in_flight, logging.getLogger("test"))
+        return throttle, monitor, pool, in_flight
+
+    def test_retire_when_idle(self):
+        throttle, monitor, pool, in_flight = self._throttle(2)
+        in_flight[("archive", "doc")] = None
+        self.assertTrue(throttle.should_pause())
+        cancelled = threading.Event()
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(throttle.wait(cancelled)))
+        waiter.start()
+        waiter.join(0.3)
+        # Waits as long as there are documents in progress
+        self.assertTrue(waiter.is_alive())
+        self.assertEqual(pool.retired, 0)
+        del in_flight[("archive", "doc")]
+        waiter.join(5.)
+        self.assertEqual(result, [True])
+        self.assertEqual(pool.retired, 1)
+        self.assertEqual(throttle.workers_retired, 1)
+
+    def test_give_up(self):
+        throttle, monitor, pool, in_flight = self._throttle(1)
+        self.assertTrue(throttle.wait(threading.Event()))
+        # Can't stop the last worker
+        self.assertEqual(pool.retired, 0)
+        # Don't pause again until the pressure's gone away
+        self.assertFalse(throttle.should_pause())
+        monitor.total = 10.
+        self.assertFalse(throttle.should_pause())
+        monitor.total = 95.
+        self.assertTrue(throttle.should_pause())
+
+    def test_resume(self):
+        throttle, monitor, pool, in_flight = self._throttle(2)
+        in_flight[("archive", "doc")] = None
+        monitor.total = 10.
+        self.assertTrue(throttle.wait(threading.Event()))
+        self.assertEqual(pool.retired, 0)
+
+    def test_cancelled(self):
+        throttle, monitor, pool, in_flight = self._throttle(2)
+        in_flight[("archive", "doc")] = None
+        cancelled = threading.Event()
+        cancelled.set()
+        self.assertFalse(throttle.wait(cancelled))
+
+
+if __name__ == "__main__":
+    unittest.main()
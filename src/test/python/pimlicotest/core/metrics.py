@@ -0,0 +1,150 @@
+"""
+Tests for the performance metrics recorded for module runs.
+
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class LatencySampleTest(unittest.TestCase):
+    def test_percentiles(self):
+        from pimlico.core.modules.metrics import LatencySample
+
+        sample = LatencySample(1000)
+        self.assertIsNone(sample.summary())
+        for i in range(1, 101):
+            sample.add(float(i))
+        summary = sample.summary()
+        self.assertEqual(summary["docs"], 100)
+        self.assertEqual(summary["mean"], 50.5)
+        self.assertEqual(summary["p50"], 50.)
+        self.assertEqual(summary["p95"], 95.)
+        self.assertEqual(summary["p99"], 99.)
+        self.assertEqual(summary["max"], 100.)
+
+    def test_sampled(self):
+        from pimlico.core.modules.metrics import LatencySample
+
+        sample = LatencySample(100)
+        for i in range(10000):
+            sample.add(float(i % 100))
+        self.assertEqual(len(sample.sample), 100)
+        summary = sample.summary()
+        self.assertEqual(summary["docs"], 10000)
+        self.assertEqual(summary["max"], 99.)
+        # Only estimated from the sample
+        self.assertTrue(30. < summary["p50"] < 70.)
+
+
+class ModuleRunMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_history(self):
+        from pimlico.core.modules.metrics import ModuleRunMetrics, load_metrics_history
+
+        self.assertEqual(load_metrics_history(self.output_dir), [])
+        for run in range(2):
+            metrics = ModuleRunMetrics(processes=2)
+            metrics.start()
+            for i in range(10):
+                metrics.add_docs(1, invalid=(i == 3))
+                metrics.add_latency(0.01)
+            metrics.extra["run"] = run
+            metrics.finish()
+            metrics.save(self.output_dir, status="COMPLETE")
+
+        runs = load_metrics_history(self.output_dir)
+        self.assertEqual([record["run"] for record in runs], [0, 1])
+        record = runs[-1]
+        self.assertEqual(record["status"], "COMPLETE")
+        self.assertEqual(record["processes"], 2)
+        self.assertEqual(record["docs_processed"], 10)
+        self.assertEqual(record["invalid_docs"], 1)
+        self.assertEqual(record["latency"]["docs"], 10)
+        self.assertAlmostEqual(record["latency"]["p99"], 0.01)
+        self.assertGreaterEqual(record["wall_time"], 0.)
+        self.assertGreaterEqual(record["cpu_time"]["total"], 0.)
+
+    def test_no_docs(self):
+        from pimlico.core.modules.metrics import ModuleRunMetrics
+
+        metrics = ModuleRunMetrics()
+        metrics.start()
+        metrics.finish()
+        record = metrics.to_dict()
+        # Not counted, rather than 0
+        self.assertIsNone(record["docs_processed"])
+        self.assertIsNone(record["invalid_docs"])
+        self.assertIsNone(record["docs_per_second"])
+        self.assertIsNone(record["latency"])
+
+    def test_main_peak(self):
+        """ The main process' peak is measured just for the run """
+        from pimlico.core.modules.metrics import ModuleRunMetrics
+
+        if not os.path.exists("/proc/self/statm"):
+            self.skipTest("memory can't be measured here")
+        # Use more memory before the run than during it
+        data = b"x" * (200 * 1024 * 1024)
+        del data
+
+        metrics = ModuleRunMetrics()
+        metrics.RSS_SAMPLE_INTERVAL = 0.05
+        metrics.start()
+        data = b"x" * (50 * 1024 * 1024)
+        time.sleep(0.3)
+        del data
+        metrics.finish()
+        peak = metrics.to_dict()["peak_rss_mb"]["main"]
+        # Includes what we used during the run, but not the bigger peak before it
+        self.assertGreater(peak, 50.)
+        self.assertLess(peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. - 100.)
+
+    def test_workers(self):
+        import multiprocessing
+        from pimlico.core.modules.metrics import ModuleRunMetrics
+
+        if not os.path.exists("/proc/self/stat"):
+            self.skipTest("process usage can't be read here")
+        context = multiprocessing.get_context("fork")
+        ready, stop = context.Event(), context.Event()
+        worker = context.Process(target=_use_memory, args=(ready, stop))
+        worker.start()
+        try:
+            metrics = ModuleRunMetrics(processes=1)
+            metrics.start()
+            self.assertTrue(ready.wait(10.))
+            metrics.add_worker("worker", worker.pid)
+            metrics.finish()
+        finally:
+            stop.set()
+            worker.join()
+
+        record = metrics.to_dict()
+        usage = record["workers"]["worker"]
+        self.assertEqual(usage["pid"], worker.pid)
+        self.assertGreaterEqual(usage["user"] + usage["system"], 0.)
+        self.assertGreater(usage["peak_rss_mb"], 100.)
+        self.assertEqual(record["peak_rss_mb"]["workers"], usage["peak_rss_mb"])
+
+
+def _use_memory(ready, stop):
+    data = b"x" * (100 * 1024 * 1024)
+    ready.set()
+    stop.wait(10.)
+
+
+if __name__ == "__main__":
+    unittest.main()
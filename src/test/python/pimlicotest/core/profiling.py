@@ -0,0 +1,102 @@
+"""
+Tests for the profiling of module execution.
+
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+def _busy_worker(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(1000))
+
+
+class ModuleProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _profile_with_worker(self, mode):
+        import multiprocessing
+        from pimlico.core.modules.profiling import ModuleProfiler
+
+        profiler = ModuleProfiler(mode, interval=0.001)
+        profiler.start()
+        worker = multiprocessing.get_context("fork").Process(target=_busy_worker, args=(0.2,), name="worker-1")
+        worker.start()
+        _busy_worker(0.1)
+        worker.join()
+        profiler.stop()
+        return profiler.save(self.output_dir)
+
+    def test_sampling(self):
+        import pstats
+
+        paths = self._profile_with_worker("sampling")
+        self.assertEqual([os.path.basename(path) for path in paths], ["profile.pstats", "profile.collapsed"])
+
+        with open(paths[1], "r") as f:
+            lines = f.read().splitlines()
+        # Stacks from both processes, each ending in the busy function
+        processes = set(line.split(";", 1)[0] for line in lines)
+        self.assertEqual(processes, {"main", "worker-1"})
+        for process in processes:
+            self.assertTrue(any(line.startswith(process) and "_busy_worker" in line for line in lines))
+        for line in lines:
+            self.assertTrue(line.rsplit(" ", 1)[1].isdigit())
+
+        stats = pstats.Stats(paths[0])
+        self.assertTrue(any(func[2] == "_busy_worker" for func in stats.stats))
+
+    def test_deterministic(self):
+        import pstats
+
+        paths = self._profile_with_worker("deterministic")
+        self.assertEqual([os.path.basename(path) for path in paths], ["profile.pstats"])
+        stats = pstats.Stats(paths[0])
+        busy_stats = [s for (func, s) in stats.stats.items() if func[2] == "_busy_worker"]
+        # Called once in each process
+        self.assertEqual(busy_stats[0][1], 2)
+
+    def test_rerun(self):
+        from pimlico.core.modules.profiling import ModuleProfiler
+
+        for run in range(2):
+            profiler = ModuleProfiler("sampling")
+            profiler.start()
+            profiler.stop()
+            paths = profiler.save(self.output_dir)
+        self.assertEqual([os.path.basename(path) for path in paths], ["profile.1.pstats", "profile.1.collapsed"])
+        self.assertFalse(os.path.exists(profiler.profiles_dir))
+
+
+class SamplesToStatsTest(unittest.TestCase):
+    def test_stats(self):
+        from pimlico.core.modules.profiling import samples_to_stats
+
+        main, f, g = ("a.py", 1, "main"), ("a.py", 5, "f"), ("a.py", 10, "g")
+        samples = {
+            ("main", "MainThread", (main, f)): 3,
+            ("main", "MainThread", (main, f, g)): 2,
+            # Recursive
+            ("main", "MainThread", (main, f, f)): 1,
+        }
+        stats = samples_to_stats(samples, 0.5)
+        cc, nc, tt, ct, callers = stats[f]
+        self.assertEqual(nc, 7)
+        self.assertEqual(cc, 6)
+        self.assertEqual(tt, 2.)
+        self.assertEqual(ct, 3.)
+        self.assertEqual(set(callers), {main, f})
+        self.assertEqual(stats[g][:4], (2, 2, 1., 1.))
+        self.assertEqual(stats[main][:4], (6, 6, 0., 3.))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Tests for the scheduler that decides which modules can be executed in parallel.
+
+"""
+import unittest
+
+
+class FakeModule(object):
+    def __init__(self, module_name, deps=[], processes=1, memory=None):
+        self.module_name = module_name
+        self.deps = deps
+        self.processes = processes
+        self.memory = memory
+
+    def get_transitive_dependencies(self):
+        return list(self.deps)
+
+    def get_processes(self):
+        return self.processes
+
+    def get_memory_budget(self):
+        return self.memory
+
+
+class ModuleSchedulerTest(unittest.TestCase):
+    def test_dependencies(self):
+        from pimlico.core.modules.scheduler import ModuleScheduler
+
+        a = FakeModule("a")
+        b = FakeModule("b")
+        # Depends on a module that's not being run, which should be ignored
+        c = FakeModule("c", deps=["a", "earlier"])
+        scheduler = ModuleScheduler([a, b, c], jobs=4)
+
+        # a and b can run together, but c needs to wait for a
+        self.assertIs(scheduler.start_next(), a)
+        self.assertIs(scheduler.start_next(), b)
+        self.assertIsNone(scheduler.start_next())
+
+        scheduler.finish(b)
+        self.assertIsNone(scheduler.start_next())
+        scheduler.finish(a, success=False)
+        self.assertIs(scheduler.start_next(), c)
+        self.assertEqual(scheduler.failed_dependencies(c), ["a"])
+        scheduler.finish(c)
+        self.assertTrue(scheduler.done)
+
+    def test_resources(self):
+        from pimlico.core.modules.scheduler import ModuleScheduler
+
+        big = FakeModule("big", processes=6, memory=1000)
+        medium = FakeModule("medium", processes=4)
+        small = FakeModule("small", processes=2, memory=500)
+        huge = FakeModule("huge", processes=20)
+        scheduler = ModuleScheduler([big, medium, small, huge], jobs=3, max_processes=8, max_memory=1200)
+
+        self.assertIs(scheduler.start_next(), big)
+        # medium doesn't fit alongside big, but small would, apart from its memory budget
+        self.assertIsNone(scheduler.start_next())
+        scheduler.finish(big)
+        self.assertIs(scheduler.start_next(), medium)
+        self.assertIs(scheduler.start_next(), small)
+        # Too big to run with anything else
+        self.assertIsNone(scheduler.start_next())
+        scheduler.finish(medium)
+        scheduler.finish(small)
+        # But can be run on its own
+        self.assertIs(scheduler.start_next(), huge)
+
+    def test_jobs_limit(self):
+        from pimlico.core.modules.scheduler import ModuleScheduler
+
+        modules = [FakeModule("mod{}".format(i)) for i in range(4)]
+        scheduler = ModuleScheduler(modules, jobs=2, max_processes=None)
+        self.assertIs(scheduler.start_next(), modules[0])
+        self.assertIs(scheduler.start_next(), modules[1])
+        self.assertIsNone(scheduler.start_next())
+        self.assertEqual(scheduler.cancel_pending(), modules[2:])
@@ -138,3 +138,41 @@ class FloatListTypeWriterTest(GroupedCorpusWriterTest, unittest.TestCase):
             lst = [random.uniform(0., 10.) for i in range(random.randint(0, 20))]
             name = u"".join(random.choice(string.ascii_uppercase) for _ in range(10))
             yield name, self.data_point_type(list=lst)
+
+
+class ArchiveCacheTest(GroupedCorpusWriterTest, unittest.TestCase):
+    """
+    Write a corpus split over several archives, then read it back using random access,
+    checking that the reader's cache of open archives behaves as expected.
+
+    """
+    data_point_type = TextDocumentType()
+
+    def get_documents(self):
+        for i in range(20):
+            yield "doc{:02d}".format(i), self.data_point_type(text=u"Document number {}".format(i))
+
+    def test_write(self):
+        from pimlico.core.config import PipelineConfig
+
+        super(ArchiveCacheTest, self).test_write()
+        pipeline = PipelineConfig.empty(override_local_config={"archive_cache_size": "2"})
+        reader = self.instantiate_datatype()([self.output_dir])(pipeline)
+        self.assertEqual(reader.archive_cache_size, 2)
+
+        self.assertEqual(reader.extract_file("archive_00", "doc01").decode("utf-8"), u"Document number 1")
+        reader.extract_file("archive_00", "doc02")
+        arc1 = reader.get_archive("archive_01")
+        self.assertDictEqual(reader.archive_cache_stats(), {"size": 2, "open": 2, "hits": 1, "misses": 2})
+        # Using archive_00 again makes archive_01 the least recently used, so it gets closed
+        reader.extract_file("archive_00", "doc03")
+        reader.extract_file("archive_02", "doc11")
+        self.assertTrue(arc1.closed)
+        self.assertDictEqual(reader.archive_cache_stats(), {"size": 2, "open": 2, "hits": 2, "misses": 3})
+
+        # Iterating over the corpus doesn't disturb the cache
+        self.assertEqual(len(list(reader)), 20)
+        self.assertEqual(reader.archive_cache_stats()["open"], 2)
+
+        reader.close_archives()
+        self.assertEqual(reader.archive_cache_stats()["open"], 0)
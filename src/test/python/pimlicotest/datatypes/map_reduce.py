@@ -0,0 +1,106 @@
+"""
+Tests for processing a grouped corpus in shards, using its reader's map_reduce().
+
+"""
+import shutil
+import unittest
+from collections import Counter
+from tempfile import mkdtemp
+
+
+class GroupedCorpusMapReduceTest(unittest.TestCase):
+    def setUp(self):
+        from pimlico.core.config import PipelineConfig
+        from pimlico.datatypes.corpora.data_points import TextDocumentType
+        from pimlico.datatypes.corpora.grouped import GroupedCorpus
+
+        self.output_dir = mkdtemp()
+        self.pipeline = PipelineConfig.empty()
+        self.datatype = GroupedCorpus(TextDocumentType())
+        self.texts = ["doc {} in archive {}".format(i, i // 7) for i in range(30)]
+        with self.datatype.get_writer(self.output_dir, self.pipeline) as writer:
+            for i, text in enumerate(self.texts):
+                writer.add_document("archive_{}".format(i // 7), "doc_{}".format(i),
+                                    self.datatype.data_point_type(text=text))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _get_reader(self):
+        return self.datatype([self.output_dir]).get_reader(self.pipeline)
+
+    def test_shards(self):
+        reader = self._get_reader()
+        # One shard per archive by default
+        self.assertEqual(len(reader.get_shards()), 5)
+        shards = reader.get_shards(shard_size=3)
+        # Each archive of 7 docs is split into 3, the last of 2 docs into 1
+        self.assertEqual(len(shards), 13)
+        # The shards together contain every document, in order
+        self.assertEqual([doc.text for shard in shards for __, doc in reader.shard_iter(shard)], self.texts)
+
+    def test_map_reduce(self):
+        reader = self._get_reader()
+        expected = Counter(word for text in self.texts for word in text.split())
+
+        def count_words(doc_iter):
+            return Counter(word for __, doc in doc_iter for word in doc.text.split())
+
+        def add(counts1, counts2):
+            counts1.update(counts2)
+            return counts1
+
+        for processes in [1, 3]:
+            for shard_size in [None, 4]:
+                self.assertEqual(
+                    reader.map_reduce(count_words, add, processes=processes, shard_size=shard_size), expected
+                )
+        # Results are combined in order
+        doc_names = reader.map_reduce(lambda docs: [name for name, __ in docs], lambda a, b: a + b,
+                                      processes=3, shard_size=2)
+        self.assertEqual(doc_names, ["doc_{}".format(i) for i in range(30)])
+
+    def test_aligned_shard_iter(self):
+        from pimlico.datatypes.corpora.grouped import AlignedGroupedCorpora
+
+        aligned = AlignedGroupedCorpora([self._get_reader(), self._get_reader()])
+        items = list(aligned.shard_iter(("archive_1", 2, None)))
+        self.assertEqual([(archive, name) for (archive, name, __) in items],
+                         [("archive_1", "doc_{}".format(i)) for i in range(9, 14)])
+        self.assertEqual([docs[1].text for (__, __, docs) in items], self.texts[9:14])
+
+    def test_write_archives_separately(self):
+        import filecmp
+        import multiprocessing
+        import os
+
+        # Write each archive in a separate process, using forked copies of the same writer,
+        #  as in archive-parallel execution of document map modules
+        reader = self._get_reader()
+        parallel_dir = mkdtemp()
+        try:
+            with self.datatype.get_writer(parallel_dir, self.pipeline) as writer:
+                def _write_archive(archive_name):
+                    for doc_name, doc in reader.shard_iter((archive_name, 0, None)):
+                        writer.add_document(archive_name, doc_name, doc)
+                    writer.close_archive()
+
+                processes = [multiprocessing.get_context("fork").Process(target=_write_archive, args=(archive_name,))
+                             for archive_name in reader.archives]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+                writer.doc_count = len(reader)
+
+            for filename in os.listdir(os.path.join(self.output_dir, "data")):
+                self.assertTrue(filecmp.cmp(os.path.join(self.output_dir, "data", filename),
+                                            os.path.join(parallel_dir, "data", filename), shallow=False))
+            self.assertEqual([doc.text for __, doc in self.datatype([parallel_dir]).get_reader(self.pipeline)],
+                             self.texts)
+        finally:
+            shutil.rmtree(parallel_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
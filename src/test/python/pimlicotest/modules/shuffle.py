@@ -0,0 +1,82 @@
+"""
+Tests for the shuffle module, which randomly accesses the documents of its input corpus.
+
+"""
+import os
+import shutil
+import unittest
+from glob import glob
+from tempfile import mkdtemp
+
+
+PIPELINE = """\
+[pipeline]
+name=shuffle_test
+release=latest
+
+[corpus]
+type=pimlico.datatypes.corpora.GroupedCorpus
+data_point_type=RawTextDocumentType
+dir={corpus_dir}
+
+[shuffle]
+type=pimlico.modules.corpora.shuffle
+"""
+
+
+class ShuffleTest(unittest.TestCase):
+    def setUp(self):
+        from pimlico.datatypes.corpora.data_points import RawTextDocumentType
+        from pimlico.datatypes.corpora.grouped import GroupedCorpus
+
+        self.storage_dir = mkdtemp()
+        self.corpus_dir = os.path.join(self.storage_dir, "corpus")
+        self.datatype = GroupedCorpus(RawTextDocumentType())
+        self.texts = dict(("doc_{}".format(i), "doc {} in archive {}".format(i, i // 7)) for i in range(30))
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def _write_corpus(self, **writer_kwargs):
+        from pimlico.core.config import PipelineConfig
+
+        with self.datatype.get_writer(self.corpus_dir, PipelineConfig.empty(), **writer_kwargs) as writer:
+            for i in range(30):
+                doc_name = "doc_{}".format(i)
+                writer.add_document("archive_{}".format(i // 7), doc_name,
+                                    self.datatype.data_point_type(text=self.texts[doc_name]))
+
+    def _shuffle(self):
+        import logging
+        from pimlico.core.config import PipelineConfig
+        from pimlico.core.modules.execute import check_and_execute_modules
+
+        path = os.path.join(self.storage_dir, "pipeline.conf")
+        with open(path, "w") as f:
+            f.write(PIPELINE.format(corpus_dir=self.corpus_dir))
+        pipeline = PipelineConfig.load(path, override_local_config={"store": self.storage_dir},
+                                       only_override_config=True)
+        self.assertEqual(check_and_execute_modules(pipeline, ["shuffle"], log=logging.getLogger("test")), 0)
+        return [(doc_name, doc.text) for (doc_name, doc) in pipeline["shuffle"].get_output("corpus")]
+
+    def _check_shuffled(self, output):
+        # The same documents, in a different order
+        self.assertEqual(sorted(output), sorted(self.texts.items()))
+        self.assertNotEqual([doc_name for (doc_name, text) in output], ["doc_{}".format(i) for i in range(30)])
+
+    def test_binary_index(self):
+        from pimlico.utils.pimarc.binindex import build_binary_index
+
+        self._write_corpus()
+        for archive_filename in glob(os.path.join(self.corpus_dir, "data", "*.prc")):
+            build_binary_index(archive_filename)
+        self._check_shuffled(self._shuffle())
+
+    def test_compressed(self):
+        # Documents are read by random access into the compressed blocks
+        self._write_corpus(compression="zlib")
+        self._check_shuffled(self._shuffle())
+
+
+if __name__ == "__main__":
+    unittest.main()
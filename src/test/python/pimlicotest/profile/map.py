@@ -5,12 +5,18 @@ I'm trying to get to the bottom of what's taking most time when executing
 document map modules, to work out how we can reduce overheads and speed
 up execution.
 
-.. todo::
+Runs a pipeline that reads in the BBC News corpus and tokenizes it, with
+profiling turned on, as with ``run --profile``, and shows the functions
+that took most time. The full profile is left in the tokenizer's output
+directory, including collapsed stacks for drawing a flame graph. Run as a
+script, optionally with the profiling mode and number of processes::
 
-   This is unfinished: continue working on it.
+   python -m pimlicotest.profile.map --mode deterministic --processes 4
 
 """
+import argparse
 import os
+import pstats
 from urllib.request import urlretrieve
 from zipfile import ZipFile
 
@@ -19,12 +25,32 @@ from pimlico import TEST_STORAGE_DIR
 BBC_NEWS_URL = "http://mlg.ucd.ie/files/datasets/bbc-fulltext.zip"
 
 
-def profile_doc_map():
-    # TODO:
-    #  - Create a pipeline that reads in the BBC corpus and applies tokenization
-    #  - Wrap the pipeline execution code to load a profiler
-    #  - Investigate what is taking most time: e.g.
-    pass
+def profile_doc_map(mode="sampling", processes=1):
+    """
+    Run the tokenization pipeline over the BBC corpus with profiling, returning
+    the path to the merged profile.
+
+    """
+    from pimlico.core.config import PipelineConfig
+    from pimlico.core.modules.execute import check_and_execute_modules
+    from pimlico.core.modules.metrics import load_metrics_history
+    from pimlico.utils.logging import get_console_logger
+
+    corpus_dir = get_bbc_corpus()
+    profile_dir = os.path.join(TEST_STORAGE_DIR, "map_profile")
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    conf_path = os.path.join(profile_dir, "map_profile.conf")
+    with open(conf_path, "w") as f:
+        f.write(PIPELINE.format(corpus_dir=corpus_dir, processes=processes))
+
+    pipeline = PipelineConfig.load(conf_path, override_local_config={"store": profile_dir},
+                                   only_override_config=True)
+    log = get_console_logger("Profile")
+    check_and_execute_modules(pipeline, ["tokenize"], log=log, force_rerun=True, profile=mode)
+    # The profile's path is recorded with the metrics for the run
+    runs = load_metrics_history(pipeline["tokenize"].get_module_output_dir(absolute=True))
+    return runs[-1]["profile"]
 
 
 def get_bbc_corpus():
@@ -43,25 +69,41 @@ def get_bbc_corpus():
     if os.path.exists(archive_path):
         print("Archive already exists at {}".format(archive_path))
     else:
+        if not os.path.exists(bbc_news_dir):
+            os.makedirs(bbc_news_dir)
         print("Downloading BBC news corpus...")
         urlretrieve(BBC_NEWS_URL, archive_path)
     print("Extracting corpus to {}".format(bbc_news_dir))
-    os.makedirs(bbc_news_dir)
     with ZipFile(archive_path, "r") as zf:
         zf.extractall(bbc_news_dir)
     os.remove(archive_path)
     return corpus_dir
 
 
-if __name__ == "__main__":
-    corpus_dir = get_bbc_corpus()
-    print("Using BBC corpus in {}".format(corpus_dir))
-
-
 PIPELINE = """
 [pipeline]
 name=test_map_profile
 release=latest
 python_path=%(project_root)s/src/python
 
+[bbc]
+type=pimlico.modules.input.text.raw_text_files
+files={corpus_dir}/*/*.txt
+encoding_errors=replace
+
+[tokenize]
+type=pimlico.modules.text.simple_tokenize
+processes={processes}
 """
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile a document map module over the BBC News corpus")
+    parser.add_argument("--mode", choices=["sampling", "deterministic"], default="sampling",
+                        help="Profiling mode. Default: sampling")
+    parser.add_argument("--processes", type=int, default=1, help="Processes for the tokenizer to use. Default: 1")
+    opts = parser.parse_args()
+
+    profile_path = profile_doc_map(mode=opts.mode, processes=opts.processes)
+    print("Full profile in {}".format(profile_path))
+    pstats.Stats(profile_path).sort_stats("tottime").print_stats(30)
@@ -0,0 +1,122 @@
+"""
+Test the binary index for Pimarc archives.
+
+"""
+import os
+import tempfile
+import time
+import unittest
+
+
+class PimarcBinaryIndexTest(unittest.TestCase):
+    def setUp(self):
+        # Create a temporary directory to use as our storage location
+        self.storage_dir = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.storage_dir, "test.prc")
+        self.filenames = ["file{}.txt".format(i) for i in range(50)]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.storage_dir)
+
+    def _write_archive(self, binary_index):
+        from pimlico.utils.pimarc import PimarcWriter
+
+        with PimarcWriter(self.archive_path, binary_index=binary_index) as arc:
+            for filename in self.filenames:
+                arc.write_file("Contents of {}".format(filename).encode("utf-8"), name=filename)
+
+
+class WriteBinaryIndexTest(PimarcBinaryIndexTest):
+    """
+    Write an archive with a binary index, then read it back in, using the binary index.
+
+    """
+    def test_write_read(self):
+        from pimlico.utils.pimarc import PimarcReader
+        from pimlico.utils.pimarc.binindex import PimarcBinaryIndex
+        from pimlico.utils.pimarc.index import FilenameNotInArchive
+
+        self._write_archive(True)
+        self.assertTrue(os.path.exists("{}x".format(self.archive_path)))
+
+        with PimarcReader(self.archive_path) as arc:
+            self.assertIsInstance(arc.index, PimarcBinaryIndex)
+            self.assertEqual(len(arc), len(self.filenames))
+            # Iteration is in archive order
+            self.assertListEqual(list(arc.index), self.filenames)
+            # Lookup by name
+            self.assertIn("file7.txt", arc.index)
+            self.assertNotIn("file700.txt", arc.index)
+            self.assertEqual(arc["file7.txt"][1].decode("utf-8"), "Contents of file7.txt")
+            with self.assertRaises(FilenameNotInArchive):
+                arc["file700.txt"]
+            # Lookup by position
+            self.assertEqual(arc.index.get_position("file7.txt"), 7)
+            self.assertEqual(arc.index.get_entry(7)[0], "file7.txt")
+            self.assertEqual(arc.index.get_entry(-1)[0], self.filenames[-1])
+            self.assertListEqual(list(arc.index.iter_sorted_filenames()), sorted(self.filenames))
+            # Both indexes give the same start bytes
+            from pimlico.utils.pimarc.index import PimarcIndex
+            text_index = PimarcIndex.load("{}i".format(self.archive_path))
+            for filename in self.filenames:
+                self.assertEqual(tuple(arc.index[filename]), tuple(text_index[filename]))
+
+            self.assertListEqual([m["name"] for m, d in arc], self.filenames)
+
+
+class ConvertBinaryIndexTest(PimarcBinaryIndexTest):
+    """
+    Write an archive with just a text index, then convert the index to binary.
+
+    """
+    def test_convert(self):
+        from pimlico.utils.pimarc import PimarcReader
+        from pimlico.utils.pimarc.binindex import PimarcBinaryIndex, build_binary_index
+        from pimlico.utils.pimarc.index import PimarcIndex
+
+        self._write_archive(False)
+        with PimarcReader(self.archive_path) as arc:
+            self.assertIsInstance(arc.index, PimarcIndex)
+
+        self.assertEqual(build_binary_index(self.archive_path), len(self.filenames))
+        with PimarcReader(self.archive_path) as arc:
+            self.assertIsInstance(arc.index, PimarcBinaryIndex)
+            self.assertEqual(arc["file3.txt"][1].decode("utf-8"), "Contents of file3.txt")
+
+    def test_stale(self):
+        """ A binary index older than the text index should not be used """
+        from pimlico.utils.pimarc import PimarcReader
+        from pimlico.utils.pimarc.index import PimarcIndex
+
+        self._write_archive(True)
+        # Make the text index look newer than the binary one
+        future = time.time() + 10
+        os.utime("{}i".format(self.archive_path), (future, future))
+        with PimarcReader(self.archive_path) as arc:
+            self.assertIsInstance(arc.index, PimarcIndex)
+
+    def test_append(self):
+        """ While appending, the old binary index should not be used, even if the times don't show it's stale """
+        from pimlico.utils.pimarc import PimarcReader, PimarcWriter
+        from pimlico.utils.pimarc.binindex import PimarcBinaryIndex
+        from pimlico.utils.pimarc.index import PimarcIndex
+
+        self._write_archive(True)
+        # As if the filesystem's times were too coarse to tell the indexes apart
+        future = time.time() + 10
+        os.utime("{}x".format(self.archive_path), (future, future))
+        with PimarcWriter(self.archive_path, mode="a") as writer:
+            writer.write_file(b"Contents of new.txt", name="new.txt")
+            writer.flush()
+            with PimarcReader(self.archive_path) as arc:
+                self.assertIsInstance(arc.index, PimarcIndex)
+                self.assertEqual(len(arc), len(self.filenames) + 1)
+        # Rebuilt once we've finished appending
+        with PimarcReader(self.archive_path) as arc:
+            self.assertIsInstance(arc.index, PimarcBinaryIndex)
+            self.assertEqual(arc["new.txt"][1], b"Contents of new.txt")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Test writing and reading block-compressed archives.
+
+"""
+import os
+import random
+import tempfile
+import unittest
+
+
+class CompressedArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.storage_dir, "test.prc")
+        rand = random.Random(42)
+        words = ["the", "cat", "sat", "on", "a", "mat", "dog", "ran"]
+        self.files_data = [
+            " ".join(rand.choice(words) for i in range(rand.randint(0, 200))).encode("utf-8")
+            for j in range(50)
+        ]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.storage_dir)
+
+    def _write(self, path, compression, block_size=500, **kwargs):
+        from pimlico.utils.pimarc import PimarcWriter
+
+        with PimarcWriter(path, compression=compression, block_size=block_size, **kwargs) as arc:
+            for i, data in enumerate(self.files_data):
+                arc.write_file(data, "doc_{}".format(i), metadata={"num": i})
+
+    def _check_archive(self, use_mmap=False):
+        from pimlico.utils.pimarc import PimarcReader
+
+        with PimarcReader(self.archive_path, use_mmap=use_mmap) as arc:
+            self.assertTrue(arc.compressed)
+            self.assertEqual(len(arc), len(self.files_data))
+            # Iterate over everything
+            self.assertEqual([bytes(data) for __, data in arc], self.files_data)
+            self.assertEqual([md["num"] for md in arc.iter_metadata()], list(range(len(self.files_data))))
+            # Skipping and starting part-way through
+            self.assertEqual([bytes(data) for __, data in arc.iter_files(skip=17)], self.files_data[17:])
+            self.assertEqual([bytes(data) for __, data in arc.iter_files(skip=len(self.files_data))], [])
+            self.assertEqual([bytes(data) for __, data in arc.iter_files(start_after="doc_30")],
+                             self.files_data[31:])
+            self.assertEqual([bytes(data) for __, data in arc.iter_files(name_filter=lambda fn: fn.endswith("7"))],
+                             self.files_data[7::10])
+            # Random access, in a random order
+            order = list(range(len(self.files_data)))
+            random.Random(1).shuffle(order)
+            for i in order:
+                metadata, data = arc["doc_{}".format(i)]
+                self.assertEqual(metadata["num"], i)
+                self.assertEqual(bytes(data), self.files_data[i])
+
+    def test_codecs(self):
+        from pimlico.utils.pimarc.compression import available_codecs
+
+        for codec in available_codecs():
+            self._write(self.archive_path, codec)
+            self._check_archive()
+            self._check_archive(use_mmap=True)
+
+    def test_smaller(self):
+        uncompressed_path = os.path.join(self.storage_dir, "uncompressed.prc")
+        self._write(uncompressed_path, None)
+        self._write(self.archive_path, "zlib", compression_level=9)
+        self.assertLess(os.path.getsize(self.archive_path), os.path.getsize(uncompressed_path) / 2)
+
+    def test_append(self):
+        from pimlico.utils.pimarc import PimarcWriter
+
+        all_data = self.files_data
+        self.files_data = all_data[:20]
+        self._write(self.archive_path, "lzma")
+        # Appending uses the archive's codec, whatever we ask for
+        with PimarcWriter(self.archive_path, mode="a", block_size=500) as arc:
+            self.assertEqual(arc.codec.name, "lzma")
+            for i, data in enumerate(all_data[20:], start=20):
+                arc.write_file(data, "doc_{}".format(i), metadata={"num": i})
+        self.files_data = all_data
+        self._check_archive()
+
+    def test_reindex(self):
+        from pimlico.utils.pimarc import PimarcReader
+        from pimlico.utils.pimarc.index import reindex, check_index, PimarcIndex
+
+        self._write(self.archive_path, "zlib")
+        with PimarcReader(self.archive_path) as arc:
+            original_index = list(arc.index.filenames.items())
+        self.assertEqual(check_index(self.archive_path), len(self.files_data))
+        os.remove("{}i".format(self.archive_path))
+        reindex(self.archive_path)
+        self.assertEqual(list(PimarcIndex.load("{}i".format(self.archive_path)).filenames.items()), original_index)
+
+    def test_parse_spec(self):
+        from pimlico.utils.pimarc.compression import parse_compression_spec, PimarcCompressionError
+
+        self.assertEqual(parse_compression_spec("zlib"), ("zlib", None))
+        self.assertEqual(parse_compression_spec("lzma:9"), ("lzma", 9))
+        self.assertEqual(parse_compression_spec("none"), (None, None))
+        with self.assertRaises(PimarcCompressionError):
+            parse_compression_spec("rar")
+        with self.assertRaises(PimarcCompressionError):
+            parse_compression_spec("zlib:high")
+
+
+if __name__ == "__main__":
+    unittest.main()
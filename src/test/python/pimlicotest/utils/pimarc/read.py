@@ -66,5 +66,61 @@ class ReadFilesTest(PimarcReadTest):
                                  msg="text read in file in archive did not start with the expected string")
 
 
+class IndexedSkipTest(unittest.TestCase):
+    """
+    Check that skipping, starting after a given file and filtering by name produce the
+    expected files, with and without mmap.
+
+    Then corrupt the files that should be skipped over and check that we can still read the
+    rest, since the skipped files should not be read at all.
+
+    """
+    def setUp(self):
+        from pimlico.utils.pimarc import PimarcWriter
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "test.prc")
+        self.names = ["doc_{}".format(i) for i in range(12)]
+        with PimarcWriter(self.path) as arc:
+            for name in self.names:
+                arc.write_file("Content of {}".format(name).encode("utf-8"), name)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+
+    def test_skip(self):
+        from pimlico.utils.pimarc import PimarcReader
+
+        names = self.names
+        for use_mmap in [False, True]:
+            with PimarcReader(self.path, use_mmap=use_mmap) as arc:
+                self.assertEqual([md["name"] for md, __ in arc.iter_files(skip=3)], names[3:])
+                self.assertEqual([md["name"] for md, __ in arc.iter_files(start_after=names[4])], names[5:])
+                self.assertEqual(list(arc.iter_files(skip=len(names))), [])
+                selected = set(names[5::2])
+                filtered = list(arc.iter_files(skip=5, name_filter=lambda fn: fn in selected))
+                self.assertEqual([md["name"] for md, __ in filtered], names[5::2])
+                for metadata, data in filtered:
+                    self.assertEqual(bytes(data), "Content of {}".format(metadata["name"]).encode("utf-8"))
+
+    def test_skip_corrupted(self):
+        from pimlico.utils.pimarc import PimarcReader
+
+        names = self.names
+        with PimarcReader(self.path) as arc:
+            corrupt_start, __ = arc.index[names[0]]
+            corrupt_end, __ = arc.index[names[5]]
+        # Overwrite the first five files with bytes that can't be read as metadata
+        with open(self.path, "r+b") as f:
+            f.seek(corrupt_start)
+            f.write(b"\xff" * (corrupt_end - corrupt_start))
+
+        with PimarcReader(self.path) as arc:
+            self.assertEqual([md["name"] for md, __ in arc.iter_files(skip=5)], names[5:])
+            self.assertEqual([md["name"] for md, __ in arc.iter_files(start_after=names[4])], names[5:])
+            self.assertEqual([md["name"] for md, __ in arc.iter_files(name_filter=lambda fn: fn == names[7])],
+                             [names[7]])
+
 if __name__ == "__main__":
     unittest.main()
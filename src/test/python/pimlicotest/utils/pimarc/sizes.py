@@ -0,0 +1,93 @@
+"""
+Test the recording of file sizes in Pimarc indexes.
+
+"""
+import os
+import tempfile
+import unittest
+
+
+class PimarcSizesTest(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.storage_dir, "test.prc")
+        self.files_data = [" ".join(["word"] * i).encode("utf-8") for i in range(30)]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.storage_dir)
+
+    def _write(self, **kwargs):
+        from pimlico.utils.pimarc import PimarcWriter
+
+        with PimarcWriter(self.archive_path, **kwargs) as arc:
+            for i, data in enumerate(self.files_data):
+                # Only record token counts for some of the files
+                arc.write_file(data, "doc_{}".format(i), tokens=i if i % 2 == 0 else None)
+
+    def _check_sizes(self, index, tokens=True):
+        for i, data in enumerate(self.files_data):
+            self.assertEqual(index.get_size("doc_{}".format(i)),
+                             (len(data), i if tokens and i % 2 == 0 else None))
+
+    def test_sizes(self):
+        from pimlico.utils.pimarc import PimarcReader
+        from pimlico.utils.pimarc.binindex import PimarcBinaryIndex
+        from pimlico.utils.pimarc.index import PimarcIndex, check_index, reindex, FilenameNotInArchive
+
+        for compression in [None, "zlib"]:
+            self._write(compression=compression, binary_index=True)
+            with PimarcReader(self.archive_path) as arc:
+                self.assertIsInstance(arc.index, PimarcBinaryIndex)
+                self._check_sizes(arc.index)
+                with self.assertRaises(FilenameNotInArchive):
+                    arc.index.get_size("doc_100")
+            self._check_sizes(PimarcIndex.load("{}i".format(self.archive_path)))
+            self.assertEqual(check_index(self.archive_path), len(self.files_data))
+
+            # Lengths can be recovered from the archive, but not token counts
+            self._check_sizes(reindex(self.archive_path), tokens=False)
+
+    def test_old_index(self):
+        from pimlico.utils.pimarc import PimarcReader
+
+        self._write()
+        # Remove the sizes from the index, as it would have been written before they were recorded
+        index_path = "{}i".format(self.archive_path)
+        with open(index_path, "r") as f:
+            lines = ["\t".join(line.split("\t")[:3]) for line in f.read().splitlines()]
+        with open(index_path, "w") as f:
+            f.write("".join("{}\n".format(line) for line in lines))
+
+        with PimarcReader(self.archive_path) as arc:
+            self.assertEqual(arc.index.get_size("doc_3"), (None, None))
+            self.assertEqual(bytes(arc["doc_3"][1]), self.files_data[3])
+
+
+class GroupedCorpusSizesTest(unittest.TestCase):
+    def test_token_counts(self):
+        import shutil
+        from pimlico.core.config import PipelineConfig
+        from pimlico.datatypes.corpora.grouped import GroupedCorpus
+        from pimlico.datatypes.corpora.tokenized import TokenizedDocumentType
+
+        output_dir = tempfile.mkdtemp()
+        try:
+            pipeline = PipelineConfig.empty()
+            datatype = GroupedCorpus(TokenizedDocumentType())
+            with datatype.get_writer(output_dir, pipeline) as writer:
+                writer.add_document("archive", "internal", {"sentences": [["a", "b", "c"], ["d", "e"]]})
+                writer.add_document("archive", "raw", datatype.data_point_type(raw_data=b"a b\nc"))
+                writer.add_document("archive", "bytes", b"a b c d")
+            reader = datatype([output_dir]).get_reader(pipeline)
+            self.assertEqual(reader.get_document_size("archive", "internal"), (len(b"a b c\nd e"), 5))
+            self.assertEqual(reader.get_document_size("archive", "raw"), (5, 3))
+            # Raw bytes added directly don't get counted
+            self.assertEqual(reader.get_document_size("archive", "bytes"), (7, None))
+            reader.close_archives()
+        finally:
+            shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
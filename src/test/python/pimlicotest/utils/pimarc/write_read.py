@@ -70,5 +70,54 @@ class WriteRandomDocumentsTest(PimarcWriteReadTest):
                                      "for the corresponding file")
 
 
+class MmapReadTest(PimarcWriteReadTest):
+    """
+    Write some random documents, then read them back in using the memory-mapped reader,
+    checking iteration, skipping and random access all give the same as the normal reader.
+
+    """
+    def test_read(self):
+        from pimlico.utils.pimarc import PimarcWriter, PimarcReader
+        files_data = [_generate_random_text() for i in range(20)]
+
+        with PimarcWriter(self.archive_path) as arc:
+            for i, text in enumerate(files_data):
+                arc.write_file(text.encode("utf-8"), "doc_{}".format(i))
+
+        with PimarcReader(self.archive_path, use_mmap=True) as arc:
+            self.assertEqual(len(arc), len(files_data))
+
+            docs = list(arc)
+            self.assertEqual(len(docs), len(files_data))
+            for i, ((metadata, file_data), expected_data) in enumerate(zip(docs, files_data)):
+                self.assertIsInstance(file_data, memoryview)
+                self.assertEqual(metadata["name"], "doc_{}".format(i))
+                self.assertEqual(str(file_data, "utf-8"), expected_data)
+
+            self.assertListEqual([m["name"] for m in arc.iter_metadata()],
+                                 ["doc_{}".format(i) for i in range(len(files_data))])
+            self.assertListEqual([m["name"] for (m, d) in arc.iter_files(skip=5)],
+                                 ["doc_{}".format(i) for i in range(5, len(files_data))])
+            self.assertListEqual([m["name"] for (m, d) in arc.iter_files(start_after="doc_17")],
+                                 ["doc_18", "doc_19"])
+
+            metadata, file_data = arc["doc_12"]
+            self.assertEqual(metadata["name"], "doc_12")
+            self.assertEqual(bytes(file_data).decode("utf-8"), files_data[12])
+
+        # Slices we've kept hold of are still readable after the reader is closed
+        self.assertEqual(str(file_data, "utf-8"), files_data[12])
+
+    def test_empty(self):
+        from pimlico.utils.pimarc import PimarcWriter, PimarcReader
+
+        with PimarcWriter(self.archive_path):
+            pass
+
+        with PimarcReader(self.archive_path, use_mmap=True) as arc:
+            self.assertEqual(len(arc), 0)
+            self.assertListEqual(list(arc), [])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,85 @@
+"""
+Tests for waiting on queues without polling.
+
+"""
+import multiprocessing
+import threading
+import time
+import unittest
+
+
+def _consume(waiter, results, stopped):
+    while not stopped.is_set():
+        item = waiter.get()
+        if item is not None:
+            results.put(item)
+
+
+class QueueWaiterTest(unittest.TestCase):
+    def _check_waiter(self, queue, results, start):
+        from pimlico.utils.pipes import QueueWaiter
+
+        waiter = QueueWaiter(queue)
+        stopped = multiprocessing.Event()
+        consumer = start(_consume, waiter, results, stopped)
+        try:
+            for i in range(5):
+                queue.put(i)
+            self.assertEqual([results.get(timeout=2.) for i in range(5)], list(range(5)))
+            # Nothing on the queue: the consumer should stop as soon as it's woken
+            time.sleep(0.1)
+            stopped.set()
+            waiter.wake()
+            consumer.join(2.)
+            self.assertFalse(consumer.is_alive())
+        finally:
+            stopped.set()
+            waiter.wake()
+
+    def test_thread_queue(self):
+        from queue import Queue
+        from pimlico.utils.pipes import WakeableQueue
+
+        def start(target, *args):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+            return thread
+        self._check_waiter(WakeableQueue(), Queue(), start)
+
+    def test_process_queue(self):
+        from pimlico.utils.pipes import wait_for_connections
+
+        if wait_for_connections is None:
+            self.skipTest("connection waiting not available")
+
+        def start(target, *args):
+            process = multiprocessing.Process(target=target, args=args)
+            process.daemon = True
+            process.start()
+            return process
+        self._check_waiter(multiprocessing.Queue(), multiprocessing.Queue(), start)
+
+    def test_timeout(self):
+        """ The timeout is kept to overall, even if the queue looks ready but we can't get anything from it """
+        from pimlico.utils.pipes import QueueWaiter, wait_for_connections
+
+        if wait_for_connections is None:
+            self.skipTest("connection waiting not available")
+
+        queue = multiprocessing.Queue()
+        waiter = QueueWaiter(queue)
+        queue.put(0)
+        # As if another consumer were in the middle of reading the item
+        queue._rlock.acquire()
+        try:
+            start = time.monotonic()
+            self.assertIsNone(waiter.get(timeout=0.3))
+            self.assertLess(time.monotonic() - start, 1.)
+        finally:
+            queue._rlock.release()
+        self.assertEqual(waiter.get(timeout=1.), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()